@@ -0,0 +1,143 @@
+/*
+ * This file is open source software, licensed to you under the terms
+ * of the Apache License, Version 2.0 (the "License").  See the NOTICE file
+ * distributed with this work for additional information regarding copyright
+ * ownership.  You may not use this file except in compliance with the License.
+ *
+ * You may obtain a copy of the License at
+ *
+ *   http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing,
+ * software distributed under the License is distributed on an
+ * "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+ * KIND, either express or implied.  See the License for the
+ * specific language governing permissions and limitations
+ * under the License.
+ */
+
+#include "admission.hh"
+#include "core/future-util.hh"
+#include "core/memory.hh"
+#include "core/metrics.hh"
+#include "core/sleep.hh"
+
+#include <algorithm>
+
+namespace hero {
+
+// How often a connection paused by memory pressure checks for its end;
+// nothing signals it.
+static constexpr auto memory_poll_interval = std::chrono::milliseconds(10);
+
+admission_control::admission_control(admission_config config)
+    : _config(config)
+    , _connections(_config.max_connections)
+    , _connects(_config.max_concurrent_connects)
+    , _inbound(_config.max_inbound_bytes)
+    , _outbound(_config.max_outbound_bytes)
+{
+    setup_metrics();
+}
+
+void admission_control::setup_metrics() {
+    namespace sm = seastar::metrics;
+    _metrics.add_group("hero_admission", {
+        sm::make_gauge("connection_slots_used", [this] { return _config.max_connections - _connections.current(); },
+                sm::description("Connection slots in use")),
+        sm::make_gauge("connects_waiting", [this] { return _connects.waiters(); },
+                sm::description("CONNECTs waiting for a slot")),
+        sm::make_gauge("inbound_bytes", [this] { return _config.max_inbound_bytes - _inbound.current(); },
+                sm::description("Bytes of received packets being handled or partly received")),
+        sm::make_gauge("outbound_exhausted", [this] { return outbound_exhausted(); },
+                sm::description("1 while the bytes queued for sending exceed the outbound budget")),
+        sm::make_gauge("memory_pressure", [this] { return memory_pressure(); },
+                sm::description("1 while the shard's free memory is below the configured minimum")),
+        sm::make_derive("connections_refused", _stats.connections_refused,
+                sm::description("Sockets closed on accept because the shard had no connection slot left")),
+        sm::make_derive("connects_rejected", _stats.connects_rejected,
+                sm::description("CONNECTs answered with server busy")),
+        sm::make_derive("connect_waits", _stats.connect_waits,
+                sm::description("CONNECTs which waited for a slot")),
+        sm::make_derive("inbound_waits", _stats.inbound_waits,
+                sm::description("Reads which waited for the inbound budget")),
+        sm::make_derive("outbound_pauses", _stats.outbound_pauses,
+                sm::description("Times a connection stopped reading because the shard's outbound budget was exhausted")),
+        sm::make_derive("memory_pauses", _stats.memory_pauses,
+                sm::description("Times a connection stopped reading because the shard was short of memory")),
+        sm::make_derive("qos0_shed", _stats.qos0_shed,
+                sm::description("QoS 0 deliveries dropped because of memory pressure or the outbound budget")),
+    });
+}
+
+bool admission_control::memory_pressure() const {
+    auto s = memory::stats();
+    // The system allocator, used by debug builds, reports no totals.
+    return s.total_memory() && s.free_memory() < s.total_memory() * _config.min_free_memory_ratio;
+}
+
+std::optional<semaphore_units<>> admission_control::admit_connection() {
+    if (!_connections.try_wait(1)) {
+        _stats.connections_refused++;
+        return {};
+    }
+    return semaphore_units<>(_connections, 1);
+}
+
+future<semaphore_units<>> admission_control::start_connect() {
+    if (!_connects.current()) {
+        _stats.connect_waits++;
+    }
+    return get_units(_connects, 1);
+}
+
+bool admission_control::reject_connect() {
+    if (!_config.reject_connects || !(memory_pressure() || outbound_exhausted())) {
+        return false;
+    }
+    _stats.connects_rejected++;
+    return true;
+}
+
+future<semaphore_units<>> admission_control::receive(size_t size) {
+    // A buffer larger than the whole budget waits for all of it.
+    size = std::min(size, _config.max_inbound_bytes);
+    if (_inbound.current() < size) {
+        _stats.inbound_waits++;
+    }
+    return get_units(_inbound, size);
+}
+
+bool admission_control::shed(size_t size) {
+    if (!_config.shed_qos0 || (_outbound.current() >= size && !memory_pressure())) {
+        return false;
+    }
+    _stats.qos0_shed++;
+    return true;
+}
+
+// Waits for a quarter (by default) of the budget to be free, then hands
+// the units straight back: the wait is only a way to be woken by sent().
+future<> admission_control::wait_for_outbound() {
+    if (!_config.pause_reads) {
+        return make_ready_future<>();
+    }
+    if (memory_pressure()) {
+        _stats.memory_pauses++;
+        return do_until([this] { return !memory_pressure(); }, [] {
+            return sleep(memory_poll_interval);
+        }).then([this] {
+            return wait_for_outbound();
+        });
+    }
+    if (!outbound_exhausted()) {
+        return make_ready_future<>();
+    }
+    _stats.outbound_pauses++;
+    auto resume = std::max<size_t>(1, _config.max_outbound_bytes * (1 - _config.outbound_resume_ratio));
+    return _outbound.wait(resume).then([this, resume] {
+        _outbound.signal(resume);
+    });
+}
+
+} /* namespace hero */
@@ -0,0 +1,125 @@
+/*
+ * This file is open source software, licensed to you under the terms
+ * of the Apache License, Version 2.0 (the "License").  See the NOTICE file
+ * distributed with this work for additional information regarding copyright
+ * ownership.  You may not use this file except in compliance with the License.
+ *
+ * You may obtain a copy of the License at
+ *
+ *   http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing,
+ * software distributed under the License is distributed on an
+ * "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+ * KIND, either express or implied.  See the License for the
+ * specific language governing permissions and limitations
+ * under the License.
+ */
+
+#pragma once
+
+#include "core/future.hh"
+#include "core/metrics_registration.hh"
+#include "core/semaphore.hh"
+
+#include <optional>
+
+namespace hero {
+
+using namespace seastar;
+
+// Per-shard limits, and what to do past them.
+struct admission_config {
+    // Open connections; sockets beyond it are closed once accepted.
+    size_t max_connections = 100000;
+    // CONNECTs handled at once.  The others wait, and their clients'
+    // sockets are not read meanwhile, so a reconnect storm is absorbed at
+    // the pace the session owners can take.
+    size_t max_concurrent_connects = 256;
+    // Bytes of received packets being handled; connections stop reading
+    // while it is exhausted.
+    size_t max_inbound_bytes = 64 * 1024 * 1024;
+    // The largest packet a client may send, fixed header included, which
+    // v5 clients are told in CONNACK...
+    uint32_t max_packet_size = 1024 * 1024;
+    // ...and the largest before that, so that a connection which has not
+    // even sent CONNECT cannot make the shard buffer much.
+    uint32_t max_connect_packet_size = 64 * 1024;
+    // Bytes queued for sending over all connections.
+    size_t max_outbound_bytes = 256 * 1024 * 1024;
+    // Once exhausted, the outbound budget counts as available again below
+    // this fraction of it.
+    double outbound_resume_ratio = 0.75;
+    // The shard is under memory pressure when less than this fraction of
+    // its memory is free.
+    double min_free_memory_ratio = 0.05;
+
+    // Under pressure or past the outbound budget, answer CONNECT with
+    // server busy...
+    bool reject_connects = true;
+    // ...drop QoS 0 deliveries...
+    bool shed_qos0 = true;
+    // ...and stop reading from connections, whose requests would add to
+    // the outbound queues.
+    bool pause_reads = true;
+};
+
+struct admission_stats {
+    uint64_t connections_refused = 0;
+    uint64_t connects_rejected = 0;
+    uint64_t connect_waits = 0;
+    uint64_t inbound_waits = 0;
+    uint64_t outbound_pauses = 0;
+    uint64_t memory_pauses = 0;
+    uint64_t qos0_shed = 0;
+};
+
+// Admission control for one shard.  Each budget is a semaphore: a
+// connection slot is held for the life of a connection, a CONNECT slot
+// while a CONNECT is handled, inbound units while a read buffer's packets
+// are handled or a partly received packet is buffered, and outbound units
+// while bytes wait in output queues.
+// Outbound units are taken without waiting, since the bytes are already
+// there; the budget going negative is what the shard reacts to.
+class admission_control {
+    admission_config _config;
+    semaphore _connections;
+    semaphore _connects;
+    semaphore _inbound;
+    semaphore _outbound;
+    admission_stats _stats;
+    metrics::metric_groups _metrics;
+public:
+    explicit admission_control(admission_config config = admission_config());
+
+    const admission_config& config() const { return _config; }
+    const admission_stats& stats() const { return _stats; }
+
+    // A slot for a new connection, or nothing if the shard is full.
+    std::optional<semaphore_units<>> admit_connection();
+    // Waits for a CONNECT slot.
+    future<semaphore_units<>> start_connect();
+    // Whether a CONNECT is to be answered with server busy.
+    bool reject_connect();
+
+    // Waits until the shard can take a read buffer, or a partial packet,
+    // of size bytes; the units are to be held until the buffer's packets
+    // are handled, or the packet is complete.
+    future<semaphore_units<>> receive(size_t size);
+
+    // Output queue accounting.
+    void queued(size_t size) { _outbound.consume(size); }
+    void sent(size_t size) { _outbound.signal(size); }
+    // Whether a QoS 0 delivery of size bytes is to be dropped.
+    bool shed(size_t size);
+    // Resolves once connections may read again, as far as the shard's
+    // outbound budget and free memory are concerned.
+    future<> wait_for_outbound();
+
+    bool memory_pressure() const;
+private:
+    bool outbound_exhausted() const { return !_outbound.current(); }
+    void setup_metrics();
+};
+
+} /* namespace hero */
@@ -0,0 +1,78 @@
+/*
+ * This file is open source software, licensed to you under the terms
+ * of the Apache License, Version 2.0 (the "License").  See the NOTICE file
+ * distributed with this work for additional information regarding copyright
+ * ownership.  You may not use this file except in compliance with the License.
+ *
+ * You may obtain a copy of the License at
+ *
+ *   http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing,
+ * software distributed under the License is distributed on an
+ * "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+ * KIND, either express or implied.  See the License for the
+ * specific language governing permissions and limitations
+ * under the License.
+ */
+
+#include "broker_metrics.hh"
+#include "core/metrics.hh"
+
+namespace hero {
+
+metrics::histogram latency_histogram::to_metrics() const {
+    metrics::histogram h;
+    uint64_t count = 0;
+    // The last bucket has no upper bound; it is what sample_count adds to
+    // the others.
+    for (unsigned i = 0; i < buckets - 1; ++i) {
+        count += _counts[i];
+        h.buckets.push_back(metrics::histogram_bucket{count, double(uint64_t(1) << i)});
+    }
+    h.sample_count = _samples;
+    h.sample_sum = _sum;
+    return h;
+}
+
+stall_probe::stall_probe(clock_type::duration period, clock_type::duration threshold)
+    : _period(period)
+    , _threshold(threshold)
+    , _timer([this] { tick(); })
+{
+    setup_metrics();
+}
+
+void stall_probe::setup_metrics() {
+    namespace sm = seastar::metrics;
+    _metrics.add_group("hero_reactor", {
+        sm::make_histogram("timer_lateness", [this] { return _lateness.to_metrics(); },
+                sm::description("Microseconds by which a periodic timer fired late, that is, went without the reactor polling")),
+        sm::make_derive("stalls", _stalls,
+                sm::description("Times the reactor went without polling for longer than the stall threshold")),
+        sm::make_gauge("max_stall", [this] {
+            return std::chrono::duration_cast<std::chrono::microseconds>(_worst).count();
+        }, sm::description("Longest time, in microseconds, the reactor went without polling")),
+    });
+}
+
+void stall_probe::start() {
+    _expected = clock_type::now() + _period;
+    _timer.arm(_expected);
+}
+
+void stall_probe::tick() {
+    auto now = clock_type::now();
+    auto late = now - _expected;
+    _lateness.record(late);
+    if (late >= _threshold) {
+        _stalls++;
+    }
+    _worst = std::max(_worst, late);
+    // Rearmed from now rather than from the missed deadline, so a long
+    // stall is recorded once instead of as a burst of late ticks.
+    _expected = now + _period;
+    _timer.arm(_expected);
+}
+
+} /* namespace hero */
@@ -0,0 +1,97 @@
+/*
+ * This file is open source software, licensed to you under the terms
+ * of the Apache License, Version 2.0 (the "License").  See the NOTICE file
+ * distributed with this work for additional information regarding copyright
+ * ownership.  You may not use this file except in compliance with the License.
+ *
+ * You may obtain a copy of the License at
+ *
+ *   http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing,
+ * software distributed under the License is distributed on an
+ * "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+ * KIND, either express or implied.  See the License for the
+ * specific language governing permissions and limitations
+ * under the License.
+ */
+
+#pragma once
+
+#include "core/metrics_registration.hh"
+#include "core/metrics_types.hh"
+#include "core/timer.hh"
+
+#include <array>
+#include <chrono>
+
+namespace hero {
+
+using namespace seastar;
+
+// Counters shared by the connections of a shard, indexed by MQTT packet
+// type.
+struct protocol_stats {
+    uint64_t connections_accepted = 0;
+    uint64_t bytes_received = 0;
+    std::array<uint64_t, 16> packets_received{};
+    std::array<uint64_t, 16> packets_sent{};
+};
+
+// A latency histogram with power-of-two microsecond buckets.  Recording is
+// a count-leading-zeros and three increments; the cumulative buckets the
+// metrics layer wants are only built when the metrics are read.
+class latency_histogram {
+public:
+    using clock_type = std::chrono::steady_clock;
+    // Bucket i counts samples below 2^i microseconds; the last one counts
+    // everything else, 2^(buckets-2) microseconds (about 8s) and up.
+    static constexpr unsigned buckets = 25;
+private:
+    std::array<uint64_t, buckets> _counts{};
+    uint64_t _samples = 0;
+    uint64_t _sum = 0;
+public:
+    void record(clock_type::duration d) {
+        auto us = std::chrono::duration_cast<std::chrono::microseconds>(d).count();
+        unsigned i = us > 0 ? std::min<unsigned>(64 - __builtin_clzll(us), buckets - 1) : 0;
+        _counts[i]++;
+        _samples++;
+        _sum += us > 0 ? us : 0;
+    }
+    void record_since(clock_type::time_point start) {
+        record(clock_type::now() - start);
+    }
+
+    uint64_t samples() const { return _samples; }
+    // In microseconds.
+    metrics::histogram to_metrics() const;
+};
+
+// Measures how late a periodic timer fires.  The reactor runs timers
+// between tasks, so the lateness is how long the shard went without
+// getting back to its poll loop: a task that ran too long, or a blocking
+// system call.
+class stall_probe {
+    using clock_type = latency_histogram::clock_type;
+    clock_type::duration _period;
+    clock_type::duration _threshold;
+    timer<clock_type> _timer;
+    clock_type::time_point _expected;
+    latency_histogram _lateness;
+    uint64_t _stalls = 0;
+    clock_type::duration _worst = clock_type::duration::zero();
+    metrics::metric_groups _metrics;
+public:
+    // Lateness of threshold or more counts as a stall.
+    stall_probe(clock_type::duration period = std::chrono::milliseconds(10),
+            clock_type::duration threshold = std::chrono::milliseconds(5));
+
+    void start();
+    void stop() { _timer.cancel(); }
+private:
+    void tick();
+    void setup_metrics();
+};
+
+} /* namespace hero */
@@ -0,0 +1,891 @@
+/*
+ * This file is open source software, licensed to you under the terms
+ * of the Apache License, Version 2.0 (the "License").  See the NOTICE file
+ * distributed with this work for additional information regarding copyright
+ * ownership.  You may not use this file except in compliance with the License.
+ *
+ * You may obtain a copy of the License at
+ *
+ *   http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing,
+ * software distributed under the License is distributed on an
+ * "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+ * KIND, either express or implied.  See the License for the
+ * specific language governing permissions and limitations
+ * under the License.
+ */
+
+#include "cluster.hh"
+#include "server.hh"
+#include "core/future-util.hh"
+#include "core/iostream.hh"
+#include "core/metrics.hh"
+#include "core/reactor.hh"
+#include "core/semaphore.hh"
+#include "net/packet.hh"
+#include "util/log.hh"
+#include "mqtt/decoder.hh"
+#include "mqtt/encoder.hh"
+
+#include <lz4.h>
+
+#include <algorithm>
+#include <cstring>
+#include <optional>
+#include <stdexcept>
+
+namespace hero {
+
+static logger nlog("cluster");
+
+// Frames between nodes are an 8 byte header, holding the body's length,
+// the frame type and flags, followed by the body.  Integers are in host
+// byte order, like the session log's: all nodes of a cluster are meant
+// to run on the same kind of machine.
+enum class frame_type : uint8_t {
+    // Node id and shard of the sender, answered with those of the
+    // receiver.
+    hello = 1,
+    // Filters added and removed on the sender's node.
+    routes = 2,
+    // The digest and number of the sender's filters, once the route
+    // updates before it are applied.
+    digest = 3,
+    // v5 PUBLISH packets, back to back.
+    publish = 4,
+};
+
+// The publish body is a 32 bit uncompressed size followed by LZ4 data.
+static constexpr uint8_t frame_lz4 = 1;
+
+static constexpr size_t frame_header_size = 8;
+static constexpr size_t max_frame_size = 64 * 1024 * 1024;
+static constexpr uint32_t hello_magic = 0x4f524548; // "HERO"
+static constexpr uint16_t cluster_protocol_version = 1;
+
+// A snapshot of a node's filters is sent in frames of this many filters.
+static constexpr size_t route_chunk = 4096;
+
+static constexpr auto digest_interval = std::chrono::seconds(1);
+static constexpr auto min_backoff = std::chrono::milliseconds(100);
+static constexpr auto max_backoff = std::chrono::milliseconds(2000);
+
+static std::string_view view(const sstring& s) {
+    return std::string_view(s.c_str(), s.size());
+}
+
+// Digests are the XOR of the filters' hashes, so adding or removing one
+// filter updates them in constant time, whatever the order.
+static uint64_t filter_hash(const sstring& filter) {
+    uint64_t h = 14695981039346656037ull;
+    for (auto c : filter) {
+        h = (h ^ uint8_t(c)) * 1099511628211ull;
+    }
+    return h;
+}
+
+namespace {
+
+class frame_writer {
+    char* _p;
+public:
+    explicit frame_writer(char* p) : _p(p) {}
+    void u8(uint8_t v) { *_p++ = v; }
+    void u16(uint16_t v) { bytes(&v, sizeof(v)); }
+    void u32(uint32_t v) { bytes(&v, sizeof(v)); }
+    void u64(uint64_t v) { bytes(&v, sizeof(v)); }
+    void str(const sstring& s) {
+        u16(s.size());
+        bytes(s.c_str(), s.size());
+    }
+    void bytes(const void* p, size_t n) {
+        std::memcpy(_p, p, n);
+        _p += n;
+    }
+};
+
+class frame_reader {
+    const char* _p;
+    const char* _end;
+public:
+    explicit frame_reader(const temporary_buffer<char>& b) : _p(b.get()), _end(b.get() + b.size()) {}
+    uint8_t u8() { return *need(1); }
+    uint16_t u16() { uint16_t v; std::memcpy(&v, need(2), 2); return v; }
+    uint32_t u32() { uint32_t v; std::memcpy(&v, need(4), 4); return v; }
+    uint64_t u64() { uint64_t v; std::memcpy(&v, need(8), 8); return v; }
+    sstring str() {
+        auto n = u16();
+        auto p = need(n);
+        return sstring(p, n);
+    }
+    size_t remaining() const { return _end - _p; }
+private:
+    const char* need(size_t n) {
+        if (size_t(_end - _p) < n) {
+            throw std::out_of_range("truncated cluster frame");
+        }
+        auto p = _p;
+        _p += n;
+        return p;
+    }
+};
+
+struct frame {
+    frame_type type;
+    uint8_t flags;
+    temporary_buffer<char> body;
+};
+
+struct hello {
+    uint32_t node;
+    uint16_t shard;
+};
+
+}
+
+static net::packet make_frame(frame_type type, uint8_t flags, net::packet body) {
+    temporary_buffer<char> header(frame_header_size);
+    frame_writer w(header.get_write());
+    w.u32(body.len());
+    w.u8(uint8_t(type));
+    w.u8(flags);
+    w.u16(0);
+    net::packet p(std::move(header));
+    p.append(std::move(body));
+    return p;
+}
+
+static net::packet encode_hello(uint32_t node) {
+    temporary_buffer<char> body(4 + 2 + 4 + 2);
+    frame_writer w(body.get_write());
+    w.u32(hello_magic);
+    w.u16(cluster_protocol_version);
+    w.u32(node);
+    w.u16(engine().cpu_id());
+    return make_frame(frame_type::hello, 0, net::packet(std::move(body)));
+}
+
+static hello decode_hello(const frame& f) {
+    if (f.type != frame_type::hello) {
+        throw std::runtime_error("expected a hello frame");
+    }
+    frame_reader r(f.body);
+    if (r.u32() != hello_magic) {
+        throw std::runtime_error("not a hero cluster node");
+    }
+    auto version = r.u16();
+    if (version != cluster_protocol_version) {
+        throw std::runtime_error(sprint("unsupported cluster protocol version %d", version));
+    }
+    hello h;
+    h.node = r.u32();
+    h.shard = r.u16();
+    return h;
+}
+
+static net::packet encode_routes(bool reset, const std::vector<sstring>& added, const std::vector<sstring>& removed) {
+    size_t size = 1 + 4 + 4;
+    for (auto& f : added) {
+        size += 2 + f.size();
+    }
+    for (auto& f : removed) {
+        size += 2 + f.size();
+    }
+    temporary_buffer<char> body(size);
+    frame_writer w(body.get_write());
+    w.u8(reset);
+    w.u32(added.size());
+    for (auto& f : added) {
+        w.str(f);
+    }
+    w.u32(removed.size());
+    for (auto& f : removed) {
+        w.str(f);
+    }
+    return make_frame(frame_type::routes, 0, net::packet(std::move(body)));
+}
+
+static net::packet encode_digest(uint64_t digest, uint32_t filters) {
+    temporary_buffer<char> body(8 + 4);
+    frame_writer w(body.get_write());
+    w.u64(digest);
+    w.u32(filters);
+    return make_frame(frame_type::digest, 0, net::packet(std::move(body)));
+}
+
+// Returns nothing at the end of the stream.
+static future<std::optional<frame>> read_frame(input_stream<char>& in) {
+    return in.read_exactly(frame_header_size).then([&in] (temporary_buffer<char> header) {
+        if (header.size() < frame_header_size) {
+            return make_ready_future<std::optional<frame>>();
+        }
+        frame_reader r(header);
+        auto size = r.u32();
+        auto type = frame_type(r.u8());
+        auto flags = r.u8();
+        if (size > max_frame_size) {
+            throw std::runtime_error(sprint("cluster frame of %d bytes", size));
+        }
+        return in.read_exactly(size).then([size, type, flags] (temporary_buffer<char> body) {
+            if (body.size() < size) {
+                return std::optional<frame>();
+            }
+            return std::optional<frame>(frame{type, flags, std::move(body)});
+        });
+    });
+}
+
+// A connection from this shard to another node.  It keeps reconnecting
+// until the cluster stops, and only sends: publish batches, and on shard
+// 0 the node's routes.
+//
+// A link may outlive the cluster while a connect is pending, which cannot
+// be aborted; it touches the cluster only while it is not stopped.
+class cluster::link : public enable_lw_shared_from_this<link> {
+    cluster& _cluster;
+    sstring _address;
+    socket_address _addr;
+    std::optional<uint32_t> _node;
+    connected_socket _socket;
+    input_stream<char> _in;
+    output_stream<char> _out;
+    bool _connected = false;
+    bool _up = false;
+    bool _stopped = false;
+    // Counts connections, so that frames queued for a closed one are not
+    // written to the next.
+    uint64_t _generation = 0;
+    semaphore _write{1};
+    // The PUBLISH packets of the next batch.
+    std::vector<temporary_buffer<char>> _batch;
+    size_t _batch_bytes = 0;
+    // Bytes of frames waiting to be written.
+    size_t _queued_bytes = 0;
+    std::chrono::milliseconds _backoff = min_backoff;
+    timer<> _retry;
+    promise<> _wakeup;
+public:
+    link(cluster& c, sstring address)
+        : _cluster(c)
+        , _address(std::move(address))
+        , _addr(make_ipv4_address(ipv4_addr(std::string(_address.c_str()))))
+    {
+        _retry.set_callback([this] { _wakeup.set_value(); });
+    }
+
+    const sstring& address() const { return _address; }
+    std::optional<uint32_t> node() const { return _node; }
+    bool up() const { return _up; }
+    bool has_batch() const { return !_batch.empty(); }
+    size_t queued_bytes() const { return _batch_bytes + _queued_bytes; }
+
+    future<> run();
+    void stop();
+    void push(const message& msg);
+    void send_batch();
+    void send(net::packet frame);
+private:
+    future<> serve(connected_socket s);
+    future<> pause();
+};
+
+future<> cluster::link::run() {
+    return repeat([this] {
+        if (_stopped) {
+            return make_ready_future<stop_iteration>(stop_iteration::yes);
+        }
+        return engine().net().connect(_addr).then([this] (connected_socket s) {
+            if (_stopped) {
+                return make_ready_future<>();
+            }
+            return with_gate(_cluster._gate, [this, s = std::move(s)] () mutable {
+                return serve(std::move(s));
+            });
+        }).handle_exception([this] (std::exception_ptr ep) {
+            if (!_stopped) {
+                nlog.debug("{}: {}", _address, ep);
+            }
+        }).then([this] {
+            if (_stopped) {
+                return make_ready_future<stop_iteration>(stop_iteration::yes);
+            }
+            return pause().then([] {
+                return stop_iteration::no;
+            });
+        });
+    });
+}
+
+future<> cluster::link::pause() {
+    _wakeup = promise<>();
+    _retry.arm(_backoff);
+    _backoff = std::min(_backoff * 2, max_backoff);
+    return _wakeup.get_future();
+}
+
+future<> cluster::link::serve(connected_socket s) {
+    _socket = std::move(s);
+    _in = _socket.input();
+    _out = _socket.output();
+    _connected = true;
+    return _out.write(encode_hello(_cluster._config.node_id)).then([this] {
+        return _out.flush();
+    }).then([this] {
+        return read_frame(_in);
+    }).then([this] (std::optional<frame> f) {
+        if (!f) {
+            throw std::runtime_error("closed before hello");
+        }
+        auto h = decode_hello(*f);
+        if (h.node == _cluster._config.node_id) {
+            throw std::runtime_error(sprint("peer has this node's id %d", h.node));
+        }
+        if (_node && *_node != h.node) {
+            nlog.warn("{}: node id changed from {} to {}", _address, *_node, h.node);
+        }
+        _node = h.node;
+        _backoff = min_backoff;
+        _up = true;
+        nlog.info("{}: connected to node {}", _address, h.node);
+        _cluster.link_up(*this);
+        // The other node sends nothing more; reading only tells when it
+        // goes away.
+        return repeat([this] {
+            return _in.read().then([] (temporary_buffer<char> data) {
+                return data.empty() ? stop_iteration::yes : stop_iteration::no;
+            });
+        });
+    }).finally([this] {
+        if (_up) {
+            _up = false;
+            nlog.info("{}: disconnected from node {}", _address, *_node);
+            if (!_stopped) {
+                _cluster.link_down(*this);
+            }
+        }
+        _connected = false;
+        _generation++;
+        _batch.clear();
+        _batch_bytes = 0;
+        return with_semaphore(_write, 1, [this] {
+            return _out.close();
+        }).handle_exception([] (std::exception_ptr) {});
+    });
+}
+
+void cluster::link::stop() {
+    _stopped = true;
+    if (_connected) {
+        _socket.shutdown_input();
+        _socket.shutdown_output();
+    }
+    if (_retry.cancel()) {
+        _wakeup.set_value();
+    }
+}
+
+void cluster::link::push(const message& msg) {
+    auto& stats = _cluster._stats;
+    auto size = msg.topic.size() + msg.payload.size();
+    if (queued_bytes() + size > _cluster._config.max_queued_bytes) {
+        stats.messages_dropped++;
+        return;
+    }
+    // The same encoding as the session log's, which the receiving node
+    // parses with the protocol decoder.
+    mqtt::publish pub;
+    pub.topic = msg.topic.share();
+    pub.payload = msg.payload.share();
+    pub.qos = msg.qos;
+    pub.retain = msg.retain;
+    pub.dup = false;
+    pub.packet_id = msg.qos == mqtt::qos::at_most_once ? 0 : 1;
+    pub.properties = mqtt::forwarded_properties(msg.properties);
+    auto header = mqtt::encode_publish_header(mqtt::protocol_version::v5, pub);
+    _batch_bytes += header.size() + pub.payload.size();
+    _batch.push_back(std::move(header));
+    if (!pub.payload.empty()) {
+        _batch.push_back(std::move(pub.payload));
+    }
+    stats.messages_forwarded++;
+    if (_batch_bytes >= _cluster._config.max_batch_bytes) {
+        send_batch();
+    } else {
+        _cluster.schedule_flush();
+    }
+}
+
+void cluster::link::send_batch() {
+    auto& stats = _cluster._stats;
+    auto raw_size = std::exchange(_batch_bytes, 0);
+    auto batch = std::exchange(_batch, {});
+    stats.batches_sent++;
+    stats.bytes_uncompressed += raw_size;
+    if (_cluster._config.compress) {
+        temporary_buffer<char> raw(raw_size);
+        auto p = raw.get_write();
+        for (auto& b : batch) {
+            std::memcpy(p, b.get(), b.size());
+            p += b.size();
+        }
+        auto bound = LZ4_compressBound(raw_size);
+        temporary_buffer<char> body(4 + bound);
+        frame_writer(body.get_write()).u32(raw_size);
+        auto n = LZ4_compress_default(raw.get(), body.get_write() + 4, raw_size, bound);
+        // Incompressible batches go as they are.
+        if (n > 0 && size_t(n) < raw_size) {
+            body.trim(4 + n);
+            stats.bytes_sent += body.size();
+            send(make_frame(frame_type::publish, frame_lz4, net::packet(std::move(body))));
+            return;
+        }
+        batch.clear();
+        batch.push_back(std::move(raw));
+    }
+    net::packet body;
+    for (auto& b : batch) {
+        body = net::packet(std::move(body), std::move(b));
+    }
+    stats.bytes_sent += raw_size;
+    send(make_frame(frame_type::publish, 0, std::move(body)));
+}
+
+// Frames are written in the order they are sent, one at a time.
+void cluster::link::send(net::packet frame) {
+    auto size = frame.len();
+    _queued_bytes += size;
+    (void)with_semaphore(_write, 1, [this, generation = _generation, frame = std::move(frame)] () mutable {
+        if (generation != _generation) {
+            return make_ready_future<>();
+        }
+        return _out.write(std::move(frame)).then([this] {
+            return _out.flush();
+        });
+    }).then_wrapped([this, self = shared_from_this(), size] (future<> f) {
+        _queued_bytes -= size;
+        try {
+            f.get();
+        } catch (...) {
+            nlog.debug("{}: write failed: {}", _address, std::current_exception());
+            if (_connected) {
+                _socket.shutdown_input();
+            }
+        }
+    });
+}
+
+// A connection from another node's shard, which only receives.
+class cluster::peer {
+public:
+    uint64_t id;
+    connected_socket socket;
+    socket_address addr;
+    input_stream<char> in;
+    output_stream<char> out;
+    std::optional<uint32_t> node;
+    // Whether the other node's routes came over this connection.
+    bool routes = false;
+
+    peer(uint64_t id, connected_socket&& s, socket_address addr)
+        : id(id)
+        , socket(std::move(s))
+        , addr(addr)
+        , in(socket.input())
+        , out(socket.output())
+    {
+    }
+};
+
+cluster::cluster(server& s, cluster_config config)
+    : _server(s)
+    , _config(std::move(config))
+{
+    setup_metrics();
+}
+
+cluster::~cluster() = default;
+
+void cluster::setup_metrics() {
+    namespace sm = seastar::metrics;
+    _metrics.add_group("hero_cluster", {
+        sm::make_derive("messages_forwarded", _stats.messages_forwarded,
+                sm::description("Messages queued for sending to other nodes")),
+        sm::make_derive("messages_dropped", _stats.messages_dropped,
+                sm::description("Messages not sent to a node because it was unreachable or too slow")),
+        sm::make_derive("messages_received", _stats.messages_received,
+                sm::description("Messages received from other nodes")),
+        sm::make_derive("batches_sent", _stats.batches_sent,
+                sm::description("Message batches sent to other nodes")),
+        sm::make_derive("batches_received", _stats.batches_received,
+                sm::description("Message batches received from other nodes")),
+        sm::make_derive("bytes_sent", _stats.bytes_sent,
+                sm::description("Bytes of message batches sent to other nodes, after compression")),
+        sm::make_derive("bytes_uncompressed", _stats.bytes_uncompressed,
+                sm::description("Bytes of message batches sent to other nodes, before compression")),
+        sm::make_derive("route_updates_sent", _stats.route_updates_sent,
+                sm::description("Route updates sent to other nodes")),
+        sm::make_derive("route_updates_received", _stats.route_updates_received,
+                sm::description("Route updates received from other nodes")),
+        sm::make_derive("digest_mismatches", _stats.digest_mismatches,
+                sm::description("Route digests from other nodes which disagreed with their routes here")),
+        sm::make_gauge("nodes_connected", [this] { return _links_by_node.size(); },
+                sm::description("Other nodes this shard has a connection to")),
+        sm::make_gauge("remote_filters", [this] { return _remote_routes.size(); },
+                sm::description("Filters with subscribers on other nodes, counted once per node")),
+        sm::make_gauge("queued_bytes", [this] {
+            size_t n = 0;
+            for (auto& l : _links) {
+                n += l->queued_bytes();
+            }
+            return n;
+        }, sm::description("Bytes of messages waiting to be sent to other nodes")),
+    });
+}
+
+void cluster::listen() {
+    listen_options lo;
+    lo.reuse_address = true;
+    _listener = engine().listen(_config.listener.bind_address(), lo);
+    keep_doing([this] {
+        return _listener->accept().then([this] (connected_socket fd, socket_address addr) mutable {
+            auto id = (uint64_t(engine().cpu_id()) << 48) | _next_peer++;
+            auto p = make_lw_shared<peer>(id, std::move(fd), addr);
+            with_gate(_gate, [this, p] {
+                _peers.emplace(p->id, p);
+                return serve(p).finally([this, p] {
+                    _peers.erase(p->id);
+                });
+            });
+        });
+    }).handle_exception([this] (std::exception_ptr ep) {
+        if (!_stopping) {
+            nlog.error("accept failed: {}", ep);
+        }
+    });
+}
+
+void cluster::start() {
+    if (_config.listener.on_shard(engine().cpu_id())) {
+        listen();
+    }
+    for (auto& address : _config.peers) {
+        auto l = make_lw_shared<link>(*this, address);
+        _links.push_back(l);
+        (void)l->run().finally([l] {});
+    }
+    if (engine().cpu_id() == 0) {
+        _digest_timer.set_callback([this] { send_digests(); });
+        _digest_timer.arm_periodic(digest_interval);
+    }
+}
+
+future<> cluster::stop() {
+    _stopping = true;
+    _digest_timer.cancel();
+    if (_listener) {
+        _listener->abort_accept();
+    }
+    for (auto& l : _links) {
+        l->stop();
+    }
+    for (auto& p : _peers) {
+        p.second->socket.shutdown_input();
+    }
+    return _gate.close();
+}
+
+void cluster::forward(const lw_shared_ptr<message>& msg) {
+    if (_links.empty()) {
+        return;
+    }
+    if (msg->retain) {
+        for (auto& l : _links) {
+            if (l->up()) {
+                l->push(*msg);
+            } else {
+                _stats.messages_dropped++;
+            }
+        }
+        return;
+    }
+    auto nodes = _remote_routes.match(msg->topic_view());
+    for (auto& n : *nodes) {
+        auto i = _links_by_node.find(n.id);
+        if (i == _links_by_node.end()) {
+            _stats.messages_dropped++;
+        } else {
+            i->second->push(*msg);
+        }
+    }
+}
+
+void cluster::schedule_flush() {
+    if (_flush_scheduled || _stopping) {
+        return;
+    }
+    _flush_scheduled = true;
+    // As in the fanout, everything queued during this poll cycle goes out
+    // in one batch.
+    with_gate(_gate, [this] {
+        return later().then([this] {
+            _flush_scheduled = false;
+            flush();
+        });
+    });
+}
+
+void cluster::flush() {
+    send_route_changes();
+    for (auto& l : _links) {
+        if (l->up() && l->has_batch()) {
+            l->send_batch();
+        }
+    }
+}
+
+void cluster::local_route_added(const sstring& filter) {
+    if (_local_filters[filter]++ == 0) {
+        _local_digest ^= filter_hash(filter);
+        _changed.insert(filter);
+        schedule_flush();
+    }
+}
+
+void cluster::local_route_removed(const sstring& filter) {
+    auto i = _local_filters.find(filter);
+    if (i == _local_filters.end()) {
+        return;
+    }
+    if (--i->second == 0) {
+        _local_filters.erase(i);
+        _local_digest ^= filter_hash(filter);
+        _changed.insert(filter);
+        schedule_flush();
+    }
+}
+
+// A filter that was added and removed again since the last update is sent
+// as removed, which the other nodes take as a no-op.
+void cluster::send_route_changes() {
+    if (_changed.empty()) {
+        return;
+    }
+    std::vector<sstring> added;
+    std::vector<sstring> removed;
+    for (auto& f : _changed) {
+        if (_local_filters.count(f)) {
+            added.push_back(f);
+        } else {
+            removed.push_back(f);
+        }
+    }
+    _changed.clear();
+    for (auto& n : _links_by_node) {
+        _stats.route_updates_sent++;
+        n.second->send(encode_routes(false, added, removed));
+    }
+}
+
+void cluster::send_digests() {
+    send_route_changes();
+    for (auto& n : _links_by_node) {
+        n.second->send(encode_digest(_local_digest, _local_filters.size()));
+    }
+}
+
+// Shard 0 starts every connection with all of this node's filters, so the
+// other node's replica no longer depends on updates the previous
+// connection lost.
+void cluster::link_up(link& l) {
+    auto node = *l.node();
+    auto i = _links_by_node.emplace(node, &l);
+    if (!i.second && i.first->second != &l) {
+        nlog.warn("{}: node {} is also at {}", l.address(), node, i.first->second->address());
+        return;
+    }
+    if (engine().cpu_id() != 0) {
+        return;
+    }
+    std::vector<sstring> chunk;
+    bool reset = true;
+    auto send_chunk = [&] {
+        _stats.route_updates_sent++;
+        l.send(encode_routes(reset, chunk, {}));
+        chunk.clear();
+        reset = false;
+    };
+    for (auto& f : _local_filters) {
+        chunk.push_back(f.first);
+        if (chunk.size() == route_chunk) {
+            send_chunk();
+        }
+    }
+    if (reset || !chunk.empty()) {
+        send_chunk();
+    }
+}
+
+void cluster::link_down(link& l) {
+    auto i = _links_by_node.find(*l.node());
+    if (i != _links_by_node.end() && i->second == &l) {
+        _links_by_node.erase(i);
+    }
+}
+
+void cluster::apply_routes(uint32_t node, uint64_t connection, bool reset,
+        const std::vector<sstring>& added, const std::vector<sstring>& removed) {
+    auto& r = _remote[node];
+    if (reset) {
+        for (auto& f : r.filters) {
+            _remote_routes.unsubscribe(view(f), node);
+        }
+        r.filters.clear();
+        r.digest = 0;
+        r.connection = connection;
+    } else if (r.connection != connection) {
+        return;
+    }
+    for (auto& f : added) {
+        if (r.filters.insert(f).second) {
+            _remote_routes.subscribe(view(f), node, subscription_options());
+            r.digest ^= filter_hash(f);
+        }
+    }
+    for (auto& f : removed) {
+        if (r.filters.erase(f)) {
+            _remote_routes.unsubscribe(view(f), node);
+            r.digest ^= filter_hash(f);
+        }
+    }
+}
+
+void cluster::forget_node(uint32_t node, uint64_t connection) {
+    auto i = _remote.find(node);
+    if (i == _remote.end() || i->second.connection != connection) {
+        return;
+    }
+    for (auto& f : i->second.filters) {
+        _remote_routes.unsubscribe(view(f), node);
+    }
+    _remote.erase(i);
+}
+
+future<> cluster::serve(lw_shared_ptr<peer> p) {
+    return read_frame(p->in).then([this, p] (std::optional<frame> f) {
+        if (!f) {
+            throw std::runtime_error("closed before hello");
+        }
+        auto h = decode_hello(*f);
+        p->node = h.node;
+        nlog.debug("{}: node {} shard {} connected", p->addr, h.node, h.shard);
+        return p->out.write(encode_hello(_config.node_id)).then([p] {
+            return p->out.flush();
+        });
+    }).then([this, p] {
+        // Frames are handled one at a time, so a digest is only checked
+        // once the route updates before it are applied on every shard.
+        return repeat([this, p] {
+            return read_frame(p->in).then([this, p] (std::optional<frame> f) {
+                if (!f) {
+                    return make_ready_future<stop_iteration>(stop_iteration::yes);
+                }
+                return handle_frame(*p, uint8_t(f->type), f->flags, std::move(f->body)).then([] {
+                    return stop_iteration::no;
+                });
+            });
+        });
+    }).handle_exception([p] (std::exception_ptr ep) {
+        nlog.debug("{}: connection closed: {}", p->addr, ep);
+    }).finally([this, p] {
+        if (!p->routes) {
+            return make_ready_future<>();
+        }
+        return _server.container().invoke_on_all([node = *p->node, id = p->id] (server& s) {
+            s.get_cluster()->forget_node(node, id);
+        });
+    }).finally([p] {
+        return p->out.close().handle_exception([] (std::exception_ptr) {});
+    });
+}
+
+future<> cluster::handle_frame(peer& p, uint8_t type, uint8_t flags, temporary_buffer<char> body) {
+    switch (frame_type(type)) {
+    case frame_type::routes: {
+        frame_reader r(body);
+        bool reset = r.u8();
+        std::vector<sstring> added(r.u32());
+        for (auto& f : added) {
+            f = r.str();
+        }
+        std::vector<sstring> removed(r.u32());
+        for (auto& f : removed) {
+            f = r.str();
+        }
+        p.routes = true;
+        _stats.route_updates_received++;
+        return _server.container().invoke_on_all([node = *p.node, id = p.id, reset,
+                added = std::move(added), removed = std::move(removed)] (server& s) {
+            s.get_cluster()->apply_routes(node, id, reset, added, removed);
+        });
+    }
+    case frame_type::digest: {
+        frame_reader r(body);
+        auto digest = r.u64();
+        auto filters = r.u32();
+        auto i = _remote.find(*p.node);
+        if (i != _remote.end() && i->second.connection == p.id
+                && i->second.digest == digest && i->second.filters.size() == filters) {
+            return make_ready_future<>();
+        }
+        _stats.digest_mismatches++;
+        nlog.warn("{}: routes of node {} out of sync, reconnecting", p.addr, *p.node);
+        // The other node resends all its filters once it reconnects.
+        p.socket.shutdown_input();
+        return make_ready_future<>();
+    }
+    case frame_type::publish:
+        return receive_batch(flags, std::move(body));
+    default:
+        throw std::runtime_error(sprint("unexpected cluster frame type %d", type));
+    }
+}
+
+future<> cluster::receive_batch(uint8_t flags, temporary_buffer<char> body) {
+    _stats.batches_received++;
+    if (flags & frame_lz4) {
+        frame_reader r(body);
+        auto size = r.u32();
+        if (size > max_frame_size) {
+            throw std::runtime_error(sprint("cluster batch of %d bytes", size));
+        }
+        temporary_buffer<char> raw(size);
+        auto n = LZ4_decompress_safe(body.get() + 4, raw.get_write(), body.size() - 4, size);
+        if (n < 0 || size_t(n) != size) {
+            throw std::runtime_error("malformed compressed cluster batch");
+        }
+        body = std::move(raw);
+    }
+    mqtt::decoder d;
+    std::vector<mqtt::packet> packets;
+    d.feed(std::move(body), packets);
+    if (!d.idle()) {
+        throw std::runtime_error("truncated cluster batch");
+    }
+    _stats.messages_received += packets.size();
+    std::vector<future<>> durable;
+    for (auto& packet : packets) {
+        auto pub = mqtt::parse_publish(std::move(packet), mqtt::protocol_version::v5);
+        // No connection has this origin, so no-local subscriptions get
+        // messages from other nodes.
+        auto f = _server.publish_from_peer(make_message(std::move(pub), uint64_t(-1)));
+        if (!f.available() || f.failed()) {
+            durable.push_back(std::move(f));
+        }
+    }
+    // The next frame is read once the messages are handed to their
+    // sessions, which bounds what a fast node can pile up here.
+    return when_all(durable.begin(), durable.end()).discard_result();
+}
+
+} /* namespace hero */
@@ -0,0 +1,168 @@
+/*
+ * This file is open source software, licensed to you under the terms
+ * of the Apache License, Version 2.0 (the "License").  See the NOTICE file
+ * distributed with this work for additional information regarding copyright
+ * ownership.  You may not use this file except in compliance with the License.
+ *
+ * You may obtain a copy of the License at
+ *
+ *   http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing,
+ * software distributed under the License is distributed on an
+ * "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+ * KIND, either express or implied.  See the License for the
+ * specific language governing permissions and limitations
+ * under the License.
+ */
+
+#pragma once
+
+#include "core/future.hh"
+#include "core/gate.hh"
+#include "core/metrics_registration.hh"
+#include "core/shared_ptr.hh"
+#include "core/sstring.hh"
+#include "core/timer.hh"
+#include "net/api.hh"
+#include "listener.hh"
+#include "message.hh"
+#include "subscription_index.hh"
+
+#include <memory>
+#include <unordered_map>
+#include <unordered_set>
+#include <vector>
+
+namespace hero {
+
+using namespace seastar;
+using namespace net;
+
+class server;
+
+struct cluster_config {
+    // The listener other nodes connect to; port 0 runs the broker on its
+    // own.
+    listener_config listener{listener_kind::cluster};
+    uint32_t node_id = 0;
+    // The "host:port" cluster addresses of the other nodes.
+    std::vector<sstring> peers;
+    // Compress forwarding batches with LZ4.
+    bool compress = false;
+    // A forwarding batch is sent once it holds this many bytes, and at
+    // the end of the poll cycle otherwise.
+    size_t max_batch_bytes = 64 * 1024;
+    // Bytes of batches a link holds while its peer is slow to take them;
+    // messages beyond it are dropped.
+    size_t max_queued_bytes = 16 * 1024 * 1024;
+};
+
+// Cluster mode: the nodes of a cluster forward each PUBLISH to the nodes
+// with subscribers for it.
+//
+// Every shard connects to every other node and forwards the messages
+// published on it over its own connections, batched per poll cycle like
+// the fanout.  Route updates travel over the connections of shard 0:
+// whenever a filter gains its first or loses its last subscriber on this
+// node, shard 0 sends the change to every node, and a node that connects
+// gets all of this node's filters first.  Each receiving node replicates
+// a peer's filters on all its shards, so any shard can tell which nodes a
+// topic has subscribers on.  Every digest_interval a digest of the filters
+// follows, and a node whose replica disagrees drops the connection, which
+// makes the sender reconnect and send all its filters again.
+//
+// Forwarding is at most once between nodes: messages for an unreachable
+// or slow node are dropped.  Retained messages go to every node, so each
+// keeps them all.  A shared subscription group is routed like its filter,
+// so a group with members on several nodes gets a message once per node.
+class cluster {
+public:
+    struct stats {
+        uint64_t messages_forwarded = 0;
+        uint64_t messages_dropped = 0;
+        uint64_t messages_received = 0;
+        uint64_t batches_sent = 0;
+        uint64_t batches_received = 0;
+        uint64_t bytes_sent = 0;
+        // Bytes of batches before compression.
+        uint64_t bytes_uncompressed = 0;
+        uint64_t route_updates_sent = 0;
+        uint64_t route_updates_received = 0;
+        uint64_t digest_mismatches = 0;
+    };
+    class link;
+    class peer;
+private:
+    struct node_routes {
+        std::unordered_set<sstring> filters;
+        uint64_t digest = 0;
+        // The connection that sent the node's filters.  Updates from any
+        // other are stale, and the routes go away only when it closes.
+        uint64_t connection = 0;
+    };
+    server& _server;
+    cluster_config _config;
+    lw_shared_ptr<server_socket> _listener;
+    std::vector<lw_shared_ptr<link>> _links;
+    // The connected links, by the node they lead to.
+    std::unordered_map<uint32_t, link*> _links_by_node;
+    std::unordered_map<uint64_t, lw_shared_ptr<peer>> _peers;
+    uint64_t _next_peer = 0;
+    // Subscriber ids in this index are node ids.
+    subscription_index _remote_routes;
+    std::unordered_map<uint32_t, node_routes> _remote;
+    // On shard 0: the filters with subscribers on this node, with the
+    // number of shards routing each, and the filters added or removed
+    // since the last update was sent.
+    std::unordered_map<sstring, unsigned> _local_filters;
+    uint64_t _local_digest = 0;
+    std::unordered_set<sstring> _changed;
+    bool _flush_scheduled = false;
+    timer<> _digest_timer;
+    gate _gate;
+    bool _stopping = false;
+    stats _stats;
+    metrics::metric_groups _metrics;
+public:
+    cluster(server& s, cluster_config config);
+    ~cluster();
+
+    void start();
+    future<> stop();
+
+    // Sends a message published on this node to the nodes with
+    // subscribers for it.
+    void forward(const lw_shared_ptr<message>& msg);
+
+    // On shard 0: a filter is routed to one more, or one less, shard of
+    // this node.
+    void local_route_added(const sstring& filter);
+    void local_route_removed(const sstring& filter);
+
+    // Replicates a node's route update on this shard.  reset replaces all
+    // of the node's filters with the added ones.
+    void apply_routes(uint32_t node, uint64_t connection, bool reset,
+            const std::vector<sstring>& added, const std::vector<sstring>& removed);
+    // Drops a node's routes if they came over connection.
+    void forget_node(uint32_t node, uint64_t connection);
+
+    const cluster_config& config() const { return _config; }
+    stats& get_stats() { return _stats; }
+private:
+    void setup_metrics();
+    void listen();
+    void schedule_flush();
+    void flush();
+    void send_route_changes();
+    void send_digests();
+    void link_up(link& l);
+    void link_down(link& l);
+    future<> serve(lw_shared_ptr<peer> p);
+    future<> handle_frame(peer& p, uint8_t type, uint8_t flags, temporary_buffer<char> body);
+    future<> receive_batch(uint8_t flags, temporary_buffer<char> body);
+
+    friend class link;
+};
+
+} /* namespace hero */
@@ -1,6 +1,7 @@
 #!/usr/bin/python3
 
 import os, os.path, textwrap, argparse, sys, shlex, subprocess, tempfile, re, platform
+import concurrent.futures, hashlib, json, threading
 from distutils.spawn import find_executable
 
 tempfile.tempdir = "./build/tmp"
@@ -64,14 +65,56 @@ def pkg_config(option, package):
     output = subprocess.check_output(['pkg-config', option, package])
     return output.decode('utf-8').strip()
 
-def try_compile(compiler, source = '', flags = []):
-    return try_compile_and_link(compiler, source, flags = flags + ['-c'])
+# Results of compiler probes are kept in build/ and reused for as long as
+# the compiler, its version and the user's flags stay the same.  Probes
+# which also depend on installed packages or tools (boost, gold) are not
+# cached.
+probe_cache_file = 'build/compiler-probes.json'
+probe_cache_lock = threading.Lock()
+probe_cache = {}
+
+def probe_cache_key(compiler):
+    path = find_executable(compiler) or compiler
+    try:
+        version = subprocess.check_output([compiler, '--version'], stderr = subprocess.DEVNULL).decode('utf-8')
+    except (OSError, subprocess.CalledProcessError):
+        version = None
+    return {'compiler': os.path.realpath(path), 'version': version, 'user_cflags': args.user_cflags}
+
+def load_probe_cache(key):
+    try:
+        with open(probe_cache_file) as f:
+            cached = json.load(f)
+        if cached['key'] == key:
+            probe_cache.update(cached['results'])
+    except (OSError, ValueError, KeyError):
+        pass
+
+def save_probe_cache(key):
+    os.makedirs(os.path.dirname(probe_cache_file), exist_ok = True)
+    with open(probe_cache_file + '.tmp', 'w') as f:
+        json.dump({'key': key, 'results': probe_cache}, f, indent = 2, sort_keys = True)
+    os.rename(probe_cache_file + '.tmp', probe_cache_file)
+
+def try_compile(compiler, source = '', flags = [], cache = True):
+    return try_compile_and_link(compiler, source, flags = flags + ['-c'], cache = cache)
 
 def ensure_tmp_dir_exists():
-    if not os.path.exists(tempfile.tempdir):
-        os.makedirs(tempfile.tempdir)
-
-def try_compile_and_link(compiler, source = '', flags = []):
+    os.makedirs(tempfile.tempdir, exist_ok = True)
+
+def try_compile_and_link(compiler, source = '', flags = [], cache = True):
+    key = json.dumps([compiler, source, flags])
+    if cache:
+        with probe_cache_lock:
+            if key in probe_cache:
+                return probe_cache[key]
+    result = run_compiler(compiler, source, flags)
+    if cache:
+        with probe_cache_lock:
+            probe_cache[key] = result
+    return result
+
+def run_compiler(compiler, source, flags):
     ensure_tmp_dir_exists()
     with tempfile.NamedTemporaryFile() as sfile:
         ofile = tempfile.mktemp()
@@ -108,7 +151,7 @@ def debug_flag(compiler):
 
 def gold_supported(compiler):
     src_main = 'int main(int argc, char **argv) { return 0; }'
-    if try_compile_and_link(source = src_main, flags = ['-fuse-ld=gold'], compiler = compiler):
+    if try_compile_and_link(source = src_main, flags = ['-fuse-ld=gold'], compiler = compiler, cache = False):
         return '-fuse-ld=gold'
     else:
         print('Note: gold not found; using default system linker')
@@ -126,24 +169,69 @@ def default_target_arch():
     else:
         return ''
 
+# seastar_mode is the seastar build a mode links against; seastar itself
+# only has debug and release.
 modes = {
     'debug': {
         'sanitize': '-fsanitize=address -fsanitize=leak -fsanitize=undefined',
         'sanitize_libs': '-lasan -lubsan',
         'opt': '-O0 -DDEBUG -DDEBUG_SHARED_PTR -DDEFAULT_ALLOCATOR -DDEBUG_LSA_SANITIZER',
         'libs': '',
+        'seastar_mode': 'debug',
     },
     'release': {
         'sanitize': '',
         'sanitize_libs': '',
         'opt': '-O3',
         'libs': '',
+        'seastar_mode': 'release',
+    },
+    # Link-time optimization of our code; -flto is added once the compiler
+    # has been probed.
+    'release-lto': {
+        'sanitize': '',
+        'sanitize_libs': '',
+        'opt': '-O3',
+        'libs': '',
+        'seastar_mode': 'release',
+    },
+    # Profile-guided optimization.  An instrumented hero is built under
+    # build/release-pgo/instrumented and run under
+    # tests/perf/pgo_workload.py, and everything is then built with the
+    # profile it left.
+    'release-pgo': {
+        'sanitize': '',
+        'sanitize_libs': '',
+        'opt': '-O3',
+        'libs': '',
+        'seastar_mode': 'release',
     },
 }
 
-hero_tests = []
+# Built by "ninja" alone; the others are built by naming them.
+default_modes = ['debug', 'release']
 
-perf_tests = []
+hero_tests = [
+    'tests/mqtt_decoder_test',
+    'tests/subscription_index_test',
+    'tests/timer_wheel_test',
+    'tests/segment_log_test',
+    'tests/publish_encoder_test',
+]
+
+perf_tests = [
+    'tests/perf/perf_mqtt_load',
+    'tests/perf/perf_codec',
+    'tests/perf/perf_output',
+    'tests/perf/perf_smp',
+    'tests/perf/perf_buffers',
+]
+
+# Perf tests which are applications of their own rather than
+# microbenchmarks run by tests/perf/perf.cc.
+perf_apps = set([
+    'tests/perf/perf_mqtt_load',
+])
 
 apps = ['hero',]
 
@@ -203,25 +291,55 @@ defines = []
 
 extra_cxxflags = {}
 
-hero_core = ([])
+hero_core = (['mqtt/decoder.cc',
+              'mqtt/encoder.cc',
+              'subscription_index.cc',
+              'message.cc',
+              'fanout.cc',
+              'session.cc',
+              'output_queue.cc',
+              'timer_wheel.cc',
+              'segment_log.cc',
+              'session_store.cc',
+              'admission.cc',
+              'broker_metrics.cc',
+              'slab_arena.cc',
+              'retained_store.cc',
+              'shared_subscriptions.cc',
+              'publish_encoder.cc',
+              'listener.cc',
+              'cluster.cc',
+              'tls_acceptor.cc',
+              'connection.cc',
+              'server.cc',
+              ])
 
 api = []
 
 hero_tests_dependencies = hero_core + []
 
-hero_tests_seastar_deps = []
+hero_tests_seastar_deps = [
+    'seastar/tests/test-utils.cc',
+    'seastar/tests/test_runner.cc',
+]
 
 deps = {
     'hero': ['main.cc',] + hero_core + api,
 }
 
-pure_boost_tests = set([])
+pure_boost_tests = set([
+    'tests/mqtt_decoder_test',
+    'tests/subscription_index_test',
+    'tests/timer_wheel_test',
+    'tests/publish_encoder_test',
+])
 
-tests_not_using_seastar_test_framework = set([]) | pure_boost_tests
+# Perf tests are applications with their own main().
+tests_not_using_seastar_test_framework = set(perf_tests) | pure_boost_tests
 
 for t in tests_not_using_seastar_test_framework:
-    if not t in hero_tests:
-        raise Exception("Test %s not found in hero_tests" % (t))
+    if not t in tests:
+        raise Exception("Test %s not found in tests" % (t))
 
 for t in hero_tests:
     deps[t] = [t + '.cc']
@@ -231,10 +349,14 @@ for t in hero_tests:
     else:
         deps[t] += hero_core
 
-perf_tests_seastar_deps = []
+perf_tests_seastar_deps = [
+    'tests/perf/perf.cc',
+]
 
 for t in perf_tests:
-    deps[t] = [t + '.cc'] + hero_tests_dependencies + perf_tests_seastar_deps
+    deps[t] = [t + '.cc'] + hero_tests_dependencies
+    if t not in perf_apps:
+        deps[t] += perf_tests_seastar_deps
 
 warnings = [
     '-Wno-mismatched-tags',  # clang-only
@@ -253,23 +375,60 @@ warnings = [
     '-Wno-nonnull-compare'
     ]
 
+optimization_flags = [
+    '--param inline-unit-growth=300',
+]
+
+# All compiler probes are started here and run in parallel; each result is
+# waited for where it is used.
+probe_key = probe_cache_key(args.cxx)
+load_probe_cache(probe_key)
+probe_pool = concurrent.futures.ThreadPoolExecutor(max_workers = os.cpu_count() or 1)
+
+flags_supported = {flag: probe_pool.submit(flag_supported, flag = flag, compiler = args.cxx)
+                   for flag in warnings + optimization_flags +
+                               ['-flto=auto', '-fprofile-update=atomic', '-Wno-missing-profile']}
+gold_probe = probe_pool.submit(gold_supported, compiler = args.cxx)
+debug_probe = probe_pool.submit(debug_flag, args.cxx) if args.debuginfo else None
+boost_probe = probe_pool.submit(try_compile, compiler = args.cxx, source = '#include <boost/version.hpp>', cache = False)
+boost_version_probe = probe_pool.submit(try_compile, compiler = args.cxx, source = '''\
+        #include <boost/version.hpp>
+        #if BOOST_VERSION < 105500
+        #error Boost version too low
+        #endif
+        ''', cache = False)
+sanitize_probe = probe_pool.submit(try_compile, compiler = args.cxx, flags = ['-fsanitize-address-use-after-scope'],
+                                   source = 'int f() {}')
+
 warnings = [w
             for w in warnings
-            if flag_supported(flag = w, compiler = args.cxx)]
+            if flags_supported[w].result()]
 
 warnings = ' '.join(warnings + ['-Wno-error=deprecated-declarations'])
 
-optimization_flags = [
-    '--param inline-unit-growth=300',
-]
 optimization_flags = [o
                       for o in optimization_flags
-                      if flag_supported(flag = o, compiler = args.cxx)]
-modes['release']['opt'] += ' ' + ' '.join(optimization_flags)
-
-gold_linker_flag = gold_supported(compiler = args.cxx)
-
-dbgflag = debug_flag(args.cxx) if args.debuginfo else ''
+                      if flags_supported[o].result()]
+for mode in modes:
+    if mode != 'debug':
+        modes[mode]['opt'] += ' ' + ' '.join(optimization_flags)
+
+# -flto=auto runs the link-time optimization in parallel.
+lto_flag = '-flto=auto' if flags_supported['-flto=auto'].result() else '-flto'
+modes['release-lto']['opt'] += ' ' + lto_flag
+
+# Seastar's reactor threads update the counters concurrently, hence the
+# atomic updates and the correction of the inconsistencies left anyway.
+pgo_generate_flags = ' '.join(['-fprofile-generate'] +
+                              [o for o in ['-fprofile-update=atomic'] if flags_supported[o].result()])
+pgo_use_flags = ' '.join(['-fprofile-use', '-fprofile-correction'] +
+                         [w for w in ['-Wno-missing-profile'] if flags_supported[w].result()])
+modes['release-pgo']['opt_instrumented'] = modes['release-pgo']['opt'] + ' ' + pgo_generate_flags
+modes['release-pgo']['opt'] += ' ' + pgo_use_flags
+
+gold_linker_flag = gold_probe.result()
+
+dbgflag = debug_probe.result() if debug_probe else ''
 tests_link_rule = 'link' if args.tests_debuginfo else 'link_stripped'
 
 if args.so:
@@ -308,21 +467,19 @@ for pkglist in optional_packages:
             alternatives = ':'.join(pkglist[1:])
             print('Missing optional package {pkglist[0]} (or alteratives {alternatives})'.format(**locals()))
 
-if not try_compile(compiler=args.cxx, source='#include <boost/version.hpp>'):
+if not boost_probe.result():
     print('Boost not installed.  Please install {}.'.format(pkgname("boost-devel")))
     sys.exit(1)
 
-if not try_compile(compiler=args.cxx, source='''\
-        #include <boost/version.hpp>
-        #if BOOST_VERSION < 105500
-        #error Boost version too low
-        #endif
-        '''):
+if not boost_version_probe.result():
     print('Installed boost version too old.  Please update {}.'.format(pkgname("boost-devel")))
     sys.exit(1)
 
 
-has_sanitize_address_use_after_scope = try_compile(compiler=args.cxx, flags=['-fsanitize-address-use-after-scope'], source='int f() {}')
+has_sanitize_address_use_after_scope = sanitize_probe.result()
+
+probe_pool.shutdown()
+save_probe_cache(probe_key)
 
 defines = ' '.join(['-D' + d for d in defines])
 
@@ -331,7 +488,7 @@ globals().update(vars(args))
 total_memory = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
 link_pool_depth = max(int(total_memory / 7e9), 1)
 
-build_modes = modes if args.mode == 'all' else [args.mode]
+build_modes = list(modes) if args.mode == 'all' else [args.mode]
 build_artifacts = all_artifacts if not args.artifacts else args.artifacts
 
 status = subprocess.call("./HERO-VERSION-GENERATOR")
@@ -371,27 +528,83 @@ seastar_flags += ['--compiler', args.cxx, '--c-compiler', args.cc, '--cflags=%s'
                   '--c++-dialect=gnu++1z', '--optflags=%s' % (modes['release']['opt']),
                  ]
 
-status = subprocess.call([python, './configure.py'] + seastar_flags, cwd = 'seastar')
-
-if status != 0:
-    print('Seastar configuration failed')
-    sys.exit(1)
+# Seastar's configure and the generation of its seastar.pc files are skipped
+# if neither the submodule, nor the flags it is configured with, nor the
+# toolchain changed since the last run; the fingerprint of these and the
+# parsed seastar.pc files are kept in build/.
+seastar_cache_file = 'build/seastar-configure.json'
+
+def git_output(*cmd):
+    try:
+        return subprocess.check_output(['git', '-C', 'seastar'] + list(cmd), stderr = subprocess.DEVNULL).decode('utf-8')
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def seastar_fingerprint():
+    diff = git_output('diff', 'HEAD')
+    inputs = {
+        'revision': git_output('rev-parse', 'HEAD'),
+        # Local changes to the submodule count as well.
+        'diff': hashlib.sha1(diff.encode('utf-8')).hexdigest() if diff else diff,
+        'flags': seastar_flags,
+        'cxx': probe_key,
+        'cc': probe_cache_key(args.cc),
+        'python': python,
+    }
+    return hashlib.sha1(json.dumps(inputs, sort_keys = True).encode('utf-8')).hexdigest()
+
+def load_seastar_cache(fingerprint):
+    if not os.path.exists('seastar/build.ninja'):
+        return None
+    try:
+        with open(seastar_cache_file) as f:
+            cached = json.load(f)
+        if cached['fingerprint'] == fingerprint:
+            return cached['pc']
+    except (OSError, ValueError, KeyError):
+        pass
+    return None
+
+def save_seastar_cache(fingerprint, pcs):
+    os.makedirs(os.path.dirname(seastar_cache_file), exist_ok = True)
+    with open(seastar_cache_file + '.tmp', 'w') as f:
+        json.dump({'fingerprint': fingerprint, 'pc': pcs}, f, indent = 2, sort_keys = True)
+    os.rename(seastar_cache_file + '.tmp', seastar_cache_file)
+
+seastar_fingerprint_value = seastar_fingerprint()
+seastar_pcs = load_seastar_cache(seastar_fingerprint_value)
+
+if seastar_pcs is None:
+    seastar_pcs = {}
+    # A failed run must not leave the old fingerprint behind.
+    if os.path.exists(seastar_cache_file):
+        os.unlink(seastar_cache_file)
+    status = subprocess.call([python, './configure.py'] + seastar_flags, cwd = 'seastar')
+
+    if status != 0:
+        print('Seastar configuration failed')
+        sys.exit(1)
 
 
-pc = { mode : 'build/{}/seastar.pc'.format(mode) for mode in build_modes }
 ninja = find_executable('ninja') or find_executable('ninja-build')
 if not ninja:
     print('Ninja executable (ninja or ninja-build) not found on PATH\n')
     sys.exit(1)
-status = subprocess.call([ninja] + list(pc.values()), cwd = 'seastar')
-if status:
-    print('Failed to generate {}\n'.format(pc))
-    sys.exit(1)
+missing_pcs = sorted(set(modes[mode]['seastar_mode'] for mode in build_modes) - set(seastar_pcs))
+if missing_pcs:
+    pc = ['build/{}/seastar.pc'.format(m) for m in missing_pcs]
+    status = subprocess.call([ninja] + pc, cwd = 'seastar')
+    if status:
+        print('Failed to generate {}\n'.format(pc))
+        sys.exit(1)
+    for m in missing_pcs:
+        seastar_pcs[m] = dict([line.strip().split(': ', 1)
+                               for line in open('seastar/build/{}/seastar.pc'.format(m))
+                               if ': ' in line])
+    save_seastar_cache(seastar_fingerprint_value, seastar_pcs)
 
 for mode in build_modes:
-    cfg =  dict([line.strip().split(': ', 1)
-                 for line in open('seastar/' + pc[mode])
-                 if ': ' in line])
+    cfg = dict(seastar_pcs[modes[mode]['seastar_mode']])
     if args.staticcxx:
         cfg['Libs'] = cfg['Libs'].replace('-lstdc++ ', '')
     modes[mode]['seastar_cflags'] = cfg['Cflags']
@@ -404,6 +617,11 @@ libs = ' '.join([maybe_static(args.staticyamlcpp, '-lyaml-cpp'), '-llz4', '-lz',
                  maybe_static(args.staticboost, '-lboost_date_time'),
                 ])
 
+# tls_acceptor.cc wraps seastar's calls of these GnuTLS functions, to
+# enable session tickets and to measure handshakes, which seastar's TLS
+# API does not reach.
+libs += ' -Wl,--wrap=gnutls_init,--wrap=gnutls_handshake'
+
 if not args.staticboost:
     args.user_cflags += ' -DBOOST_TEST_DYN_LINK'
 
@@ -423,6 +641,40 @@ do_sanitize = True
 if args.static:
     do_sanitize = False
 
+def write_pgo_training(f, mode, modeval):
+    # The instrumented hero's objects leave their .gcda files next to them
+    # when it exits.  The training then copies them to where the objects
+    # built with -fprofile-use look for them, the same paths without
+    # "instrumented/".
+    srcs = [src for src in deps['hero'] if src.endswith('.cc')]
+    objs = ['$builddir/{}/instrumented/{}'.format(mode, src.replace('.cc', '.o')) for src in srcs]
+    gen_headers = ['seastar/build/{}/gen/http/request_parser.hh'.format(modeval['seastar_mode']),
+                   'seastar/build/{}/gen/http/http_response_parser.hh'.format(modeval['seastar_mode'])]
+    f.write(textwrap.dedent('''\
+        cxxflags_{mode}_instrumented = {opt_instrumented} -DXXH_PRIVATE_API -I. -I $builddir/{mode}/gen -I seastar -I seastar/build/{seastar_mode}/gen
+        rule cxx.{mode}.instrumented
+          command = $cxx -MD -MT $out -MF $out.d {seastar_cflags} $cxxflags $cxxflags_{mode}_instrumented $obj_cxxflags -c -o $out $in
+          description = CXX $out
+          depfile = $out.d
+        rule link.{mode}.instrumented
+          command = $cxx  $cxxflags_{mode}_instrumented $ldflags {seastar_libs} -o $out $in $libs
+          description = LINK $out
+          pool = link_pool
+        rule train.{mode}
+          command = find $builddir/{mode}/instrumented -name '*.gcda' -delete && {python} tests/perf/pgo_workload.py --hero $in && (cd $builddir/{mode}/instrumented && find . -name '*.gcda' -exec cp --parents {{}} .. ';') && touch $out
+          description = TRAIN $in
+          pool = console
+        ''').format(mode = mode, python = args.python, **modeval))
+    for src, obj in zip(srcs, objs):
+        f.write('build {}: cxx.{}.instrumented {} || {}\n'.format(obj, mode, src, ' '.join(gen_headers)))
+        if src in extra_cxxflags:
+            f.write('    cxxflags = {seastar_cflags} $cxxflags $cxxflags_{mode}_instrumented {extra_cxxflags}\n'.format(
+                mode = mode, extra_cxxflags = extra_cxxflags[src], **modeval))
+    f.write('build $builddir/{}/instrumented/hero: link.{}.instrumented {} seastar/build/{}/libseastar.a\n'.format(
+        mode, mode, ' '.join(objs), modeval['seastar_mode']))
+    f.write('build $builddir/{mode}/profile.stamp: train.{mode} $builddir/{mode}/instrumented/hero | tests/perf/pgo_workload.py\n'.format(
+        mode = mode))
+
 with open(buildfile, 'w') as f:
     f.write(textwrap.dedent('''\
         configure_args = {configure_args}
@@ -449,10 +701,11 @@ with open(buildfile, 'w') as f:
             command = cp $in $out
             description = COPY $out
         ''').format(**globals()))
+    seastar_built = set()
     for mode in build_modes:
         modeval = modes[mode]
         f.write(textwrap.dedent('''\
-            cxxflags_{mode} = {opt} -DXXH_PRIVATE_API -I. -I $builddir/{mode}/gen -I seastar -I seastar/build/{mode}/gen
+            cxxflags_{mode} = {opt} -DXXH_PRIVATE_API -I. -I $builddir/{mode}/gen -I seastar -I seastar/build/{seastar_mode}/gen
             rule cxx.{mode}
               command = $cxx -MD -MT $out -MF $out.d {seastar_cflags} $cxxflags $cxxflags_{mode} $obj_cxxflags -c -o $out $in
               description = CXX $out
@@ -492,14 +745,14 @@ with open(buildfile, 'w') as f:
                     # quickly re-link the test unstripped by adding a "_g"
                     # to the test name, e.g., "ninja build/release/testname_g"
                     f.write('build $builddir/{}/{}: {}.{} {} {}\n'.format(mode, binary, tests_link_rule, mode, str.join(' ', objs),
-                                                                                     'seastar/build/{}/libseastar.a'.format(mode)))
+                                                                                     'seastar/build/{}/libseastar.a'.format(modeval['seastar_mode'])))
                     f.write('   libs = {}\n'.format(local_libs))
                     f.write('build $builddir/{}/{}_g: link.{} {} {}\n'.format(mode, binary, mode, str.join(' ', objs),
-                                                                              'seastar/build/{}/libseastar.a'.format(mode)))
+                                                                              'seastar/build/{}/libseastar.a'.format(modeval['seastar_mode'])))
                     f.write('   libs = {}\n'.format(local_libs))
                 else:
                     f.write('build $builddir/{}/{}: link.{} {} {}\n'.format(mode, binary, mode, str.join(' ', objs),
-                                                                            'seastar/build/{}/libseastar.a'.format(mode)))
+                                                                            'seastar/build/{}/libseastar.a'.format(modeval['seastar_mode'])))
             for src in srcs:
                 if src.endswith('.cc'):
                     obj = '$builddir/' + mode + '/' + src.replace('.cc', '.o')
@@ -509,13 +762,25 @@ with open(buildfile, 'w') as f:
         for obj in compiles:
             src = compiles[obj]
             gen_headers = list()
-            gen_headers += ['seastar/build/{}/gen/http/request_parser.hh'.format(mode)]
-            gen_headers += ['seastar/build/{}/gen/http/http_response_parser.hh'.format(mode)]
-            f.write('build {}: cxx.{} {} || {} \n'.format(obj, mode, src, ' '.join(gen_headers)))
+            gen_headers += ['seastar/build/{}/gen/http/request_parser.hh'.format(modeval['seastar_mode'])]
+            gen_headers += ['seastar/build/{}/gen/http/http_response_parser.hh'.format(modeval['seastar_mode'])]
+            # Everything built with the profile is rebuilt when it changes.
+            profile = ' | $builddir/{}/profile.stamp'.format(mode) if mode == 'release-pgo' else ''
+            f.write('build {}: cxx.{} {}{} || {} \n'.format(obj, mode, src, profile, ' '.join(gen_headers)))
             if src in extra_cxxflags:
                 f.write('    cxxflags = {seastar_cflags} $cxxflags $cxxflags_{mode} {extra_cxxflags}\n'.format(mode = mode, extra_cxxflags = extra_cxxflags[src], **modeval))
-        f.write('  pool = seastar_pool\n')
-        f.write('  subdir = seastar\n')
+        if mode == 'release-pgo':
+            write_pgo_training(f, mode, modeval)
+        # Modes sharing a seastar build share its build statement.
+        if modeval['seastar_mode'] not in seastar_built:
+            seastar_built.add(modeval['seastar_mode'])
+            seastar_targets = ['build/{}/libseastar.a'.format(modeval['seastar_mode']),
+                               'build/{}/gen/http/request_parser.hh'.format(modeval['seastar_mode']),
+                               'build/{}/gen/http/http_response_parser.hh'.format(modeval['seastar_mode'])]
+            f.write('build {}: ninja {}\n'.format(' '.join('seastar/' + t for t in seastar_targets), seastar_deps))
+            f.write('  pool = seastar_pool\n')
+            f.write('  subdir = seastar\n')
+            f.write('  target = {}\n'.format(' '.join(seastar_targets)))
     f.write('build {}: phony\n'.format(seastar_deps))
     f.write(textwrap.dedent('''\
         rule configure
@@ -531,4 +796,4 @@ with open(buildfile, 'w') as f:
             description = CLEAN
         build clean: clean
         default {modes_list}
-        ''').format(modes_list = ' '.join(build_modes), **globals()))
+        ''').format(modes_list = ' '.join(default_modes if args.mode == 'all' else build_modes), **globals()))
@@ -0,0 +1,554 @@
+/*
+ * This file is open source software, licensed to you under the terms
+ * of the Apache License, Version 2.0 (the "License").  See the NOTICE file
+ * distributed with this work for additional information regarding copyright
+ * ownership.  You may not use this file except in compliance with the License.
+ *
+ * You may obtain a copy of the License at
+ *
+ *   http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing,
+ * software distributed under the License is distributed on an
+ * "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+ * KIND, either express or implied.  See the License for the
+ * specific language governing permissions and limitations
+ * under the License.
+ */
+
+#include "connection.hh"
+#include "server.hh"
+#include "core/future-util.hh"
+#include "core/print.hh"
+#include "core/reactor.hh"
+#include "util/log.hh"
+#include "mqtt/encoder.hh"
+
+#include <limits>
+
+namespace hero {
+
+static logger clog("connection");
+
+static thread_local uint64_t next_client_id;
+
+// Topic aliases a v5 publisher may set.
+static constexpr uint16_t topic_alias_maximum = 256;
+
+// How long a new connection has to send CONNECT.
+static constexpr auto connect_timeout = std::chrono::seconds(10);
+
+// Seconds before an unacknowledged QoS 1/2 message is resent to a 3.1.1
+// client that stays connected.
+static constexpr uint32_t retransmit_interval = 20;
+
+connection::connection(server& s, uint64_t id, connected_socket&& socket, socket_address addr,
+        std::optional<tls_handshake> handshake)
+    : _server(s)
+    , _id(id)
+    , _socket(std::move(socket))
+    , _addr(addr)
+    , _in(_socket.input())
+    , _out(_socket.output())
+    , _output(_out, s.get_output_policy(), s.get_output_stats(), s.admission())
+    , _publish_encoder(s.get_output_stats(), s.get_output_policy().topic_cache_size)
+    , _decoder(s.admission().config().max_connect_packet_size)
+    , _keepalive([this] { keepalive_expired(); })
+    , _keepalive_interval(connect_timeout)
+    , _handshake(std::move(handshake))
+    , _handshake_deadline([this] { handshake_expired(); })
+{
+}
+
+void connection::keepalive_expired() {
+    clog.debug("{}: keep alive expired", _addr);
+    fail(mqtt::reason_code::keep_alive_timeout);
+    _socket.shutdown_input();
+}
+
+void connection::handshake_expired() {
+    // A client still handshaking holds a handshake slot, which it must not
+    // keep until the CONNECT timeout.
+    if (_handshake && _handshake->expire()) {
+        clog.debug("{}: TLS handshake timed out", _addr);
+        shutdown();
+    }
+}
+
+connection_location connection::location() const {
+    return connection_location{engine().cpu_id(), _id};
+}
+
+bool connection::done() {
+    return _closing || _in.eof();
+}
+
+void connection::shutdown() {
+    _closing = true;
+    _socket.shutdown_input();
+}
+
+void connection::disconnect(mqtt::reason_code code) {
+    if (_closing) {
+        return;
+    }
+    // The session is someone else's now.
+    _session = {};
+    fail(code).finally([self = shared_from_this()] {
+        self->_socket.shutdown_input();
+    });
+}
+
+future<> connection::run() {
+    _server.timers().arm(_keepalive, _keepalive_interval);
+    if (_handshake) {
+        _server.timers().arm(_handshake_deadline, _handshake->timeout());
+    }
+    return do_until([this] { return done(); }, [this] {
+        return process();
+    }).handle_exception([this] (std::exception_ptr ep) {
+        clog.debug("{}: connection closed: {}", _addr, ep);
+    }).finally([this] {
+        _partial_units = {};
+        _keepalive.cancel();
+        _handshake_deadline.cancel();
+        _handshake.reset();
+        if (!_session) {
+            return make_ready_future<>();
+        }
+        return _server.container().invoke_on(_session_owner, [id = *_session, loc = location()] (server& s) {
+            s.detach(id, loc);
+        });
+    }).finally([this] {
+        _closed = true;
+        _early.clear();
+        return _output.close().then([this] {
+            return _out.close();
+        });
+    });
+}
+
+future<> connection::process() {
+    // A client that does not read what we send stops being read from, so
+    // its requests cannot queue replies without bound.
+    return _output.wait_for_space().then([this] {
+        return _in.read();
+    }).then([this] (temporary_buffer<char> data) {
+        if (data.empty()) {
+            return _in.close();
+        }
+        if (_handshake) {
+            _handshake_deadline.cancel();
+            _handshake.reset();
+        }
+        _server.get_protocol_stats().bytes_received += data.size();
+        if (_version && _keepalive.armed()) {
+            _server.timers().arm(_keepalive, _keepalive_interval);
+        }
+        // The buffer is accounted until its packets are handled, and the
+        // connection reads nothing more until the shard can take it.
+        return _server.admission().receive(data.size()).then([this, data = std::move(data)] (semaphore_units<> units) mutable {
+            _decoder.feed(std::move(data), _packets);
+            return do_for_each(_packets, [this] (mqtt::packet& p) {
+                return _closing ? make_ready_future<>() : handle(std::move(p));
+            }).then([this] {
+                _packets.clear();
+            }).finally([units = std::move(units)] {});
+        }).then([this] {
+            return hold_partial();
+        });
+    }).then_wrapped([this] (future<> f) {
+        try {
+            f.get();
+        } catch (mqtt::protocol_error& e) {
+            clog.debug("{}: protocol error: {}", _addr, e.what());
+            _packets.clear();
+            return fail(e.code());
+        }
+        return make_ready_future<>();
+    });
+}
+
+// A packet split across reads outlives the read units of its bytes, so
+// the bytes buffered for it are accounted separately, and the connection
+// reads on only once the shard can take them.
+future<> connection::hold_partial() {
+    auto size = _decoder.buffered();
+    if (size == _partial_bytes) {
+        return make_ready_future<>();
+    }
+    _partial_units = {};
+    _partial_bytes = size;
+    if (!size) {
+        return make_ready_future<>();
+    }
+    return _server.admission().receive(size).then([this] (semaphore_units<> units) {
+        _partial_units = std::move(units);
+    });
+}
+
+// Packets are queued in order and written by the output queue, so the
+// returned future does not wait for the write.
+future<> connection::send(temporary_buffer<char> buf) {
+    return send(net::packet(std::move(buf)));
+}
+
+future<> connection::send(net::packet p) {
+    if (!_closed) {
+        _server.get_protocol_stats().packets_sent[type_of(p)]++;
+        _output.push(std::move(p));
+    }
+    return make_ready_future<>();
+}
+
+bool connection::send_droppable(net::packet p) {
+    if (_closed) {
+        return false;
+    }
+    auto type = type_of(p);
+    if (!_output.push_droppable(std::move(p))) {
+        return false;
+    }
+    _server.get_protocol_stats().packets_sent[type]++;
+    return true;
+}
+
+// Every packet starts in its first fragment, whose first byte holds the
+// type.
+unsigned connection::type_of(const net::packet& p) {
+    return uint8_t(p.frag(0).base[0]) >> 4;
+}
+
+// Tells the client why it is being dropped, where the protocol allows it,
+// and stops reading.
+future<> connection::fail(mqtt::reason_code code) {
+    _closing = true;
+    if (!_version) {
+        if (code == mqtt::reason_code::unsupported_protocol_version) {
+            return send(mqtt::encode_connack(mqtt::protocol_version::v311, false, code));
+        }
+        return make_ready_future<>();
+    }
+    if (version() == mqtt::protocol_version::v5) {
+        return send(mqtt::encode_disconnect(version(), code));
+    }
+    return make_ready_future<>();
+}
+
+future<> connection::handle(mqtt::packet&& p) {
+    auto type = p.header.type;
+    _server.get_protocol_stats().packets_received[unsigned(type)]++;
+    if (!_version && type != mqtt::packet_type::connect) {
+        throw mqtt::protocol_error(mqtt::reason_code::protocol_error, "first packet must be CONNECT");
+    }
+    switch (type) {
+    case mqtt::packet_type::connect:
+        return handle_connect(mqtt::parse_connect(std::move(p)));
+    case mqtt::packet_type::publish:
+        return handle_publish(mqtt::parse_publish(std::move(p), version()));
+    case mqtt::packet_type::puback:
+    case mqtt::packet_type::pubcomp: {
+        auto ack = mqtt::parse_ack(std::move(p), version());
+        forward_ack(type, ack.packet_id);
+        return make_ready_future<>();
+    }
+    case mqtt::packet_type::pubrec: {
+        auto ack = mqtt::parse_ack(std::move(p), version());
+        forward_ack(type, ack.packet_id);
+        if (ack.code >= mqtt::reason_code::unspecified_error) {
+            // The receiver refused the message; the flow ends here.
+            forward_ack(mqtt::packet_type::pubcomp, ack.packet_id);
+            return make_ready_future<>();
+        }
+        return send(mqtt::encode_ack(version(), mqtt::packet_type::pubrel, ack.packet_id));
+    }
+    case mqtt::packet_type::pubrel:
+        return handle_pubrel(mqtt::parse_ack(std::move(p), version()));
+    case mqtt::packet_type::subscribe:
+        return handle_subscribe(mqtt::parse_subscribe(std::move(p), version()));
+    case mqtt::packet_type::unsubscribe:
+        return handle_unsubscribe(mqtt::parse_unsubscribe(std::move(p), version()));
+    case mqtt::packet_type::pingreq:
+        return send(mqtt::encode_pingresp());
+    case mqtt::packet_type::disconnect:
+        mqtt::parse_disconnect(std::move(p), version());
+        _closing = true;
+        return make_ready_future<>();
+    default:
+        throw mqtt::protocol_error(mqtt::reason_code::protocol_error, "unexpected packet type");
+    }
+}
+
+future<> connection::handle_connect(mqtt::connect&& c) {
+    if (_version) {
+        throw mqtt::protocol_error(mqtt::reason_code::protocol_error, "second CONNECT");
+    }
+    _version = c.version;
+    // Only so many CONNECTs proceed at once; the rest wait here, unread,
+    // and are turned away if the shard is overloaded when their turn
+    // comes.
+    auto& admission = _server.admission();
+    return admission.start_connect().then([this, &admission, c = std::move(c)] (semaphore_units<> units) mutable {
+        if (_closing) {
+            return make_ready_future<>();
+        }
+        if (admission.reject_connect()) {
+            _closing = true;
+            return send(mqtt::encode_connack(version(), false, mqtt::reason_code::server_busy));
+        }
+        return accept_connect(std::move(c)).finally([units = std::move(units)] {});
+    });
+}
+
+future<> connection::accept_connect(mqtt::connect&& c) {
+    mqtt::properties props;
+    if (c.client_id.empty()) {
+        if (c.version == mqtt::protocol_version::v311 && !c.clean_start) {
+            _closing = true;
+            return send(mqtt::encode_connack(version(), false, mqtt::reason_code::client_identifier_not_valid));
+        }
+        _client_id = sprint("hero-%d-%d", engine().cpu_id(), next_client_id++);
+        if (c.version == mqtt::protocol_version::v5) {
+            props.assigned_client_identifier = temporary_buffer<char>(_client_id.c_str(), _client_id.size());
+        }
+    } else {
+        _client_id = sstring(c.client_id.get(), c.client_id.size());
+    }
+    // MQTT 5 makes either 0 a protocol error; a receive maximum of 0 would
+    // leave every QoS 1/2 delivery queued for good.
+    if (c.properties.maximum_packet_size == 0u || c.properties.receive_maximum == 0u) {
+        _closing = true;
+        return send(mqtt::encode_connack(version(), false, mqtt::reason_code::protocol_error));
+    }
+    auto max_packet_size = _server.admission().config().max_packet_size;
+    session_config config;
+    config.clean_start = c.clean_start;
+    if (c.version == mqtt::protocol_version::v5) {
+        config.expiry_interval = c.properties.session_expiry_interval.value_or(0);
+        config.receive_maximum = c.properties.receive_maximum.value_or(65535);
+        props.topic_alias_maximum = topic_alias_maximum;
+        props.maximum_packet_size = max_packet_size;
+        _topic_aliases.resize(topic_alias_maximum + 1);
+        if (c.properties.maximum_packet_size) {
+            _client_max_packet_size = *c.properties.maximum_packet_size;
+        }
+    } else {
+        // A 3.1.1 session without clean session lasts until the next clean
+        // one.
+        config.expiry_interval = c.clean_start ? 0 : std::numeric_limits<uint32_t>::max();
+        config.retransmit_interval = retransmit_interval;
+    }
+    _publish_encoder.start(c.version, c.properties.topic_alias_maximum.value_or(0));
+    if (c.keep_alive) {
+        _keepalive_interval = std::chrono::milliseconds(c.keep_alive * 1500);
+        _server.timers().arm(_keepalive, _keepalive_interval);
+    } else {
+        _keepalive.cancel();
+    }
+    _session_owner = session_owner(std::string_view(_client_id.c_str(), _client_id.size()));
+    return _server.container().invoke_on(_session_owner, [client_id = _client_id, config, loc = location()] (server& s) {
+        return s.attach(client_id, config, loc);
+    }).then([this, props = std::move(props)] (attach_result r) mutable {
+        _session = r.session;
+        return send(mqtt::encode_connack(version(), r.session_present, mqtt::reason_code::success, props));
+    }).then([this, max_packet_size] {
+        _connack_sent = true;
+        _decoder.set_max_packet_size(max_packet_size);
+        auto early = std::move(_early);
+        return do_with(std::move(early), [this] (auto& early) {
+            return do_for_each(early, [this] (auto& e) {
+                return write_delivery(*e.first, e.second);
+            });
+        });
+    });
+}
+
+void connection::forward_ack(mqtt::packet_type type, uint16_t packet_id) {
+    if (!_session) {
+        return;
+    }
+    _server.on_owner(_session_owner, [id = *_session, type, packet_id] (server& s) {
+        s.acknowledge(id, type, packet_id);
+    });
+}
+
+future<> connection::handle_publish(mqtt::publish&& pub) {
+    if (pub.properties.topic_alias) {
+        auto alias = *pub.properties.topic_alias;
+        if (alias == 0 || alias >= _topic_aliases.size()) {
+            throw mqtt::protocol_error(mqtt::reason_code::topic_alias_invalid, "topic alias out of range");
+        }
+        auto& topic = _topic_aliases[alias];
+        if (pub.topic.empty()) {
+            if (topic.empty()) {
+                throw mqtt::protocol_error(mqtt::reason_code::protocol_error, "topic alias not set");
+            }
+            pub.topic = topic.share();
+        } else {
+            // A copy, so that the alias does not keep the whole read
+            // buffer the topic arrived in.
+            topic = temporary_buffer<char>(pub.topic.get(), pub.topic.size());
+        }
+    } else if (pub.topic.empty()) {
+        throw mqtt::protocol_error(mqtt::reason_code::protocol_error, "empty topic without a topic alias");
+    }
+    auto qos = pub.qos;
+    auto packet_id = pub.packet_id;
+    if (qos == mqtt::qos::exactly_once && _session) {
+        // The packet id is remembered on the owner until PUBREL, so a
+        // retransmitted PUBLISH is acknowledged without being routed twice.
+        return _server.container().invoke_on(_session_owner, [id = *_session, packet_id] (server& s) {
+            return s.receive_qos2(id, packet_id);
+        }).then([this, pub = std::move(pub), packet_id] (bool first) mutable {
+            auto routed = first ? _server.publish(_id, std::move(pub)) : make_ready_future<>();
+            return routed.then([this, packet_id] {
+                return send(mqtt::encode_ack(version(), mqtt::packet_type::pubrec, packet_id));
+            });
+        });
+    }
+    return _server.publish(_id, std::move(pub)).then([this, qos, packet_id] {
+        switch (qos) {
+        case mqtt::qos::at_most_once:
+            return make_ready_future<>();
+        case mqtt::qos::at_least_once:
+            return send(mqtt::encode_ack(version(), mqtt::packet_type::puback, packet_id));
+        case mqtt::qos::exactly_once:
+            return send(mqtt::encode_ack(version(), mqtt::packet_type::pubrec, packet_id));
+        }
+        return make_ready_future<>();
+    });
+}
+
+future<> connection::handle_pubrel(mqtt::ack&& ack) {
+    auto packet_id = ack.packet_id;
+    if (!_session) {
+        return send(mqtt::encode_ack(version(), mqtt::packet_type::pubcomp, packet_id));
+    }
+    return _server.container().invoke_on(_session_owner, [id = *_session, packet_id] (server& s) {
+        s.release_qos2(id, packet_id);
+    }).then([this, packet_id] {
+        return send(mqtt::encode_ack(version(), mqtt::packet_type::pubcomp, packet_id));
+    });
+}
+
+future<> connection::handle_subscribe(mqtt::subscribe&& sub) {
+    // Invalid filters are answered here; the rest go to the owner in one
+    // request, and their codes are slotted back in order.
+    std::vector<mqtt::reason_code> codes;
+    std::vector<size_t> forwarded;
+    std::vector<std::pair<sstring, subscription_options>> filters;
+    for (auto& s : sub.subscriptions) {
+        auto filter = mqtt::as_string_view(s.topic_filter);
+        if (!mqtt::valid_topic_filter(filter)) {
+            codes.push_back(mqtt::reason_code::topic_filter_invalid);
+            continue;
+        }
+        if (is_shared_filter(filter)) {
+            if (!parse_shared_filter(filter)) {
+                codes.push_back(mqtt::reason_code::topic_filter_invalid);
+                continue;
+            }
+            if (s.no_local) {
+                throw mqtt::protocol_error(mqtt::reason_code::protocol_error, "no local shared subscription");
+            }
+        }
+        subscription_options options;
+        options.max_qos = s.max_qos;
+        options.no_local = s.no_local;
+        options.retain_as_published = s.retain_as_published;
+        options.retain_handling = s.retain_handling;
+        if (!sub.properties.subscription_identifiers.empty()) {
+            options.subscription_identifier = sub.properties.subscription_identifiers.front();
+        }
+        forwarded.push_back(codes.size());
+        codes.push_back(mqtt::reason_code::success);
+        filters.emplace_back(sstring(filter.data(), filter.size()), options);
+    }
+    auto packet_id = sub.packet_id;
+    if (filters.empty()) {
+        return send(mqtt::encode_suback(version(), packet_id, codes));
+    }
+    // The session was taken over, and the connection is closing.
+    if (!_session) {
+        return make_ready_future<>();
+    }
+    // The session may be taken over while the owner subscribes.
+    auto id = *_session;
+    return _server.container().invoke_on(_session_owner, [id, filters = std::move(filters)] (server& s) mutable {
+        return s.subscribe(id, std::move(filters));
+    }).then([this, id, packet_id, codes = std::move(codes), forwarded = std::move(forwarded)] (subscribe_result r) mutable {
+        for (size_t i = 0; i < forwarded.size(); i++) {
+            codes[forwarded[i]] = r.codes[i];
+        }
+        auto sent = send(mqtt::encode_suback(version(), packet_id, codes));
+        // Queued behind the SUBACK, which the client must see first.
+        if (!r.retained.empty() && _session && !_closing) {
+            _server.on_owner(_session_owner, [id, retained = std::move(r.retained)] (server& s) mutable {
+                return s.send_retained(id, std::move(retained));
+            });
+        }
+        return sent;
+    });
+}
+
+future<> connection::handle_unsubscribe(mqtt::unsubscribe&& unsub) {
+    std::vector<sstring> filters;
+    for (auto& f : unsub.topic_filters) {
+        filters.emplace_back(f.get(), f.size());
+    }
+    auto packet_id = unsub.packet_id;
+    if (!_session) {
+        return make_ready_future<>();
+    }
+    return _server.container().invoke_on(_session_owner, [id = *_session, filters = std::move(filters)] (server& s) mutable {
+        return s.unsubscribe(id, std::move(filters));
+    }).then([this, packet_id] (std::vector<mqtt::reason_code> codes) {
+        return send(mqtt::encode_unsuback(version(), packet_id, codes));
+    });
+}
+
+future<> connection::deliver(const lw_shared_ptr<message>& msg, const delivery& d) {
+    if (!_version || _closing) {
+        return make_ready_future<>();
+    }
+    if (!_connack_sent) {
+        _early.emplace_back(msg, d);
+        return make_ready_future<>();
+    }
+    return write_delivery(*msg, d).finally([msg] {});
+}
+
+future<> connection::write_delivery(message& msg, const delivery& d) {
+    if (d.kind == delivery::kind::pubrel) {
+        return send(mqtt::encode_ack(version(), mqtt::packet_type::pubrel, d.packet_id));
+    }
+    if (msg.received != std::chrono::steady_clock::time_point()) {
+        _server.delivery_latency().record_since(msg.received);
+    }
+    auto encoded = _publish_encoder.encode(msg, d);
+    if (encoded.packet.len() > _client_max_packet_size) {
+        // Too large for the client: dropped as if it had been sent, and,
+        // past QoS 0, as if it had been acknowledged.
+        _server.get_output_stats().oversized_dropped++;
+        if (encoded.sets_alias) {
+            _publish_encoder.dropped(msg.topic_view());
+        }
+        if (d.qos == mqtt::qos::at_least_once) {
+            forward_ack(mqtt::packet_type::puback, d.packet_id);
+        } else if (d.qos == mqtt::qos::exactly_once) {
+            forward_ack(mqtt::packet_type::pubrec, d.packet_id);
+            forward_ack(mqtt::packet_type::pubcomp, d.packet_id);
+        }
+        return make_ready_future<>();
+    }
+    if (d.qos == mqtt::qos::at_most_once) {
+        // Slow subscribers lose QoS 0 messages rather than hold them.
+        if (!send_droppable(std::move(encoded.packet)) && encoded.sets_alias) {
+            _publish_encoder.dropped(msg.topic_view());
+        }
+        return make_ready_future<>();
+    }
+    return send(std::move(encoded.packet));
+}
+
+} /* namespace hero */
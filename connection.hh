@@ -0,0 +1,132 @@
+/*
+ * This file is open source software, licensed to you under the terms
+ * of the Apache License, Version 2.0 (the "License").  See the NOTICE file
+ * distributed with this work for additional information regarding copyright
+ * ownership.  You may not use this file except in compliance with the License.
+ *
+ * You may obtain a copy of the License at
+ *
+ *   http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing,
+ * software distributed under the License is distributed on an
+ * "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+ * KIND, either express or implied.  See the License for the
+ * specific language governing permissions and limitations
+ * under the License.
+ */
+
+#pragma once
+
+#include "core/iostream.hh"
+#include "core/shared_ptr.hh"
+#include "core/sstring.hh"
+#include "net/api.hh"
+#include "mqtt/decoder.hh"
+#include "message.hh"
+#include "output_queue.hh"
+#include "publish_encoder.hh"
+#include "session.hh"
+#include "subscription_index.hh"
+#include "timer_wheel.hh"
+#include "tls_acceptor.hh"
+
+#include <optional>
+#include <utility>
+#include <vector>
+
+namespace hero {
+
+using namespace seastar;
+using namespace net;
+
+class server;
+
+// One MQTT client connection on this shard.  Its session lives on the
+// owner shard of the client identifier; the connection forwards session
+// operations there and writes out whatever the session sends back.
+class connection : public enable_lw_shared_from_this<connection> {
+    server& _server;
+    uint64_t _id;
+    connected_socket _socket;
+    socket_address _addr;
+    input_stream<char> _in;
+    output_stream<char> _out;
+    // Replies and deliveries are queued here and written in batches.
+    output_queue _output;
+    publish_encoder _publish_encoder;
+    // The topics a v5 publisher set for its topic aliases, indexed by
+    // alias; empty for an alias it has not set.
+    std::vector<temporary_buffer<char>> _topic_aliases;
+    mqtt::decoder _decoder;
+    std::vector<mqtt::packet> _packets;
+    // Inbound budget held for what the decoder buffers of a partly
+    // received packet.
+    std::optional<semaphore_units<>> _partial_units;
+    size_t _partial_bytes = 0;
+    // The largest packet the client takes; larger PUBLISHes are dropped.
+    uint32_t _client_max_packet_size = mqtt::max_remaining_length + mqtt::max_fixed_header_size;
+    // Set once CONNECT has been accepted.
+    std::optional<mqtt::protocol_version> _version;
+    // Until CONNECT, the time allowed to send it; then one and a half
+    // times the client's keep alive.
+    wheel_timer _keepalive;
+    timer_wheel::duration _keepalive_interval;
+    sstring _client_id;
+    unsigned _session_owner = 0;
+    std::optional<subscriber_id> _session;
+    // Deliveries the session sent before CONNACK went out, which must
+    // precede them on the wire.
+    bool _connack_sent = false;
+    std::vector<std::pair<lw_shared_ptr<message>, delivery>> _early;
+    bool _closing = false;
+    bool _closed = false;
+    // Set on a TLS connection until its first bytes are decrypted.
+    std::optional<tls_handshake> _handshake;
+    wheel_timer _handshake_deadline;
+public:
+    connection(server& s, uint64_t id, connected_socket&& socket, socket_address addr,
+            std::optional<tls_handshake> handshake = {});
+
+    uint64_t id() const { return _id; }
+    const socket_address& address() const { return _addr; }
+    connection_location location() const;
+
+    // Reads and handles packets until the client goes away or breaks the
+    // protocol, then closes the connection.
+    future<> run();
+
+    // Stops reading; run() then winds down.
+    void shutdown();
+
+    // Sends what the session decided to deliver: a PUBLISH, or a PUBREL
+    // for a QoS 2 message being resent after a reconnect.
+    future<> deliver(const lw_shared_ptr<message>& msg, const delivery& d);
+
+    // Drops the connection, telling a v5 client why.
+    void disconnect(mqtt::reason_code code);
+private:
+    bool done();
+    future<> process();
+    future<> hold_partial();
+    future<> fail(mqtt::reason_code code);
+    future<> send(temporary_buffer<char> buf);
+    future<> send(net::packet p);
+    bool send_droppable(net::packet p);
+    static unsigned type_of(const net::packet& p);
+    mqtt::protocol_version version() const { return *_version; }
+    void keepalive_expired();
+    void handshake_expired();
+    future<> write_delivery(message& msg, const delivery& d);
+    void forward_ack(mqtt::packet_type type, uint16_t packet_id);
+
+    future<> handle(mqtt::packet&& p);
+    future<> handle_connect(mqtt::connect&& c);
+    future<> accept_connect(mqtt::connect&& c);
+    future<> handle_publish(mqtt::publish&& pub);
+    future<> handle_pubrel(mqtt::ack&& ack);
+    future<> handle_subscribe(mqtt::subscribe&& sub);
+    future<> handle_unsubscribe(mqtt::unsubscribe&& unsub);
+};
+
+} /* namespace hero */
@@ -0,0 +1,164 @@
+/*
+ * This file is open source software, licensed to you under the terms
+ * of the Apache License, Version 2.0 (the "License").  See the NOTICE file
+ * distributed with this work for additional information regarding copyright
+ * ownership.  You may not use this file except in compliance with the License.
+ *
+ * You may obtain a copy of the License at
+ *
+ *   http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing,
+ * software distributed under the License is distributed on an
+ * "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+ * KIND, either express or implied.  See the License for the
+ * specific language governing permissions and limitations
+ * under the License.
+ */
+
+#include "fanout.hh"
+#include "core/bitops.hh"
+#include "core/future-util.hh"
+#include "core/metrics.hh"
+#include "core/reactor.hh"
+#include "util/log.hh"
+
+namespace hero {
+
+static logger flog("fanout");
+
+static constexpr size_t batch_size_buckets = 16;
+
+fanout::fanout(sender send, size_t max_batch)
+    : _send(std::move(send))
+    , _max_batch(max_batch)
+    , _destinations(smp::count)
+{
+    _stats.batch_sizes.resize(batch_size_buckets);
+    setup_metrics();
+}
+
+void fanout::setup_metrics() {
+    namespace sm = seastar::metrics;
+    _metrics.add_group("hero_fanout", {
+        sm::make_derive("messages_queued", _stats.messages_queued,
+                sm::description("Messages queued for delivery on another shard")),
+        sm::make_derive("batches_sent", _stats.batches_sent,
+                sm::description("Batches sent to other shards")),
+        sm::make_derive("messages_sent", _stats.messages_sent,
+                sm::description("Messages sent to other shards")),
+        sm::make_derive("threshold_flushes", _stats.threshold_flushes,
+                sm::description("Batches sent early because they reached the size limit")),
+        sm::make_derive("batches_received", _stats.batches_received,
+                sm::description("Batches received from other shards")),
+        sm::make_derive("messages_received", _stats.messages_received,
+                sm::description("Messages received from other shards")),
+        sm::make_gauge("queue_depth", [this] { return _queued; },
+                sm::description("Messages waiting to be sent to other shards")),
+        sm::make_gauge("batches_in_flight", [this] {
+            unsigned n = 0;
+            for (auto& d : _destinations) {
+                n += d.in_flight;
+            }
+            return n;
+        }, sm::description("Batches sent but not yet taken by their destination")),
+        sm::make_histogram("batch_size", [this] {
+            sm::histogram h;
+            uint64_t count = 0;
+            for (size_t i = 0; i < batch_size_buckets; ++i) {
+                count += _stats.batch_sizes[i];
+                h.buckets.push_back(sm::histogram_bucket{count, double(uint64_t(1) << i)});
+            }
+            h.sample_count = _stats.batches_sent;
+            h.sample_sum = _stats.messages_sent;
+            return h;
+        }, sm::description("Messages per batch sent to other shards")),
+    });
+}
+
+void fanout::enqueue(unsigned shard, const lw_shared_ptr<message>& msg) {
+    push(shard, msg, no_connection, delivery(), false);
+}
+
+void fanout::enqueue(unsigned shard, uint64_t connection, const lw_shared_ptr<message>& msg, const delivery& d) {
+    push(shard, msg, connection, d, false);
+}
+
+void fanout::enqueue_shared(unsigned shard, uint64_t session, const lw_shared_ptr<message>& msg, const delivery& d) {
+    push(shard, msg, session, d, true);
+}
+
+void fanout::push(unsigned shard, const lw_shared_ptr<message>& msg, uint64_t connection, const delivery& dl,
+        bool to_session) {
+    auto& d = _destinations[shard];
+    // The batch's pointer keeps msg alive, so its address is not reused
+    // while it is a key.
+    auto index = d.indexes.emplace(msg.get(), d.pending.messages.size());
+    if (index.second) {
+        d.pending.messages.push_back(make_foreign(msg));
+    }
+    d.pending.items.push_back(item{index.first->second, connection, dl, to_session});
+    _queued++;
+    _stats.messages_queued++;
+    if (d.pending.items.size() >= _max_batch) {
+        _stats.threshold_flushes++;
+        send(shard);
+    } else {
+        schedule_flush();
+    }
+}
+
+void fanout::schedule_flush() {
+    if (_flush_scheduled) {
+        return;
+    }
+    _flush_scheduled = true;
+    // later() runs after the tasks already queued, so everything published
+    // during this poll cycle ends up in the same batch.
+    with_gate(_gate, [this] {
+        return later().then([this] {
+            _flush_scheduled = false;
+            flush();
+        });
+    });
+}
+
+void fanout::flush() {
+    for (unsigned shard = 0; shard < _destinations.size(); ++shard) {
+        if (!_destinations[shard].pending.items.empty()) {
+            send(shard);
+        }
+    }
+}
+
+void fanout::send(unsigned shard) {
+    auto& d = _destinations[shard];
+    batch b = std::move(d.pending);
+    d.pending = batch();
+    d.indexes.clear();
+    auto size = b.items.size();
+    _queued -= size;
+    _stats.batches_sent++;
+    _stats.messages_sent += size;
+    auto bucket = std::min<size_t>(log2ceil(size), batch_size_buckets - 1);
+    _stats.batch_sizes[bucket]++;
+    d.in_flight++;
+    with_gate(_gate, [this, shard, b = std::move(b)] () mutable {
+        return _send(shard, std::move(b)).then_wrapped([this, shard] (future<batch> f) {
+            _destinations[shard].in_flight--;
+            try {
+                // Frees the returned batch.
+                f.get();
+            } catch (...) {
+                flog.warn("delivery to shard {} failed: {}", shard, std::current_exception());
+            }
+        });
+    });
+}
+
+future<> fanout::stop() {
+    flush();
+    return _gate.close();
+}
+
+} /* namespace hero */
@@ -0,0 +1,126 @@
+/*
+ * This file is open source software, licensed to you under the terms
+ * of the Apache License, Version 2.0 (the "License").  See the NOTICE file
+ * distributed with this work for additional information regarding copyright
+ * ownership.  You may not use this file except in compliance with the License.
+ *
+ * You may obtain a copy of the License at
+ *
+ *   http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing,
+ * software distributed under the License is distributed on an
+ * "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+ * KIND, either express or implied.  See the License for the
+ * specific language governing permissions and limitations
+ * under the License.
+ */
+
+#pragma once
+
+#include "core/future.hh"
+#include "core/gate.hh"
+#include "core/metrics_registration.hh"
+#include "core/sharded.hh"
+#include "message.hh"
+
+#include <functional>
+#include <unordered_map>
+#include <vector>
+
+namespace hero {
+
+using namespace seastar;
+
+// Groups messages bound for other shards so that each destination receives
+// one smp message per poll cycle, or per max_batch messages, rather than
+// one per delivery.
+class fanout {
+public:
+    // Marks an item that is matched against the destination's
+    // subscriptions rather than addressed to one of its connections.
+    static constexpr uint64_t no_connection = uint64_t(-1);
+
+    struct item {
+        // The message's index in the batch's messages.
+        uint32_t msg;
+        uint64_t connection;
+        hero::delivery delivery;
+        // Set for a shared subscription's message, which goes to the
+        // session whose id is in connection, on its owner shard.
+        bool to_session = false;
+    };
+    // A message for several subscribers on the destination travels in a
+    // batch once, so only one pointer to it is ever released back to this
+    // shard.
+    struct batch {
+        std::vector<foreign_ptr<lw_shared_ptr<message>>> messages;
+        std::vector<item> items;
+    };
+    // Ships a batch to a shard; the future resolves once the destination
+    // has taken it, with the batch and whatever pointers the destination
+    // left in it, so they are freed here rather than one by one from the
+    // destination.
+    using sender = std::function<future<batch> (unsigned shard, batch&&)>;
+
+    struct stats {
+        uint64_t messages_queued = 0;
+        uint64_t batches_sent = 0;
+        uint64_t messages_sent = 0;
+        uint64_t threshold_flushes = 0;
+        uint64_t batches_received = 0;
+        uint64_t messages_received = 0;
+        // batch_sizes[i] counts batches of at most 2^i messages.
+        std::vector<uint64_t> batch_sizes;
+    };
+private:
+    struct destination {
+        batch pending;
+        // The index of each message in pending.
+        std::unordered_map<const message*, uint32_t> indexes;
+        unsigned in_flight = 0;
+    };
+    sender _send;
+    size_t _max_batch;
+    std::vector<destination> _destinations;
+    size_t _queued = 0;
+    bool _flush_scheduled = false;
+    gate _gate;
+    stats _stats;
+    metrics::metric_groups _metrics;
+public:
+    fanout(sender send, size_t max_batch = 256);
+
+    // Queues msg for the subscribers on shard.  Must not be called for the
+    // local shard.
+    void enqueue(unsigned shard, const lw_shared_ptr<message>& msg);
+    // Queues msg for one connection on shard, as a session decided to
+    // deliver it.
+    void enqueue(unsigned shard, uint64_t connection, const lw_shared_ptr<message>& msg, const delivery& d);
+    // Queues msg for a session owned by shard, picked from a shared
+    // subscription group; d carries the subscription's options.
+    void enqueue_shared(unsigned shard, uint64_t session, const lw_shared_ptr<message>& msg, const delivery& d);
+
+    // Sends every pending batch now.
+    void flush();
+
+    // Accounts for a batch arriving from another shard.
+    void received(size_t messages) {
+        _stats.batches_received++;
+        _stats.messages_received += messages;
+    }
+
+    // Waits for batches in flight.  Nothing may be queued afterwards.
+    future<> stop();
+
+    size_t queued() const { return _queued; }
+    const stats& get_stats() const { return _stats; }
+private:
+    void push(unsigned shard, const lw_shared_ptr<message>& msg, uint64_t connection, const delivery& d,
+            bool to_session);
+    void send(unsigned shard);
+    void schedule_flush();
+    void setup_metrics();
+};
+
+} /* namespace hero */
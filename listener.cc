@@ -0,0 +1,170 @@
+/*
+ * This file is open source software, licensed to you under the terms
+ * of the Apache License, Version 2.0 (the "License").  See the NOTICE file
+ * distributed with this work for additional information regarding copyright
+ * ownership.  You may not use this file except in compliance with the License.
+ *
+ * You may obtain a copy of the License at
+ *
+ *   http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing,
+ * software distributed under the License is distributed on an
+ * "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+ * KIND, either express or implied.  See the License for the
+ * specific language governing permissions and limitations
+ * under the License.
+ */
+
+#include "listener.hh"
+#include "core/print.hh"
+
+#include <yaml-cpp/yaml.h>
+
+#include <algorithm>
+#include <fstream>
+#include <stdexcept>
+
+namespace hero {
+
+static const char* kind_name(listener_kind k) {
+    switch (k) {
+    case listener_kind::mqtt: return "mqtt";
+    case listener_kind::tls: return "tls";
+    case listener_kind::cluster: return "cluster";
+    }
+    return "unknown";
+}
+
+static listener_kind parse_kind(const sstring& kind) {
+    for (auto k : {listener_kind::mqtt, listener_kind::tls, listener_kind::cluster}) {
+        if (kind == kind_name(k)) {
+            return k;
+        }
+    }
+    throw std::invalid_argument(sprint("unknown listener kind: %s", kind));
+}
+
+static unsigned parse_number(const sstring& s, const char* what) {
+    if (s.empty() || s.size() > 9 || !std::all_of(s.begin(), s.end(), [] (char c) { return c >= '0' && c <= '9'; })) {
+        throw std::invalid_argument(sprint("invalid %s: %s", what, s));
+    }
+    return std::stoul(std::string(s.c_str()));
+}
+
+static uint16_t parse_port(const sstring& s) {
+    auto port = parse_number(s, "port");
+    if (port == 0 || port > 65535) {
+        throw std::invalid_argument(sprint("invalid port: %s", s));
+    }
+    return port;
+}
+
+bool listener_config::on_shard(unsigned shard) const {
+    return shards.empty() || std::find(shards.begin(), shards.end(), shard) != shards.end();
+}
+
+socket_address listener_config::bind_address() const {
+    return make_ipv4_address(ipv4_addr(std::string(address.c_str()), port));
+}
+
+sstring listener_config::name() const {
+    return sprint("%s:%s:%d", kind_name(kind), address, port);
+}
+
+std::vector<unsigned> parse_shards(const sstring& shards) {
+    std::vector<unsigned> result;
+    size_t start = 0;
+    while (start <= shards.size()) {
+        auto end = std::min(shards.find(',', start), shards.size());
+        auto item = shards.substr(start, end - start);
+        auto dash = item.find('-');
+        if (dash == sstring::npos) {
+            result.push_back(parse_number(item, "shard"));
+        } else {
+            auto first = parse_number(item.substr(0, dash), "shard");
+            auto last = parse_number(item.substr(dash + 1), "shard");
+            if (first > last) {
+                throw std::invalid_argument(sprint("invalid shard range: %s", item));
+            }
+            for (auto s = first; s <= last; ++s) {
+                result.push_back(s);
+            }
+        }
+        start = end + 1;
+    }
+    std::sort(result.begin(), result.end());
+    result.erase(std::unique(result.begin(), result.end()), result.end());
+    return result;
+}
+
+listener_config parse_listener(const sstring& spec) {
+    listener_config l;
+    auto rest = spec;
+    auto at = rest.find('@');
+    if (at != sstring::npos) {
+        l.shards = parse_shards(rest.substr(at + 1));
+        rest = rest.substr(0, at);
+    }
+    auto colon = rest.find(':');
+    if (colon == sstring::npos) {
+        throw std::invalid_argument(sprint("invalid listener, expected <kind>:[<address>:]<port>[@<shards>]: %s", spec));
+    }
+    l.kind = parse_kind(rest.substr(0, colon));
+    rest = rest.substr(colon + 1);
+    colon = rest.rfind(':');
+    if (colon != sstring::npos) {
+        l.address = rest.substr(0, colon);
+        rest = rest.substr(colon + 1);
+    }
+    l.port = parse_port(rest);
+    return l;
+}
+
+static sstring scalar(const YAML::Node& node) {
+    auto s = node.as<std::string>();
+    return sstring(s.data(), s.size());
+}
+
+static listener_config parse_listener(const YAML::Node& node) {
+    if (node.IsScalar()) {
+        return parse_listener(scalar(node));
+    }
+    listener_config l;
+    if (node["kind"]) {
+        l.kind = parse_kind(scalar(node["kind"]));
+    }
+    if (node["address"]) {
+        l.address = scalar(node["address"]);
+    }
+    l.port = parse_port(scalar(node["port"]));
+    if (node["shards"]) {
+        l.shards = parse_shards(scalar(node["shards"]));
+    }
+    return l;
+}
+
+std::vector<listener_config> load_listeners(const sstring& file, balance_config& balance) {
+    auto root = YAML::LoadFile(std::string(file.c_str()));
+    std::vector<listener_config> listeners;
+    for (auto&& node : root["listen"]) {
+        listeners.push_back(parse_listener(node));
+    }
+    if (auto b = root["balance"]) {
+        if (b["interval"]) {
+            balance.interval = std::chrono::milliseconds(b["interval"].as<unsigned>());
+        }
+        balance.withdraw_ratio = b["withdraw-ratio"].as<double>(balance.withdraw_ratio);
+        balance.rejoin_ratio = b["rejoin-ratio"].as<double>(balance.rejoin_ratio);
+        balance.min_excess = b["min-excess"].as<unsigned>(balance.min_excess);
+    }
+    return listeners;
+}
+
+bool accept_queues_migrate() {
+    std::ifstream f("/proc/sys/net/ipv4/tcp_migrate_req");
+    int value = 0;
+    return f >> value && value == 1;
+}
+
+} /* namespace hero */
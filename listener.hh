@@ -0,0 +1,104 @@
+/*
+ * This file is open source software, licensed to you under the terms
+ * of the Apache License, Version 2.0 (the "License").  See the NOTICE file
+ * distributed with this work for additional information regarding copyright
+ * ownership.  You may not use this file except in compliance with the License.
+ *
+ * You may obtain a copy of the License at
+ *
+ *   http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing,
+ * software distributed under the License is distributed on an
+ * "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+ * KIND, either express or implied.  See the License for the
+ * specific language governing permissions and limitations
+ * under the License.
+ */
+
+#pragma once
+
+#include "core/sstring.hh"
+#include "net/api.hh"
+
+#include <chrono>
+#include <vector>
+
+namespace hero {
+
+using namespace seastar;
+using namespace net;
+
+enum class listener_kind {
+    mqtt,
+    tls,
+    // Connections from other cluster nodes.
+    cluster,
+};
+
+struct listener_config {
+    listener_kind kind = listener_kind::mqtt;
+    sstring address = "0.0.0.0";
+    // 0 for no listener.
+    uint16_t port = 0;
+    // The shards which listen; all of them if empty.
+    std::vector<unsigned> shards;
+
+    bool on_shard(unsigned shard) const;
+    socket_address bind_address() const;
+    // As in a listener spec, without the shards.
+    sstring name() const;
+};
+
+// Parses a listener spec, "<kind>:[<address>:]<port>[@<shards>]", where
+// kind is mqtt, tls or cluster and shards is a comma-separated list of
+// shard ids and ranges, such as "0-3,6".  Throws std::invalid_argument.
+listener_config parse_listener(const sstring& spec);
+std::vector<unsigned> parse_shards(const sstring& shards);
+
+// How a listener's shards keep their connection counts even.
+//
+// The kernel spreads the connections of a port among the shards listening
+// on it by hashing their addresses, which may leave some shards with far
+// more connections than others.  Every interval, shard 0 compares the
+// shards' connection counts on each MQTT listener, and a shard over the
+// average by withdraw_ratio, and at least min_excess connections, closes
+// its listening socket, so the kernel sends new connections to the others.
+// It listens again once back within rejoin_ratio of the average.  One
+// shard always keeps listening.
+//
+// Connections still waiting in a socket's accept queue when it closes are
+// handed to the other sockets on the port only if the kernel migrates
+// them (net.ipv4.tcp_migrate_req = 1, Linux 5.14 and later); otherwise it
+// resets them.  Shard 0 therefore leaves balancing off, whatever the
+// interval, unless accept_queues_migrate() says so.
+struct balance_config {
+    // 0 disables balancing.
+    std::chrono::milliseconds interval = std::chrono::milliseconds(1000);
+    double withdraw_ratio = 0.25;
+    double rejoin_ratio = 0.05;
+    unsigned min_excess = 64;
+};
+
+// Loads listeners and balancing settings from a YAML file:
+//
+//   listen:
+//     - mqtt:1883
+//     - kind: tls
+//       address: 0.0.0.0
+//       port: 8883
+//       shards: 0-3
+//   balance:
+//     interval: 1000
+//     withdraw-ratio: 0.25
+//     rejoin-ratio: 0.05
+//     min-excess: 64
+//
+// Settings the file leaves out keep their value in balance.
+std::vector<listener_config> load_listeners(const sstring& file, balance_config& balance);
+
+// Whether the kernel moves the accept queue of a closing SO_REUSEPORT
+// socket to the other sockets on its port, rather than resetting it.
+bool accept_queues_migrate();
+
+} /* namespace hero */
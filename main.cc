@@ -18,93 +18,237 @@
 
 #include "core/app-template.hh"
 #include "core/distributed.hh"
+#include "core/print.hh"
+#include "core/prometheus.hh"
+#include "http/httpd.hh"
+#include "server.hh"
 
-using namespace seastar;
-using namespace net;
-
-namespace hero {
+#include <boost/algorithm/string.hpp>
 
-class server {
-private:
-    uint16_t _port;
-    lw_shared_ptr<server_socket> _listener;
+#include <algorithm>
+#include <stdexcept>
+#include <vector>
 
-    struct connection {
-        connected_socket _socket;
-        socket_address _addr;
-        input_stream<char> _in;
-        output_stream<char> _out;
-
-        connection(connected_socket&& socket, socket_address addr)
-            : _socket(std::move(socket))
-            , _addr(addr)
-            , _in(_socket.input())
-            , _out(_socket.output())
-        {
-        }
-
-        ~connection() {
-        }
-
-        future<> process() {
-            return _in.read().then([this] (auto&& data) mutable {
-                if (!data.empty()) {
-                    return _out.write(std::move(data)).then([this] {
-                        return _out.flush();
-                    });
-                } else {
-                    return _in.close();
-                }
-             });
-        }
-
-    };
-
-public:
-    server(uint16_t port = 1883) : _port(port) {}
-
-    void start() {
-        listen_options lo;
-        lo.reuse_address = true;
-        _listener = engine().listen(make_ipv4_address({_port}), lo);
-        keep_doing([this] {
-            return _listener->accept().then([this] (connected_socket fd, socket_address addr) mutable {
-                auto conn = make_lw_shared<connection>(std::move(fd), addr);
-                do_until([conn] { return conn->_in.eof(); }, [conn] {
-                    return conn->process().then([conn] {
-                        return conn->_out.flush();
-                    });
-                }).finally([conn] {
-                    return conn->_out.close().finally([conn]{});
-                });
-            });
-        }).or_terminate();
-    }
-
-    future<> stop() { return make_ready_future<>(); }
-};
-
-} /* namespace hero */
+using namespace seastar;
+using namespace net;
 
 using namespace hero;
 
 int main(int argc, char **argv) {
-    distributed<server> shard_echo_server;
+    distributed<server> shard_server;
+    httpd::http_server_control metrics_server;
 
     namespace bpo = boost::program_options;
     app_template app;
     app.add_options()
-        ("port", bpo::value<uint16_t>()->default_value(1883), "The TCP port which the echo server will listen on");
+        ("port", bpo::value<uint16_t>()->default_value(1883), "The TCP port which the MQTT broker will listen on, unless there are --listen options")
+        ("listen", bpo::value<std::vector<sstring>>()->composing(),
+                "A listener, as <kind>:[<address>:]<port>[@<shards>], where kind is mqtt, tls or cluster and shards is a "
+                "list such as 0-3,6, all of them by default; may be repeated, and replaces --port, --tls-port and --cluster-port")
+        ("listeners-config", bpo::value<sstring>()->default_value(""), "YAML file with more listeners and the connection balancing settings")
+        ("balance-interval", bpo::value<unsigned>()->default_value(1000),
+                "Milliseconds between comparisons of the shards' connection counts; 0 leaves spreading connections to the kernel, as does net.ipv4.tcp_migrate_req != 1")
+        ("balance-withdraw-ratio", bpo::value<double>()->default_value(0.25),
+                "Fraction over the average connection count of a listener's shards at which a shard stops accepting on it")
+        ("balance-rejoin-ratio", bpo::value<double>()->default_value(0.05),
+                "Fraction over the average connection count of a listener's shards at which a shard accepts on it again")
+        ("balance-min-excess", bpo::value<unsigned>()->default_value(64),
+                "Connections over the average a shard must have before it stops accepting")
+        ("flush-bytes", bpo::value<size_t>()->default_value(64 * 1024), "Write to a client as soon as this many bytes are queued for it")
+        ("flush-packets", bpo::value<size_t>()->default_value(128), "Write to a client as soon as this many packets are queued for it")
+        ("max-send-queue", bpo::value<size_t>()->default_value(4 * 1024 * 1024), "Bytes queued for a client above which QoS 0 messages are dropped and its requests are no longer read")
+        ("resume-send-queue", bpo::value<size_t>()->default_value(1024 * 1024), "Bytes queued for a client below which its requests are read again")
+        ("topic-cache", bpo::value<size_t>()->default_value(64), "Topics each connection keeps encoded PUBLISH headers and, for v5 clients, topic aliases for")
+        ("data-dir", bpo::value<sstring>()->default_value(""), "Directory for the session log; sessions are kept in memory only if empty")
+        ("commit-delay", bpo::value<unsigned>()->default_value(2000), "Microseconds a log record may wait for others to share its fsync")
+        ("commit-bytes", bpo::value<size_t>()->default_value(256 * 1024), "Bytes of log records which start an fsync without waiting for the commit delay")
+        ("segment-size", bpo::value<uint64_t>()->default_value(32 * 1024 * 1024), "Size of a log segment file")
+        ("retained-memory", bpo::value<size_t>()->default_value(256 * 1024 * 1024), "Bytes of retained messages each shard keeps in memory")
+        ("retained-spill-dir", bpo::value<sstring>()->default_value(""), "Directory for retained messages over the memory budget; defaults to <data-dir>/retained, and they are dropped if neither is set")
+        ("max-connections", bpo::value<size_t>()->default_value(100000), "Connections each shard accepts; further sockets are closed right away")
+        ("max-concurrent-connects", bpo::value<size_t>()->default_value(256), "CONNECTs each shard handles at once; the others wait")
+        ("max-inbound-bytes", bpo::value<size_t>()->default_value(64 * 1024 * 1024), "Bytes of received packets each shard handles at once; connections stop reading beyond it")
+        ("max-packet-size", bpo::value<uint32_t>()->default_value(1024 * 1024), "Bytes a packet from a client may have; larger ones close the connection")
+        ("max-connect-packet-size", bpo::value<uint32_t>()->default_value(64 * 1024), "Bytes a packet from a client may have until its CONNECT is accepted")
+        ("max-outbound-bytes", bpo::value<size_t>()->default_value(256 * 1024 * 1024), "Bytes each shard queues for sending over all its connections")
+        ("min-free-memory", bpo::value<double>()->default_value(0.05), "Fraction of a shard's memory below which the shard counts as overloaded")
+        ("overload-actions", bpo::value<sstring>()->default_value("reject-connect,shed-qos0,pause-reads"),
+                "What an overloaded shard does, as a comma-separated list of reject-connect (answer CONNECT with server busy), "
+                "shed-qos0 (drop QoS 0 deliveries) and pause-reads (stop reading from clients)")
+        ("metrics-port", bpo::value<uint16_t>()->default_value(9180), "The HTTP port serving Prometheus metrics at /metrics; 0 disables it")
+        ("tls-port", bpo::value<uint16_t>()->default_value(0), "The TCP port for MQTT over TLS, unless there are --listen options; 0 disables it")
+        ("tls-certificate", bpo::value<sstring>()->default_value(""), "PEM file with the broker's TLS certificate chain")
+        ("tls-key", bpo::value<sstring>()->default_value(""), "PEM file with the private key of the TLS certificate")
+        ("tls-priority", bpo::value<sstring>()->default_value(""), "GnuTLS priority string for TLS connections; empty for the library's default")
+        ("max-concurrent-handshakes", bpo::value<size_t>()->default_value(64), "TLS handshakes each shard runs at once; the other TLS connections wait")
+        ("tls-handshake-timeout", bpo::value<unsigned>()->default_value(5000), "Milliseconds a TLS client has to complete its handshake before it is disconnected")
+        ("tls-session-tickets", bpo::value<bool>()->default_value(true), "Let TLS clients resume their sessions from session tickets")
+        ("tls-ticket-key", bpo::value<sstring>()->default_value(""),
+                "File with the 64 byte key which encrypts TLS session tickets, for clients to resume across restarts and "
+                "cluster nodes; a key is made at startup if empty")
+        ("cluster-port", bpo::value<uint16_t>()->default_value(0), "The TCP port other cluster nodes connect to, unless there are --listen options; 0 runs the broker on its own")
+        ("node-id", bpo::value<uint32_t>()->default_value(0), "This node's id, unique within the cluster")
+        ("peers", bpo::value<sstring>()->default_value(""), "The other cluster nodes, as a comma-separated list of address:port")
+        ("cluster-compress", bpo::bool_switch(), "Compress messages sent to other cluster nodes with LZ4")
+        ("cluster-batch-bytes", bpo::value<size_t>()->default_value(64 * 1024), "Send a batch of messages to another node as soon as it holds this many bytes")
+        ("cluster-queue-bytes", bpo::value<size_t>()->default_value(16 * 1024 * 1024), "Bytes each shard queues for another node above which messages for it are dropped");
 
     return app.run_deprecated(argc, argv, [&] {
-        engine().at_exit([&] { return shard_echo_server.stop(); });
+        engine().at_exit([&] { return shard_server.stop(); });
 
         auto&& config = app.configuration();
-        uint16_t port = config["port"].as<uint16_t>();
-        return shard_echo_server.start(port).then([&] {
-            return shard_echo_server.invoke_on_all(&server::start);
-        }).then([&, port] {
-            std::cout << "TCP echo server listen on: " << port << "\n";
+        uint16_t metrics_port = config["metrics-port"].as<uint16_t>();
+        output_policy policy;
+        policy.flush_bytes = config["flush-bytes"].as<size_t>();
+        policy.flush_packets = config["flush-packets"].as<size_t>();
+        policy.max_queued_bytes = config["max-send-queue"].as<size_t>();
+        policy.resume_bytes = std::min(config["resume-send-queue"].as<size_t>(), policy.max_queued_bytes);
+        policy.topic_cache_size = config["topic-cache"].as<size_t>();
+        log_config log;
+        log.directory = config["data-dir"].as<sstring>();
+        log.max_delay = std::chrono::microseconds(config["commit-delay"].as<unsigned>());
+        log.max_batch_bytes = config["commit-bytes"].as<size_t>();
+        log.segment_size = config["segment-size"].as<uint64_t>();
+        retained_config retained;
+        retained.memory_budget = config["retained-memory"].as<size_t>();
+        retained.spill_directory = config["retained-spill-dir"].as<sstring>();
+        if (retained.spill_directory.empty() && !log.directory.empty()) {
+            retained.spill_directory = log.directory + "/retained";
+        }
+        admission_config admission;
+        admission.max_connections = config["max-connections"].as<size_t>();
+        admission.max_concurrent_connects = std::max<size_t>(1, config["max-concurrent-connects"].as<size_t>());
+        admission.max_inbound_bytes = config["max-inbound-bytes"].as<size_t>();
+        admission.max_packet_size = config["max-packet-size"].as<uint32_t>();
+        admission.max_connect_packet_size = std::min(config["max-connect-packet-size"].as<uint32_t>(), admission.max_packet_size);
+        admission.max_outbound_bytes = config["max-outbound-bytes"].as<size_t>();
+        admission.min_free_memory_ratio = config["min-free-memory"].as<double>();
+        admission.reject_connects = admission.shed_qos0 = admission.pause_reads = false;
+        std::vector<sstring> actions;
+        auto list = config["overload-actions"].as<sstring>();
+        boost::split(actions, list, boost::is_any_of(","));
+        for (auto& a : actions) {
+            if (a == "reject-connect") {
+                admission.reject_connects = true;
+            } else if (a == "shed-qos0") {
+                admission.shed_qos0 = true;
+            } else if (a == "pause-reads") {
+                admission.pause_reads = true;
+            } else if (!a.empty()) {
+                throw std::invalid_argument(sprint("unknown overload action: %s", a));
+            }
+        }
+        balance_config balance;
+        std::vector<listener_config> listeners;
+        if (config.count("listen")) {
+            for (auto& spec : config["listen"].as<std::vector<sstring>>()) {
+                listeners.push_back(parse_listener(spec));
+            }
+        }
+        auto listeners_file = config["listeners-config"].as<sstring>();
+        if (!listeners_file.empty()) {
+            auto loaded = load_listeners(listeners_file, balance);
+            listeners.insert(listeners.end(), loaded.begin(), loaded.end());
+        }
+        // Balancing options given on the command line override the file.
+        if (!config["balance-interval"].defaulted()) {
+            balance.interval = std::chrono::milliseconds(config["balance-interval"].as<unsigned>());
+        }
+        if (!config["balance-withdraw-ratio"].defaulted()) {
+            balance.withdraw_ratio = config["balance-withdraw-ratio"].as<double>();
+        }
+        if (!config["balance-rejoin-ratio"].defaulted()) {
+            balance.rejoin_ratio = config["balance-rejoin-ratio"].as<double>();
+        }
+        if (!config["balance-min-excess"].defaulted()) {
+            balance.min_excess = config["balance-min-excess"].as<unsigned>();
+        }
+        balance.rejoin_ratio = std::min(balance.rejoin_ratio, balance.withdraw_ratio);
+        if (listeners.empty()) {
+            listener_config mqtt;
+            mqtt.port = config["port"].as<uint16_t>();
+            listeners.push_back(mqtt);
+            if (auto port = config["tls-port"].as<uint16_t>()) {
+                listener_config l;
+                l.kind = listener_kind::tls;
+                l.port = port;
+                listeners.push_back(l);
+            }
+            if (auto port = config["cluster-port"].as<uint16_t>()) {
+                listener_config l;
+                l.kind = listener_kind::cluster;
+                l.port = port;
+                listeners.push_back(l);
+            }
+        }
+        cluster_config cluster;
+        bool has_tls = false;
+        for (auto& l : listeners) {
+            for (auto shard : l.shards) {
+                if (shard >= smp::count) {
+                    throw std::invalid_argument(sprint("%s: no shard %d, there are %d", l.name(), shard, smp::count));
+                }
+            }
+            has_tls |= l.kind == listener_kind::tls;
+            if (l.kind == listener_kind::cluster) {
+                if (cluster.listener.port) {
+                    throw std::invalid_argument("there can be only one cluster listener");
+                }
+                cluster.listener = l;
+            }
+        }
+        listeners.erase(std::remove_if(listeners.begin(), listeners.end(), [] (const listener_config& l) {
+            return l.kind == listener_kind::cluster;
+        }), listeners.end());
+        tls_config tls;
+        tls.certificate_file = config["tls-certificate"].as<sstring>();
+        tls.key_file = config["tls-key"].as<sstring>();
+        tls.priority = config["tls-priority"].as<sstring>();
+        tls.max_concurrent_handshakes = std::max<size_t>(1, config["max-concurrent-handshakes"].as<size_t>());
+        tls.handshake_timeout = std::chrono::milliseconds(config["tls-handshake-timeout"].as<unsigned>());
+        if (has_tls && (tls.certificate_file.empty() || tls.key_file.empty())) {
+            throw std::invalid_argument("TLS listeners need --tls-certificate and --tls-key");
+        }
+        if (has_tls && config["tls-session-tickets"].as<bool>()) {
+            // One key for every shard.
+            tls.ticket_key = load_ticket_key(config["tls-ticket-key"].as<sstring>());
+        }
+        cluster.node_id = config["node-id"].as<uint32_t>();
+        cluster.compress = config["cluster-compress"].as<bool>();
+        cluster.max_batch_bytes = config["cluster-batch-bytes"].as<size_t>();
+        cluster.max_queued_bytes = config["cluster-queue-bytes"].as<size_t>();
+        auto peers = config["peers"].as<sstring>();
+        boost::split(cluster.peers, peers, boost::is_any_of(","));
+        cluster.peers.erase(std::remove(cluster.peers.begin(), cluster.peers.end(), ""), cluster.peers.end());
+        return shard_server.start(listeners, policy, log, retained, admission, cluster, tls, balance).then([&] {
+            // Every shard replays its own log at the same time.
+            return shard_server.invoke_on_all(&server::recover);
+        }).then([&] {
+            return shard_server.invoke_on_all(&server::start);
+        }).then([&, metrics_port] {
+            if (!metrics_port) {
+                return make_ready_future<>();
+            }
+            // The HTTP server runs on every shard, and each scrape gathers
+            // the metrics of all of them.
+            engine().at_exit([&] { return metrics_server.stop(); });
+            prometheus::config pconfig;
+            pconfig.metric_help = "Hero MQTT broker statistics";
+            return metrics_server.start("prometheus").then([&, pconfig] {
+                return prometheus::start(metrics_server, pconfig);
+            }).then([&, metrics_port] {
+                return metrics_server.listen(ipv4_addr{metrics_port});
+            });
+        }).then([&, metrics_port, listeners, cluster] {
+            for (auto& l : listeners) {
+                std::cout << "MQTT broker listening on: " << l.name() << "\n";
+            }
+            if (cluster.listener.port) {
+                std::cout << "Cluster node " << cluster.node_id << " listening on: " << cluster.listener.name() << "\n";
+            }
+            if (metrics_port) {
+                std::cout << "Prometheus metrics on: " << metrics_port << "\n";
+            }
         });
     });
 }
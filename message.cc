@@ -0,0 +1,88 @@
+/*
+ * This file is open source software, licensed to you under the terms
+ * of the Apache License, Version 2.0 (the "License").  See the NOTICE file
+ * distributed with this work for additional information regarding copyright
+ * ownership.  You may not use this file except in compliance with the License.
+ *
+ * You may obtain a copy of the License at
+ *
+ *   http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing,
+ * software distributed under the License is distributed on an
+ * "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+ * KIND, either express or implied.  See the License for the
+ * specific language governing permissions and limitations
+ * under the License.
+ */
+
+#include "message.hh"
+#include "core/reactor.hh"
+#include "mqtt/decoder.hh"
+#include "mqtt/encoder.hh"
+
+#include <stdexcept>
+
+namespace hero {
+
+lw_shared_ptr<message> make_message(mqtt::publish&& pub, uint64_t origin) {
+    auto m = make_lw_shared<message>();
+    m->topic = std::move(pub.topic);
+    m->payload = std::move(pub.payload);
+    m->qos = pub.qos;
+    m->retain = pub.retain;
+    m->properties = mqtt::forwarded_properties(pub.properties);
+    m->origin_shard = engine().cpu_id();
+    m->origin = origin;
+    m->received = std::chrono::steady_clock::now();
+    return m;
+}
+
+lw_shared_ptr<message> decode_message(temporary_buffer<char> data) {
+    mqtt::decoder d;
+    std::vector<mqtt::packet> packets;
+    d.feed(std::move(data), packets);
+    if (packets.size() != 1 || !d.idle()) {
+        throw std::runtime_error("malformed stored message");
+    }
+    auto m = make_message(mqtt::parse_publish(std::move(packets.front()), mqtt::protocol_version::v5), uint64_t(-1));
+    m->received = {};
+    return m;
+}
+
+lw_shared_ptr<message> import_message(foreign_ptr<lw_shared_ptr<message>> remote) {
+    const message& r = *remote;
+    // Every buffer of the local copy holds a share of this deleter, which
+    // owns the foreign pointer.
+    deleter d = make_object_deleter(std::move(remote));
+    auto wrap = [&d] (const temporary_buffer<char>& b) {
+        return temporary_buffer<char>(const_cast<char*>(b.get()), b.size(), d.share());
+    };
+    auto wrap_opt = [&wrap] (const std::optional<temporary_buffer<char>>& b) -> std::optional<temporary_buffer<char>> {
+        if (!b) {
+            return {};
+        }
+        return wrap(*b);
+    };
+    auto m = make_lw_shared<message>();
+    m->topic = wrap(r.topic);
+    m->payload = wrap(r.payload);
+    m->qos = r.qos;
+    m->retain = r.retain;
+    m->origin_shard = r.origin_shard;
+    m->origin = r.origin;
+    m->received = r.received;
+    auto& p = m->properties;
+    p.payload_format_indicator = r.properties.payload_format_indicator;
+    p.message_expiry_interval = r.properties.message_expiry_interval;
+    p.content_type = wrap_opt(r.properties.content_type);
+    p.response_topic = wrap_opt(r.properties.response_topic);
+    p.correlation_data = wrap_opt(r.properties.correlation_data);
+    p.user_properties.reserve(r.properties.user_properties.size());
+    for (auto& up : r.properties.user_properties) {
+        p.user_properties.push_back(mqtt::user_property{wrap(up.name), wrap(up.value)});
+    }
+    return m;
+}
+
+} /* namespace hero */
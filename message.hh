@@ -0,0 +1,79 @@
+/*
+ * This file is open source software, licensed to you under the terms
+ * of the Apache License, Version 2.0 (the "License").  See the NOTICE file
+ * distributed with this work for additional information regarding copyright
+ * ownership.  You may not use this file except in compliance with the License.
+ *
+ * You may obtain a copy of the License at
+ *
+ *   http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing,
+ * software distributed under the License is distributed on an
+ * "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+ * KIND, either express or implied.  See the License for the
+ * specific language governing permissions and limitations
+ * under the License.
+ */
+
+#pragma once
+
+#include "core/sharded.hh"
+#include "core/shared_ptr.hh"
+#include "mqtt/protocol.hh"
+
+#include <chrono>
+
+namespace hero {
+
+using namespace seastar;
+
+// A PUBLISH on its way to subscribers.  The buffers are shared with the
+// packet it was decoded from; a message is never modified once built, so a
+// shard other than the one that built it may read it through a foreign_ptr.
+struct message {
+    temporary_buffer<char> topic;
+    temporary_buffer<char> payload;
+    mqtt::qos qos;
+    bool retain;
+    // Only the properties that are forwarded to subscribers.
+    mqtt::properties properties;
+    // Where the publisher is connected, for no-local subscriptions.
+    unsigned origin_shard;
+    uint64_t origin;
+    // When the PUBLISH was received, for the delivery latency histogram;
+    // unset for messages restored from disk.
+    std::chrono::steady_clock::time_point received;
+
+    std::string_view topic_view() const {
+        return std::string_view(topic.get(), topic.size());
+    }
+};
+
+// What a session asks its connection to send for one message.
+struct delivery {
+    enum class kind : uint8_t {
+        publish,
+        // Resend PUBREL for a QoS 2 message the client already received.
+        pubrel,
+    };
+    delivery::kind kind = kind::publish;
+    mqtt::qos qos = mqtt::qos::at_most_once;
+    bool retain = false;
+    bool dup = false;
+    uint16_t packet_id = 0;
+    uint32_t subscription_identifier = 0;
+};
+
+lw_shared_ptr<message> make_message(mqtt::publish&& pub, uint64_t origin);
+
+// Parses a message kept on disk or in memory as a v5 PUBLISH.  The
+// message's buffers share data, and it has no origin.
+lw_shared_ptr<message> decode_message(temporary_buffer<char> data);
+
+// Makes a local message whose buffers point at the remote one's without
+// copying.  The remote message is released on its owning shard once every
+// local buffer is gone.
+lw_shared_ptr<message> import_message(foreign_ptr<lw_shared_ptr<message>> remote);
+
+} /* namespace hero */
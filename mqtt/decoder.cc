@@ -0,0 +1,478 @@
+/*
+ * This file is open source software, licensed to you under the terms
+ * of the Apache License, Version 2.0 (the "License").  See the NOTICE file
+ * distributed with this work for additional information regarding copyright
+ * ownership.  You may not use this file except in compliance with the License.
+ *
+ * You may obtain a copy of the License at
+ *
+ *   http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing,
+ * software distributed under the License is distributed on an
+ * "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+ * KIND, either express or implied.  See the License for the
+ * specific language governing permissions and limitations
+ * under the License.
+ */
+
+#include "mqtt/decoder.hh"
+
+#include <algorithm>
+#include <cstring>
+
+namespace hero {
+
+namespace mqtt {
+
+const char* to_string(packet_type t) {
+    switch (t) {
+    case packet_type::connect: return "CONNECT";
+    case packet_type::connack: return "CONNACK";
+    case packet_type::publish: return "PUBLISH";
+    case packet_type::puback: return "PUBACK";
+    case packet_type::pubrec: return "PUBREC";
+    case packet_type::pubrel: return "PUBREL";
+    case packet_type::pubcomp: return "PUBCOMP";
+    case packet_type::subscribe: return "SUBSCRIBE";
+    case packet_type::suback: return "SUBACK";
+    case packet_type::unsubscribe: return "UNSUBSCRIBE";
+    case packet_type::unsuback: return "UNSUBACK";
+    case packet_type::pingreq: return "PINGREQ";
+    case packet_type::pingresp: return "PINGRESP";
+    case packet_type::disconnect: return "DISCONNECT";
+    case packet_type::auth: return "AUTH";
+    }
+    return "UNKNOWN";
+}
+
+static void validate_flags(packet_type type, uint8_t flags) {
+    switch (type) {
+    case packet_type::publish:
+        if ((flags & 0x06) == 0x06) {
+            throw protocol_error(reason_code::malformed_packet, "PUBLISH with QoS 3");
+        }
+        return;
+    case packet_type::pubrel:
+    case packet_type::subscribe:
+    case packet_type::unsubscribe:
+        if (flags != 0x02) {
+            throw protocol_error(reason_code::malformed_packet, "invalid fixed header flags");
+        }
+        return;
+    default:
+        if (flags != 0) {
+            throw protocol_error(reason_code::malformed_packet, "invalid fixed header flags");
+        }
+        return;
+    }
+}
+
+void decoder::feed(temporary_buffer<char> buf, std::vector<packet>& out) {
+    while (!buf.empty()) {
+        switch (_state) {
+        case state::header: {
+            uint8_t b = buf[0];
+            buf.trim_front(1);
+            auto type = b >> 4;
+            if (type == 0) {
+                throw protocol_error(reason_code::malformed_packet, "reserved packet type");
+            }
+            _header.type = packet_type(type);
+            _header.flags = b & 0x0f;
+            validate_flags(_header.type, _header.flags);
+            _header.remaining_length = 0;
+            _multiplier = 1;
+            _length_bytes = 0;
+            _state = state::length;
+            break;
+        }
+        case state::length: {
+            if (++_length_bytes > 4) {
+                throw protocol_error(reason_code::malformed_packet, "remaining length too long");
+            }
+            uint8_t b = buf[0];
+            buf.trim_front(1);
+            _header.remaining_length += (b & 0x7f) * _multiplier;
+            _multiplier <<= 7;
+            if (b & 0x80) {
+                break;
+            }
+            if (_header.remaining_length + 1 + _length_bytes > _max_packet_size) {
+                throw protocol_error(reason_code::packet_too_large, "packet exceeds maximum size");
+            }
+            start_body(buf, out);
+            break;
+        }
+        case state::body: {
+            auto len = _header.remaining_length;
+            auto n = std::min<size_t>(buf.size(), len - _partial_filled);
+            if (_partial_filled + n > _partial.size()) {
+                grow_partial(_partial_filled + n);
+            }
+            std::copy_n(buf.get(), n, _partial.get_write() + _partial_filled);
+            _partial_filled += n;
+            buf.trim_front(n);
+            if (_partial_filled == len) {
+                _partial.trim(len);
+                out.push_back(packet{_header, std::move(_partial)});
+                _partial = {};
+                _partial_filled = 0;
+                _state = state::header;
+            }
+            break;
+        }
+        }
+    }
+}
+
+void decoder::start_body(temporary_buffer<char>& buf, std::vector<packet>& out) {
+    auto len = _header.remaining_length;
+    if (len == 0) {
+        out.push_back(packet{_header, temporary_buffer<char>()});
+        _state = state::header;
+    } else if (buf.size() >= len) {
+        // Common case: the whole packet sits in this read.  Share, don't copy.
+        out.push_back(packet{_header, buf.share(0, len)});
+        buf.trim_front(len);
+        _state = state::header;
+    } else {
+        _partial = {};
+        _partial_filled = 0;
+        _state = state::body;
+    }
+}
+
+// The remaining length is only a claim until the bytes arrive, so the
+// buffer grows with them, doubling to keep the copying linear.
+void decoder::grow_partial(size_t needed) {
+    auto size = std::max({needed, _partial.size() * 2, initial_partial_size});
+    temporary_buffer<char> grown(std::min<size_t>(size, _header.remaining_length));
+    std::copy_n(_partial.get(), _partial_filled, grown.get_write());
+    _partial = std::move(grown);
+}
+
+namespace {
+
+// Cursor over a packet body.  Every read is bounds checked; variable length
+// fields are returned as views sharing the body.
+class reader {
+    temporary_buffer<char> _buf;
+    size_t _pos = 0;
+public:
+    explicit reader(temporary_buffer<char>&& buf) : _buf(std::move(buf)) {}
+
+    size_t remaining() const { return _buf.size() - _pos; }
+    bool empty() const { return remaining() == 0; }
+
+    void need(size_t n) const {
+        if (remaining() < n) {
+            throw protocol_error(reason_code::malformed_packet, "packet truncated");
+        }
+    }
+
+    uint8_t read_u8() {
+        need(1);
+        return uint8_t(_buf[_pos++]);
+    }
+
+    uint16_t read_u16() {
+        need(2);
+        auto p = reinterpret_cast<const uint8_t*>(_buf.get() + _pos);
+        _pos += 2;
+        return (uint16_t(p[0]) << 8) | p[1];
+    }
+
+    uint32_t read_u32() {
+        need(4);
+        auto p = reinterpret_cast<const uint8_t*>(_buf.get() + _pos);
+        _pos += 4;
+        return (uint32_t(p[0]) << 24) | (uint32_t(p[1]) << 16) | (uint32_t(p[2]) << 8) | p[3];
+    }
+
+    uint32_t read_varint() {
+        uint32_t value = 0;
+        for (int i = 0; i < 4; ++i) {
+            auto b = read_u8();
+            value |= uint32_t(b & 0x7f) << (7 * i);
+            if (!(b & 0x80)) {
+                return value;
+            }
+        }
+        throw protocol_error(reason_code::malformed_packet, "variable byte integer too long");
+    }
+
+    buffer_view read_bytes(size_t n) {
+        need(n);
+        auto v = _buf.share(_pos, n);
+        _pos += n;
+        return v;
+    }
+
+    buffer_view read_binary() {
+        return read_bytes(read_u16());
+    }
+
+    buffer_view read_string() {
+        auto s = read_binary();
+        if (std::memchr(s.get(), '\0', s.size())) {
+            throw protocol_error(reason_code::malformed_packet, "NUL in UTF-8 string");
+        }
+        return s;
+    }
+
+    buffer_view rest() {
+        return read_bytes(remaining());
+    }
+};
+
+template <typename T>
+void set_once(std::optional<T>& field, T value) {
+    if (field) {
+        throw protocol_error(reason_code::protocol_error, "duplicate property");
+    }
+    field = std::move(value);
+}
+
+properties read_properties(reader& r) {
+    properties props;
+    auto len = r.read_varint();
+    reader pr(r.read_bytes(len));
+    while (!pr.empty()) {
+        auto id = pr.read_varint();
+        switch (id) {
+        case 0x01: set_once(props.payload_format_indicator, pr.read_u8()); break;
+        case 0x02: set_once(props.message_expiry_interval, pr.read_u32()); break;
+        case 0x03: set_once(props.content_type, pr.read_string()); break;
+        case 0x08: set_once(props.response_topic, pr.read_string()); break;
+        case 0x09: set_once(props.correlation_data, pr.read_binary()); break;
+        case 0x0b: {
+            auto sid = pr.read_varint();
+            if (sid == 0) {
+                throw protocol_error(reason_code::protocol_error, "subscription identifier 0");
+            }
+            props.subscription_identifiers.push_back(sid);
+            break;
+        }
+        case 0x11: set_once(props.session_expiry_interval, pr.read_u32()); break;
+        case 0x12: set_once(props.assigned_client_identifier, pr.read_string()); break;
+        case 0x13: set_once(props.server_keep_alive, pr.read_u16()); break;
+        case 0x15: set_once(props.authentication_method, pr.read_string()); break;
+        case 0x16: set_once(props.authentication_data, pr.read_binary()); break;
+        case 0x17: set_once(props.request_problem_information, pr.read_u8()); break;
+        case 0x18: set_once(props.will_delay_interval, pr.read_u32()); break;
+        case 0x19: set_once(props.request_response_information, pr.read_u8()); break;
+        case 0x1a: set_once(props.response_information, pr.read_string()); break;
+        case 0x1c: set_once(props.server_reference, pr.read_string()); break;
+        case 0x1f: set_once(props.reason_string, pr.read_string()); break;
+        case 0x21: set_once(props.receive_maximum, pr.read_u16()); break;
+        case 0x22: set_once(props.topic_alias_maximum, pr.read_u16()); break;
+        case 0x23: set_once(props.topic_alias, pr.read_u16()); break;
+        case 0x24: set_once(props.maximum_qos, pr.read_u8()); break;
+        case 0x25: set_once(props.retain_available, pr.read_u8()); break;
+        case 0x26: {
+            auto name = pr.read_string();
+            auto value = pr.read_string();
+            props.user_properties.push_back(user_property{std::move(name), std::move(value)});
+            break;
+        }
+        case 0x27: set_once(props.maximum_packet_size, pr.read_u32()); break;
+        case 0x28: set_once(props.wildcard_subscription_available, pr.read_u8()); break;
+        case 0x29: set_once(props.subscription_identifier_available, pr.read_u8()); break;
+        case 0x2a: set_once(props.shared_subscription_available, pr.read_u8()); break;
+        default:
+            throw protocol_error(reason_code::malformed_packet, "unknown property");
+        }
+    }
+    return props;
+}
+
+mqtt::qos to_qos(uint8_t v) {
+    if (v > 2) {
+        throw protocol_error(reason_code::malformed_packet, "invalid QoS");
+    }
+    return mqtt::qos(v);
+}
+
+} /* anonymous namespace */
+
+connect parse_connect(packet&& p) {
+    reader r(std::move(p.body));
+    connect c;
+    auto name = r.read_string();
+    auto level = r.read_u8();
+    if (as_string_view(name) == "MQIsdp" && level == 3) {
+        // 3.1 clients get the same treatment as 3.1.1 ones.
+        c.version = protocol_version::v311;
+    } else if (as_string_view(name) != "MQTT") {
+        throw protocol_error(reason_code::malformed_packet, "bad protocol name");
+    } else if (level == uint8_t(protocol_version::v311) || level == uint8_t(protocol_version::v5)) {
+        c.version = protocol_version(level);
+    } else {
+        throw protocol_error(reason_code::unsupported_protocol_version, "unsupported protocol version");
+    }
+    auto flags = r.read_u8();
+    if (flags & 0x01) {
+        throw protocol_error(reason_code::malformed_packet, "reserved CONNECT flag set");
+    }
+    c.clean_start = flags & 0x02;
+    bool has_will = flags & 0x04;
+    auto will_qos = to_qos((flags >> 3) & 0x03);
+    bool will_retain = flags & 0x20;
+    if (!has_will && (will_qos != qos::at_most_once || will_retain)) {
+        throw protocol_error(reason_code::malformed_packet, "will flags without will");
+    }
+    c.keep_alive = r.read_u16();
+    if (c.version == protocol_version::v5) {
+        c.properties = read_properties(r);
+    }
+    c.client_id = r.read_string();
+    if (has_will) {
+        will_message w;
+        if (c.version == protocol_version::v5) {
+            w.properties = read_properties(r);
+        }
+        w.topic = r.read_string();
+        if (!valid_topic_name(as_string_view(w.topic))) {
+            throw protocol_error(reason_code::topic_name_invalid, "invalid will topic");
+        }
+        w.payload = r.read_binary();
+        w.qos = will_qos;
+        w.retain = will_retain;
+        c.will = std::move(w);
+    }
+    if (flags & 0x80) {
+        c.username = r.read_string();
+    }
+    if (flags & 0x40) {
+        c.password = r.read_binary();
+    }
+    return c;
+}
+
+publish parse_publish(packet&& p, protocol_version v) {
+    publish pub;
+    pub.dup = p.header.flags & 0x08;
+    pub.qos = to_qos((p.header.flags >> 1) & 0x03);
+    pub.retain = p.header.flags & 0x01;
+    reader r(std::move(p.body));
+    pub.topic = r.read_string();
+    if (pub.qos != qos::at_most_once) {
+        pub.packet_id = r.read_u16();
+        if (pub.packet_id == 0) {
+            throw protocol_error(reason_code::protocol_error, "packet identifier 0");
+        }
+    }
+    if (v == protocol_version::v5) {
+        pub.properties = read_properties(r);
+    }
+    // An empty topic is only legal in v5 together with a topic alias; the
+    // connection resolves that.
+    if (!pub.topic.empty() && !valid_topic_name(as_string_view(pub.topic))) {
+        throw protocol_error(reason_code::topic_name_invalid, "invalid topic name");
+    }
+    pub.payload = r.rest();
+    return pub;
+}
+
+ack parse_ack(packet&& p, protocol_version v) {
+    reader r(std::move(p.body));
+    ack a;
+    a.packet_id = r.read_u16();
+    if (v == protocol_version::v5 && !r.empty()) {
+        a.code = reason_code(r.read_u8());
+        if (!r.empty()) {
+            a.properties = read_properties(r);
+        }
+    }
+    return a;
+}
+
+subscribe parse_subscribe(packet&& p, protocol_version v) {
+    reader r(std::move(p.body));
+    subscribe s;
+    s.packet_id = r.read_u16();
+    if (v == protocol_version::v5) {
+        s.properties = read_properties(r);
+    }
+    while (!r.empty()) {
+        subscription_request req;
+        req.topic_filter = r.read_string();
+        auto opts = r.read_u8();
+        req.max_qos = to_qos(opts & 0x03);
+        if (v == protocol_version::v5) {
+            req.no_local = opts & 0x04;
+            req.retain_as_published = opts & 0x08;
+            req.retain_handling = (opts >> 4) & 0x03;
+            if (req.retain_handling == 3 || (opts & 0xc0)) {
+                throw protocol_error(reason_code::malformed_packet, "invalid subscription options");
+            }
+        } else if (opts & 0xfc) {
+            throw protocol_error(reason_code::malformed_packet, "invalid subscription options");
+        }
+        s.subscriptions.push_back(std::move(req));
+    }
+    if (s.subscriptions.empty()) {
+        throw protocol_error(reason_code::protocol_error, "SUBSCRIBE without topic filters");
+    }
+    return s;
+}
+
+unsubscribe parse_unsubscribe(packet&& p, protocol_version v) {
+    reader r(std::move(p.body));
+    unsubscribe u;
+    u.packet_id = r.read_u16();
+    if (v == protocol_version::v5) {
+        u.properties = read_properties(r);
+    }
+    while (!r.empty()) {
+        u.topic_filters.push_back(r.read_string());
+    }
+    if (u.topic_filters.empty()) {
+        throw protocol_error(reason_code::protocol_error, "UNSUBSCRIBE without topic filters");
+    }
+    return u;
+}
+
+disconnect parse_disconnect(packet&& p, protocol_version v) {
+    reader r(std::move(p.body));
+    disconnect d;
+    if (v == protocol_version::v5 && !r.empty()) {
+        d.code = reason_code(r.read_u8());
+        if (!r.empty()) {
+            d.properties = read_properties(r);
+        }
+    }
+    return d;
+}
+
+bool valid_topic_name(std::string_view topic) {
+    return !topic.empty() && topic.find_first_of("+#") == std::string_view::npos;
+}
+
+bool valid_topic_filter(std::string_view filter) {
+    if (filter.empty()) {
+        return false;
+    }
+    size_t start = 0;
+    while (true) {
+        auto end = filter.find('/', start);
+        auto level = filter.substr(start, end == std::string_view::npos ? std::string_view::npos : end - start);
+        if (level.find_first_of("+#") != std::string_view::npos) {
+            if (level.size() != 1) {
+                return false;
+            }
+            if (level[0] == '#' && end != std::string_view::npos) {
+                return false;
+            }
+        }
+        if (end == std::string_view::npos) {
+            return true;
+        }
+        start = end + 1;
+    }
+}
+
+} /* namespace mqtt */
+
+} /* namespace hero */
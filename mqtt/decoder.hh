@@ -0,0 +1,90 @@
+/*
+ * This file is open source software, licensed to you under the terms
+ * of the Apache License, Version 2.0 (the "License").  See the NOTICE file
+ * distributed with this work for additional information regarding copyright
+ * ownership.  You may not use this file except in compliance with the License.
+ *
+ * You may obtain a copy of the License at
+ *
+ *   http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing,
+ * software distributed under the License is distributed on an
+ * "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+ * KIND, either express or implied.  See the License for the
+ * specific language governing permissions and limitations
+ * under the License.
+ */
+
+#pragma once
+
+#include "mqtt/protocol.hh"
+
+#include <vector>
+
+namespace hero {
+
+namespace mqtt {
+
+// Incremental MQTT framer.
+//
+// Buffers are fed in the order they were read from the socket.  A packet
+// which lies entirely within one buffer is handed out as a shared slice of
+// that buffer; only packets straddling two reads are linearized, and only
+// once.  The decoder keeps no reference to a buffer after feed() returns
+// other than the slices it emitted.  A straddling packet is buffered as its
+// bytes arrive, not all at once when its length is read.
+class decoder {
+    enum class state {
+        header,
+        length,
+        body,
+    };
+    state _state = state::header;
+    fixed_header _header;
+    uint32_t _multiplier;
+    uint8_t _length_bytes;
+    static constexpr size_t initial_partial_size = 4096;
+    temporary_buffer<char> _partial;
+    size_t _partial_filled = 0;
+    uint32_t _max_packet_size;
+public:
+    explicit decoder(uint32_t max_packet_size = max_remaining_length + max_fixed_header_size)
+        : _max_packet_size(max_packet_size)
+    {
+    }
+
+    // Appends every packet completed by buf to out.  Throws protocol_error
+    // on a malformed fixed header or a packet over the size limit, after
+    // which the decoder must not be used again.
+    void feed(temporary_buffer<char> buf, std::vector<packet>& out);
+
+    // True when no partially received packet is pending.
+    bool idle() const { return _state == state::header; }
+    // Bytes held for the partially received packet.
+    size_t buffered() const { return _partial.size(); }
+
+    void set_max_packet_size(uint32_t size) { _max_packet_size = size; }
+private:
+    void start_body(temporary_buffer<char>& buf, std::vector<packet>& out);
+    void grow_partial(size_t needed);
+};
+
+// The parsers below consume a framed packet.  Strings and binary fields are
+// returned as views sharing the packet body.  All of them throw
+// protocol_error when the packet is malformed.
+connect parse_connect(packet&& p);
+publish parse_publish(packet&& p, protocol_version v);
+ack parse_ack(packet&& p, protocol_version v);
+subscribe parse_subscribe(packet&& p, protocol_version v);
+unsubscribe parse_unsubscribe(packet&& p, protocol_version v);
+disconnect parse_disconnect(packet&& p, protocol_version v);
+
+// Topic names must be non-empty and free of wildcards; filters may use '+'
+// and '#' only as whole levels, '#' only as the last one.
+bool valid_topic_name(std::string_view topic);
+bool valid_topic_filter(std::string_view filter);
+
+} /* namespace mqtt */
+
+} /* namespace hero */
@@ -0,0 +1,287 @@
+/*
+ * This file is open source software, licensed to you under the terms
+ * of the Apache License, Version 2.0 (the "License").  See the NOTICE file
+ * distributed with this work for additional information regarding copyright
+ * ownership.  You may not use this file except in compliance with the License.
+ *
+ * You may obtain a copy of the License at
+ *
+ *   http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing,
+ * software distributed under the License is distributed on an
+ * "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+ * KIND, either express or implied.  See the License for the
+ * specific language governing permissions and limitations
+ * under the License.
+ */
+
+#include "mqtt/encoder.hh"
+
+#include <algorithm>
+
+namespace hero {
+
+namespace mqtt {
+
+size_t varint_size(uint32_t value) {
+    if (value < 128) {
+        return 1;
+    } else if (value < 16384) {
+        return 2;
+    } else if (value < 2097152) {
+        return 3;
+    }
+    return 4;
+}
+
+char* write_varint(char* out, uint32_t value) {
+    do {
+        uint8_t b = value & 0x7f;
+        value >>= 7;
+        if (value) {
+            b |= 0x80;
+        }
+        *out++ = char(b);
+    } while (value);
+    return out;
+}
+
+namespace {
+
+class writer {
+    char* _p;
+public:
+    explicit writer(char* p) : _p(p) {}
+    char* pos() const { return _p; }
+
+    void u8(uint8_t v) {
+        *_p++ = char(v);
+    }
+    void u16(uint16_t v) {
+        *_p++ = char(v >> 8);
+        *_p++ = char(v);
+    }
+    void u32(uint32_t v) {
+        u16(v >> 16);
+        u16(v);
+    }
+    void varint(uint32_t v) {
+        _p = write_varint(_p, v);
+    }
+    void bytes(const char* data, size_t n) {
+        _p = std::copy_n(data, n, _p);
+    }
+    void binary(const buffer_view& b) {
+        u16(b.size());
+        bytes(b.get(), b.size());
+    }
+};
+
+// Visits every property that is set, in identifier order.  Both sizing and
+// writing go through here so the two can never disagree.
+template <typename U8, typename U16, typename U32, typename VarInt, typename Binary, typename Pair>
+void for_each_property(const properties& p, U8 u8, U16 u16, U32 u32, VarInt varint, Binary binary, Pair pair) {
+    if (p.payload_format_indicator) u8(0x01, *p.payload_format_indicator);
+    if (p.message_expiry_interval) u32(0x02, *p.message_expiry_interval);
+    if (p.content_type) binary(0x03, *p.content_type);
+    if (p.response_topic) binary(0x08, *p.response_topic);
+    if (p.correlation_data) binary(0x09, *p.correlation_data);
+    for (auto sid : p.subscription_identifiers) varint(0x0b, sid);
+    if (p.session_expiry_interval) u32(0x11, *p.session_expiry_interval);
+    if (p.assigned_client_identifier) binary(0x12, *p.assigned_client_identifier);
+    if (p.server_keep_alive) u16(0x13, *p.server_keep_alive);
+    if (p.authentication_method) binary(0x15, *p.authentication_method);
+    if (p.authentication_data) binary(0x16, *p.authentication_data);
+    if (p.response_information) binary(0x1a, *p.response_information);
+    if (p.server_reference) binary(0x1c, *p.server_reference);
+    if (p.reason_string) binary(0x1f, *p.reason_string);
+    if (p.receive_maximum) u16(0x21, *p.receive_maximum);
+    if (p.topic_alias_maximum) u16(0x22, *p.topic_alias_maximum);
+    if (p.topic_alias) u16(0x23, *p.topic_alias);
+    if (p.maximum_qos) u8(0x24, *p.maximum_qos);
+    if (p.retain_available) u8(0x25, *p.retain_available);
+    for (auto& up : p.user_properties) pair(0x26, up.name, up.value);
+    if (p.maximum_packet_size) u32(0x27, *p.maximum_packet_size);
+    if (p.wildcard_subscription_available) u8(0x28, *p.wildcard_subscription_available);
+    if (p.subscription_identifier_available) u8(0x29, *p.subscription_identifier_available);
+    if (p.shared_subscription_available) u8(0x2a, *p.shared_subscription_available);
+}
+
+size_t properties_size(const properties& p) {
+    size_t n = 0;
+    for_each_property(p,
+        [&] (uint8_t, uint8_t) { n += 2; },
+        [&] (uint8_t, uint16_t) { n += 3; },
+        [&] (uint8_t, uint32_t) { n += 5; },
+        [&] (uint8_t, uint32_t v) { n += 1 + varint_size(v); },
+        [&] (uint8_t, const buffer_view& b) { n += 3 + b.size(); },
+        [&] (uint8_t, const buffer_view& k, const buffer_view& v) { n += 5 + k.size() + v.size(); });
+    return n;
+}
+
+void write_properties(writer& w, const properties& p, size_t size) {
+    w.varint(size);
+    for_each_property(p,
+        [&] (uint8_t id, uint8_t v) { w.u8(id); w.u8(v); },
+        [&] (uint8_t id, uint16_t v) { w.u8(id); w.u16(v); },
+        [&] (uint8_t id, uint32_t v) { w.u8(id); w.u32(v); },
+        [&] (uint8_t id, uint32_t v) { w.u8(id); w.varint(v); },
+        [&] (uint8_t id, const buffer_view& b) { w.u8(id); w.binary(b); },
+        [&] (uint8_t id, const buffer_view& k, const buffer_view& v) { w.u8(id); w.binary(k); w.binary(v); });
+}
+
+// Allocates a buffer for a packet with the given fixed header byte and
+// remaining length, writes the fixed header and returns a writer
+// positioned at the variable header.
+// The last omitted bytes of the packet are left for the caller to send
+// separately.
+std::pair<temporary_buffer<char>, writer> make_packet(uint8_t first_byte, uint32_t remaining_length, size_t omitted = 0) {
+    temporary_buffer<char> buf(1 + varint_size(remaining_length) + remaining_length - omitted);
+    writer w(buf.get_write());
+    w.u8(first_byte);
+    w.varint(remaining_length);
+    return {std::move(buf), w};
+}
+
+uint8_t connack_return_code(reason_code code) {
+    switch (code) {
+    case reason_code::success: return 0;
+    case reason_code::unsupported_protocol_version: return 1;
+    case reason_code::client_identifier_not_valid: return 2;
+    case reason_code::server_unavailable:
+    case reason_code::server_busy: return 3;
+    case reason_code::bad_user_name_or_password: return 4;
+    default: return 5;
+    }
+}
+
+uint8_t suback_return_code(reason_code code) {
+    return uint8_t(code) < 0x80 ? uint8_t(code) : 0x80;
+}
+
+} /* anonymous namespace */
+
+properties forwarded_properties(properties& p) {
+    auto share = [] (std::optional<buffer_view>& b) -> std::optional<buffer_view> {
+        if (!b) {
+            return {};
+        }
+        return b->share();
+    };
+    properties f;
+    f.payload_format_indicator = p.payload_format_indicator;
+    f.message_expiry_interval = p.message_expiry_interval;
+    f.content_type = share(p.content_type);
+    f.response_topic = share(p.response_topic);
+    f.correlation_data = share(p.correlation_data);
+    f.user_properties.reserve(p.user_properties.size());
+    for (auto& up : p.user_properties) {
+        f.user_properties.push_back(user_property{up.name.share(), up.value.share()});
+    }
+    return f;
+}
+
+temporary_buffer<char> encode_connack(protocol_version v, bool session_present, reason_code code,
+        const properties& props) {
+    if (v != protocol_version::v5) {
+        auto pw = make_packet(uint8_t(packet_type::connack) << 4, 2);
+        pw.second.u8(session_present);
+        pw.second.u8(connack_return_code(code));
+        return std::move(pw.first);
+    }
+    auto psize = properties_size(props);
+    auto pw = make_packet(uint8_t(packet_type::connack) << 4, 2 + varint_size(psize) + psize);
+    pw.second.u8(session_present);
+    pw.second.u8(uint8_t(code));
+    write_properties(pw.second, props, psize);
+    return std::move(pw.first);
+}
+
+temporary_buffer<char> encode_publish(protocol_version v, const publish& p) {
+    return encode_publish_header(v, p, p.payload.size());
+}
+
+temporary_buffer<char> encode_publish_header(protocol_version v, const publish& p, size_t inline_payload) {
+    uint8_t first = (uint8_t(packet_type::publish) << 4) | (p.dup << 3) | (uint8_t(p.qos) << 1) | p.retain;
+    size_t len = 2 + p.topic.size() + p.payload.size();
+    if (p.qos != qos::at_most_once) {
+        len += 2;
+    }
+    size_t psize = 0;
+    if (v == protocol_version::v5) {
+        psize = properties_size(p.properties);
+        len += varint_size(psize) + psize;
+    }
+    auto pw = make_packet(first, len, p.payload.size() - inline_payload);
+    auto& w = pw.second;
+    w.binary(p.topic);
+    if (p.qos != qos::at_most_once) {
+        w.u16(p.packet_id);
+    }
+    if (v == protocol_version::v5) {
+        write_properties(w, p.properties, psize);
+    }
+    w.bytes(p.payload.get(), inline_payload);
+    return std::move(pw.first);
+}
+
+temporary_buffer<char> encode_ack(protocol_version v, packet_type type, uint16_t packet_id, reason_code code) {
+    uint8_t first = uint8_t(type) << 4;
+    if (type == packet_type::pubrel) {
+        first |= 0x02;
+    }
+    // The reason code may be omitted in v5 when it is success.
+    bool with_code = v == protocol_version::v5 && code != reason_code::success;
+    auto pw = make_packet(first, with_code ? 3 : 2);
+    pw.second.u16(packet_id);
+    if (with_code) {
+        pw.second.u8(uint8_t(code));
+    }
+    return std::move(pw.first);
+}
+
+temporary_buffer<char> encode_suback(protocol_version v, uint16_t packet_id, const std::vector<reason_code>& codes) {
+    bool v5 = v == protocol_version::v5;
+    auto pw = make_packet(uint8_t(packet_type::suback) << 4, 2 + (v5 ? 1 : 0) + codes.size());
+    pw.second.u16(packet_id);
+    if (v5) {
+        pw.second.varint(0);
+    }
+    for (auto c : codes) {
+        pw.second.u8(v5 ? uint8_t(c) : suback_return_code(c));
+    }
+    return std::move(pw.first);
+}
+
+temporary_buffer<char> encode_unsuback(protocol_version v, uint16_t packet_id, const std::vector<reason_code>& codes) {
+    if (v != protocol_version::v5) {
+        auto pw = make_packet(uint8_t(packet_type::unsuback) << 4, 2);
+        pw.second.u16(packet_id);
+        return std::move(pw.first);
+    }
+    auto pw = make_packet(uint8_t(packet_type::unsuback) << 4, 3 + codes.size());
+    pw.second.u16(packet_id);
+    pw.second.varint(0);
+    for (auto c : codes) {
+        pw.second.u8(uint8_t(c));
+    }
+    return std::move(pw.first);
+}
+
+temporary_buffer<char> encode_pingresp() {
+    return std::move(make_packet(uint8_t(packet_type::pingresp) << 4, 0).first);
+}
+
+temporary_buffer<char> encode_disconnect(protocol_version v, reason_code code) {
+    if (v != protocol_version::v5) {
+        return std::move(make_packet(uint8_t(packet_type::disconnect) << 4, 0).first);
+    }
+    auto pw = make_packet(uint8_t(packet_type::disconnect) << 4, 1);
+    pw.second.u8(uint8_t(code));
+    return std::move(pw.first);
+}
+
+} /* namespace mqtt */
+
+} /* namespace hero */
@@ -0,0 +1,58 @@
+/*
+ * This file is open source software, licensed to you under the terms
+ * of the Apache License, Version 2.0 (the "License").  See the NOTICE file
+ * distributed with this work for additional information regarding copyright
+ * ownership.  You may not use this file except in compliance with the License.
+ *
+ * You may obtain a copy of the License at
+ *
+ *   http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing,
+ * software distributed under the License is distributed on an
+ * "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+ * KIND, either express or implied.  See the License for the
+ * specific language governing permissions and limitations
+ * under the License.
+ */
+
+#pragma once
+
+#include "mqtt/protocol.hh"
+
+#include <vector>
+
+namespace hero {
+
+namespace mqtt {
+
+// Encoders for the packets the broker sends.  Properties are only written
+// for v5; for 3.1.1 reason codes are mapped to the closest return code.
+temporary_buffer<char> encode_connack(protocol_version v, bool session_present, reason_code code,
+        const properties& props = {});
+temporary_buffer<char> encode_publish(protocol_version v, const publish& p);
+// Encodes a PUBLISH up to and including the first inline_payload bytes of
+// the payload; the rest of the payload is meant to follow as a separate
+// fragment, shared rather than copied.
+temporary_buffer<char> encode_publish_header(protocol_version v, const publish& p, size_t inline_payload = 0);
+temporary_buffer<char> encode_ack(protocol_version v, packet_type type, uint16_t packet_id,
+        reason_code code = reason_code::success);
+temporary_buffer<char> encode_suback(protocol_version v, uint16_t packet_id, const std::vector<reason_code>& codes);
+temporary_buffer<char> encode_unsuback(protocol_version v, uint16_t packet_id, const std::vector<reason_code>& codes);
+temporary_buffer<char> encode_pingresp();
+temporary_buffer<char> encode_disconnect(protocol_version v, reason_code code);
+
+// The properties of a received PUBLISH that travel with it to subscribers.
+// Topic aliases and subscription identifiers belong to a single connection
+// and are left out.  Shares p's buffers.
+properties forwarded_properties(properties& p);
+
+// Wire size of a variable byte integer.
+size_t varint_size(uint32_t value);
+
+// Writes a variable byte integer at out and returns the position after it.
+char* write_varint(char* out, uint32_t value);
+
+} /* namespace mqtt */
+
+} /* namespace hero */
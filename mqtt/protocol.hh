@@ -0,0 +1,234 @@
+/*
+ * This file is open source software, licensed to you under the terms
+ * of the Apache License, Version 2.0 (the "License").  See the NOTICE file
+ * distributed with this work for additional information regarding copyright
+ * ownership.  You may not use this file except in compliance with the License.
+ *
+ * You may obtain a copy of the License at
+ *
+ *   http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing,
+ * software distributed under the License is distributed on an
+ * "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+ * KIND, either express or implied.  See the License for the
+ * specific language governing permissions and limitations
+ * under the License.
+ */
+
+#pragma once
+
+#include "core/temporary_buffer.hh"
+
+#include <cstdint>
+#include <optional>
+#include <stdexcept>
+#include <string_view>
+#include <utility>
+#include <vector>
+
+namespace hero {
+
+namespace mqtt {
+
+using namespace seastar;
+
+// A view into a received packet.  Shares the underlying read buffer, so
+// holding on to it keeps that buffer alive but never copies it.
+using buffer_view = temporary_buffer<char>;
+
+inline std::string_view as_string_view(const buffer_view& b) {
+    return std::string_view(b.get(), b.size());
+}
+
+enum class packet_type : uint8_t {
+    connect = 1,
+    connack = 2,
+    publish = 3,
+    puback = 4,
+    pubrec = 5,
+    pubrel = 6,
+    pubcomp = 7,
+    subscribe = 8,
+    suback = 9,
+    unsubscribe = 10,
+    unsuback = 11,
+    pingreq = 12,
+    pingresp = 13,
+    disconnect = 14,
+    auth = 15,
+};
+
+const char* to_string(packet_type t);
+
+enum class protocol_version : uint8_t {
+    v311 = 4,
+    v5 = 5,
+};
+
+enum class qos : uint8_t {
+    at_most_once = 0,
+    at_least_once = 1,
+    exactly_once = 2,
+};
+
+// MQTT 5 reason codes.  Only the ones the broker emits are listed; 3.1.1
+// return codes are derived from them by the encoder.
+enum class reason_code : uint8_t {
+    success = 0x00,
+    granted_qos_1 = 0x01,
+    granted_qos_2 = 0x02,
+    no_matching_subscribers = 0x10,
+    no_subscription_existed = 0x11,
+    unspecified_error = 0x80,
+    malformed_packet = 0x81,
+    protocol_error = 0x82,
+    implementation_specific_error = 0x83,
+    unsupported_protocol_version = 0x84,
+    client_identifier_not_valid = 0x85,
+    bad_user_name_or_password = 0x86,
+    not_authorized = 0x87,
+    server_unavailable = 0x88,
+    server_busy = 0x89,
+    keep_alive_timeout = 0x8d,
+    session_taken_over = 0x8e,
+    topic_filter_invalid = 0x8f,
+    topic_name_invalid = 0x90,
+    packet_identifier_in_use = 0x91,
+    packet_identifier_not_found = 0x92,
+    receive_maximum_exceeded = 0x93,
+    topic_alias_invalid = 0x94,
+    packet_too_large = 0x95,
+    quota_exceeded = 0x97,
+    shared_subscriptions_not_supported = 0x9e,
+};
+
+// Thrown by the decoder and packet parsers.  The reason code is what a v5
+// client is told in the DISCONNECT the broker sends before closing.
+class protocol_error : public std::runtime_error {
+    reason_code _code;
+public:
+    protocol_error(reason_code code, const char* what)
+        : std::runtime_error(what)
+        , _code(code)
+    {
+    }
+    reason_code code() const { return _code; }
+};
+
+constexpr uint32_t max_remaining_length = 268435455;
+constexpr size_t max_fixed_header_size = 5;
+
+struct fixed_header {
+    packet_type type;
+    uint8_t flags;
+    uint32_t remaining_length;
+};
+
+// A complete packet as framed by the decoder.  body holds the variable
+// header and payload and shares the buffer it was read into.
+struct packet {
+    fixed_header header;
+    buffer_view body;
+};
+
+struct user_property {
+    buffer_view name;
+    buffer_view value;
+};
+
+// MQTT 5 properties.  Absent in 3.1.1, where every field stays empty.
+struct properties {
+    std::optional<uint8_t> payload_format_indicator;
+    std::optional<uint32_t> message_expiry_interval;
+    std::optional<buffer_view> content_type;
+    std::optional<buffer_view> response_topic;
+    std::optional<buffer_view> correlation_data;
+    std::vector<uint32_t> subscription_identifiers;
+    std::optional<uint32_t> session_expiry_interval;
+    std::optional<buffer_view> assigned_client_identifier;
+    std::optional<uint16_t> server_keep_alive;
+    std::optional<buffer_view> authentication_method;
+    std::optional<buffer_view> authentication_data;
+    std::optional<uint8_t> request_problem_information;
+    std::optional<uint32_t> will_delay_interval;
+    std::optional<uint8_t> request_response_information;
+    std::optional<buffer_view> response_information;
+    std::optional<buffer_view> server_reference;
+    std::optional<buffer_view> reason_string;
+    std::optional<uint16_t> receive_maximum;
+    std::optional<uint16_t> topic_alias_maximum;
+    std::optional<uint16_t> topic_alias;
+    std::optional<uint8_t> maximum_qos;
+    std::optional<uint8_t> retain_available;
+    std::vector<user_property> user_properties;
+    std::optional<uint32_t> maximum_packet_size;
+    std::optional<uint8_t> wildcard_subscription_available;
+    std::optional<uint8_t> subscription_identifier_available;
+    std::optional<uint8_t> shared_subscription_available;
+};
+
+struct will_message {
+    buffer_view topic;
+    buffer_view payload;
+    mqtt::qos qos;
+    bool retain;
+    mqtt::properties properties;
+};
+
+struct connect {
+    protocol_version version;
+    bool clean_start;
+    uint16_t keep_alive;
+    buffer_view client_id;
+    std::optional<will_message> will;
+    std::optional<buffer_view> username;
+    std::optional<buffer_view> password;
+    mqtt::properties properties;
+};
+
+struct publish {
+    buffer_view topic;
+    buffer_view payload;
+    mqtt::qos qos;
+    bool retain;
+    bool dup;
+    uint16_t packet_id = 0;
+    mqtt::properties properties;
+};
+
+// PUBACK, PUBREC, PUBREL and PUBCOMP share one layout.
+struct ack {
+    uint16_t packet_id;
+    reason_code code = reason_code::success;
+    mqtt::properties properties;
+};
+
+struct subscription_request {
+    buffer_view topic_filter;
+    mqtt::qos max_qos;
+    bool no_local = false;
+    bool retain_as_published = false;
+    uint8_t retain_handling = 0;
+};
+
+struct subscribe {
+    uint16_t packet_id;
+    mqtt::properties properties;
+    std::vector<subscription_request> subscriptions;
+};
+
+struct unsubscribe {
+    uint16_t packet_id;
+    mqtt::properties properties;
+    std::vector<buffer_view> topic_filters;
+};
+
+struct disconnect {
+    reason_code code = reason_code::success;
+    mqtt::properties properties;
+};
+
+} /* namespace mqtt */
+
+} /* namespace hero */
@@ -0,0 +1,141 @@
+/*
+ * This file is open source software, licensed to you under the terms
+ * of the Apache License, Version 2.0 (the "License").  See the NOTICE file
+ * distributed with this work for additional information regarding copyright
+ * ownership.  You may not use this file except in compliance with the License.
+ *
+ * You may obtain a copy of the License at
+ *
+ *   http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing,
+ * software distributed under the License is distributed on an
+ * "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+ * KIND, either express or implied.  See the License for the
+ * specific language governing permissions and limitations
+ * under the License.
+ */
+
+#include "output_queue.hh"
+#include "core/future-util.hh"
+#include "core/reactor.hh"
+#include "util/log.hh"
+
+namespace hero {
+
+static logger olog("output");
+
+void output_queue::push(net::packet p) {
+    if (_failed || !p.len()) {
+        return;
+    }
+    _queued_bytes += p.len();
+    _admission.queued(p.len());
+    _pending.append(std::move(p));
+    _pending_packets++;
+    _stats.packets_queued++;
+    if (_pending.len() >= _policy.flush_bytes || _pending_packets >= _policy.flush_packets) {
+        _stats.threshold_flushes++;
+        start_write();
+    } else {
+        schedule_flush();
+    }
+}
+
+bool output_queue::push_droppable(net::packet p) {
+    if (_queued_bytes >= _policy.max_queued_bytes || _admission.shed(p.len())) {
+        _stats.packets_dropped++;
+        return false;
+    }
+    push(std::move(p));
+    return true;
+}
+
+void output_queue::schedule_flush() {
+    if (_flush_scheduled || _writing) {
+        return;
+    }
+    _flush_scheduled = true;
+    // As in fanout, later() lets every packet produced during this poll
+    // cycle join the write.
+    with_gate(_gate, [this] {
+        return later().then([this] {
+            _flush_scheduled = false;
+            if (_writing) {
+                return make_ready_future<>();
+            }
+            _writing = true;
+            return write_pending();
+        });
+    });
+}
+
+void output_queue::start_write() {
+    if (_writing) {
+        // The write in progress picks the new packets up when it is done.
+        return;
+    }
+    _writing = true;
+    with_gate(_gate, [this] {
+        return write_pending();
+    });
+}
+
+future<> output_queue::write_pending() {
+    return repeat([this] {
+        if (_failed || !_pending_packets) {
+            _writing = false;
+            return make_ready_future<stop_iteration>(stop_iteration::yes);
+        }
+        auto p = std::exchange(_pending, net::packet());
+        auto len = p.len();
+        _pending_packets = 0;
+        _stats.writes++;
+        _stats.bytes_written += len;
+        return _out.write(std::move(p)).then([this] {
+            return _out.flush();
+        }).then([this, len] {
+            _queued_bytes -= len;
+            _admission.sent(len);
+            release_space();
+            return stop_iteration::no;
+        });
+    }).handle_exception([this] (std::exception_ptr ep) {
+        olog.debug("write failed: {}", ep);
+        // The connection is going away; what is left will never be sent.
+        _failed = true;
+        _writing = false;
+        _pending = net::packet();
+        _pending_packets = 0;
+        _admission.sent(_queued_bytes);
+        _queued_bytes = 0;
+        release_space();
+    });
+}
+
+future<> output_queue::wait_for_space() {
+    if (_failed || _queued_bytes <= _policy.max_queued_bytes) {
+        return _admission.wait_for_outbound();
+    }
+    _stats.read_pauses++;
+    _space = promise<>();
+    return _space->get_future().then([this] {
+        return _admission.wait_for_outbound();
+    });
+}
+
+void output_queue::release_space() {
+    if (_space && (_failed || _queued_bytes <= _policy.resume_bytes)) {
+        _space->set_value();
+        _space = {};
+    }
+}
+
+future<> output_queue::close() {
+    if (_pending_packets) {
+        start_write();
+    }
+    return _gate.close();
+}
+
+} /* namespace hero */
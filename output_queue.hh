@@ -0,0 +1,114 @@
+/*
+ * This file is open source software, licensed to you under the terms
+ * of the Apache License, Version 2.0 (the "License").  See the NOTICE file
+ * distributed with this work for additional information regarding copyright
+ * ownership.  You may not use this file except in compliance with the License.
+ *
+ * You may obtain a copy of the License at
+ *
+ *   http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing,
+ * software distributed under the License is distributed on an
+ * "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+ * KIND, either express or implied.  See the License for the
+ * specific language governing permissions and limitations
+ * under the License.
+ */
+
+#pragma once
+
+#include "core/future.hh"
+#include "core/gate.hh"
+#include "core/iostream.hh"
+#include "net/packet.hh"
+#include "admission.hh"
+
+#include <optional>
+
+namespace hero {
+
+using namespace seastar;
+
+// When a connection writes what it has queued.
+struct output_policy {
+    // Write as soon as this much is queued...
+    size_t flush_bytes = 64 * 1024;
+    // ...or this many packets; otherwise at the end of the poll cycle.
+    size_t flush_packets = 128;
+    // Droppable packets are refused above this many queued bytes.
+    size_t max_queued_bytes = 4 * 1024 * 1024;
+    // A connection stops reading above max_queued_bytes and resumes below
+    // this.
+    size_t resume_bytes = 1024 * 1024;
+    // Topics a connection keeps its last encoded PUBLISH header for and,
+    // if the client accepts them, topic aliases for; 0 disables both.
+    size_t topic_cache_size = 64;
+};
+
+// Counters shared by the connections of a shard.
+struct output_stats {
+    uint64_t packets_queued = 0;
+    uint64_t packets_dropped = 0;
+    uint64_t writes = 0;
+    uint64_t bytes_written = 0;
+    uint64_t threshold_flushes = 0;
+    uint64_t read_pauses = 0;
+    uint64_t topic_alias_hits = 0;
+    uint64_t header_cache_hits = 0;
+    uint64_t oversized_dropped = 0;
+};
+
+// The send side of a connection.  Packets are gathered into one
+// scatter-gather net::packet and written, then flushed, once per poll cycle
+// or whenever the policy's thresholds are reached, with at most one write
+// outstanding.  Queued bytes also count against the shard's outbound
+// budget.
+class output_queue {
+    output_stream<char>& _out;
+    const output_policy& _policy;
+    output_stats& _stats;
+    admission_control& _admission;
+    net::packet _pending;
+    size_t _pending_packets = 0;
+    // Pending bytes plus the bytes of the write in progress.
+    size_t _queued_bytes = 0;
+    bool _writing = false;
+    bool _flush_scheduled = false;
+    bool _failed = false;
+    std::optional<promise<>> _space;
+    gate _gate;
+public:
+    output_queue(output_stream<char>& out, const output_policy& policy, output_stats& stats, admission_control& admission)
+        : _out(out)
+        , _policy(policy)
+        , _stats(stats)
+        , _admission(admission)
+    {
+    }
+
+    // Queues a packet that must reach the client.
+    void push(net::packet p);
+    // Queues a packet the client can do without, such as a QoS 0 PUBLISH,
+    // unless the queue is full or the shard sheds such packets.  Returns
+    // false if it was dropped.
+    bool push_droppable(net::packet p);
+
+    // Resolves once the queue, and the shard's outbound budget, leave room
+    // for the connection to read more requests, whose replies would add to
+    // them.
+    future<> wait_for_space();
+
+    // Writes what is left and waits for it.  Nothing may be queued
+    // afterwards.
+    future<> close();
+
+    size_t queued_bytes() const { return _queued_bytes; }
+private:
+    void schedule_flush();
+    void start_write();
+    future<> write_pending();
+    void release_space();
+};
+
+} /* namespace hero */
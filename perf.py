@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+#
+# This file is open source software, licensed to you under the terms
+# of the Apache License, Version 2.0 (the "License").  See the NOTICE file
+# distributed with this work for additional information regarding copyright
+# ownership.  You may not use this file except in compliance with the License.
+#
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+
+# Runs the microbenchmarks in build/<mode>/tests/perf, writes their results
+# as JSON and compares them with a baseline from an earlier run.
+#
+# A benchmark regressed if its time per operation grew by more than both
+# --threshold percent and --noise times the larger median absolute
+# deviation of the two runs, or if it allocates more per operation than
+# --alloc-threshold above the baseline.  The exit status is 1 if any did.
+
+import argparse
+import datetime
+import glob
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+
+# Perf tests which are not microbenchmarks; see perf_apps in configure.py.
+apps = set(['perf_mqtt_load'])
+
+
+def find_benchmarks(mode):
+    binaries = []
+    for path in sorted(glob.glob(os.path.join('build', mode, 'tests', 'perf', 'perf_*'))):
+        name = os.path.basename(path)
+        if name in apps or name.endswith('_g') or not os.access(path, os.X_OK):
+            continue
+        binaries.append(path)
+    return binaries
+
+
+def run_benchmark(path, args):
+    with tempfile.NamedTemporaryFile(suffix = '.json') as out:
+        cmd = [path, '-c', str(args.smp), '-m', args.memory,
+               '--runs', str(args.runs),
+               '--min-time', str(args.min_time),
+               '--json', out.name]
+        if args.filter:
+            cmd += ['--filter', args.filter]
+        print(' '.join(cmd))
+        subprocess.check_call(cmd)
+        return json.load(open(out.name))['benchmarks']
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], universal_newlines = True).strip()
+    except (subprocess.CalledProcessError, OSError):
+        return None
+
+
+def cpu_model():
+    try:
+        for line in open('/proc/cpuinfo'):
+            if line.startswith('model name'):
+                return line.split(':', 1)[1].strip()
+    except OSError:
+        pass
+    return platform.processor()
+
+
+def compare(baseline, results, args):
+    regressions = 0
+    print('{:<40} {:>12} {:>12} {:>9} {:>10} {:>10}  {}'.format(
+        'benchmark', 'base ns/op', 'ns/op', 'change', 'base alloc', 'alloc', 'verdict'))
+    for name in sorted(results):
+        cur = results[name]
+        if name not in baseline:
+            print('{:<40} {:>12} {:>12.2f} {:>9} {:>10} {:>10.2f}  new'.format(
+                name, '-', cur['ns_per_op'], '-', '-', cur['allocations_per_op']))
+            continue
+        base = baseline[name]
+        delta = cur['ns_per_op'] - base['ns_per_op']
+        # A change has to stand out from both a fixed fraction and the
+        # spread the runs themselves showed.
+        allowed = max(base['ns_per_op'] * args.threshold / 100,
+                      args.noise * max(base['mad_ns'], cur['mad_ns']))
+        verdicts = []
+        if delta > allowed:
+            verdicts.append('slower')
+        elif -delta > allowed:
+            verdicts.append('faster')
+        if cur['allocations_per_op'] - base['allocations_per_op'] > args.alloc_threshold:
+            verdicts.append('more allocations')
+        elif base['allocations_per_op'] - cur['allocations_per_op'] > args.alloc_threshold:
+            verdicts.append('fewer allocations')
+        if 'slower' in verdicts or 'more allocations' in verdicts:
+            regressions += 1
+        print('{:<40} {:>12.2f} {:>12.2f} {:>+8.1f}% {:>10.2f} {:>10.2f}  {}'.format(
+            name, base['ns_per_op'], cur['ns_per_op'], 100 * delta / base['ns_per_op'],
+            base['allocations_per_op'], cur['allocations_per_op'], ', '.join(verdicts) or 'same'))
+    for name in sorted(set(baseline) - set(results)):
+        print('{:<40} missing from this run'.format(name))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Run HeroMQ microbenchmarks and compare them with a baseline')
+    parser.add_argument('--mode', default = 'release', help = 'Build mode of the benchmarks')
+    parser.add_argument('--filter', default = '', help = 'Only run benchmarks whose names match this regular expression')
+    parser.add_argument('--runs', type = int, default = 5, help = 'Measured runs of each benchmark')
+    parser.add_argument('--min-time', type = int, default = 200, help = 'Milliseconds each run lasts at least')
+    parser.add_argument('--smp', type = int, default = 2, help = 'Shards to run the benchmarks on')
+    parser.add_argument('--memory', default = '1G', help = 'Memory to give the benchmarks')
+    parser.add_argument('--output', default = None, help = 'Where to write the results; build/<mode>/perf.json by default')
+    parser.add_argument('--baseline', default = None, help = 'Results of an earlier run to compare with')
+    parser.add_argument('--save-baseline', action = 'store_true', help = 'Also write the results to the --baseline file')
+    parser.add_argument('--threshold', type = float, default = 5, help = 'Percent by which time per operation may grow')
+    parser.add_argument('--noise', type = float, default = 3, help = 'Median absolute deviations by which time per operation may grow')
+    parser.add_argument('--alloc-threshold', type = float, default = 0.5, help = 'Allocations per operation by which a benchmark may grow')
+    args = parser.parse_args()
+
+    binaries = find_benchmarks(args.mode)
+    if not binaries:
+        print('No benchmarks found in build/{}/tests/perf; build them with ninja first'.format(args.mode))
+        sys.exit(2)
+
+    results = {}
+    for path in binaries:
+        for b in run_benchmark(path, args):
+            b['binary'] = os.path.basename(path)
+            results[b.pop('name')] = b
+
+    doc = {
+        'metadata': {
+            'revision': git_revision(),
+            'mode': args.mode,
+            'host': platform.node(),
+            'cpu': cpu_model(),
+            'smp': args.smp,
+            'date': datetime.datetime.utcnow().replace(microsecond = 0).isoformat() + 'Z',
+        },
+        'benchmarks': results,
+    }
+    output = args.output or os.path.join('build', args.mode, 'perf.json')
+    with open(output, 'w') as f:
+        json.dump(doc, f, indent = 2, sort_keys = True)
+    print('Results written to {}'.format(output))
+
+    if not args.baseline:
+        return
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(doc, f, indent = 2, sort_keys = True)
+        print('Baseline saved to {}'.format(args.baseline))
+        return
+    baseline = json.load(open(args.baseline))
+    if baseline['metadata'].get('cpu') != doc['metadata']['cpu']:
+        print('Warning: the baseline was taken on a different CPU ({})'.format(baseline['metadata'].get('cpu')))
+    regressions = compare(baseline['benchmarks'], results, args)
+    if regressions:
+        print('{} benchmark(s) regressed'.format(regressions))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
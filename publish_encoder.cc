@@ -0,0 +1,183 @@
+/*
+ * This file is open source software, licensed to you under the terms
+ * of the Apache License, Version 2.0 (the "License").  See the NOTICE file
+ * distributed with this work for additional information regarding copyright
+ * ownership.  You may not use this file except in compliance with the License.
+ *
+ * You may obtain a copy of the License at
+ *
+ *   http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing,
+ * software distributed under the License is distributed on an
+ * "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+ * KIND, either express or implied.  See the License for the
+ * specific language governing permissions and limitations
+ * under the License.
+ */
+
+#include "publish_encoder.hh"
+#include "mqtt/encoder.hh"
+
+#include <cstring>
+
+namespace hero {
+
+// Only these properties keep a header from being reused; the subscription
+// identifier is part of what a cached header was encoded for.
+static bool has_properties(const mqtt::properties& p) {
+    return p.payload_format_indicator || p.message_expiry_interval || p.content_type
+            || p.response_topic || p.correlation_data || !p.user_properties.empty();
+}
+
+publish_encoder::publish_encoder(output_stats& stats, size_t capacity)
+    : _stats(stats)
+    , _capacity(capacity)
+{
+}
+
+void publish_encoder::start(mqtt::protocol_version v, uint16_t alias_maximum) {
+    _version = v;
+    _alias_maximum = v == mqtt::protocol_version::v5 ? std::min<size_t>(alias_maximum, _capacity) : 0;
+}
+
+uint16_t publish_encoder::allocate_alias() {
+    if (!_free_aliases.empty()) {
+        auto alias = _free_aliases.back();
+        _free_aliases.pop_back();
+        return alias;
+    }
+    if (_next_alias <= _alias_maximum) {
+        return _next_alias++;
+    }
+    return 0;
+}
+
+publish_encoder::entry* publish_encoder::find(std::string_view topic) {
+    auto i = _topics.find(topic);
+    if (i != _topics.end()) {
+        _lru.splice(_lru.begin(), _lru, i->second);
+        return &*i->second;
+    }
+    if (!_capacity) {
+        return nullptr;
+    }
+    if (_topics.size() == _capacity) {
+        auto& victim = _lru.back();
+        if (victim.alias) {
+            _free_aliases.push_back(victim.alias);
+        }
+        _topics.erase(std::string_view(victim.topic.c_str(), victim.topic.size()));
+        _lru.pop_back();
+    }
+    _lru.emplace_front();
+    auto& e = _lru.front();
+    e.topic = sstring(topic.data(), topic.size());
+    _topics.emplace(std::string_view(e.topic.c_str(), e.topic.size()), _lru.begin());
+    return &e;
+}
+
+void publish_encoder::dropped(std::string_view topic) {
+    auto i = _topics.find(topic);
+    if (i != _topics.end()) {
+        i->second->alias_known = false;
+    }
+}
+
+encoded_publish publish_encoder::encode(message& msg, const delivery& d) {
+    encoded_publish result;
+    auto e = find(msg.topic_view());
+    bool alias_only = false;
+    uint16_t alias = 0;
+    if (e) {
+        if (!e->alias) {
+            e->alias = allocate_alias();
+        }
+        if (e->alias) {
+            alias = e->alias;
+            alias_only = e->alias_known;
+            if (!alias_only) {
+                e->alias_known = true;
+                result.sets_alias = true;
+            } else {
+                _stats.topic_alias_hits++;
+            }
+        }
+    }
+    uint8_t first = (uint8_t(mqtt::packet_type::publish) << 4) | (d.dup << 3) | (uint8_t(d.qos) << 1) | d.retain;
+    bool plain = _version != mqtt::protocol_version::v5 || !has_properties(msg.properties);
+    auto payload_size = msg.payload.size();
+    if (e && plain && e->header.size() && e->first_byte == first && e->header_alias == alias
+            && e->alias_only == alias_only && e->payload_size == payload_size && e->subscription_identifier == d.subscription_identifier) {
+        _stats.header_cache_hits++;
+        result.packet = assemble(e->header, e->packet_id_offset, msg, d);
+        return result;
+    }
+    mqtt::publish out;
+    if (!alias_only) {
+        out.topic = msg.topic.share();
+    }
+    out.payload = msg.payload.share();
+    out.qos = d.qos;
+    out.retain = d.retain;
+    out.dup = d.dup;
+    out.packet_id = d.packet_id;
+    if (_version == mqtt::protocol_version::v5) {
+        out.properties = mqtt::forwarded_properties(msg.properties);
+        if (d.subscription_identifier) {
+            out.properties.subscription_identifiers.push_back(d.subscription_identifier);
+        }
+        if (alias) {
+            out.properties.topic_alias = alias;
+        }
+    }
+    if (!e || !plain) {
+        // Only the header is built per subscriber.  The payload goes out
+        // as a fragment sharing the message's buffer, which every
+        // subscriber of the message references; small payloads are
+        // cheaper to copy than to reference.
+        if (payload_size <= inline_payload_limit) {
+            result.packet = net::packet(mqtt::encode_publish(_version, out));
+        } else {
+            result.packet = net::packet(net::packet(mqtt::encode_publish_header(_version, out)), std::move(out.payload));
+        }
+        return result;
+    }
+    auto header = mqtt::encode_publish_header(_version, out);
+    // The packet identifier follows the remaining length and the topic.
+    size_t offset = 1;
+    while (uint8_t(header[offset++]) & 0x80) {
+    }
+    e->packet_id_offset = offset + 2 + out.topic.size();
+    e->header = std::move(header);
+    e->first_byte = first;
+    e->header_alias = alias;
+    e->alias_only = alias_only;
+    e->payload_size = payload_size;
+    e->subscription_identifier = d.subscription_identifier;
+    result.packet = assemble(e->header, e->packet_id_offset, msg, d);
+    return result;
+}
+
+net::packet publish_encoder::assemble(temporary_buffer<char>& header, size_t packet_id_offset,
+        message& msg, const delivery& d) {
+    auto payload_size = msg.payload.size();
+    bool inline_payload = payload_size <= inline_payload_limit;
+    if (!inline_payload && d.qos == mqtt::qos::at_most_once) {
+        return net::packet(net::packet(header.share()), msg.payload.share());
+    }
+    temporary_buffer<char> buf(header.size() + (inline_payload ? payload_size : 0));
+    auto p = buf.get_write();
+    std::memcpy(p, header.get(), header.size());
+    if (d.qos != mqtt::qos::at_most_once) {
+        p[packet_id_offset] = char(d.packet_id >> 8);
+        p[packet_id_offset + 1] = char(d.packet_id);
+    }
+    if (inline_payload) {
+        std::memcpy(p + header.size(), msg.payload.get(), payload_size);
+        return net::packet(std::move(buf));
+    }
+    return net::packet(net::packet(std::move(buf)), msg.payload.share());
+}
+
+} /* namespace hero */
@@ -0,0 +1,108 @@
+/*
+ * This file is open source software, licensed to you under the terms
+ * of the Apache License, Version 2.0 (the "License").  See the NOTICE file
+ * distributed with this work for additional information regarding copyright
+ * ownership.  You may not use this file except in compliance with the License.
+ *
+ * You may obtain a copy of the License at
+ *
+ *   http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing,
+ * software distributed under the License is distributed on an
+ * "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+ * KIND, either express or implied.  See the License for the
+ * specific language governing permissions and limitations
+ * under the License.
+ */
+
+#pragma once
+
+#include "core/sstring.hh"
+#include "core/temporary_buffer.hh"
+#include "net/packet.hh"
+#include "mqtt/protocol.hh"
+#include "message.hh"
+#include "output_queue.hh"
+
+#include <list>
+#include <string_view>
+#include <unordered_map>
+#include <vector>
+
+namespace hero {
+
+using namespace seastar;
+
+struct encoded_publish {
+    net::packet packet;
+    // Whether the packet tells the client a topic alias.  If it is dropped
+    // rather than sent, the encoder must be told (see dropped()).
+    bool sets_alias = false;
+};
+
+// Builds the PUBLISH packets a connection sends, remembering the topics it
+// sent last.
+//
+// Each remembered topic keeps the header last encoded for it, without the
+// payload.  A delivery on the topic with the same flags, payload size and
+// subscription identifier, and no other properties, reuses that header
+// with its packet identifier patched in instead of encoding a new one.
+//
+// For a v5 client that accepts topic aliases, remembered topics also get
+// aliases, as many as the client allows.  A topic goes out in full with
+// its alias once, and as the alias alone after that.  The alias of a
+// topic that is forgotten goes to the next new topic.
+class publish_encoder {
+public:
+    // Payloads up to this size are copied after the header rather than
+    // sent as a separate fragment.
+    static constexpr size_t inline_payload_limit = 256;
+private:
+    struct entry {
+        sstring topic;
+        uint16_t alias = 0;
+        // Whether the client has been sent the alias with the topic.
+        bool alias_known = false;
+        temporary_buffer<char> header;
+        // What header was encoded for.
+        uint8_t first_byte = 0;
+        uint16_t header_alias = 0;
+        bool alias_only = false;
+        uint32_t payload_size = 0;
+        uint32_t subscription_identifier = 0;
+        size_t packet_id_offset = 0;
+    };
+    using lru_list = std::list<entry>;
+    output_stats& _stats;
+    size_t _capacity;
+    mqtt::protocol_version _version = mqtt::protocol_version::v311;
+    uint16_t _alias_maximum = 0;
+    uint16_t _next_alias = 1;
+    std::vector<uint16_t> _free_aliases;
+    // Most recently used first.
+    lru_list _lru;
+    std::unordered_map<std::string_view, lru_list::iterator> _topics;
+public:
+    // Remembers up to capacity topics; none if 0.
+    publish_encoder(output_stats& stats, size_t capacity);
+
+    // Sets up the encoder for the protocol version and topic alias maximum
+    // of the client's CONNECT.
+    void start(mqtt::protocol_version v, uint16_t alias_maximum);
+
+    encoded_publish encode(message& msg, const delivery& d);
+
+    // The packet encode() returned for topic was dropped; its alias is to
+    // be sent again with the topic.
+    void dropped(std::string_view topic);
+
+    size_t topics() const { return _topics.size(); }
+private:
+    entry* find(std::string_view topic);
+    uint16_t allocate_alias();
+    static net::packet assemble(temporary_buffer<char>& header, size_t packet_id_offset,
+            message& msg, const delivery& d);
+};
+
+} /* namespace hero */
@@ -0,0 +1,817 @@
+/*
+ * This file is open source software, licensed to you under the terms
+ * of the Apache License, Version 2.0 (the "License").  See the NOTICE file
+ * distributed with this work for additional information regarding copyright
+ * ownership.  You may not use this file except in compliance with the License.
+ *
+ * You may obtain a copy of the License at
+ *
+ *   http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing,
+ * software distributed under the License is distributed on an
+ * "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+ * KIND, either express or implied.  See the License for the
+ * specific language governing permissions and limitations
+ * under the License.
+ */
+
+#include "retained_store.hh"
+#include "core/future-util.hh"
+#include "core/metrics.hh"
+#include "core/print.hh"
+#include "core/reactor.hh"
+#include "mqtt/encoder.hh"
+#include "session.hh"
+#include "util/log.hh"
+
+#include <algorithm>
+#include <cstring>
+#include <iterator>
+#include <limits>
+#include <stdexcept>
+
+namespace hero {
+
+static logger rlog("retained");
+
+// A lookup step visits at most this many nodes, and gathers at most this
+// many matches, before handing them over and yielding.
+static constexpr size_t lookup_nodes = 4096;
+static constexpr size_t lookup_batch = 256;
+// Spill files are written this much at a time.
+static constexpr size_t spill_batch_bytes = 1024 * 1024;
+// Eviction looks at this many of the least recently used messages and
+// spills the largest, so that the budget is met with fewer messages moved
+// to disk and small ones, cheap to keep, stay in memory longer.
+static constexpr unsigned victim_sample = 8;
+
+static size_t align_up(size_t v, size_t alignment) {
+    return (v + alignment - 1) & ~(alignment - 1);
+}
+
+// Calls func with each '/'-separated level of a topic or filter; stops
+// early if func returns false.
+template <typename Func>
+static void for_each_level(std::string_view topic, Func&& func) {
+    size_t start = 0;
+    while (true) {
+        auto end = topic.find('/', start);
+        if (!func(topic.substr(start, end == std::string_view::npos ? end : end - start))) {
+            return;
+        }
+        if (end == std::string_view::npos) {
+            return;
+        }
+        start = end + 1;
+    }
+}
+
+unsigned retained_owner(std::string_view topic) {
+    // Topics are spread over the shards with the same stable hash as
+    // client identifiers.
+    return session_owner(topic);
+}
+
+// An incremental walk of the trie for one filter.  The walk keeps a stack
+// of nodes whose children it is going through; a child removed while the
+// walk is paused keeps its link to the next sibling, and is not reused
+// before the walk ends, so the walk can carry on from it.
+class retained_store::lookup {
+    struct frame {
+        node_index parent;
+        node_index cursor;
+        uint32_t depth;
+        // Under a '#': every node below parent matches.
+        bool subtree;
+    };
+    retained_store& _store;
+    std::vector<sstring> _filter;
+    bool _exact = true;
+    uint64_t _epoch;
+    bool _started = false;
+    std::vector<frame> _stack;
+public:
+    std::vector<lw_shared_ptr<message>> found;
+    std::vector<spilled_match> spilled;
+
+    lookup(retained_store& store, std::string_view filter)
+        : _store(store)
+        , _epoch(++store._epoch)
+    {
+        _store._lookups[_epoch]++;
+        for_each_level(filter, [this] (std::string_view level) {
+            _filter.emplace_back(level.data(), level.size());
+            _exact = _exact && level != "+" && level != "#";
+            return true;
+        });
+    }
+    lookup(const lookup&) = delete;
+    ~lookup() {
+        auto i = _store._lookups.find(_epoch);
+        if (!--i->second) {
+            _store._lookups.erase(i);
+        }
+        _store.release_retired();
+    }
+
+    bool exact() const { return _exact; }
+
+    // Gathers the next matches into found and spilled; returns false once
+    // there are no more.
+    bool step() {
+        if (!_started) {
+            _started = true;
+            visit(root, 0);
+        }
+        size_t visited = 0;
+        while (!_stack.empty()) {
+            if (visited >= lookup_nodes || found.size() + spilled.size() >= lookup_batch) {
+                return true;
+            }
+            auto& top = _stack.back();
+            auto c = top.cursor;
+            if (c == npos) {
+                _stack.pop_back();
+                continue;
+            }
+            const auto& cn = _store._nodes[c];
+            top.cursor = cn.next;
+            visited++;
+            if (cn.level == dead_level || (top.parent == root && cn.system)) {
+                continue;
+            }
+            auto depth = top.depth;
+            if (top.subtree) {
+                emit(c);
+                _stack.push_back(frame{c, cn.first_child, depth, true});
+            } else {
+                visit(c, depth + 1);
+            }
+        }
+        return false;
+    }
+private:
+    // Matches the rest of the filter, from depth on, below n.
+    void visit(node_index n, uint32_t depth) {
+        while (depth < _filter.size()) {
+            auto& level = _filter[depth];
+            if (level == "#") {
+                // "a/#" matches "a" too.
+                emit(n);
+                _stack.push_back(frame{n, _store._nodes[n].first_child, depth, true});
+                return;
+            }
+            if (level == "+") {
+                _stack.push_back(frame{n, _store._nodes[n].first_child, depth, false});
+                return;
+            }
+            n = _store.find_child(n, std::string_view(level.c_str(), level.size()));
+            if (n == npos) {
+                return;
+            }
+            depth++;
+        }
+        emit(n);
+    }
+
+    void emit(node_index n) {
+        auto i = _store._nodes[n].entry;
+        if (i == npos) {
+            return;
+        }
+        auto& e = _store._entries[i];
+        if (e.data) {
+            if (_exact) {
+                _store.touch(e);
+            }
+            found.push_back(_store.decode(e));
+        } else if (e.segment) {
+            spilled.push_back(spilled_match{e.index, e.version, _store._segments.at(e.segment->id), e.offset, e.size});
+        }
+    }
+};
+
+retained_store::retained_store(retained_config config)
+    : _config(std::move(config))
+{
+    _nodes.emplace_back();
+    setup_metrics();
+}
+
+void retained_store::setup_metrics() {
+    namespace sm = seastar::metrics;
+    _metrics.add_group("hero_retained", {
+        sm::make_gauge("messages", [this] { return _messages; },
+                sm::description("Retained messages held by this shard")),
+        sm::make_gauge("resident_bytes", [this] { return _resident; },
+                sm::description("Bytes of retained messages held in memory")),
+        sm::make_gauge("arena_used_bytes", [this] { return _arena.used(); },
+                sm::description("Bytes of arena slots in use, including those of replaced messages still being sent")),
+        sm::make_gauge("arena_reserved_bytes", [this] { return _arena.reserved(); },
+                sm::description("Bytes the retained message arena took from the system")),
+        sm::make_gauge("index_nodes", [this] { return _nodes.size() - _free_nodes.size(); },
+                sm::description("Nodes in the retained topic index")),
+        sm::make_gauge("index_levels", [this] { return _levels.size(); },
+                sm::description("Distinct topic levels in the retained topic index")),
+        sm::make_gauge("spilled_messages", [this] { return _spilled; },
+                sm::description("Retained messages held only in spill files")),
+        sm::make_gauge("spill_file_bytes", [this] {
+                    uint64_t bytes = 0;
+                    for (auto& s : _segments) {
+                        bytes += s.second->size;
+                    }
+                    return bytes;
+                },
+                sm::description("Size of the spill files")),
+        sm::make_derive("stored", _stats.stored,
+                sm::description("Retained messages stored or replaced")),
+        sm::make_derive("cleared", _stats.cleared,
+                sm::description("Retained messages cleared by an empty retained PUBLISH")),
+        sm::make_derive("spills", _stats.spilled,
+                sm::description("Retained messages moved to spill files")),
+        sm::make_derive("spill_reads", _stats.spill_reads,
+                sm::description("Retained messages read back from spill files")),
+        sm::make_derive("dropped", _stats.dropped,
+                sm::description("Retained messages dropped because they did not fit the memory budget and could not be spilled")),
+        sm::make_derive("lookups", _stats.lookups,
+                sm::description("Retained message lookups for new subscriptions")),
+        sm::make_derive("matches", _stats.matches,
+                sm::description("Retained messages found by lookups")),
+        sm::make_derive("segments_compacted", _stats.segments_compacted,
+                sm::description("Spill files compacted")),
+    });
+}
+
+sstring retained_store::segment_name(uint64_t id) const {
+    return sprint("%s/%016x.spill", _dir, id);
+}
+
+future<> retained_store::start() {
+    if (_config.spill_directory.empty()) {
+        return make_ready_future<>();
+    }
+    _dir = sprint("%s/shard-%d", _config.spill_directory, engine().cpu_id());
+    return recursive_touch_directory(_dir).then([this] {
+        return open_directory(_dir);
+    }).then([this] (file dir) {
+        return do_with(std::move(dir), std::vector<sstring>(), [this] (file& dir, std::vector<sstring>& names) {
+            auto listing = dir.list_directory([&names] (directory_entry de) {
+                const auto& name = de.name;
+                if (name.size() > 6 && std::equal(name.end() - 6, name.end(), ".spill")) {
+                    names.push_back(name);
+                }
+                return make_ready_future<>();
+            });
+            return do_with(std::move(listing), [] (auto& listing) {
+                return listing.done();
+            }).then([this, &names] {
+                return parallel_for_each(names, [this] (const sstring& name) {
+                    return remove_file(_dir + "/" + name);
+                });
+            }).finally([&dir] {
+                return dir.close();
+            });
+        });
+    });
+}
+
+future<> retained_store::stop() {
+    _stopping = true;
+    return _gate.close().then([this] {
+        _active = nullptr;
+        return do_with(std::move(_segments), [this] (auto& segments) {
+            return parallel_for_each(segments, [this] (auto& i) {
+                auto s = i.second;
+                return s->readers.close().then([s] {
+                    return s->f.close();
+                }).then([this, s] {
+                    return remove_file(segment_name(s->id));
+                }).handle_exception([] (std::exception_ptr ep) {
+                    rlog.warn("cannot remove spill file: {}", ep);
+                });
+            });
+        });
+    });
+}
+
+retained_store::node_index retained_store::find_child(node_index parent, std::string_view level) const {
+    auto id = _levels.find(level);
+    if (id == topic_level_interner::npos) {
+        return npos;
+    }
+    auto i = _edges.find(edge_key(parent, id));
+    return i == _edges.end() ? npos : i->second;
+}
+
+retained_store::node_index retained_store::find_node(std::string_view topic) const {
+    auto n = root;
+    for_each_level(topic, [this, &n] (std::string_view level) {
+        n = find_child(n, level);
+        return n != npos;
+    });
+    return n;
+}
+
+retained_store::node_index retained_store::child(node_index parent, std::string_view level) {
+    auto n = find_child(parent, level);
+    if (n != npos) {
+        return n;
+    }
+    auto id = _levels.intern(level);
+    n = allocate_node(parent, id);
+    _nodes[n].system = parent == root && !level.empty() && level[0] == '$';
+    _edges.emplace(edge_key(parent, id), n);
+    return n;
+}
+
+retained_store::node_index retained_store::allocate_node(node_index parent, level_id level) {
+    node_index n;
+    if (_free_nodes.empty()) {
+        n = _nodes.size();
+        _nodes.emplace_back();
+    } else {
+        n = _free_nodes.back();
+        _free_nodes.pop_back();
+        _nodes[n] = node();
+    }
+    auto& nd = _nodes[n];
+    auto& p = _nodes[parent];
+    nd.parent = parent;
+    nd.level = level;
+    nd.next = p.first_child;
+    if (nd.next != npos) {
+        _nodes[nd.next].prev = n;
+    }
+    p.first_child = n;
+    return n;
+}
+
+// Removes n and its ancestors as long as they are unused.  A removed node
+// keeps its next link for the lookups that may be on it.
+void retained_store::prune(node_index n) {
+    while (n != root && _nodes[n].unused()) {
+        auto& nd = _nodes[n];
+        auto parent = nd.parent;
+        if (nd.prev != npos) {
+            _nodes[nd.prev].next = nd.next;
+        } else {
+            _nodes[parent].first_child = nd.next;
+        }
+        if (nd.next != npos) {
+            _nodes[nd.next].prev = nd.prev;
+        }
+        _edges.erase(edge_key(parent, nd.level));
+        _levels.release(nd.level);
+        nd.level = dead_level;
+        if (_lookups.empty()) {
+            _free_nodes.push_back(n);
+        } else {
+            _retired.emplace_back(_epoch, n);
+        }
+        n = parent;
+    }
+}
+
+// A node removed in epoch f may be on the path of lookups that started in
+// epoch f or earlier, and no other.
+void retained_store::release_retired() {
+    auto oldest = _lookups.empty() ? std::numeric_limits<uint64_t>::max() : _lookups.begin()->first;
+    while (!_retired.empty() && _retired.front().first < oldest) {
+        _free_nodes.push_back(_retired.front().second);
+        _retired.pop_front();
+    }
+}
+
+retained_store::entry& retained_store::allocate_entry(node_index n) {
+    entry_index i;
+    if (_free_entries.empty()) {
+        i = _entries.size();
+        _entries.emplace_back();
+    } else {
+        i = _free_entries.back();
+        _free_entries.pop_back();
+    }
+    auto& e = _entries[i];
+    e.index = i;
+    e.node = n;
+    _nodes[n].entry = i;
+    _messages++;
+    return e;
+}
+
+void retained_store::erase_entry(entry& e) {
+    drop_data(e);
+    auto n = e.node;
+    e.version = 0;
+    e.node = npos;
+    _nodes[n].entry = npos;
+    _free_entries.push_back(e.index);
+    _messages--;
+    prune(n);
+}
+
+void retained_store::drop_data(entry& e) {
+    e.lru.unlink();
+    e.evicting = false;
+    if (e.data) {
+        _resident -= e.size;
+        e.data = {};
+    }
+    if (e.segment) {
+        unspill(e);
+    }
+}
+
+void retained_store::unspill(entry& e) {
+    auto& s = *e.segment;
+    s.live -= e.size;
+    e.spilled.unlink();
+    e.segment = nullptr;
+    _spilled--;
+    release_segment(s);
+    maybe_compact();
+}
+
+void retained_store::touch(entry& e) {
+    e.evicting = false;
+    e.lru.unlink();
+    _lru.push_front(e);
+}
+
+lw_shared_ptr<message> retained_store::decode(entry& e) {
+    return decode_message(e.data.share());
+}
+
+void retained_store::put(message& msg) {
+    auto topic = msg.topic_view();
+    if (msg.payload.empty()) {
+        auto n = find_node(topic);
+        if (n != npos && _nodes[n].entry != npos) {
+            erase_entry(_entries[_nodes[n].entry]);
+            _stats.cleared++;
+        }
+        return;
+    }
+    mqtt::publish pub;
+    pub.topic = msg.topic.share();
+    pub.payload = msg.payload.share();
+    pub.qos = msg.qos;
+    pub.retain = true;
+    pub.dup = false;
+    pub.packet_id = msg.qos == mqtt::qos::at_most_once ? 0 : 1;
+    pub.properties = mqtt::forwarded_properties(msg.properties);
+    auto header = mqtt::encode_publish_header(mqtt::protocol_version::v5, pub);
+    auto data = _arena.allocate(header.size() + pub.payload.size());
+    std::copy(header.begin(), header.end(), data.get_write());
+    std::copy(pub.payload.begin(), pub.payload.end(), data.get_write() + header.size());
+
+    auto n = root;
+    for_each_level(topic, [this, &n] (std::string_view level) {
+        n = child(n, level);
+        return true;
+    });
+    auto i = _nodes[n].entry;
+    auto& e = i == npos ? allocate_entry(n) : _entries[i];
+    drop_data(e);
+    e.version = _next_version++;
+    e.size = data.size();
+    e.data = std::move(data);
+    _resident += e.size;
+    _lru.push_front(e);
+    _stats.stored++;
+    maybe_evict();
+}
+
+future<> retained_store::for_each_match(sstring filter, consumer consume) {
+    _stats.lookups++;
+    return with_gate(_gate, [this, filter = std::move(filter), consume = std::move(consume)] () mutable {
+        auto l = std::make_unique<lookup>(*this, std::string_view(filter.c_str(), filter.size()));
+        return do_with(std::move(l), std::move(consume), [this] (std::unique_ptr<lookup>& l, consumer& consume) {
+            return repeat([this, &l, &consume] {
+                if (_stopping) {
+                    return make_ready_future<stop_iteration>(stop_iteration::yes);
+                }
+                auto more = l->step();
+                auto found = std::move(l->found);
+                l->found.clear();
+                auto spilled = std::move(l->spilled);
+                l->spilled.clear();
+                return read_spilled(std::move(spilled), l->exact()).then([this, &consume, more,
+                        found = std::move(found)] (std::vector<lw_shared_ptr<message>> read) mutable {
+                    std::move(read.begin(), read.end(), std::back_inserter(found));
+                    _stats.matches += found.size();
+                    auto consumed = found.empty() ? make_ready_future<stop_iteration>(stop_iteration::no)
+                            : consume(std::move(found));
+                    return consumed.then([more] (stop_iteration stop) {
+                        if (stop == stop_iteration::yes || !more) {
+                            return make_ready_future<stop_iteration>(stop_iteration::yes);
+                        }
+                        return later().then([] {
+                            return stop_iteration::no;
+                        });
+                    });
+                });
+            });
+        });
+    });
+}
+
+future<temporary_buffer<char>> retained_store::read(const spilled_match& m) {
+    return with_gate(m.segment->readers, [&m] {
+        return m.segment->f.dma_read<char>(m.offset, m.size);
+    }).then([this, &m] (temporary_buffer<char> data) {
+        _stats.spill_reads++;
+        if (data.size() != m.size) {
+            throw std::runtime_error(sprint("short read from %s", segment_name(m.segment->id)));
+        }
+        return data;
+    });
+}
+
+// Brings a spilled message back to memory, most or least recently used,
+// unless it changed since it was matched.
+bool retained_store::promote(const spilled_match& m, const temporary_buffer<char>& data, bool recent) {
+    auto& e = _entries[m.entry];
+    if (e.version != m.version || e.segment != m.segment.get() || e.data) {
+        return false;
+    }
+    auto copy = _arena.allocate(data.size());
+    std::copy(data.begin(), data.end(), copy.get_write());
+    unspill(e);
+    e.data = std::move(copy);
+    _resident += e.size;
+    if (recent) {
+        _lru.push_front(e);
+    } else {
+        _lru.push_back(e);
+    }
+    maybe_evict();
+    return true;
+}
+
+future<std::vector<lw_shared_ptr<message>>> retained_store::read_spilled(std::vector<spilled_match> matches, bool promote) {
+    if (matches.empty()) {
+        return make_ready_future<std::vector<lw_shared_ptr<message>>>();
+    }
+    return do_with(std::move(matches), std::vector<lw_shared_ptr<message>>(), [this, promote] (auto& matches, auto& out) {
+        return parallel_for_each(matches, [this, promote, &out] (spilled_match& m) {
+            return read(m).then_wrapped([this, promote, &m, &out] (future<temporary_buffer<char>> f) {
+                try {
+                    auto data = f.get0();
+                    if (promote && this->promote(m, data, true)) {
+                        out.push_back(decode(_entries[m.entry]));
+                    } else {
+                        out.push_back(decode_message(std::move(data)));
+                    }
+                } catch (...) {
+                    // The spill file went away under a compaction, which
+                    // brought the message back to memory.
+                    auto& e = _entries[m.entry];
+                    if (e.version == m.version && e.data) {
+                        out.push_back(decode(e));
+                    } else {
+                        rlog.warn("cannot read retained message from {}: {}", segment_name(m.segment->id), std::current_exception());
+                    }
+                }
+            });
+        }).then([&out] {
+            return std::move(out);
+        });
+    });
+}
+
+void retained_store::maybe_evict() {
+    if (_evicting || _stopping || _resident <= _config.memory_budget) {
+        return;
+    }
+    if (_config.spill_directory.empty() || _spill_failed) {
+        auto over = _resident - _config.memory_budget;
+        size_t freed = 0;
+        while (freed < over) {
+            auto e = pick_victim();
+            if (!e) {
+                break;
+            }
+            freed += e->size;
+            erase_entry(*e);
+            _stats.dropped++;
+        }
+        return;
+    }
+    _evicting = true;
+    with_gate(_gate, [this] {
+        return repeat([this] {
+            if (_stopping || _resident <= _config.memory_budget) {
+                return make_ready_future<stop_iteration>(stop_iteration::yes);
+            }
+            return spill_batch();
+        });
+    }).then_wrapped([this] (future<> f) {
+        _evicting = false;
+        try {
+            f.get();
+        } catch (...) {
+            rlog.error("cannot write spill file, retained messages over the memory budget will be dropped: {}",
+                    std::current_exception());
+            _spill_failed = true;
+            maybe_evict();
+        }
+    });
+}
+
+retained_store::entry* retained_store::pick_victim() {
+    entry* victim = nullptr;
+    unsigned n = 0;
+    for (auto i = _lru.rbegin(); i != _lru.rend() && n < victim_sample; ++i, ++n) {
+        if (!victim || i->size > victim->size) {
+            victim = &*i;
+        }
+    }
+    return victim;
+}
+
+// Writes a batch of the least recently used messages to the active spill
+// file.  Messages used or replaced while the write is in flight stay in
+// memory, and their copies in the file are dead from the start.
+future<stop_iteration> retained_store::spill_batch() {
+    std::vector<std::pair<entry_index, uint64_t>> victims;
+    size_t bytes = 0;
+    auto want = std::min(_resident - _config.memory_budget, spill_batch_bytes);
+    while (bytes < want) {
+        auto e = pick_victim();
+        if (!e) {
+            break;
+        }
+        e->lru.unlink();
+        e->evicting = true;
+        victims.emplace_back(e->index, e->version);
+        bytes += e->size;
+    }
+    if (victims.empty()) {
+        return make_ready_future<stop_iteration>(stop_iteration::yes);
+    }
+    auto restore = [this, victims] {
+        for (auto& v : victims) {
+            auto& e = _entries[v.first];
+            if (e.version == v.second && e.evicting) {
+                e.evicting = false;
+                _lru.push_back(e);
+            }
+        }
+    };
+    auto len = align_up(bytes, _alignment);
+    return roll_over(len).then([this, victims, len] {
+        auto s = _active;
+        auto buf = temporary_buffer<char>::aligned(_alignment, len);
+        std::vector<uint64_t> offsets;
+        size_t pos = 0;
+        for (auto& v : victims) {
+            auto& e = _entries[v.first];
+            offsets.push_back(pos);
+            if (e.version == v.second && e.evicting) {
+                std::copy(e.data.begin(), e.data.end(), buf.get_write() + pos);
+                pos += e.size;
+            }
+        }
+        std::fill(buf.get_write() + pos, buf.get_write() + len, 0);
+        auto base = s->size;
+        s->size += len;
+        return s->f.dma_write(base, buf.get(), len).then([this, s, base, len, victims,
+                offsets = std::move(offsets), buf = std::move(buf)] (size_t written) {
+            if (written != len) {
+                throw std::runtime_error(sprint("short write to %s", segment_name(s->id)));
+            }
+            for (size_t i = 0; i < victims.size(); i++) {
+                auto& e = _entries[victims[i].first];
+                if (e.version != victims[i].second || !e.evicting) {
+                    continue;
+                }
+                e.evicting = false;
+                e.data = {};
+                _resident -= e.size;
+                e.segment = s.get();
+                e.offset = base + offsets[i];
+                s->entries.push_back(e);
+                s->live += e.size;
+                _spilled++;
+                _stats.spilled++;
+            }
+            return stop_iteration::no;
+        });
+    }).then_wrapped([restore = std::move(restore)] (future<stop_iteration> f) {
+        if (f.failed()) {
+            restore();
+        }
+        return f;
+    });
+}
+
+// Makes sure the active spill file has room for bytes more.
+future<> retained_store::roll_over(uint64_t bytes) {
+    if (_active && (!_active->size || _active->size + bytes <= _config.spill_segment_size)) {
+        return make_ready_future<>();
+    }
+    auto id = _next_segment++;
+    auto flags = open_flags::rw | open_flags::create | open_flags::truncate;
+    return open_file_dma(segment_name(id), flags).then([this, id] (file f) {
+        auto s = make_lw_shared<spill_segment>();
+        s->id = id;
+        s->f = std::move(f);
+        _alignment = std::max(s->f.disk_write_dma_alignment(), s->f.memory_dma_alignment());
+        _segments.emplace(id, s);
+        auto old = std::exchange(_active, s);
+        if (old) {
+            release_segment(*old);
+            maybe_compact();
+        }
+    });
+}
+
+// Deletes a spill file that is no longer written to and holds nothing live.
+void retained_store::release_segment(spill_segment& s) {
+    if (_stopping || &s == _active.get() || s.live) {
+        return;
+    }
+    auto i = _segments.find(s.id);
+    if (i == _segments.end()) {
+        return;
+    }
+    auto seg = i->second;
+    _segments.erase(i);
+    with_gate(_gate, [this, seg] {
+        return seg->readers.close().then([seg] {
+            return seg->f.close();
+        }).then([this, seg] {
+            return remove_file(segment_name(seg->id));
+        });
+    }).handle_exception([] (std::exception_ptr ep) {
+        rlog.warn("cannot remove spill file: {}", ep);
+    });
+}
+
+void retained_store::maybe_compact() {
+    if (_compacting || _stopping) {
+        return;
+    }
+    for (auto& i : _segments) {
+        auto& s = i.second;
+        if (s != _active && s->live < s->size * _config.compaction_threshold) {
+            _compacting = true;
+            with_gate(_gate, [this, s] {
+                return compact(s);
+            }).then_wrapped([this] (future<> f) {
+                _compacting = false;
+                try {
+                    f.get();
+                    _stats.segments_compacted++;
+                    maybe_compact();
+                } catch (...) {
+                    rlog.warn("spill file compaction failed: {}", std::current_exception());
+                }
+            });
+            return;
+        }
+    }
+}
+
+// Brings the live messages of a sparse spill file back to memory as the
+// least recently used ones, so that eviction writes them to the active
+// file next; the file is deleted once the last of them has left.
+future<> retained_store::compact(lw_shared_ptr<spill_segment> s) {
+    return repeat([this, s] {
+        if (_stopping || s->entries.empty()) {
+            return make_ready_future<stop_iteration>(stop_iteration::yes);
+        }
+        std::vector<spilled_match> batch;
+        size_t bytes = 0;
+        for (auto& e : s->entries) {
+            if (bytes >= spill_batch_bytes) {
+                break;
+            }
+            batch.push_back(spilled_match{e.index, e.version, s, e.offset, e.size});
+            bytes += e.size;
+        }
+        return do_with(std::move(batch), [this] (std::vector<spilled_match>& batch) {
+            return do_for_each(batch, [this] (spilled_match& m) {
+                return read(m).then_wrapped([this, &m] (future<temporary_buffer<char>> f) {
+                    try {
+                        promote(m, f.get0(), false);
+                    } catch (...) {
+                        // Unreadable; the message is lost either way.
+                        rlog.warn("cannot read retained message from {}: {}", segment_name(m.segment->id), std::current_exception());
+                        auto& e = _entries[m.entry];
+                        if (e.version == m.version) {
+                            erase_entry(e);
+                            _stats.dropped++;
+                        }
+                    }
+                });
+            });
+        }).then([] {
+            return stop_iteration::no;
+        });
+    });
+}
+
+} /* namespace hero */
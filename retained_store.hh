@@ -0,0 +1,254 @@
+/*
+ * This file is open source software, licensed to you under the terms
+ * of the Apache License, Version 2.0 (the "License").  See the NOTICE file
+ * distributed with this work for additional information regarding copyright
+ * ownership.  You may not use this file except in compliance with the License.
+ *
+ * You may obtain a copy of the License at
+ *
+ *   http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing,
+ * software distributed under the License is distributed on an
+ * "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+ * KIND, either express or implied.  See the License for the
+ * specific language governing permissions and limitations
+ * under the License.
+ */
+
+#pragma once
+
+#include "core/file.hh"
+#include "core/future.hh"
+#include "core/gate.hh"
+#include "core/metrics_registration.hh"
+#include "core/shared_ptr.hh"
+#include "core/sstring.hh"
+#include "message.hh"
+#include "slab_arena.hh"
+#include "subscription_index.hh"
+
+#include <boost/intrusive/list.hpp>
+
+#include <deque>
+#include <functional>
+#include <map>
+#include <string_view>
+#include <unordered_map>
+#include <vector>
+
+namespace hero {
+
+using namespace seastar;
+
+struct retained_config {
+    // Bytes of retained messages a shard keeps in memory; the least
+    // recently used ones beyond it are moved to spill files.
+    size_t memory_budget = 256 * 1024 * 1024;
+    // Spill files go to <spill_directory>/shard-<n>.  If empty, messages
+    // beyond the budget are dropped.
+    sstring spill_directory;
+    uint64_t spill_segment_size = 64 * 1024 * 1024;
+    // A spill file is compacted once fewer than this fraction of its bytes
+    // are live.
+    double compaction_threshold = 0.25;
+};
+
+// The shard holding the retained message of a topic.
+unsigned retained_owner(std::string_view topic);
+
+// The retained messages of the topics a shard owns.
+//
+// Topics are kept in a trie of interned levels, so a level shared by many
+// topics ("status" in site/<id>/status) is stored once, and each message,
+// encoded as a v5 PUBLISH, lives in one slab_arena slot.  Messages are
+// kept in LRU order; when they outgrow the memory budget, the least
+// recently used are written to an append-only spill file in batches and
+// read back on demand.  Spill files are a cache, and are discarded at
+// startup.
+//
+// Lookups walk the trie a bounded number of nodes at a time and hand out
+// matches in batches, waiting for each batch to be consumed before
+// gathering the next, so a filter matching millions of topics neither
+// stalls the shard nor holds its matches in memory at once.  Topics may
+// be added and removed while a lookup is paused; nodes removed meanwhile
+// are recycled only once every lookup that could reach them is over.
+class retained_store {
+public:
+    // Consumes a batch of matches; stop_iteration::yes ends the lookup.
+    using consumer = std::function<future<stop_iteration> (std::vector<lw_shared_ptr<message>>)>;
+
+    struct stats {
+        uint64_t stored = 0;
+        uint64_t cleared = 0;
+        uint64_t spilled = 0;
+        uint64_t spill_reads = 0;
+        uint64_t dropped = 0;
+        uint64_t lookups = 0;
+        uint64_t matches = 0;
+        uint64_t segments_compacted = 0;
+    };
+private:
+    using node_index = uint32_t;
+    using entry_index = uint32_t;
+    using level_id = topic_level_interner::level_id;
+    static constexpr uint32_t npos = uint32_t(-1);
+    static constexpr node_index root = 0;
+    // node::level of a removed node.
+    static constexpr level_id dead_level = topic_level_interner::npos;
+
+    using hook_type = boost::intrusive::list_member_hook<boost::intrusive::link_mode<boost::intrusive::auto_unlink>>;
+
+    struct node {
+        node_index parent = npos;
+        // Children form a doubly linked list, so that wildcards can
+        // enumerate them; literal levels are found through _edges.
+        node_index first_child = npos;
+        node_index next = npos;
+        node_index prev = npos;
+        level_id level = dead_level;
+        entry_index entry = npos;
+        // The first level of a topic starting with '$', which wildcards
+        // at the first level do not match.
+        bool system = false;
+
+        bool unused() const { return first_child == npos && entry == npos; }
+    };
+
+    struct spill_segment;
+
+    struct entry {
+        entry_index index;
+        node_index node = npos;
+        // Changes whenever the entry is reused or its message replaced; 0
+        // while the entry is free.
+        uint64_t version = 0;
+        uint32_t size = 0;
+        // The message in the arena; empty while it is only on disk.
+        temporary_buffer<char> data;
+        // Set while the message is (also) in a spill file.
+        spill_segment* segment = nullptr;
+        uint64_t offset = 0;
+        // Being written to a spill file; out of the LRU list meanwhile.
+        bool evicting = false;
+        hook_type lru;
+        hook_type spilled;
+    };
+    using entry_list = boost::intrusive::list<entry,
+          boost::intrusive::member_hook<entry, hook_type, &entry::lru>,
+          boost::intrusive::constant_time_size<false>>;
+    using spilled_list = boost::intrusive::list<entry,
+          boost::intrusive::member_hook<entry, hook_type, &entry::spilled>,
+          boost::intrusive::constant_time_size<false>>;
+
+    struct spill_segment {
+        uint64_t id;
+        file f;
+        // Bytes written, always block aligned.
+        uint64_t size = 0;
+        // Bytes of the messages which are still read from here.
+        uint64_t live = 0;
+        spilled_list entries;
+        // Held by reads, so the file is closed only after them.
+        gate readers;
+    };
+
+    // A message matched by a lookup that has to be read from disk.
+    struct spilled_match {
+        entry_index entry;
+        uint64_t version;
+        lw_shared_ptr<spill_segment> segment;
+        uint64_t offset;
+        uint32_t size;
+    };
+
+    class lookup;
+
+    retained_config _config;
+    sstring _dir;
+
+    std::vector<node> _nodes;
+    std::vector<node_index> _free_nodes;
+    std::unordered_map<uint64_t, node_index> _edges;
+    topic_level_interner _levels;
+    // Lookups in progress, by the epoch they started in, and the nodes
+    // removed while they ran, with the epoch of their removal.
+    uint64_t _epoch = 0;
+    std::map<uint64_t, unsigned> _lookups;
+    std::deque<std::pair<uint64_t, node_index>> _retired;
+
+    // Declared before the entries, whose buffers it holds.
+    slab_arena _arena;
+    // Entries never move, so the intrusive lists can link them.
+    std::deque<entry> _entries;
+    std::vector<entry_index> _free_entries;
+    size_t _messages = 0;
+    uint64_t _next_version = 1;
+    // Most recently used first.
+    entry_list _lru;
+    // Bytes of the messages held in memory, which the budget applies to.
+    size_t _resident = 0;
+
+    std::map<uint64_t, lw_shared_ptr<spill_segment>> _segments;
+    lw_shared_ptr<spill_segment> _active;
+    uint64_t _next_segment = 0;
+    size_t _alignment = 4096;
+    size_t _spilled = 0;
+    bool _evicting = false;
+    bool _compacting = false;
+    bool _spill_failed = false;
+    bool _stopping = false;
+    gate _gate;
+    stats _stats;
+    metrics::metric_groups _metrics;
+public:
+    explicit retained_store(retained_config config);
+
+    // Clears the spill files of a previous run.
+    future<> start();
+    future<> stop();
+
+    // Makes msg the retained message of its topic, or clears the topic's
+    // retained message if msg has no payload.
+    void put(message& msg);
+
+    // Passes every retained message matching filter to consume, in
+    // batches.  A filter without wildcards counts as a use of its topic's
+    // message, and brings it back to memory if it was spilled.
+    future<> for_each_match(sstring filter, consumer consume);
+
+    size_t size() const { return _messages; }
+    const stats& get_stats() const { return _stats; }
+private:
+    static uint64_t edge_key(node_index parent, level_id level) {
+        return (uint64_t(parent) << 32) | level;
+    }
+    node_index find_node(std::string_view topic) const;
+    node_index child(node_index parent, std::string_view level);
+    node_index find_child(node_index parent, std::string_view level) const;
+    node_index allocate_node(node_index parent, level_id level);
+    void prune(node_index n);
+    void release_retired();
+
+    entry& allocate_entry(node_index n);
+    void erase_entry(entry& e);
+    void drop_data(entry& e);
+    void unspill(entry& e);
+    void touch(entry& e);
+    lw_shared_ptr<message> decode(entry& e);
+    future<temporary_buffer<char>> read(const spilled_match& m);
+    bool promote(const spilled_match& m, const temporary_buffer<char>& data, bool recent);
+    future<std::vector<lw_shared_ptr<message>>> read_spilled(std::vector<spilled_match> matches, bool promote);
+
+    void maybe_evict();
+    entry* pick_victim();
+    future<stop_iteration> spill_batch();
+    future<> roll_over(uint64_t bytes);
+    void release_segment(spill_segment& s);
+    void maybe_compact();
+    future<> compact(lw_shared_ptr<spill_segment> s);
+    sstring segment_name(uint64_t id) const;
+    void setup_metrics();
+};
+
+} /* namespace hero */
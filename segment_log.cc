@@ -0,0 +1,390 @@
+/*
+ * This file is open source software, licensed to you under the terms
+ * of the Apache License, Version 2.0 (the "License").  See the NOTICE file
+ * distributed with this work for additional information regarding copyright
+ * ownership.  You may not use this file except in compliance with the License.
+ *
+ * You may obtain a copy of the License at
+ *
+ *   http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing,
+ * software distributed under the License is distributed on an
+ * "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+ * KIND, either express or implied.  See the License for the
+ * specific language governing permissions and limitations
+ * under the License.
+ */
+
+#include "segment_log.hh"
+#include "core/future-util.hh"
+#include "core/metrics.hh"
+#include "core/print.hh"
+#include "core/reactor.hh"
+#include "util/log.hh"
+
+#include <boost/crc.hpp>
+
+#include <algorithm>
+#include <cstdlib>
+#include <cstring>
+#include <stdexcept>
+
+namespace hero {
+
+static logger llog("log");
+
+// Every record is preceded by its length and a CRC-32 of the length and
+// the record.  A zero length, a length running past the end of the file or
+// a bad checksum ends a segment: it is where the last commit before a crash
+// stopped.
+static constexpr size_t header_size = 8;
+
+static uint32_t checksum(uint32_t len, const char* data) {
+    boost::crc_32_type crc;
+    crc.process_bytes(&len, sizeof(len));
+    crc.process_bytes(data, len);
+    return crc.checksum();
+}
+
+static size_t align_down(size_t v, size_t alignment) {
+    return v & ~(alignment - 1);
+}
+
+static size_t align_up(size_t v, size_t alignment) {
+    return align_down(v + alignment - 1, alignment);
+}
+
+segment_log::segment_log(log_config config, relocate_func relocate)
+    : _config(std::move(config))
+    , _relocate(std::move(relocate))
+    , _timer([this] { commit(); })
+{
+    setup_metrics();
+}
+
+void segment_log::setup_metrics() {
+    namespace sm = seastar::metrics;
+    _metrics.add_group("hero_log", {
+        sm::make_derive("records_appended", _stats.records_appended,
+                sm::description("Records appended to the log")),
+        sm::make_derive("bytes_appended", _stats.bytes_appended,
+                sm::description("Bytes appended to the log, headers included")),
+        sm::make_derive("commits", _stats.commits,
+                sm::description("Group commits, each one write and one fsync")),
+        sm::make_derive("bytes_written", _stats.bytes_written,
+                sm::description("Bytes written by commits, including rewritten partial blocks")),
+        sm::make_derive("segments_created", _stats.segments_created,
+                sm::description("Segments created")),
+        sm::make_derive("segments_deleted", _stats.segments_deleted,
+                sm::description("Segments deleted once nothing in them was live")),
+        sm::make_derive("segments_compacted", _stats.segments_compacted,
+                sm::description("Segments whose live records were appended again")),
+        sm::make_gauge("segments", [this] { return _segments.size(); },
+                sm::description("Segments on disk")),
+        sm::make_gauge("pending_bytes", [this] { return _pending; },
+                sm::description("Bytes appended but not yet being committed")),
+    });
+}
+
+sstring segment_log::segment_name(uint64_t id) const {
+    return sprint("%s/%016x.log", _dir, id);
+}
+
+future<> segment_log::replay(replay_func func) {
+    _dir = sprint("%s/shard-%d", _config.directory, engine().cpu_id());
+    return recursive_touch_directory(_dir).then([this] {
+        return open_directory(_dir);
+    }).then([this, func = std::move(func)] (file dir) mutable {
+        return do_with(std::move(dir), std::vector<uint64_t>(), std::move(func), [this] (file& dir,
+                std::vector<uint64_t>& ids, replay_func& func) {
+            auto listing = dir.list_directory([&ids] (directory_entry de) {
+                const auto& name = de.name;
+                if (name.size() == 20 && std::equal(name.end() - 4, name.end(), ".log")) {
+                    char* end;
+                    auto id = std::strtoull(name.c_str(), &end, 16);
+                    if (end == name.c_str() + 16) {
+                        ids.push_back(id);
+                    }
+                }
+                return make_ready_future<>();
+            });
+            return do_with(std::move(listing), [] (auto& listing) {
+                return listing.done();
+            }).then([this, &ids, &func] {
+                std::sort(ids.begin(), ids.end());
+                return do_for_each(ids, [this, &func] (uint64_t id) {
+                    return replay_segment(id, func);
+                });
+            }).finally([&dir] {
+                return dir.close();
+            });
+        });
+    });
+}
+
+future<> segment_log::replay_segment(uint64_t id, const replay_func& func) {
+    return open_file_dma(segment_name(id), open_flags::ro).then([this, id, &func] (file f) {
+        return f.size().then([f] (uint64_t size) mutable {
+            return f.dma_read<char>(0, size);
+        }).then([this, id, &func] (temporary_buffer<char> buf) {
+            auto& info = _segments[id];
+            size_t pos = 0;
+            while (pos + header_size <= buf.size()) {
+                uint32_t len, crc;
+                std::memcpy(&len, buf.get() + pos, sizeof(len));
+                std::memcpy(&crc, buf.get() + pos + 4, sizeof(crc));
+                if (!len || len > buf.size() - pos - header_size) {
+                    break;
+                }
+                if (checksum(len, buf.get() + pos + header_size) != crc) {
+                    llog.info("segment {:016x}: bad checksum at offset {}, ignoring the rest", id, pos);
+                    break;
+                }
+                info.records++;
+                _stats.records_replayed++;
+                func(id, buf.share(pos + header_size, len));
+                pos += header_size + len;
+            }
+        }).finally([f] () mutable {
+            return f.close().finally([f] {});
+        });
+    });
+}
+
+future<> segment_log::start() {
+    auto next = _segments.empty() ? 0 : _segments.rbegin()->first + 1;
+    return open_segment(next).then([this] {
+        maybe_delete();
+        maybe_compact();
+    });
+}
+
+future<> segment_log::open_segment(uint64_t id) {
+    auto flags = open_flags::wo | open_flags::create | open_flags::truncate;
+    return open_file_dma(segment_name(id), flags).then([this, id] (file f) {
+        _file = std::move(f);
+        _open = true;
+        _active = id;
+        _segments[id];
+        _file_pos = 0;
+        _buf_used = 0;
+        _stats.segments_created++;
+        if (!_buf) {
+            _alignment = _file.disk_write_dma_alignment();
+            _buf_size = align_up(std::max<size_t>(4 * _config.max_batch_bytes, 1024 * 1024), _alignment);
+            void* p = nullptr;
+            if (posix_memalign(&p, std::max<size_t>(_file.memory_dma_alignment(), _alignment), _buf_size)) {
+                throw std::bad_alloc();
+            }
+            _buf.reset(static_cast<char*>(p));
+        }
+        // Make the new file's directory entry durable with its first commit.
+        return sync_directory(_dir);
+    });
+}
+
+future<uint64_t> segment_log::append(temporary_buffer<char> record) {
+    if (_failed) {
+        return make_exception_future<uint64_t>(std::runtime_error("log is unusable after a failed write"));
+    }
+    auto need = header_size + record.size();
+    if (need + _alignment > _buf_size || need > _config.segment_size) {
+        return make_exception_future<uint64_t>(std::invalid_argument(sprint("log record of %d bytes is too large", record.size())));
+    }
+    if (_rolling || _buf_used + need > _buf_size || _file_pos + _buf_used + need > _config.segment_size) {
+        return wait_for_room().then([this, record = std::move(record)] () mutable {
+            return append(std::move(record));
+        });
+    }
+    uint32_t len = record.size();
+    uint32_t crc = checksum(len, record.get());
+    auto out = _buf.get() + _buf_used;
+    std::memcpy(out, &len, sizeof(len));
+    std::memcpy(out + 4, &crc, sizeof(crc));
+    std::memcpy(out + header_size, record.get(), len);
+    _buf_used += need;
+    _pending += need;
+    auto& info = _segments[_active];
+    info.records++;
+    info.live++;
+    _stats.records_appended++;
+    _stats.bytes_appended += need;
+    auto f = _batch.get_shared_future();
+    if (_pending >= _config.max_batch_bytes) {
+        commit();
+    } else if (!_timer.armed()) {
+        _timer.arm(_config.max_delay);
+    }
+    return f.then([segment = _active] {
+        return segment;
+    });
+}
+
+// Waits for whatever stops the next append from fitting: the commit in
+// flight, the pending bytes, or the end of the segment.
+future<> segment_log::wait_for_room() {
+    if (_rolling) {
+        return _rolled.get_shared_future();
+    }
+    if (!_committing && _pending) {
+        commit();
+    }
+    if (_committing) {
+        // A failed commit fails its own appends; the retry reports it.
+        return _inflight.get_shared_future().handle_exception([] (std::exception_ptr) {});
+    }
+    return roll_over();
+}
+
+future<> segment_log::roll_over() {
+    _rolling = true;
+    _rolled = shared_promise<>();
+    auto old = std::move(_file);
+    _open = false;
+    return open_segment(_active + 1).then_wrapped([this, old = std::move(old)] (future<> f) mutable {
+        _rolling = false;
+        with_gate(_gate, [old = std::move(old)] () mutable {
+            return old.close().finally([old] {});
+        });
+        if (f.failed()) {
+            _failed = true;
+            auto ep = f.get_exception();
+            llog.error("cannot open a new segment: {}", ep);
+            _rolled.set_exception(ep);
+            return make_exception_future<>(ep);
+        }
+        _rolled.set_value();
+        maybe_delete();
+        maybe_compact();
+        return make_ready_future<>();
+    });
+}
+
+void segment_log::commit() {
+    if (_committing || !_pending || _failed) {
+        return;
+    }
+    _timer.cancel();
+    _committing = true;
+    _inflight = std::exchange(_batch, shared_promise<>());
+    _pending = 0;
+    auto used = _buf_used;
+    auto len = align_up(used, _alignment);
+    std::fill(_buf.get() + used, _buf.get() + len, 0);
+    _stats.commits++;
+    _stats.bytes_written += len;
+    // Appends made while the write is in flight land after used; the
+    // block they share with it is written again by the next commit.
+    with_gate(_gate, [this, used, len] {
+        return _file.dma_write(_file_pos, _buf.get(), len).then([this, len] (size_t written) {
+            if (written != len) {
+                throw std::runtime_error(sprint("short write to segment %016x", _active));
+            }
+            return _file.flush();
+        }).then_wrapped([this, used] (future<> f) {
+            _committing = false;
+            auto keep = align_down(used, _alignment);
+            std::memmove(_buf.get(), _buf.get() + keep, _buf_used - keep);
+            _buf_used -= keep;
+            _file_pos += keep;
+            try {
+                f.get();
+                _inflight.set_value();
+            } catch (...) {
+                auto ep = std::current_exception();
+                llog.error("commit to segment {:016x} failed: {}", _active, ep);
+                _failed = true;
+                _inflight.set_exception(ep);
+                _batch.set_exception(ep);
+                return;
+            }
+            // Appends that waited out this commit go now if they are many
+            // or their deadline passed meanwhile.
+            if (_pending >= _config.max_batch_bytes || (_pending && !_timer.armed())) {
+                commit();
+            }
+        });
+    });
+}
+
+void segment_log::release(uint64_t segment) {
+    auto i = _segments.find(segment);
+    if (i == _segments.end()) {
+        return;
+    }
+    i->second.live--;
+    if (i == _segments.begin()) {
+        maybe_delete();
+    }
+    maybe_compact();
+}
+
+void segment_log::maybe_delete() {
+    while (!_stopping && !_segments.empty()) {
+        auto i = _segments.begin();
+        if (i->first == _active || i->second.live) {
+            break;
+        }
+        auto name = segment_name(i->first);
+        _segments.erase(i);
+        _stats.segments_deleted++;
+        with_gate(_gate, [name = std::move(name)] {
+            return remove_file(name).handle_exception([name] (std::exception_ptr ep) {
+                llog.warn("cannot remove {}: {}", name, ep);
+            });
+        });
+    }
+}
+
+void segment_log::maybe_compact() {
+    if (_compacting || _stopping || !_relocate || _segments.empty()) {
+        return;
+    }
+    auto i = _segments.begin();
+    if (i->first == _active || !i->second.live) {
+        return;
+    }
+    auto& info = i->second;
+    if (info.live >= info.records * _config.compaction_threshold && _segments.size() <= _config.max_segments) {
+        return;
+    }
+    _compacting = true;
+    _stats.segments_compacted++;
+    with_gate(_gate, [this, id = i->first] {
+        return _relocate(id).then_wrapped([this, id] (future<> f) {
+            _compacting = false;
+            if (f.failed()) {
+                llog.warn("compaction of segment {:016x} failed: {}", id, f.get_exception());
+            }
+        });
+    });
+}
+
+future<> segment_log::stop() {
+    _stopping = true;
+    return repeat([this] {
+        if (_committing) {
+            return _inflight.get_shared_future().then_wrapped([] (future<> f) {
+                f.ignore_ready_future();
+                return stop_iteration::no;
+            });
+        }
+        if (_pending && !_failed) {
+            commit();
+            return make_ready_future<stop_iteration>(stop_iteration::no);
+        }
+        return make_ready_future<stop_iteration>(stop_iteration::yes);
+    }).then([this] {
+        _timer.cancel();
+        return _gate.close();
+    }).then([this] {
+        if (!_open) {
+            return make_ready_future<>();
+        }
+        _open = false;
+        return _file.close();
+    });
+}
+
+} /* namespace hero */
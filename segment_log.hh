@@ -0,0 +1,154 @@
+/*
+ * This file is open source software, licensed to you under the terms
+ * of the Apache License, Version 2.0 (the "License").  See the NOTICE file
+ * distributed with this work for additional information regarding copyright
+ * ownership.  You may not use this file except in compliance with the License.
+ *
+ * You may obtain a copy of the License at
+ *
+ *   http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing,
+ * software distributed under the License is distributed on an
+ * "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+ * KIND, either express or implied.  See the License for the
+ * specific language governing permissions and limitations
+ * under the License.
+ */
+
+#pragma once
+
+#include "core/file.hh"
+#include "core/future.hh"
+#include "core/gate.hh"
+#include "core/metrics_registration.hh"
+#include "core/shared_future.hh"
+#include "core/sstring.hh"
+#include "core/temporary_buffer.hh"
+#include "core/timer.hh"
+
+#include <chrono>
+#include <functional>
+#include <map>
+#include <memory>
+
+namespace hero {
+
+using namespace seastar;
+
+struct log_config {
+    // Segments go to <directory>/shard-<n>.
+    sstring directory;
+    uint64_t segment_size = 32 * 1024 * 1024;
+    // A commit starts once this much has been appended...
+    size_t max_batch_bytes = 256 * 1024;
+    // ...or this long after the first append it would cover.
+    std::chrono::microseconds max_delay{2000};
+    // The oldest segment is compacted once fewer than this fraction of its
+    // records are live, or once there are more than max_segments segments.
+    double compaction_threshold = 0.5;
+    unsigned max_segments = 8;
+};
+
+// One shard's append-only log.
+//
+// Records are appended to an in-memory, DMA-aligned buffer and written and
+// fsynced in groups: a commit covers everything appended since the
+// previous one, and starts when max_batch_bytes have accumulated or
+// max_delay has passed, whichever comes first.  One commit is in flight at
+// a time; appends made meanwhile join the next.  The partial last block of
+// a commit is rewritten by the next one.
+//
+// The log counts live records per segment.  Its owner marks records dead
+// with release(); segments are deleted oldest first once nothing in them
+// is live, so a superseding record never outlives the record it supersedes.
+// The oldest segment is compacted by asking the owner to append its live
+// records again.
+class segment_log {
+public:
+    // Called for every intact record, in log order.
+    using replay_func = std::function<void (uint64_t segment, temporary_buffer<char> record)>;
+    // Asks the owner to append the live records of a segment again and
+    // release the old copies.
+    using relocate_func = std::function<future<> (uint64_t segment)>;
+
+    struct stats {
+        uint64_t records_appended = 0;
+        uint64_t bytes_appended = 0;
+        uint64_t commits = 0;
+        uint64_t bytes_written = 0;
+        uint64_t segments_created = 0;
+        uint64_t segments_deleted = 0;
+        uint64_t segments_compacted = 0;
+        uint64_t records_replayed = 0;
+    };
+private:
+    struct segment_info {
+        uint64_t records = 0;
+        uint64_t live = 0;
+    };
+    struct aligned_free {
+        void operator()(char* p) const { ::free(p); }
+    };
+    log_config _config;
+    sstring _dir;
+    relocate_func _relocate;
+    std::map<uint64_t, segment_info> _segments;
+    uint64_t _active = 0;
+    file _file;
+    bool _open = false;
+    // File offset of the start of _buf, which is always block aligned.
+    uint64_t _file_pos = 0;
+    size_t _alignment = 4096;
+    std::unique_ptr<char[], aligned_free> _buf;
+    size_t _buf_size = 0;
+    size_t _buf_used = 0;
+    // Bytes appended since the last commit started.
+    size_t _pending = 0;
+    shared_promise<> _batch;
+    shared_promise<> _inflight;
+    bool _committing = false;
+    bool _rolling = false;
+    shared_promise<> _rolled;
+    bool _compacting = false;
+    bool _failed = false;
+    bool _stopping = false;
+    timer<> _timer;
+    gate _gate;
+    stats _stats;
+    metrics::metric_groups _metrics;
+public:
+    segment_log(log_config config, relocate_func relocate);
+
+    // Reads back every existing segment.  Must be called, and followed by
+    // start(), before anything is appended.
+    future<> replay(replay_func func);
+    // Marks a replayed record as still live.
+    void retain(uint64_t segment) { _segments[segment].live++; }
+    // Deletes segments with nothing live and opens a new one.
+    future<> start();
+
+    // Appends a record.  The future resolves, with the record's segment,
+    // once the record is on disk.
+    future<uint64_t> append(temporary_buffer<char> record);
+    // Marks a record of segment as dead.
+    void release(uint64_t segment);
+
+    // Commits what is pending and closes the active segment.
+    future<> stop();
+
+    const stats& get_stats() const { return _stats; }
+    size_t segments() const { return _segments.size(); }
+private:
+    sstring segment_name(uint64_t id) const;
+    future<> replay_segment(uint64_t id, const replay_func& func);
+    future<> open_segment(uint64_t id);
+    future<> wait_for_room();
+    future<> roll_over();
+    void commit();
+    void maybe_delete();
+    void maybe_compact();
+    void setup_metrics();
+};
+
+} /* namespace hero */
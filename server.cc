@@ -0,0 +1,947 @@
+/*
+ * This file is open source software, licensed to you under the terms
+ * of the Apache License, Version 2.0 (the "License").  See the NOTICE file
+ * distributed with this work for additional information regarding copyright
+ * ownership.  You may not use this file except in compliance with the License.
+ *
+ * You may obtain a copy of the License at
+ *
+ *   http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing,
+ * software distributed under the License is distributed on an
+ * "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+ * KIND, either express or implied.  See the License for the
+ * specific language governing permissions and limitations
+ * under the License.
+ */
+
+#include "server.hh"
+#include "core/future-util.hh"
+#include "core/metrics.hh"
+#include "core/reactor.hh"
+#include "util/log.hh"
+
+namespace hero {
+
+static logger hlog("server");
+
+static std::string_view view(const sstring& s) {
+    return std::string_view(s.c_str(), s.size());
+}
+
+// How often each shard reports the loads of its shared subscription
+// members to the others.
+static constexpr auto shared_load_interval = std::chrono::milliseconds(20);
+
+// A shared subscription's options travel to the member's owner in the
+// fanout item's delivery.  The delivery's QoS is the subscription's maximum
+// and its retain flag is retain-as-published; shared subscriptions cannot
+// be no-local.
+static delivery shared_delivery(const subscription_options& options) {
+    delivery d;
+    d.qos = options.max_qos;
+    d.retain = options.retain_as_published;
+    d.subscription_identifier = options.subscription_identifier;
+    return d;
+}
+
+// The filter part of a "$share/<group>/<filter>" subscription.
+static sstring shared_route(const sstring& filter) {
+    auto parsed = parse_shared_filter(view(filter));
+    return sstring(parsed->filter.data(), parsed->filter.size());
+}
+
+static subscription_options shared_options(const delivery& d) {
+    subscription_options options;
+    options.max_qos = d.qos;
+    options.retain_as_published = d.retain;
+    options.subscription_identifier = d.subscription_identifier;
+    return options;
+}
+
+server::server(std::vector<listener_config> listeners, output_policy policy, log_config log,
+        retained_config retained, admission_config admission, cluster_config cluster, tls_config tls,
+        balance_config balance)
+    : _balance(balance)
+    , _retained(std::move(retained))
+    , _admission(admission)
+    , _session_sender([this] (const connection_location& loc, const lw_shared_ptr<message>& msg, const delivery& d) {
+        send_to_connection(loc, msg, d);
+    })
+    , _fanout([this] (unsigned shard, fanout::batch&& b) {
+        return smp::submit_to(shard, [this, b = std::move(b)] () mutable {
+            return container().local().deliver_batch(std::move(b));
+        });
+    })
+    , _output_policy(policy)
+{
+    if (!log.directory.empty()) {
+        _store = std::make_unique<session_store>(std::move(log));
+    }
+    for (auto& l : listeners) {
+        _listeners.push_back(listener{std::move(l)});
+        if (_listeners.back().config.kind == listener_kind::tls && !_tls) {
+            _tls = std::make_unique<tls_acceptor>(tls);
+        }
+    }
+    if (cluster.listener.port) {
+        _cluster = std::make_unique<hero::cluster>(*this, std::move(cluster));
+    }
+    setup_metrics();
+}
+
+void server::setup_metrics() {
+    namespace sm = seastar::metrics;
+    _metrics.add_group("hero_output", {
+        sm::make_derive("packets_queued", _output_stats.packets_queued,
+                sm::description("Packets queued for sending to clients")),
+        sm::make_derive("packets_dropped", _output_stats.packets_dropped,
+                sm::description("QoS 0 messages dropped because the client's send queue was full")),
+        sm::make_derive("writes", _output_stats.writes,
+                sm::description("Writes to client sockets, each carrying one or more packets")),
+        sm::make_derive("bytes_written", _output_stats.bytes_written,
+                sm::description("Bytes written to client sockets")),
+        sm::make_derive("threshold_flushes", _output_stats.threshold_flushes,
+                sm::description("Writes started early because the send queue reached a flush threshold")),
+        sm::make_derive("read_pauses", _output_stats.read_pauses,
+                sm::description("Times a connection stopped reading because its send queue was full")),
+        sm::make_derive("topic_alias_hits", _output_stats.topic_alias_hits,
+                sm::description("PUBLISH packets sent with a topic alias in place of their topic")),
+        sm::make_derive("header_cache_hits", _output_stats.header_cache_hits,
+                sm::description("PUBLISH headers reused from the last one sent on the same topic")),
+        sm::make_derive("oversized_dropped", _output_stats.oversized_dropped,
+                sm::description("PUBLISH packets not sent because they exceeded the client's maximum packet size")),
+        sm::make_gauge("connections", [this] { return _connections.size(); },
+                sm::description("Open client connections")),
+    });
+
+    sm::label type_label("type");
+    std::vector<sm::metric_definition> protocol = {
+        sm::make_derive("connections_accepted", _protocol_stats.connections_accepted,
+                sm::description("Client connections accepted")),
+        sm::make_derive("bytes_received", _protocol_stats.bytes_received,
+                sm::description("Bytes read from client sockets")),
+        sm::make_histogram("delivery_latency", [this] { return _delivery_latency.to_metrics(); },
+                sm::description("Microseconds from receiving a PUBLISH to queueing it for a subscriber")),
+        sm::make_gauge("remote_calls", [this] { return _remote_calls; },
+                sm::description("Session and retained message operations sent to other shards and not yet done")),
+    };
+    for (auto t = unsigned(mqtt::packet_type::connect); t <= unsigned(mqtt::packet_type::auth); ++t) {
+        auto type = type_label(mqtt::to_string(mqtt::packet_type(t)));
+        protocol.push_back(sm::make_derive("packets_received", _protocol_stats.packets_received[t],
+                sm::description("Packets received from clients"), {type}));
+        protocol.push_back(sm::make_derive("packets_sent", _protocol_stats.packets_sent[t],
+                sm::description("Packets queued for sending to clients"), {type}));
+    }
+    _metrics.add_group("hero_protocol", protocol);
+
+    _metrics.add_group("hero_shared", {
+        sm::make_gauge("groups", [this] { return _shared.groups(); },
+                sm::description("Shared subscription groups")),
+        sm::make_gauge("members", [this] { return _shared.members(); },
+                sm::description("Sessions in shared subscription groups")),
+        sm::make_derive("local_picks", [this] { return _shared.get_stats().local_picks; },
+                sm::description("Shared subscription messages sent to a member on the publisher's shard")),
+        sm::make_derive("remote_picks", [this] { return _shared.get_stats().remote_picks; },
+                sm::description("Shared subscription messages sent to a member on another shard")),
+        sm::make_derive("load_reports", [this] { return _shared.get_stats().load_reports; },
+                sm::description("Reports of member loads received from the shards")),
+    });
+
+    sm::label listener_label("listener");
+    std::vector<sm::metric_definition> listeners;
+    for (auto& l : _listeners) {
+        if (!l.config.on_shard(engine().cpu_id())) {
+            continue;
+        }
+        auto name = listener_label(l.config.name());
+        listeners.push_back(sm::make_gauge("connections", [&l] { return l.connections; },
+                sm::description("Open client connections accepted on the listener"), {name}));
+        listeners.push_back(sm::make_gauge("listening", [&l] { return l.socket ? 1 : 0; },
+                sm::description("Whether the shard accepts connections on the listener"), {name}));
+        listeners.push_back(sm::make_derive("withdrawals", l.withdrawals,
+                sm::description("Times the shard stopped accepting on the listener for having more connections than the others"),
+                {name}));
+    }
+    _metrics.add_group("hero_listener", listeners);
+}
+
+future<> server::start() {
+    auto loaded = _tls ? _tls->load() : make_ready_future<>();
+    return loaded.then([this] {
+        _timers.start();
+        _stall_probe.start();
+        _shared_load_timer.set_callback([this] { report_shared_loads(); });
+        _shared_load_timer.arm_periodic(shared_load_interval);
+        for (auto& l : _listeners) {
+            if (l.config.on_shard(engine().cpu_id())) {
+                listen(l);
+            }
+        }
+        if (engine().cpu_id() == 0 && _balance.interval.count() && smp::count > 1) {
+            if (accept_queues_migrate()) {
+                _balance_timer.set_callback([this] { balance_listeners(); });
+                _balance_timer.arm_periodic(_balance.interval);
+            } else {
+                hlog.warn("connection balancing disabled: it needs net.ipv4.tcp_migrate_req = 1, "
+                          "or a shard that stops accepting resets the connections it has queued");
+            }
+        }
+        if (_cluster) {
+            _cluster->start();
+        }
+    });
+}
+
+void server::listen(listener& l) {
+    listen_options lo;
+    lo.reuse_address = true;
+    l.socket = engine().listen(l.config.bind_address(), lo);
+    accept(l);
+}
+
+void server::accept(listener& l) {
+    auto socket = l.socket;
+    keep_doing([this, &l, socket] {
+        return socket->accept().then([this, &l] (connected_socket fd, socket_address addr) mutable {
+            auto slot = _admission.admit_connection();
+            if (!slot) {
+                // Closing the socket right away is the cheapest answer; the
+                // client backs off and retries.
+                hlog.debug("{}: refused, too many connections", addr);
+                return;
+            }
+            _protocol_stats.connections_accepted++;
+            if (l.config.kind != listener_kind::tls) {
+                add_connection(l, std::move(fd), addr, std::move(*slot), {});
+                return;
+            }
+            // Accepting goes on while the connection waits for a handshake
+            // slot.
+            with_gate(_gate, [this, &l, fd = std::move(fd), addr, slot = std::move(*slot)] () mutable {
+                return _tls->wrap(std::move(fd)).then([this, &l, addr, slot = std::move(slot)] (connected_socket s,
+                        tls_handshake handshake) mutable {
+                    add_connection(l, std::move(s), addr, std::move(slot), std::move(handshake));
+                });
+            }).handle_exception([addr] (std::exception_ptr ep) {
+                hlog.debug("{}: dropped before the TLS handshake: {}", addr, ep);
+            });
+        });
+    }).handle_exception([this, &l, socket] (std::exception_ptr ep) {
+        // A withdrawn listener's socket is aborted on purpose.
+        if (!_stopping && l.socket == socket) {
+            hlog.error("{}: accept failed: {}", l.config.name(), ep);
+        }
+    });
+}
+
+void server::add_connection(listener& l, connected_socket fd, socket_address addr, semaphore_units<> slot,
+        std::optional<tls_handshake> handshake) {
+    auto conn = make_lw_shared<connection>(*this, _next_connection_id++, std::move(fd), addr, std::move(handshake));
+    with_gate(_gate, [this, &l, conn, slot = std::move(slot)] () mutable {
+        _connections.emplace(conn->id(), conn);
+        l.connections++;
+        return conn->run().finally([this, &l, conn, slot = std::move(slot)] {
+            _connections.erase(conn->id());
+            l.connections--;
+        });
+    });
+}
+
+namespace {
+
+// What a shard reports to the balancer.
+struct shard_listeners {
+    size_t connections;
+    // By listener.
+    std::vector<bool> listening;
+};
+
+}
+
+// Decides which shards listen on each listener, from what every shard
+// reported: a shard stops listening once it has withdraw_ratio more
+// connections than the average of the listener's shards, and at least
+// min_excess more, and listens again once within rejoin_ratio of it.  The
+// least loaded shard listens if none would.  Compares all the connections
+// of each shard, whichever listeners they came from, since that is what
+// loads its core.
+static std::vector<std::vector<bool>> balance(const balance_config& config,
+        const std::vector<listener_config>& listeners, const std::vector<shard_listeners>& shards) {
+    std::vector<std::vector<bool>> listening;
+    for (auto& s : shards) {
+        listening.push_back(s.listening);
+    }
+    for (unsigned i = 0; i < listeners.size(); ++i) {
+        std::vector<unsigned> on;
+        size_t total = 0;
+        for (unsigned shard = 0; shard < shards.size(); ++shard) {
+            if (listeners[i].on_shard(shard)) {
+                on.push_back(shard);
+                total += shards[shard].connections;
+            }
+        }
+        if (on.size() < 2) {
+            continue;
+        }
+        auto average = double(total) / on.size();
+        bool any = false;
+        unsigned least = on.front();
+        for (auto shard : on) {
+            double n = shards[shard].connections;
+            if (listening[shard][i]) {
+                listening[shard][i] = !(n > average * (1 + config.withdraw_ratio) && n - average >= config.min_excess);
+            } else {
+                listening[shard][i] = n <= average * (1 + config.rejoin_ratio);
+            }
+            any |= listening[shard][i];
+            if (shards[shard].connections < shards[least].connections) {
+                least = shard;
+            }
+        }
+        if (!any) {
+            listening[least][i] = true;
+        }
+    }
+    return listening;
+}
+
+void server::balance_listeners() {
+    if (_balancing || _stopping || _listeners.empty()) {
+        return;
+    }
+    _balancing = true;
+    with_gate(_gate, [this] {
+        return container().map_reduce0([] (server& s) {
+            shard_listeners state{s._connections.size(), {}};
+            for (auto& l : s._listeners) {
+                state.listening.push_back(bool(l.socket));
+            }
+            return std::make_pair(engine().cpu_id(), std::move(state));
+        }, std::vector<shard_listeners>(smp::count), [] (std::vector<shard_listeners> shards,
+                std::pair<unsigned, shard_listeners> state) {
+            shards[state.first] = std::move(state.second);
+            return shards;
+        }).then([this] (std::vector<shard_listeners> shards) {
+            std::vector<listener_config> listeners;
+            for (auto& l : _listeners) {
+                listeners.push_back(l.config);
+            }
+            auto listening = balance(_balance, listeners, shards);
+            bool changed = false;
+            for (unsigned shard = 0; shard < shards.size(); ++shard) {
+                changed |= listening[shard] != shards[shard].listening;
+            }
+            if (!changed) {
+                return make_ready_future<>();
+            }
+            return container().invoke_on_all([listening = std::move(listening)] (server& s) {
+                s.set_listening(listening[engine().cpu_id()]);
+            });
+        });
+    }).finally([this] {
+        _balancing = false;
+    });
+}
+
+void server::set_listening(const std::vector<bool>& listening) {
+    if (_stopping) {
+        return;
+    }
+    for (unsigned i = 0; i < _listeners.size(); ++i) {
+        auto& l = _listeners[i];
+        if (listening[i] == bool(l.socket)) {
+            continue;
+        }
+        if (listening[i]) {
+            hlog.info("{}: accepting again with {} connections", l.config.name(), _connections.size());
+            try {
+                listen(l);
+            } catch (...) {
+                hlog.error("{}: listen failed: {}", l.config.name(), std::current_exception());
+            }
+        } else {
+            hlog.info("{}: stopped accepting with {} connections", l.config.name(), _connections.size());
+            l.withdrawals++;
+            // Balancing only runs when the kernel migrates the socket's
+            // queued connections to the shards still listening.
+            auto socket = std::move(l.socket);
+            socket->abort_accept();
+        }
+    }
+}
+
+future<> server::stop() {
+    _stopping = true;
+    _balance_timer.cancel();
+    for (auto& l : _listeners) {
+        if (l.socket) {
+            l.socket->abort_accept();
+        }
+    }
+    if (_tls) {
+        _tls->stop();
+    }
+    for (auto& c : _connections) {
+        c.second->shutdown();
+    }
+    _stall_probe.stop();
+    _shared_load_timer.cancel();
+    // Nothing arrives from other nodes once the cluster is stopped.
+    auto cluster_stopped = _cluster ? _cluster->stop() : make_ready_future<>();
+    return cluster_stopped.then([this] {
+        return _gate.close();
+    }).then([this] {
+        _timers.stop();
+        return _fanout.stop();
+    }).then([this] {
+        return _retained.stop();
+    }).then([this] {
+        return _store ? _store->stop() : make_ready_future<>();
+    });
+}
+
+future<> server::recover() {
+    return _retained.start().then([this] {
+        return _store ? _store->recover() : make_ready_future<std::vector<stored_session>>();
+    }).then([this] (std::vector<stored_session> stored) {
+        std::vector<sstring> added;
+        std::vector<shared_change> shared;
+        for (auto& ss : stored) {
+            session_config config;
+            config.clean_start = false;
+            config.expiry_interval = ss.expiry_interval;
+            auto id = _next_session_id++;
+            auto s = std::make_unique<session>(id, ss.client_id, config, _timers, _session_sender, [this, id] {
+                expire_session(id);
+            });
+            for (auto& f : ss.subscriptions) {
+                s->add_subscription(f.first, f.second);
+                if (is_shared_filter(view(f.first))) {
+                    count_shared(id, 1);
+                    shared.push_back(shared_change{f.first, id, f.second});
+                } else if (index_subscribe(f.first, id, f.second)) {
+                    added.push_back(f.first);
+                }
+            }
+            s->restore(*_store, std::move(ss.messages));
+            // The expiry interval starts over from the restart.
+            s->detach();
+            _sessions_by_client.emplace(ss.client_id, id);
+            _sessions.emplace(id, std::move(s));
+        }
+        return update_routes(std::move(added), {}).then([this, shared = std::move(shared)] () mutable {
+            return update_shared(std::move(shared), {});
+        });
+    });
+}
+
+future<> server::publish(uint64_t origin, mqtt::publish&& pub) {
+    return route(make_message(std::move(pub), origin));
+}
+
+future<> server::publish(lw_shared_ptr<message> msg) {
+    return route(std::move(msg));
+}
+
+future<> server::publish_from_peer(lw_shared_ptr<message> msg) {
+    return route(std::move(msg), false);
+}
+
+future<> server::route(lw_shared_ptr<message> msg, bool forward) {
+    if (msg->retain) {
+        retain(msg);
+    }
+    if (forward && _cluster) {
+        _cluster->forward(msg);
+    }
+    auto shards = _routes.match(msg->topic_view());
+    auto local = engine().cpu_id();
+    auto durable = make_ready_future<>();
+    for (auto& s : *shards) {
+        if (s.id == local) {
+            durable = deliver_local(msg);
+        } else {
+            _fanout.enqueue(s.id, msg);
+        }
+    }
+    std::vector<shared_pick> picks;
+    _shared.match(msg->topic_view(), picks);
+    if (picks.empty()) {
+        return durable;
+    }
+    std::vector<future<>> shared_durable;
+    shared_durable.push_back(std::move(durable));
+    for (auto& p : picks) {
+        if (p.member.shard == local) {
+            shared_durable.push_back(deliver_shared(p.member.session, msg, p.options));
+        } else {
+            _fanout.enqueue_shared(p.member.shard, p.member.session, msg, shared_delivery(p.options));
+        }
+    }
+    return when_all(shared_durable.begin(), shared_durable.end()).discard_result();
+}
+
+void server::retain(const lw_shared_ptr<message>& msg) {
+    auto owner = retained_owner(msg->topic_view());
+    if (owner == engine().cpu_id()) {
+        _retained.put(*msg);
+        return;
+    }
+    on_owner(owner, [remote = make_foreign(msg)] (server& s) mutable {
+        s._retained.put(*import_message(std::move(remote)));
+    });
+}
+
+future<fanout::batch> server::deliver_batch(fanout::batch&& batch) {
+    _fanout.received(batch.items.size());
+    std::vector<lw_shared_ptr<message>> imported;
+    imported.reserve(batch.messages.size());
+    for (auto& m : batch.messages) {
+        imported.push_back(import_message(std::move(m)));
+    }
+    std::vector<future<>> durable;
+    for (auto& i : batch.items) {
+        auto& msg = imported[i.msg];
+        if (i.to_session) {
+            auto f = deliver_shared(i.connection, msg, shared_options(i.delivery));
+            if (!f.available() || f.failed()) {
+                durable.push_back(std::move(f));
+            }
+        } else if (i.connection == fanout::no_connection) {
+            auto f = deliver_local(msg);
+            if (!f.available() || f.failed()) {
+                durable.push_back(std::move(f));
+            }
+        } else {
+            deliver_to_connection(i.connection, msg, i.delivery);
+        }
+    }
+    return when_all(durable.begin(), durable.end()).discard_result().then([batch = std::move(batch)] () mutable {
+        return std::move(batch);
+    });
+}
+
+// Resolves once every persistent session the message went to has it on
+// disk.  A failure to persist is logged and does not fail the publish; the
+// message has been delivered or queued in memory all the same.
+future<> server::deliver_local(const lw_shared_ptr<message>& msg) {
+    auto matches = _subscriptions.match(msg->topic_view());
+    std::vector<future<>> durable;
+    for (auto& m : *matches) {
+        auto i = _sessions.find(m.id);
+        if (i != _sessions.end()) {
+            auto f = i->second->deliver(msg, m.options);
+            if (!f.available() || f.failed()) {
+                durable.push_back(std::move(f));
+            }
+        }
+    }
+    if (durable.empty()) {
+        return make_ready_future<>();
+    }
+    return when_all(durable.begin(), durable.end()).then([] (std::vector<future<>> results) {
+        for (auto& f : results) {
+            if (f.failed()) {
+                hlog.warn("message not persisted: {}", f.get_exception());
+            }
+        }
+    });
+}
+
+future<> server::deliver_shared(subscriber_id id, const lw_shared_ptr<message>& msg, const subscription_options& options) {
+    auto i = _sessions.find(id);
+    if (i == _sessions.end()) {
+        return make_ready_future<>();
+    }
+    return i->second->deliver(msg, options).handle_exception([] (std::exception_ptr ep) {
+        hlog.warn("message not persisted: {}", ep);
+    });
+}
+
+void server::send_to_connection(const connection_location& loc, const lw_shared_ptr<message>& msg, const delivery& d) {
+    if (loc.shard == engine().cpu_id()) {
+        deliver_to_connection(loc.id, msg, d);
+    } else {
+        _fanout.enqueue(loc.shard, loc.id, msg, d);
+    }
+}
+
+void server::deliver_to_connection(uint64_t id, const lw_shared_ptr<message>& msg, const delivery& d) {
+    auto i = _connections.find(id);
+    if (i == _connections.end()) {
+        return;
+    }
+    auto conn = i->second;
+    conn->deliver(msg, d).finally([conn] {});
+}
+
+void server::disconnect(uint64_t id, mqtt::reason_code code) {
+    auto i = _connections.find(id);
+    if (i != _connections.end()) {
+        i->second->disconnect(code);
+    }
+}
+
+attach_result server::attach(sstring client_id, session_config config, connection_location loc) {
+    session* s = nullptr;
+    bool present = false;
+    auto i = _sessions_by_client.find(client_id);
+    if (i != _sessions_by_client.end()) {
+        s = _sessions[i->second].get();
+        if (s->attached()) {
+            // Session takeover.  The old connection no longer holds the
+            // session once this returns, so its own detach is ignored.
+            auto old = *s->attached();
+            s->detach();
+            on_owner(old.shard, [id = old.id] (server& srv) {
+                srv.disconnect(id, mqtt::reason_code::session_taken_over);
+            });
+        }
+        if (config.clean_start) {
+            destroy_session(*s);
+            s = nullptr;
+        } else {
+            present = true;
+        }
+    }
+    if (!s) {
+        auto id = _next_session_id++;
+        auto ns = std::make_unique<session>(id, client_id, config, _timers, _session_sender, [this, id] {
+            expire_session(id);
+        });
+        s = ns.get();
+        _sessions.emplace(id, std::move(ns));
+        _sessions_by_client.emplace(std::move(client_id), id);
+    }
+    s->attach(loc, config);
+    persist(*s);
+    return attach_result{s->id(), present};
+}
+
+// Sessions outliving their connection are recorded; the others are not,
+// and stop being recorded if a reconnect shortened their expiry to zero.
+void server::persist(session& s) {
+    if (!_store) {
+        return;
+    }
+    auto store = s.config().expiry_interval ? _store.get() : nullptr;
+    s.set_store(store).handle_exception([client_id = s.client_id()] (std::exception_ptr ep) {
+        hlog.warn("cannot persist session {}: {}", client_id, ep);
+    });
+}
+
+void server::detach(subscriber_id id, connection_location loc) {
+    auto i = _sessions.find(id);
+    if (i == _sessions.end()) {
+        return;
+    }
+    auto& s = *i->second;
+    if (!s.attached() || *s.attached() != loc) {
+        return;
+    }
+    s.detach();
+    if (s.config().expiry_interval == 0) {
+        destroy_session(s);
+    }
+}
+
+void server::destroy_session(session& s) {
+    s.set_store(nullptr);
+    std::vector<sstring> removed;
+    std::vector<shared_change> shared;
+    for (auto& sub : s.subscriptions()) {
+        if (is_shared_filter(view(sub.first))) {
+            count_shared(s.id(), -1);
+            shared.push_back(shared_change{sub.first, s.id(), sub.second});
+        } else if (index_unsubscribe(sub.first, s.id())) {
+            removed.push_back(sub.first);
+        }
+    }
+    _sessions_by_client.erase(s.client_id());
+    _sessions.erase(s.id());
+    if ((removed.empty() && shared.empty()) || _stopping) {
+        return;
+    }
+    with_gate(_gate, [this, removed = std::move(removed), shared = std::move(shared)] () mutable {
+        return update_routes({}, std::move(removed)).then([this, shared = std::move(shared)] () mutable {
+            return update_shared({}, std::move(shared));
+        });
+    });
+}
+
+void server::expire_session(subscriber_id id) {
+    auto i = _sessions.find(id);
+    if (i != _sessions.end()) {
+        hlog.debug("session {} expired", i->second->client_id());
+        destroy_session(*i->second);
+    }
+}
+
+bool server::index_subscribe(const sstring& filter, subscriber_id id, const subscription_options& options) {
+    if (!_subscriptions.subscribe(view(filter), id, options)) {
+        return false;
+    }
+    return _local_filters[filter]++ == 0;
+}
+
+bool server::index_unsubscribe(const sstring& filter, subscriber_id id) {
+    if (!_subscriptions.unsubscribe(view(filter), id)) {
+        return false;
+    }
+    auto i = _local_filters.find(filter);
+    if (--i->second) {
+        return false;
+    }
+    _local_filters.erase(i);
+    return true;
+}
+
+future<subscribe_result> server::subscribe(subscriber_id id,
+        std::vector<std::pair<sstring, subscription_options>> filters) {
+    subscribe_result r;
+    auto i = _sessions.find(id);
+    if (i == _sessions.end()) {
+        r.codes.assign(filters.size(), mqtt::reason_code::unspecified_error);
+        return make_ready_future<subscribe_result>(std::move(r));
+    }
+    auto& s = *i->second;
+    std::vector<sstring> added;
+    std::vector<shared_change> shared;
+    for (auto& f : filters) {
+        auto is_new = s.add_subscription(f.first, f.second);
+        if (is_shared_filter(view(f.first))) {
+            // Retained messages are not sent to shared subscriptions.
+            if (is_new) {
+                count_shared(id, 1);
+            }
+            shared.push_back(shared_change{f.first, id, f.second});
+            r.codes.push_back(mqtt::reason_code(f.second.max_qos));
+            continue;
+        }
+        if (index_subscribe(f.first, id, f.second)) {
+            added.push_back(f.first);
+        }
+        r.codes.push_back(mqtt::reason_code(f.second.max_qos));
+        if (f.second.retain_handling == 0 || (f.second.retain_handling == 1 && is_new)) {
+            r.retained.push_back(f);
+        }
+    }
+    // Acknowledge only once every shard routes matching messages here, and
+    // the subscriptions of a persistent session are durable.
+    auto saved = s.save();
+    return update_routes(std::move(added), {}).then([this, shared = std::move(shared)] () mutable {
+        return update_shared(std::move(shared), {});
+    }).then([saved = std::move(saved)] () mutable {
+        return std::move(saved);
+    }).then([r = std::move(r)] () mutable {
+        return std::move(r);
+    });
+}
+
+// Each shard holding candidates streams its matches to this one in
+// batches, and waits for a batch to be handed to the session before
+// sending the next; the session's queue limit and the connection's send
+// queue bound what a filter matching many topics can hold up.
+future<> server::send_retained(subscriber_id id, std::vector<std::pair<sstring, subscription_options>> filters) {
+    return do_with(std::move(filters), [this, id] (auto& filters) {
+        return do_for_each(filters, [this, id] (std::pair<sstring, subscription_options>& f) {
+            auto filter = std::string_view(f.first.c_str(), f.first.size());
+            std::vector<unsigned> shards;
+            if (filter.find_first_of("+#") == std::string_view::npos) {
+                shards.push_back(retained_owner(filter));
+            } else {
+                for (unsigned s = 0; s < smp::count; s++) {
+                    shards.push_back(s);
+                }
+            }
+            return parallel_for_each(std::move(shards), [this, id, &f, owner = engine().cpu_id()] (unsigned shard) {
+                return container().invoke_on(shard, [id, owner, filter = f.first, options = f.second] (server& s) {
+                    return s._retained.for_each_match(filter, [&s, id, owner, options] (std::vector<lw_shared_ptr<message>> batch) {
+                        std::vector<foreign_ptr<lw_shared_ptr<message>>> remote;
+                        remote.reserve(batch.size());
+                        for (auto& m : batch) {
+                            remote.push_back(make_foreign(std::move(m)));
+                        }
+                        return s.container().invoke_on(owner, [id, options, remote = std::move(remote)] (server& o) mutable {
+                            return o.deliver_retained(id, options, std::move(remote));
+                        });
+                    });
+                });
+            });
+        });
+    }).handle_exception([this, id] (std::exception_ptr ep) {
+        if (!_stopping) {
+            hlog.warn("cannot send retained messages to session {}: {}", id, ep);
+        }
+    });
+}
+
+future<stop_iteration> server::deliver_retained(subscriber_id id, const subscription_options& options,
+        std::vector<foreign_ptr<lw_shared_ptr<message>>> batch) {
+    auto i = _sessions.find(id);
+    if (i == _sessions.end() || _stopping) {
+        return make_ready_future<stop_iteration>(stop_iteration::yes);
+    }
+    std::vector<future<>> durable;
+    for (auto& m : batch) {
+        auto f = i->second->deliver(import_message(std::move(m)), options, true);
+        if (!f.available() || f.failed()) {
+            durable.push_back(std::move(f));
+        }
+    }
+    return when_all(durable.begin(), durable.end()).then([] (std::vector<future<>> results) {
+        for (auto& f : results) {
+            if (f.failed()) {
+                hlog.warn("message not persisted: {}", f.get_exception());
+            }
+        }
+        return stop_iteration::no;
+    });
+}
+
+future<std::vector<mqtt::reason_code>> server::unsubscribe(subscriber_id id, std::vector<sstring> filters) {
+    std::vector<mqtt::reason_code> codes;
+    auto i = _sessions.find(id);
+    if (i == _sessions.end()) {
+        codes.assign(filters.size(), mqtt::reason_code::unspecified_error);
+        return make_ready_future<std::vector<mqtt::reason_code>>(std::move(codes));
+    }
+    auto& s = *i->second;
+    std::vector<sstring> removed;
+    std::vector<shared_change> shared;
+    for (auto& f : filters) {
+        if (!s.remove_subscription(f)) {
+            codes.push_back(mqtt::reason_code::no_subscription_existed);
+            continue;
+        }
+        if (is_shared_filter(view(f))) {
+            count_shared(id, -1);
+            shared.push_back(shared_change{f, id, subscription_options()});
+        } else if (index_unsubscribe(f, id)) {
+            removed.push_back(f);
+        }
+        codes.push_back(mqtt::reason_code::success);
+    }
+    auto saved = s.save();
+    return update_routes({}, std::move(removed)).then([this, shared = std::move(shared)] () mutable {
+        return update_shared({}, std::move(shared));
+    }).then([saved = std::move(saved)] () mutable {
+        return std::move(saved);
+    }).then([codes = std::move(codes)] () mutable {
+        return std::move(codes);
+    });
+}
+
+void server::acknowledge(subscriber_id id, mqtt::packet_type type, uint16_t packet_id) {
+    auto i = _sessions.find(id);
+    if (i != _sessions.end()) {
+        i->second->acknowledge(type, packet_id);
+    }
+}
+
+bool server::receive_qos2(subscriber_id id, uint16_t packet_id) {
+    auto i = _sessions.find(id);
+    return i == _sessions.end() || i->second->receive_qos2(packet_id);
+}
+
+void server::release_qos2(subscriber_id id, uint16_t packet_id) {
+    auto i = _sessions.find(id);
+    if (i != _sessions.end()) {
+        i->second->release_qos2(packet_id);
+    }
+}
+
+// One invoke_on_all per request rather than per filter, so a client that
+// subscribes to many filters at once costs one round of smp messages.
+future<> server::update_routes(std::vector<sstring> added, std::vector<sstring> removed) {
+    if (added.empty() && removed.empty()) {
+        return make_ready_future<>();
+    }
+    return container().invoke_on_all([added = std::move(added), removed = std::move(removed),
+            shard = engine().cpu_id()] (server& s) {
+        for (auto& f : added) {
+            s.add_route(f, shard);
+        }
+        for (auto& f : removed) {
+            s.remove_route(f, shard);
+        }
+    });
+}
+
+// Shard 0 tells the cluster, which counts the shards routing each filter.
+void server::add_route(const sstring& filter, unsigned shard) {
+    if (_routes.subscribe(view(filter), shard, subscription_options()) && _cluster && engine().cpu_id() == 0) {
+        _cluster->local_route_added(filter);
+    }
+}
+
+void server::remove_route(const sstring& filter, unsigned shard) {
+    if (_routes.unsubscribe(view(filter), shard) && _cluster && engine().cpu_id() == 0) {
+        _cluster->local_route_removed(filter);
+    }
+}
+
+future<> server::update_shared(std::vector<shared_change> added, std::vector<shared_change> removed) {
+    if (added.empty() && removed.empty()) {
+        return make_ready_future<>();
+    }
+    return container().invoke_on_all([added = std::move(added), removed = std::move(removed),
+            shard = engine().cpu_id()] (server& s) {
+        // Other nodes route a group like its filter.
+        auto notify = s._cluster && engine().cpu_id() == 0;
+        for (auto& c : added) {
+            if (s._shared.add(c.filter, shared_member{shard, c.session}, c.options) && notify) {
+                s._cluster->local_route_added(shared_route(c.filter));
+            }
+        }
+        for (auto& c : removed) {
+            if (s._shared.remove(c.filter, shared_member{shard, c.session}) && notify) {
+                s._cluster->local_route_removed(shared_route(c.filter));
+            }
+        }
+    });
+}
+
+void server::count_shared(subscriber_id id, int delta) {
+    auto& m = _shared_members[id];
+    m.groups += delta;
+    if (!m.groups) {
+        _shared_members.erase(id);
+    }
+}
+
+// Only the loads that changed since the last report are sent, and a report
+// is skipped while the previous one is still on its way.
+void server::report_shared_loads() {
+    if (_reporting_loads || _stopping) {
+        return;
+    }
+    std::vector<std::pair<subscriber_id, uint32_t>> loads;
+    for (auto& m : _shared_members) {
+        auto i = _sessions.find(m.first);
+        if (i == _sessions.end()) {
+            continue;
+        }
+        auto& s = *i->second;
+        uint32_t load = s.attached() ? s.inflight_count() + s.queued_count() : shared_subscriptions::disconnected;
+        if (load != m.second.reported) {
+            m.second.reported = load;
+            loads.emplace_back(m.first, load);
+        }
+    }
+    if (loads.empty()) {
+        return;
+    }
+    _reporting_loads = true;
+    with_gate(_gate, [this, loads = std::move(loads)] () mutable {
+        return container().invoke_on_all([loads = std::move(loads), shard = engine().cpu_id()] (server& s) {
+            s._shared.update_loads(shard, loads);
+        }).finally([this] {
+            _reporting_loads = false;
+        });
+    });
+}
+
+} /* namespace hero */
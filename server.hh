@@ -0,0 +1,273 @@
+/*
+ * This file is open source software, licensed to you under the terms
+ * of the Apache License, Version 2.0 (the "License").  See the NOTICE file
+ * distributed with this work for additional information regarding copyright
+ * ownership.  You may not use this file except in compliance with the License.
+ *
+ * You may obtain a copy of the License at
+ *
+ *   http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing,
+ * software distributed under the License is distributed on an
+ * "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+ * KIND, either express or implied.  See the License for the
+ * specific language governing permissions and limitations
+ * under the License.
+ */
+
+#pragma once
+
+#include "core/distributed.hh"
+#include "core/gate.hh"
+#include "core/metrics_registration.hh"
+#include "core/shared_ptr.hh"
+#include "core/timer.hh"
+#include "net/api.hh"
+#include "admission.hh"
+#include "broker_metrics.hh"
+#include "cluster.hh"
+#include "connection.hh"
+#include "fanout.hh"
+#include "listener.hh"
+#include "message.hh"
+#include "output_queue.hh"
+#include "retained_store.hh"
+#include "segment_log.hh"
+#include "session.hh"
+#include "session_store.hh"
+#include "shared_subscriptions.hh"
+#include "subscription_index.hh"
+#include "timer_wheel.hh"
+#include "tls_acceptor.hh"
+
+#include <memory>
+#include <unordered_map>
+#include <vector>
+
+namespace hero {
+
+using namespace seastar;
+using namespace net;
+
+struct attach_result {
+    subscriber_id session;
+    bool session_present;
+};
+
+struct subscribe_result {
+    std::vector<mqtt::reason_code> codes;
+    // The filters whose retained messages are due, to be sent once the
+    // SUBACK is out.
+    std::vector<std::pair<sstring, subscription_options>> retained;
+};
+
+// The broker instance of one shard.
+//
+// A shard plays two roles.  It holds the connections the kernel handed to
+// it, and it owns the sessions of the clients whose identifiers hash to it
+// (see session_owner()).  A connection forwards session operations to the
+// owner shard, and the owner sends deliveries back to the connection's
+// shard through the fanout.  Subscriptions are indexed on the owner, with
+// session ids as subscriber ids.
+//
+// Every shard also holds a replica of the route table, which maps each
+// filter to the shards that have at least one subscriber for it, so a
+// publisher's shard knows where to send a message without asking the
+// others.
+//
+// Shared subscriptions ("$share/<group>/<filter>") are replicated on every
+// shard the same way, as groups of member sessions.  The publisher's shard
+// picks one member of each matching group by the loads the owner shards
+// report every shared_load_interval, and sends the message to the
+// member's owner.
+//
+// Retained messages are partitioned by topic (see retained_owner()).  A
+// new subscription's filter is looked up on the topic's shard, or, if it
+// has wildcards, on every shard, and the matches stream back to the
+// session's owner.
+//
+// Each listener listens on its own set of shards.  The kernel spreads a
+// listener's connections among them, and shard 0 withdraws the listeners
+// of shards with too many connections until the others catch up (see
+// balance_config).
+//
+// In cluster mode (see cluster), shard 0 also tells the other nodes about
+// the filters routed on this node, and every shard forwards the messages
+// published on it to the nodes with matching routes.  Messages from other
+// nodes are routed like local ones, but not forwarded again.
+class server : public peering_sharded_service<server> {
+private:
+    // The MQTT and TLS listeners, in the same order on every shard, and
+    // including those which do not listen on this one.
+    struct listener {
+        listener_config config;
+        // Null while this shard does not listen.
+        lw_shared_ptr<server_socket> socket;
+        unsigned connections = 0;
+        uint64_t withdrawals = 0;
+    };
+    std::vector<listener> _listeners;
+    // Null unless there is a TLS listener.
+    std::unique_ptr<tls_acceptor> _tls;
+    balance_config _balance;
+    // On shard 0.
+    timer<> _balance_timer;
+    bool _balancing = false;
+    // Declared before anything holding a wheel_timer.
+    timer_wheel _timers;
+    // Declared before the sessions, which may hold its messages.
+    retained_store _retained;
+    // Declared before the connections, which hold its units.
+    admission_control _admission;
+    uint64_t _next_connection_id = 0;
+    std::unordered_map<uint64_t, lw_shared_ptr<connection>> _connections;
+    subscriber_id _next_session_id = 0;
+    std::unordered_map<subscriber_id, std::unique_ptr<session>> _sessions;
+    std::unordered_map<sstring, subscriber_id> _sessions_by_client;
+    session::sender _session_sender;
+    // Null unless persistence is enabled.
+    std::unique_ptr<session_store> _store;
+    subscription_index _subscriptions;
+    // Number of local subscribers per filter; a route to this shard exists
+    // while it is non-zero.
+    std::unordered_map<sstring, unsigned> _local_filters;
+    // Subscriber ids in this index are shard ids.
+    subscription_index _routes;
+    shared_subscriptions _shared;
+    // The local sessions in shared subscription groups: how many groups
+    // each is in, and the load last reported for it.
+    struct shared_member_state {
+        unsigned groups = 0;
+        uint32_t reported = 0;
+    };
+    std::unordered_map<subscriber_id, shared_member_state> _shared_members;
+    timer<> _shared_load_timer;
+    bool _reporting_loads = false;
+    // Null unless cluster mode is enabled.
+    std::unique_ptr<cluster> _cluster;
+    fanout _fanout;
+    output_policy _output_policy;
+    output_stats _output_stats;
+    protocol_stats _protocol_stats;
+    // From make_message() to the delivery being queued on its connection.
+    latency_histogram _delivery_latency;
+    stall_probe _stall_probe;
+    // Operations sent to other shards through on_owner() and not yet done.
+    unsigned _remote_calls = 0;
+    gate _gate;
+    bool _stopping = false;
+    metrics::metric_groups _metrics;
+public:
+    server(std::vector<listener_config> listeners = {}, output_policy policy = output_policy(),
+            log_config log = log_config(), retained_config retained = retained_config(),
+            admission_config admission = admission_config(), cluster_config cluster = cluster_config(),
+            tls_config tls = tls_config(), balance_config balance = balance_config());
+
+    // Clears this shard's retained message spill files and restores its
+    // persistent sessions.  Runs on every shard before start().
+    future<> recover();
+
+    // Loads the TLS credentials, if any, and starts listening.
+    future<> start();
+    future<> stop();
+
+    // Hands a PUBLISH received from connection origin to every matching
+    // subscriber, on this shard and on the others.
+    future<> publish(uint64_t origin, mqtt::publish&& pub);
+    future<> publish(lw_shared_ptr<message> msg);
+    // Hands a message forwarded by another node to the subscribers here.
+    future<> publish_from_peer(lw_shared_ptr<message> msg);
+
+    // Delivers a batch sent by another shard's fanout, and returns it for
+    // the sender to free.
+    future<fanout::batch> deliver_batch(fanout::batch&& batch);
+
+    const fanout& get_fanout() const { return _fanout; }
+    const output_policy& get_output_policy() const { return _output_policy; }
+    output_stats& get_output_stats() { return _output_stats; }
+    protocol_stats& get_protocol_stats() { return _protocol_stats; }
+    latency_histogram& delivery_latency() { return _delivery_latency; }
+    admission_control& admission() { return _admission; }
+    timer_wheel& timers() { return _timers; }
+    cluster* get_cluster() { return _cluster.get(); }
+
+    // Session operations.  Each runs on the owner shard of the session;
+    // connections reach them through container().invoke_on().
+
+    // Attaches the connection at loc to the session of client_id, creating
+    // it if needed, and disconnects whichever connection held it before.
+    attach_result attach(sstring client_id, session_config config, connection_location loc);
+    // Ends the session unless it outlives its connection.  Does nothing if
+    // another connection has taken the session over meanwhile.
+    void detach(subscriber_id id, connection_location loc);
+    future<subscribe_result> subscribe(subscriber_id id,
+            std::vector<std::pair<sstring, subscription_options>> filters);
+    // Sends the retained messages matching each filter to the session.
+    future<> send_retained(subscriber_id id, std::vector<std::pair<sstring, subscription_options>> filters);
+    future<std::vector<mqtt::reason_code>> unsubscribe(subscriber_id id, std::vector<sstring> filters);
+    void acknowledge(subscriber_id id, mqtt::packet_type type, uint16_t packet_id);
+    bool receive_qos2(subscriber_id id, uint16_t packet_id);
+    void release_qos2(subscriber_id id, uint16_t packet_id);
+
+    // Connection operations, run on the connection's shard.
+    void deliver_to_connection(uint64_t id, const lw_shared_ptr<message>& msg, const delivery& d);
+    void disconnect(uint64_t id, mqtt::reason_code code);
+
+    // Runs func in the background, on the owner shard of a session or a
+    // retained topic, keeping the server alive until it is done.  Dropped
+    // once the server stops.
+    template <typename Func>
+    void on_owner(unsigned owner, Func&& func) {
+        if (_stopping) {
+            return;
+        }
+        with_gate(_gate, [this, owner, func = std::forward<Func>(func)] () mutable {
+            _remote_calls++;
+            return container().invoke_on(owner, std::move(func)).finally([this] {
+                _remote_calls--;
+            });
+        });
+    }
+private:
+    void setup_metrics();
+    void listen(listener& l);
+    void accept(listener& l);
+    void add_connection(listener& l, connected_socket fd, socket_address addr, semaphore_units<> slot,
+            std::optional<tls_handshake> handshake);
+    // On shard 0: stops and starts the shards listening to even out their
+    // connection counts (see balance_config).
+    void balance_listeners();
+    // Listens on the listeners flagged in listening, and stops listening
+    // on the others.
+    void set_listening(const std::vector<bool>& listening);
+    future<> route(lw_shared_ptr<message> msg, bool forward = true);
+    future<> deliver_local(const lw_shared_ptr<message>& msg);
+    void persist(session& s);
+    void retain(const lw_shared_ptr<message>& msg);
+    future<stop_iteration> deliver_retained(subscriber_id id, const subscription_options& options,
+            std::vector<foreign_ptr<lw_shared_ptr<message>>> batch);
+    void send_to_connection(const connection_location& loc, const lw_shared_ptr<message>& msg, const delivery& d);
+    void destroy_session(session& s);
+    void expire_session(subscriber_id id);
+    future<> update_routes(std::vector<sstring> added, std::vector<sstring> removed);
+    void add_route(const sstring& filter, unsigned shard);
+    void remove_route(const sstring& filter, unsigned shard);
+    struct shared_change {
+        sstring filter;
+        subscriber_id session;
+        subscription_options options;
+    };
+    // Like update_routes, for memberships of local sessions in shared
+    // subscription groups.
+    future<> update_shared(std::vector<shared_change> added, std::vector<shared_change> removed);
+    void count_shared(subscriber_id id, int delta);
+    void report_shared_loads();
+    future<> deliver_shared(subscriber_id id, const lw_shared_ptr<message>& msg, const subscription_options& options);
+    // Index bookkeeping shared by subscribe and unsubscribe; returns whether
+    // the filter gained its first or lost its last local subscriber.
+    bool index_subscribe(const sstring& filter, subscriber_id id, const subscription_options& options);
+    bool index_unsubscribe(const sstring& filter, subscriber_id id);
+};
+
+} /* namespace hero */
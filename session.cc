@@ -0,0 +1,274 @@
+/*
+ * This file is open source software, licensed to you under the terms
+ * of the Apache License, Version 2.0 (the "License").  See the NOTICE file
+ * distributed with this work for additional information regarding copyright
+ * ownership.  You may not use this file except in compliance with the License.
+ *
+ * You may obtain a copy of the License at
+ *
+ *   http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing,
+ * software distributed under the License is distributed on an
+ * "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+ * KIND, either express or implied.  See the License for the
+ * specific language governing permissions and limitations
+ * under the License.
+ */
+
+#include "session.hh"
+#include "core/reactor.hh"
+
+#include <limits>
+
+namespace hero {
+
+unsigned session_owner(std::string_view client_id) {
+    // FNV-1a: stable across builds and restarts, unlike std::hash, so
+    // persisted sessions are recovered on the shard that owns them.
+    uint64_t h = 14695981039346656037ull;
+    for (auto c : client_id) {
+        h ^= uint8_t(c);
+        h *= 1099511628211ull;
+    }
+    return h % smp::count;
+}
+
+uint16_t session::allocate_packet_id() {
+    while (true) {
+        auto id = _next_packet_id++;
+        if (_next_packet_id == 0) {
+            _next_packet_id = 1;
+        }
+        if (!_inflight_by_id.count(id)) {
+            return id;
+        }
+    }
+}
+
+void session::attach(const connection_location& loc, const session_config& config) {
+    _expiry.cancel();
+    _attached = loc;
+    _config = config;
+    for (auto& i : _inflight) {
+        i.d.dup = true;
+        resend(i);
+    }
+    send_queued();
+}
+
+void session::detach() {
+    _attached = {};
+    for (auto& i : _inflight) {
+        i.retransmit.cancel();
+    }
+    auto expiry = _config.expiry_interval;
+    if (expiry && expiry != std::numeric_limits<uint32_t>::max()) {
+        _timers.arm(_expiry, std::chrono::seconds(expiry));
+    }
+}
+
+// Sends an in-flight message again, or its PUBREL once the client has
+// received it, and restarts its retransmit timer.
+void session::resend(inflight& i) {
+    if (!_attached) {
+        return;
+    }
+    if (i.released) {
+        delivery d = i.d;
+        d.kind = delivery::kind::pubrel;
+        _send(*_attached, i.msg, d);
+    } else {
+        _send(*_attached, i.msg, i.d);
+    }
+    if (_config.retransmit_interval) {
+        _timers.arm(i.retransmit, std::chrono::seconds(_config.retransmit_interval));
+    }
+}
+
+bool session::add_subscription(sstring filter, const subscription_options& options) {
+    auto r = _subscriptions.emplace(std::move(filter), options);
+    if (!r.second) {
+        r.first->second = options;
+    }
+    return r.second;
+}
+
+bool session::remove_subscription(const sstring& filter) {
+    return _subscriptions.erase(filter);
+}
+
+future<> session::store_message(const lw_shared_ptr<message>& msg, mqtt::qos qos, uint64_t& stored) {
+    auto r = _store->add_message(_client_id, msg, qos);
+    stored = r.first;
+    return std::move(r.second);
+}
+
+void session::unstore_message(uint64_t stored) {
+    if (_store && stored) {
+        _store->remove_message(_client_id, stored);
+    }
+}
+
+future<> session::save() {
+    if (!_store) {
+        return make_ready_future<>();
+    }
+    return _store->save_session(_client_id, _config.expiry_interval, _subscriptions);
+}
+
+future<> session::set_store(session_store* store) {
+    if (!store) {
+        if (_store) {
+            _store->remove_session(_client_id);
+            for (auto& i : _inflight) {
+                i.stored = 0;
+            }
+            for (auto& q : _queue) {
+                q.stored = 0;
+            }
+            _store = nullptr;
+        }
+        return make_ready_future<>();
+    }
+    if (!_store) {
+        // Becoming persistent: record what the session already holds.
+        _store = store;
+        auto ignore = [] (future<> f) {
+            f.handle_exception([] (std::exception_ptr) {});
+        };
+        for (auto& i : _inflight) {
+            ignore(store_message(i.msg, i.d.qos, i.stored));
+            if (i.released) {
+                _store->release_message(_client_id, i.stored, i.d.packet_id);
+            } else {
+                _store->sent_message(_client_id, i.stored, i.d.packet_id);
+            }
+        }
+        for (auto& q : _queue) {
+            ignore(store_message(q.msg, q.d.qos, q.stored));
+        }
+    }
+    return save();
+}
+
+void session::restore(session_store& store, std::vector<stored_message>&& messages) {
+    _store = &store;
+    for (auto& m : messages) {
+        delivery d;
+        d.qos = m.qos;
+        if (m.packet_id) {
+            // The client may have received it under this id: it goes out
+            // again with the same one, as a duplicate.
+            d.packet_id = *m.packet_id;
+            d.dup = true;
+            auto i = _inflight.emplace(_inflight.end(), m.msg, d, m.id);
+            i->released = m.released;
+            _inflight_by_id.emplace(d.packet_id, i);
+            auto& entry = *i;
+            entry.retransmit.set_callback([this, &entry] {
+                resend(entry);
+            });
+        } else {
+            _queue.push_back(queued{m.msg, d, m.id});
+        }
+    }
+}
+
+void session::enqueue(const lw_shared_ptr<message>& msg, const delivery& d, uint64_t stored) {
+    if (_queue.size() >= _max_queued) {
+        unstore_message(_queue.front().stored);
+        _queue.pop_front();
+        _dropped++;
+    }
+    _queue.push_back(queued{msg, d, stored});
+}
+
+void session::send_inflight(const lw_shared_ptr<message>& msg, const delivery& d, uint64_t stored) {
+    auto i = _inflight.emplace(_inflight.end(), msg, d, stored);
+    i->d.packet_id = allocate_packet_id();
+    _inflight_by_id.emplace(i->d.packet_id, i);
+    if (_store && stored) {
+        _store->sent_message(_client_id, stored, i->d.packet_id);
+    }
+    auto& entry = *i;
+    entry.retransmit.set_callback([this, &entry] {
+        entry.d.dup = true;
+        resend(entry);
+    });
+    resend(entry);
+}
+
+future<> session::deliver(const lw_shared_ptr<message>& msg, const subscription_options& options, bool retained) {
+    if (options.no_local && _attached && _attached->shard == msg->origin_shard && _attached->id == msg->origin) {
+        return make_ready_future<>();
+    }
+    delivery d;
+    d.qos = std::min(msg->qos, options.max_qos);
+    d.retain = retained || (options.retain_as_published && msg->retain);
+    d.subscription_identifier = options.subscription_identifier;
+    if (d.qos == mqtt::qos::at_most_once) {
+        if (_attached) {
+            _send(*_attached, msg, d);
+        }
+        return make_ready_future<>();
+    }
+    uint64_t stored = 0;
+    auto durable = _store ? store_message(msg, d.qos, stored) : make_ready_future<>();
+    if (!_attached || _inflight.size() >= _config.receive_maximum) {
+        enqueue(msg, d, stored);
+    } else {
+        send_inflight(msg, d, stored);
+    }
+    return durable;
+}
+
+void session::send_queued() {
+    while (_attached && !_queue.empty() && _inflight.size() < _config.receive_maximum) {
+        auto q = std::move(_queue.front());
+        _queue.pop_front();
+        send_inflight(q.msg, q.d, q.stored);
+    }
+}
+
+void session::acknowledge(mqtt::packet_type type, uint16_t packet_id) {
+    auto i = _inflight_by_id.find(packet_id);
+    if (i == _inflight_by_id.end()) {
+        return;
+    }
+    auto& entry = *i->second;
+    switch (type) {
+    case mqtt::packet_type::puback:
+        if (entry.d.qos != mqtt::qos::at_least_once) {
+            return;
+        }
+        break;
+    case mqtt::packet_type::pubrec:
+        if (entry.d.qos == mqtt::qos::exactly_once && !entry.released) {
+            // The connection has already answered with PUBREL; the message
+            // stays in flight until PUBCOMP, and a retransmission from now
+            // on is a PUBREL.
+            entry.released = true;
+            if (_store && entry.stored) {
+                _store->release_message(_client_id, entry.stored, packet_id);
+            }
+            if (_config.retransmit_interval && _attached) {
+                _timers.arm(entry.retransmit, std::chrono::seconds(_config.retransmit_interval));
+            }
+        }
+        return;
+    case mqtt::packet_type::pubcomp:
+        if (!entry.released) {
+            return;
+        }
+        break;
+    default:
+        return;
+    }
+    unstore_message(entry.stored);
+    _inflight.erase(i->second);
+    _inflight_by_id.erase(i);
+    send_queued();
+}
+
+} /* namespace hero */
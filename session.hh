@@ -0,0 +1,183 @@
+/*
+ * This file is open source software, licensed to you under the terms
+ * of the Apache License, Version 2.0 (the "License").  See the NOTICE file
+ * distributed with this work for additional information regarding copyright
+ * ownership.  You may not use this file except in compliance with the License.
+ *
+ * You may obtain a copy of the License at
+ *
+ *   http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing,
+ * software distributed under the License is distributed on an
+ * "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+ * KIND, either express or implied.  See the License for the
+ * specific language governing permissions and limitations
+ * under the License.
+ */
+
+#pragma once
+
+#include "core/shared_ptr.hh"
+#include "core/sstring.hh"
+#include "message.hh"
+#include "session_store.hh"
+#include "subscription_index.hh"
+#include "timer_wheel.hh"
+
+#include <deque>
+#include <functional>
+#include <list>
+#include <optional>
+#include <string_view>
+#include <unordered_map>
+#include <unordered_set>
+
+namespace hero {
+
+using namespace seastar;
+
+// The shard owning the session of a client.  Every session operation for
+// the client runs there, so none of them needs cross-shard locking.
+unsigned session_owner(std::string_view client_id);
+
+// Where a client is connected.
+struct connection_location {
+    unsigned shard;
+    uint64_t id;
+
+    bool operator==(const connection_location& o) const {
+        return shard == o.shard && id == o.id;
+    }
+    bool operator!=(const connection_location& o) const {
+        return !(*this == o);
+    }
+};
+
+struct session_config {
+    bool clean_start = true;
+    // Seconds; 0 ends the session with the connection, and UINT32_MAX
+    // keeps it forever.
+    uint32_t expiry_interval = 0;
+    uint16_t receive_maximum = 65535;
+    // Seconds before an unacknowledged message is resent to a connected
+    // client; 0 resends only on reconnect, as MQTT 5 requires.
+    uint32_t retransmit_interval = 0;
+};
+
+// State of one client, kept on the client's owner shard.  The session
+// tracks outbound QoS 1/2 messages until they are acknowledged, queues
+// messages while the client is away or its receive window is full, and
+// remembers inbound QoS 2 packet ids until they are released.
+class session {
+public:
+    // Sends a message to the attached connection.
+    using sender = std::function<void (const connection_location&, const lw_shared_ptr<message>&, const delivery&)>;
+private:
+    struct inflight {
+        lw_shared_ptr<message> msg;
+        delivery d;
+        bool released = false;
+        // Id in the session store, or 0.
+        uint64_t stored;
+        wheel_timer retransmit;
+
+        inflight(lw_shared_ptr<message> m, const delivery& d, uint64_t stored)
+            : msg(std::move(m)), d(d), stored(stored) {}
+    };
+    struct queued {
+        lw_shared_ptr<message> msg;
+        delivery d;
+        uint64_t stored;
+    };
+    subscriber_id _id;
+    sstring _client_id;
+    session_config _config;
+    timer_wheel& _timers;
+    const sender& _send;
+    // Set while the session is persistent.
+    session_store* _store = nullptr;
+    wheel_timer _expiry;
+    std::optional<connection_location> _attached;
+    std::unordered_map<sstring, subscription_options> _subscriptions;
+    // In send order, so that a reconnecting client gets them back in order.
+    std::list<inflight> _inflight;
+    std::unordered_map<uint16_t, std::list<inflight>::iterator> _inflight_by_id;
+    std::deque<queued> _queue;
+    std::unordered_set<uint16_t> _inbound_qos2;
+    uint16_t _next_packet_id = 1;
+    size_t _max_queued;
+    uint64_t _dropped = 0;
+public:
+    // expired is called when a detached session outlives its expiry
+    // interval; it is expected to destroy the session.
+    session(subscriber_id id, sstring client_id, session_config config, timer_wheel& timers,
+            const sender& send, std::function<void ()> expired, size_t max_queued = 1000)
+        : _id(id)
+        , _client_id(std::move(client_id))
+        , _config(config)
+        , _timers(timers)
+        , _send(send)
+        , _expiry(std::move(expired))
+        , _max_queued(max_queued)
+    {
+    }
+
+    subscriber_id id() const { return _id; }
+    const sstring& client_id() const { return _client_id; }
+    const session_config& config() const { return _config; }
+    const std::optional<connection_location>& attached() const { return _attached; }
+    const std::unordered_map<sstring, subscription_options>& subscriptions() const { return _subscriptions; }
+    size_t inflight_count() const { return _inflight.size(); }
+    size_t queued_count() const { return _queue.size(); }
+    uint64_t dropped() const { return _dropped; }
+    bool persisted() const { return _store; }
+
+    // Starts or stops recording the session in a store; the future
+    // resolves once the session record is durable.
+    future<> set_store(session_store* store);
+    // Records the current expiry and subscriptions.
+    future<> save();
+    // Refills the session with the messages store recovered, and keeps
+    // recording it there.
+    void restore(session_store& store, std::vector<stored_message>&& messages);
+
+    // Attaches a new connection.  Unacknowledged messages are resent with
+    // DUP set, then the queue is drained as far as the client's receive
+    // window allows.
+    void attach(const connection_location& loc, const session_config& config);
+    // Starts the expiry timer, if the session has a finite expiry interval.
+    void detach();
+
+    // Returns true if the filter is new to this session.
+    bool add_subscription(sstring filter, const subscription_options& options);
+    bool remove_subscription(const sstring& filter);
+
+    // Delivers a message matched by one of this session's subscriptions,
+    // or, if retained is set, a retained message sent because of a new
+    // subscription.  The future resolves once the message is durable, if
+    // the session is persistent.
+    future<> deliver(const lw_shared_ptr<message>& msg, const subscription_options& options, bool retained = false);
+
+    // Outbound acknowledgements from the client.
+    void acknowledge(mqtt::packet_type type, uint16_t packet_id);
+
+    // Records an inbound QoS 2 PUBLISH; false if it is a retransmission of
+    // one still awaiting PUBREL and must not be routed again.
+    bool receive_qos2(uint16_t packet_id) {
+        return _inbound_qos2.insert(packet_id).second;
+    }
+    void release_qos2(uint16_t packet_id) {
+        _inbound_qos2.erase(packet_id);
+    }
+private:
+    uint16_t allocate_packet_id();
+    void send_inflight(const lw_shared_ptr<message>& msg, const delivery& d, uint64_t stored);
+    void resend(inflight& i);
+    void send_queued();
+    void enqueue(const lw_shared_ptr<message>& msg, const delivery& d, uint64_t stored);
+    future<> store_message(const lw_shared_ptr<message>& msg, mqtt::qos qos, uint64_t& stored);
+    void unstore_message(uint64_t stored);
+};
+
+} /* namespace hero */
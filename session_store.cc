@@ -0,0 +1,490 @@
+/*
+ * This file is open source software, licensed to you under the terms
+ * of the Apache License, Version 2.0 (the "License").  See the NOTICE file
+ * distributed with this work for additional information regarding copyright
+ * ownership.  You may not use this file except in compliance with the License.
+ *
+ * You may obtain a copy of the License at
+ *
+ *   http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing,
+ * software distributed under the License is distributed on an
+ * "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+ * KIND, either express or implied.  See the License for the
+ * specific language governing permissions and limitations
+ * under the License.
+ */
+
+#include "session_store.hh"
+#include "core/future-util.hh"
+#include "util/log.hh"
+#include "mqtt/encoder.hh"
+
+#include <cstring>
+#include <stdexcept>
+
+namespace hero {
+
+static logger slog("session_store");
+
+namespace {
+
+enum class record_type : uint8_t {
+    session = 1,
+    session_end = 2,
+    message = 3,
+    message_released = 4,
+    message_end = 5,
+    message_sent = 6,
+};
+
+class record_writer {
+    char* _p;
+public:
+    explicit record_writer(char* p) : _p(p) {}
+    void u8(uint8_t v) { *_p++ = v; }
+    void u16(uint16_t v) { bytes(&v, sizeof(v)); }
+    void u32(uint32_t v) { bytes(&v, sizeof(v)); }
+    void u64(uint64_t v) { bytes(&v, sizeof(v)); }
+    void str(const sstring& s) {
+        u16(s.size());
+        bytes(s.c_str(), s.size());
+    }
+    void bytes(const void* p, size_t n) {
+        std::memcpy(_p, p, n);
+        _p += n;
+    }
+};
+
+class record_reader {
+    const char* _p;
+    const char* _end;
+public:
+    explicit record_reader(const temporary_buffer<char>& b) : _p(b.get()), _end(b.get() + b.size()) {}
+    uint8_t u8() { return *need(1); }
+    uint16_t u16() { uint16_t v; std::memcpy(&v, need(2), 2); return v; }
+    uint32_t u32() { uint32_t v; std::memcpy(&v, need(4), 4); return v; }
+    uint64_t u64() { uint64_t v; std::memcpy(&v, need(8), 8); return v; }
+    sstring str() {
+        auto n = u16();
+        auto p = need(n);
+        return sstring(p, n);
+    }
+    size_t remaining() const { return _end - _p; }
+private:
+    const char* need(size_t n) {
+        if (size_t(_end - _p) < n) {
+            throw std::out_of_range("truncated log record");
+        }
+        auto p = _p;
+        _p += n;
+        return p;
+    }
+};
+
+size_t client_record_size(const sstring& client_id) {
+    return 1 + 2 + client_id.size();
+}
+
+temporary_buffer<char> encode_session(const sstring& client_id, uint32_t expiry_interval,
+        const std::unordered_map<sstring, subscription_options>& subscriptions) {
+    auto size = client_record_size(client_id) + 4 + 4;
+    for (auto& s : subscriptions) {
+        size += 2 + s.first.size() + 1 + 1 + 4;
+    }
+    temporary_buffer<char> buf(size);
+    record_writer w(buf.get_write());
+    w.u8(uint8_t(record_type::session));
+    w.str(client_id);
+    w.u32(expiry_interval);
+    w.u32(subscriptions.size());
+    for (auto& s : subscriptions) {
+        w.str(s.first);
+        w.u8(uint8_t(s.second.max_qos));
+        w.u8(s.second.no_local | (s.second.retain_as_published << 1));
+        w.u32(s.second.subscription_identifier);
+    }
+    return buf;
+}
+
+temporary_buffer<char> encode_message(const sstring& client_id, uint64_t id, message& msg, mqtt::qos qos) {
+    // The message itself is kept as a v5 PUBLISH, so that replay can use
+    // the protocol decoder.
+    mqtt::publish pub;
+    pub.topic = msg.topic.share();
+    pub.payload = msg.payload.share();
+    pub.qos = qos;
+    pub.retain = msg.retain;
+    pub.dup = false;
+    pub.packet_id = qos == mqtt::qos::at_most_once ? 0 : 1;
+    pub.properties = mqtt::forwarded_properties(msg.properties);
+    auto header = mqtt::encode_publish_header(mqtt::protocol_version::v5, pub);
+    temporary_buffer<char> buf(client_record_size(client_id) + 8 + 1 + header.size() + pub.payload.size());
+    record_writer w(buf.get_write());
+    w.u8(uint8_t(record_type::message));
+    w.str(client_id);
+    w.u64(id);
+    w.u8(uint8_t(qos));
+    w.bytes(header.get(), header.size());
+    w.bytes(pub.payload.get(), pub.payload.size());
+    return buf;
+}
+
+temporary_buffer<char> encode_message_state(const sstring& client_id, uint64_t id, uint16_t packet_id, bool released) {
+    temporary_buffer<char> buf(client_record_size(client_id) + 8 + 2);
+    record_writer w(buf.get_write());
+    w.u8(uint8_t(released ? record_type::message_released : record_type::message_sent));
+    w.str(client_id);
+    w.u64(id);
+    w.u16(packet_id);
+    return buf;
+}
+
+temporary_buffer<char> encode_message_end(const sstring& client_id, uint64_t id) {
+    temporary_buffer<char> buf(client_record_size(client_id) + 8);
+    record_writer w(buf.get_write());
+    w.u8(uint8_t(record_type::message_end));
+    w.str(client_id);
+    w.u64(id);
+    return buf;
+}
+
+temporary_buffer<char> encode_session_end(const sstring& client_id) {
+    temporary_buffer<char> buf(client_record_size(client_id));
+    record_writer w(buf.get_write());
+    w.u8(uint8_t(record_type::session_end));
+    w.str(client_id);
+    return buf;
+}
+
+}
+
+session_store::session_store(log_config config)
+    : _log(std::move(config), [this] (uint64_t segment) { return relocate(segment); })
+{
+}
+
+future<> session_store::append(temporary_buffer<char> data, uint64_t& id) {
+    id = _next_record++;
+    _records.emplace(id, record());
+    return with_gate(_gate, [this, id, data = std::move(data)] () mutable {
+        return _log.append(std::move(data)).then_wrapped([this, id] (future<uint64_t> f) {
+            auto i = _records.find(id);
+            uint64_t segment;
+            try {
+                segment = f.get0();
+            } catch (...) {
+                _records.erase(i);
+                throw;
+            }
+            if (i->second.dead) {
+                _log.release(segment);
+                _records.erase(i);
+            } else {
+                i->second.segment = segment;
+                i->second.committed = true;
+            }
+        });
+    });
+}
+
+// A tombstone is dead as soon as it is written: segments are deleted
+// oldest first, so it cannot outlive the records it ends.
+void session_store::append_tombstone(temporary_buffer<char> data) {
+    uint64_t id;
+    background(append(std::move(data), id));
+    kill(id);
+}
+
+void session_store::kill(uint64_t id) {
+    auto i = _records.find(id);
+    if (i == _records.end()) {
+        return;
+    }
+    if (i->second.committed) {
+        _log.release(i->second.segment);
+        _records.erase(i);
+    } else {
+        i->second.dead = true;
+    }
+}
+
+void session_store::background(future<> f) {
+    f.handle_exception([] (std::exception_ptr ep) {
+        slog.warn("log write failed: {}", ep);
+    });
+}
+
+bool session_store::in_segment(uint64_t id, uint64_t segment) const {
+    auto i = _records.find(id);
+    return i != _records.end() && i->second.committed && i->second.segment == segment;
+}
+
+future<> session_store::save_session(const sstring& client_id, uint32_t expiry_interval,
+        const std::unordered_map<sstring, subscription_options>& subscriptions) {
+    auto& s = _sessions[client_id];
+    auto old = s.record;
+    s.encoded = encode_session(client_id, expiry_interval, subscriptions);
+    // The old record goes only once the new one is durable.
+    return append(s.encoded.share(), s.record).then([this, old] {
+        kill(old);
+    });
+}
+
+void session_store::remove_session(const sstring& client_id) {
+    auto i = _sessions.find(client_id);
+    if (i == _sessions.end()) {
+        return;
+    }
+    kill(i->second.record);
+    for (auto& m : i->second.messages) {
+        kill(m.second.record);
+        kill(m.second.state_record);
+    }
+    _sessions.erase(i);
+    append_tombstone(encode_session_end(client_id));
+}
+
+std::pair<uint64_t, future<>> session_store::add_message(const sstring& client_id,
+        const lw_shared_ptr<message>& msg, mqtt::qos qos) {
+    auto id = _next_message++;
+    auto& m = _sessions[client_id].messages[id];
+    m.msg = msg;
+    m.qos = qos;
+    auto f = append(encode_message(client_id, id, *msg, qos), m.record);
+    return {id, std::move(f)};
+}
+
+void session_store::sent_message(const sstring& client_id, uint64_t id, uint16_t packet_id) {
+    set_message_state(client_id, id, packet_id, false);
+}
+
+void session_store::release_message(const sstring& client_id, uint64_t id, uint16_t packet_id) {
+    set_message_state(client_id, id, packet_id, true);
+}
+
+void session_store::set_message_state(const sstring& client_id, uint64_t id, uint16_t packet_id, bool released) {
+    auto i = _sessions.find(client_id);
+    if (i == _sessions.end()) {
+        return;
+    }
+    auto j = i->second.messages.find(id);
+    if (j == i->second.messages.end()) {
+        return;
+    }
+    auto& m = j->second;
+    auto old = m.state_record;
+    m.packet_id = packet_id;
+    m.released = released;
+    background(append(encode_message_state(client_id, id, packet_id, released), m.state_record).then([this, old] {
+        kill(old);
+    }));
+}
+
+void session_store::remove_message(const sstring& client_id, uint64_t id) {
+    auto i = _sessions.find(client_id);
+    if (i == _sessions.end()) {
+        return;
+    }
+    auto j = i->second.messages.find(id);
+    if (j == i->second.messages.end()) {
+        return;
+    }
+    kill(j->second.record);
+    kill(j->second.state_record);
+    i->second.messages.erase(j);
+    append_tombstone(encode_message_end(client_id, id));
+}
+
+future<> session_store::relocate(uint64_t segment) {
+    std::vector<future<>> done;
+    auto move = [this, &done, segment] (uint64_t& id, temporary_buffer<char> data) {
+        auto old = id;
+        done.push_back(append(std::move(data), id).then([this, old] {
+            kill(old);
+        }).handle_exception([] (std::exception_ptr ep) {
+            slog.warn("relocating a record failed: {}", ep);
+        }));
+    };
+    for (auto& s : _sessions) {
+        auto& client_id = s.first;
+        if (in_segment(s.second.record, segment)) {
+            move(s.second.record, s.second.encoded.share());
+        }
+        for (auto& mi : s.second.messages) {
+            auto& m = mi.second;
+            if (in_segment(m.record, segment)) {
+                move(m.record, encode_message(client_id, mi.first, *m.msg, m.qos));
+            }
+            if (in_segment(m.state_record, segment)) {
+                move(m.state_record, encode_message_state(client_id, mi.first, m.packet_id, m.released));
+            }
+        }
+    }
+    return when_all(done.begin(), done.end()).discard_result();
+}
+
+// Rebuilds the live records from the log.  Relocation may have moved a
+// record past one that refers to it, so a message or a release may come
+// before its session or message; such placeholders are dropped at the end
+// if what they belong to never shows up.
+void session_store::replay_record(uint64_t segment, temporary_buffer<char> data) {
+    auto replayed = [this, segment] {
+        auto id = _next_record++;
+        _records.emplace(id, record{segment, true, false});
+        return id;
+    };
+    try {
+        record_reader r(data);
+        auto type = record_type(r.u8());
+        auto client_id = r.str();
+        switch (type) {
+        case record_type::session: {
+            auto& s = _sessions[client_id];
+            _records.erase(s.record);
+            s.record = replayed();
+            // Copied, so the segment's buffer is not kept alive.
+            s.encoded = temporary_buffer<char>(data.get(), data.size());
+            break;
+        }
+        case record_type::session_end: {
+            auto i = _sessions.find(client_id);
+            if (i != _sessions.end()) {
+                _records.erase(i->second.record);
+                for (auto& m : i->second.messages) {
+                    _records.erase(m.second.record);
+                    _records.erase(m.second.state_record);
+                }
+                _sessions.erase(i);
+            }
+            break;
+        }
+        case record_type::message: {
+            auto id = r.u64();
+            auto qos = mqtt::qos(r.u8());
+            auto offset = data.size() - r.remaining();
+            auto msg = decode_message(temporary_buffer<char>(data.get() + offset, data.size() - offset));
+            auto& m = _sessions[client_id].messages[id];
+            _records.erase(m.record);
+            m.record = replayed();
+            m.msg = std::move(msg);
+            m.qos = qos;
+            _next_message = std::max(_next_message, id + 1);
+            break;
+        }
+        case record_type::message_sent:
+        case record_type::message_released: {
+            auto id = r.u64();
+            auto packet_id = r.u16();
+            auto released = type == record_type::message_released;
+            auto& m = _sessions[client_id].messages[id];
+            _next_message = std::max(_next_message, id + 1);
+            // A release is final; the sent record it replaced may have
+            // been relocated past it before it died.
+            if (m.released && !released) {
+                break;
+            }
+            _records.erase(m.state_record);
+            m.state_record = replayed();
+            m.packet_id = packet_id;
+            m.released = released;
+            break;
+        }
+        case record_type::message_end: {
+            auto id = r.u64();
+            auto i = _sessions.find(client_id);
+            if (i != _sessions.end()) {
+                auto j = i->second.messages.find(id);
+                if (j != i->second.messages.end()) {
+                    _records.erase(j->second.record);
+                    _records.erase(j->second.state_record);
+                    i->second.messages.erase(j);
+                }
+            }
+            _next_message = std::max(_next_message, id + 1);
+            break;
+        }
+        default:
+            slog.warn("segment {:016x}: unknown record type {}", segment, unsigned(type));
+        }
+    } catch (std::exception& e) {
+        slog.warn("segment {:016x}: skipping bad record: {}", segment, e.what());
+    }
+}
+
+stored_session session_store::decode_session(const sstring& client_id, live_session& s) {
+    stored_session out;
+    out.client_id = client_id;
+    record_reader r(s.encoded);
+    r.u8();
+    r.str();
+    out.expiry_interval = r.u32();
+    auto n = r.u32();
+    for (uint32_t i = 0; i < n; ++i) {
+        auto filter = r.str();
+        subscription_options options;
+        options.max_qos = mqtt::qos(r.u8());
+        auto flags = r.u8();
+        options.no_local = flags & 1;
+        options.retain_as_published = flags & 2;
+        options.subscription_identifier = r.u32();
+        out.subscriptions.emplace_back(std::move(filter), options);
+    }
+    for (auto& m : s.messages) {
+        stored_message sm{m.first, m.second.msg, m.second.qos, {}, m.second.released};
+        if (m.second.state_record) {
+            sm.packet_id = m.second.packet_id;
+        }
+        out.messages.push_back(std::move(sm));
+    }
+    return out;
+}
+
+future<std::vector<stored_session>> session_store::recover() {
+    return _log.replay([this] (uint64_t segment, temporary_buffer<char> data) {
+        replay_record(segment, std::move(data));
+    }).then([this] {
+        for (auto i = _sessions.begin(); i != _sessions.end();) {
+            auto& s = i->second;
+            for (auto j = s.messages.begin(); j != s.messages.end();) {
+                if (!j->second.record || !s.record) {
+                    _records.erase(j->second.state_record);
+                    _records.erase(j->second.record);
+                    j = s.messages.erase(j);
+                } else {
+                    ++j;
+                }
+            }
+            if (!s.record) {
+                i = _sessions.erase(i);
+            } else {
+                ++i;
+            }
+        }
+        for (auto& r : _records) {
+            _log.retain(r.second.segment);
+        }
+        return _log.start();
+    }).then([this] {
+        std::vector<stored_session> out;
+        out.reserve(_sessions.size());
+        for (auto& s : _sessions) {
+            try {
+                out.push_back(decode_session(s.first, s.second));
+            } catch (std::exception& e) {
+                slog.warn("dropping session {}: {}", s.first, e.what());
+            }
+        }
+        slog.info("recovered {} sessions", out.size());
+        return out;
+    });
+}
+
+future<> session_store::stop() {
+    return _gate.close().then([this] {
+        return _log.stop();
+    });
+}
+
+} /* namespace hero */
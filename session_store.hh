@@ -0,0 +1,131 @@
+/*
+ * This file is open source software, licensed to you under the terms
+ * of the Apache License, Version 2.0 (the "License").  See the NOTICE file
+ * distributed with this work for additional information regarding copyright
+ * ownership.  You may not use this file except in compliance with the License.
+ *
+ * You may obtain a copy of the License at
+ *
+ *   http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing,
+ * software distributed under the License is distributed on an
+ * "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+ * KIND, either express or implied.  See the License for the
+ * specific language governing permissions and limitations
+ * under the License.
+ */
+
+#pragma once
+
+#include "core/future.hh"
+#include "core/gate.hh"
+#include "core/shared_ptr.hh"
+#include "core/sstring.hh"
+#include "message.hh"
+#include "segment_log.hh"
+#include "subscription_index.hh"
+
+#include <map>
+#include <optional>
+#include <unordered_map>
+#include <utility>
+#include <vector>
+
+namespace hero {
+
+using namespace seastar;
+
+// A persistent session as found in the log at startup.
+struct stored_message {
+    uint64_t id;
+    lw_shared_ptr<message> msg;
+    mqtt::qos qos;
+    // Set once the message was sent to the client, to the packet id it
+    // was sent with.
+    std::optional<uint16_t> packet_id;
+    // Set once the client sent PUBREC for a QoS 2 message.
+    bool released = false;
+};
+
+struct stored_session {
+    sstring client_id;
+    uint32_t expiry_interval;
+    std::vector<std::pair<sstring, subscription_options>> subscriptions;
+    // Oldest first.
+    std::vector<stored_message> messages;
+};
+
+// Writes the persistent sessions owned by a shard, and the QoS 1/2
+// messages they hold, to the shard's segment_log, and reads them back at
+// startup.
+//
+// A session record carries the client's subscriptions and is replaced as a
+// whole when they change; a message record is added when a session accepts
+// a message and ended by a tombstone when the client acknowledges it.  In
+// between, a state record gives the packet id the message was sent with,
+// and is replaced once a QoS 2 message is released.  The
+// store keeps track of which records are live, so that the log can delete
+// and compact segments, and re-encodes live records from memory when the
+// log asks to relocate them.
+class session_store {
+    struct record {
+        uint64_t segment = 0;
+        bool committed = false;
+        bool dead = false;
+    };
+    struct live_message {
+        uint64_t record = 0;
+        lw_shared_ptr<message> msg;
+        mqtt::qos qos = mqtt::qos::at_least_once;
+        uint64_t state_record = 0;
+        uint16_t packet_id = 0;
+        bool released = false;
+    };
+    struct live_session {
+        uint64_t record = 0;
+        temporary_buffer<char> encoded;
+        std::map<uint64_t, live_message> messages;
+    };
+    segment_log _log;
+    // Record ids are the store's own; 0 means none.
+    uint64_t _next_record = 1;
+    std::unordered_map<uint64_t, record> _records;
+    std::unordered_map<sstring, live_session> _sessions;
+    uint64_t _next_message = 1;
+    gate _gate;
+public:
+    explicit session_store(log_config config);
+
+    // Replays the log and returns the sessions it holds.
+    future<std::vector<stored_session>> recover();
+    future<> stop();
+
+    // Records a session's expiry and subscriptions, replacing what was
+    // recorded before.  Resolves once they are durable.
+    future<> save_session(const sstring& client_id, uint32_t expiry_interval,
+            const std::unordered_map<sstring, subscription_options>& subscriptions);
+    void remove_session(const sstring& client_id);
+
+    // Records a message accepted by a session.  Returns the message's id in
+    // the store and a future resolving once the message is durable.
+    std::pair<uint64_t, future<>> add_message(const sstring& client_id, const lw_shared_ptr<message>& msg, mqtt::qos qos);
+    // Records the packet id a message was sent with, so that it is resent
+    // with the same one after a restart...
+    void sent_message(const sstring& client_id, uint64_t id, uint16_t packet_id);
+    // ...and that the client received a QoS 2 message.
+    void release_message(const sstring& client_id, uint64_t id, uint16_t packet_id);
+    void remove_message(const sstring& client_id, uint64_t id);
+private:
+    void set_message_state(const sstring& client_id, uint64_t id, uint16_t packet_id, bool released);
+    future<> append(temporary_buffer<char> data, uint64_t& id);
+    void append_tombstone(temporary_buffer<char> data);
+    void kill(uint64_t id);
+    void background(future<> f);
+    void replay_record(uint64_t segment, temporary_buffer<char> data);
+    stored_session decode_session(const sstring& client_id, live_session& s);
+    future<> relocate(uint64_t segment);
+    bool in_segment(uint64_t id, uint64_t segment) const;
+};
+
+} /* namespace hero */
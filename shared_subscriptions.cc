@@ -0,0 +1,151 @@
+/*
+ * This file is open source software, licensed to you under the terms
+ * of the Apache License, Version 2.0 (the "License").  See the NOTICE file
+ * distributed with this work for additional information regarding copyright
+ * ownership.  You may not use this file except in compliance with the License.
+ *
+ * You may obtain a copy of the License at
+ *
+ *   http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing,
+ * software distributed under the License is distributed on an
+ * "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+ * KIND, either express or implied.  See the License for the
+ * specific language governing permissions and limitations
+ * under the License.
+ */
+
+#include "shared_subscriptions.hh"
+#include "core/reactor.hh"
+
+namespace hero {
+
+static std::string_view view(const sstring& s) {
+    return std::string_view(s.c_str(), s.size());
+}
+
+std::optional<shared_filter> parse_shared_filter(std::string_view filter) {
+    if (!is_shared_filter(filter)) {
+        return {};
+    }
+    auto rest = filter.substr(7);
+    auto slash = rest.find('/');
+    if (slash == 0 || slash == std::string_view::npos || slash + 1 == rest.size()) {
+        return {};
+    }
+    auto group = rest.substr(0, slash);
+    if (group.find_first_of("+#") != std::string_view::npos) {
+        return {};
+    }
+    return shared_filter{group, rest.substr(slash + 1)};
+}
+
+bool shared_subscriptions::add(const sstring& filter, const shared_member& m, const subscription_options& options) {
+    auto parsed = parse_shared_filter(view(filter));
+    if (!parsed) {
+        return false;
+    }
+    auto i = _group_ids.find(filter);
+    auto created = i == _group_ids.end();
+    if (created) {
+        auto id = _next_group++;
+        auto& g = _groups[id];
+        g.key = filter;
+        g.filter = sstring(parsed->filter.data(), parsed->filter.size());
+        _index.subscribe(view(g.filter), id, subscription_options());
+        i = _group_ids.emplace(filter, id).first;
+    }
+    auto& g = _groups[i->second];
+    for (auto& existing : g.members) {
+        if (existing.id == m) {
+            existing.options = options;
+            return created;
+        }
+    }
+    auto& l = _loads[m];
+    l.groups++;
+    g.members.push_back(member{m, options, &l});
+    return created;
+}
+
+bool shared_subscriptions::remove(const sstring& filter, const shared_member& m) {
+    auto i = _group_ids.find(filter);
+    if (i == _group_ids.end()) {
+        return false;
+    }
+    auto& g = _groups[i->second];
+    auto it = std::find_if(g.members.begin(), g.members.end(), [&m] (const member& x) { return x.id == m; });
+    if (it == g.members.end()) {
+        return false;
+    }
+    if (--it->l->groups == 0) {
+        _loads.erase(m);
+    }
+    *it = g.members.back();
+    g.members.pop_back();
+    if (g.members.empty()) {
+        _index.unsubscribe(view(g.filter), i->second);
+        _groups.erase(i->second);
+        _group_ids.erase(i);
+        return true;
+    }
+    return false;
+}
+
+void shared_subscriptions::update_loads(unsigned shard, const std::vector<std::pair<subscriber_id, uint32_t>>& loads) {
+    _stats.load_reports++;
+    for (auto& r : loads) {
+        auto i = _loads.find(shared_member{shard, r.first});
+        if (i != _loads.end()) {
+            i->second.reported = r.second;
+            i->second.picked = 0;
+        }
+    }
+}
+
+shared_subscriptions::member& shared_subscriptions::pick(group& g) {
+    auto local = engine().cpu_id();
+    auto n = g.members.size();
+    member* best = nullptr;
+    member* best_local = nullptr;
+    uint32_t best_load = 0;
+    uint32_t best_local_load = 0;
+    for (size_t k = 0; k < n; ++k) {
+        auto& m = g.members[(g.next + k) % n];
+        auto load = m.l->estimate();
+        if (!best || load < best_load) {
+            best = &m;
+            best_load = load;
+        }
+        if (m.id.shard == local && (!best_local || load < best_local_load)) {
+            best_local = &m;
+            best_local_load = load;
+        }
+    }
+    g.next = (g.next + 1) % n;
+    auto chosen = best;
+    if (best_local && best_local_load != disconnected && best_local_load - best_load <= _local_slack) {
+        chosen = best_local;
+    }
+    chosen->l->picked++;
+    if (chosen->id.shard == local) {
+        _stats.local_picks++;
+    } else {
+        _stats.remote_picks++;
+    }
+    return *chosen;
+}
+
+void shared_subscriptions::match(std::string_view topic, std::vector<shared_pick>& out) {
+    if (_groups.empty()) {
+        return;
+    }
+    auto groups = _index.match(topic);
+    for (auto& m : *groups) {
+        auto& chosen = pick(_groups[m.id]);
+        out.push_back(shared_pick{chosen.id, chosen.options});
+    }
+}
+
+} /* namespace hero */
@@ -0,0 +1,146 @@
+/*
+ * This file is open source software, licensed to you under the terms
+ * of the Apache License, Version 2.0 (the "License").  See the NOTICE file
+ * distributed with this work for additional information regarding copyright
+ * ownership.  You may not use this file except in compliance with the License.
+ *
+ * You may obtain a copy of the License at
+ *
+ *   http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing,
+ * software distributed under the License is distributed on an
+ * "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+ * KIND, either express or implied.  See the License for the
+ * specific language governing permissions and limitations
+ * under the License.
+ */
+
+#pragma once
+
+#include "core/sstring.hh"
+#include "subscription_index.hh"
+
+#include <algorithm>
+#include <functional>
+#include <optional>
+#include <string_view>
+#include <unordered_map>
+#include <utility>
+#include <vector>
+
+namespace hero {
+
+using namespace seastar;
+
+// The parts of a "$share/<group>/<filter>" subscription.
+struct shared_filter {
+    std::string_view group;
+    std::string_view filter;
+};
+
+inline bool is_shared_filter(std::string_view filter) {
+    return filter.compare(0, 7, "$share/") == 0;
+}
+
+// Splits a shared subscription's filter; nothing if it is malformed: an
+// empty group or one with wildcards, or no filter after it.
+std::optional<shared_filter> parse_shared_filter(std::string_view filter);
+
+// A member of a shared subscription group: a session on its owner shard.
+struct shared_member {
+    unsigned shard;
+    subscriber_id session;
+
+    bool operator==(const shared_member& o) const {
+        return shard == o.shard && session == o.session;
+    }
+};
+
+struct shared_pick {
+    shared_member member;
+    subscription_options options;
+};
+
+// The shared subscription groups, replicated on every shard like the route
+// table, together with the load each member's owner shard last reported
+// for it: the messages its session has in flight or queued.
+//
+// A message matching a group goes to one member, the least loaded one,
+// counting the messages sent to each since its last report.  A member on
+// the publishing shard is preferred as long as it is within local_slack of
+// the least loaded, which saves the message a trip to another shard.
+// Equally loaded members take turns.
+class shared_subscriptions {
+public:
+    // The load reported for a member whose session is not connected.  It
+    // only gets messages when no member of its group is connected.
+    static constexpr uint32_t disconnected = uint32_t(-1);
+
+    struct stats {
+        uint64_t local_picks = 0;
+        uint64_t remote_picks = 0;
+        uint64_t load_reports = 0;
+    };
+private:
+    struct member_hash {
+        size_t operator()(const shared_member& m) const {
+            return std::hash<uint64_t>()(m.session) ^ (size_t(m.shard) << 48);
+        }
+    };
+    struct load {
+        uint32_t reported = 0;
+        // Messages picked for the member since its last report.
+        uint32_t picked = 0;
+        // Groups the member belongs to.
+        unsigned groups = 0;
+
+        uint32_t estimate() const {
+            return reported == disconnected ? disconnected : reported + std::min(picked, disconnected - 1 - reported);
+        }
+    };
+    struct member {
+        shared_member id;
+        subscription_options options;
+        // Owned by _loads, whose nodes never move.
+        load* l;
+    };
+    struct group {
+        // The "$share/<group>/<filter>" string, and the filter part of it.
+        sstring key;
+        sstring filter;
+        std::vector<member> members;
+        // Where the search for the least loaded member starts.
+        size_t next = 0;
+    };
+    // Subscriber ids in this index are group ids.
+    subscription_index _index;
+    std::unordered_map<subscriber_id, group> _groups;
+    std::unordered_map<sstring, subscriber_id> _group_ids;
+    subscriber_id _next_group = 0;
+    std::unordered_map<shared_member, load, member_hash> _loads;
+    uint32_t _local_slack;
+    stats _stats;
+public:
+    explicit shared_subscriptions(uint32_t local_slack = 16) : _local_slack(local_slack) {}
+
+    // Adds a member to the group of a "$share/..." filter, or updates its
+    // options.  Returns true if the group is new.
+    bool add(const sstring& filter, const shared_member& m, const subscription_options& options);
+    // Returns true if the group is gone with its last member.
+    bool remove(const sstring& filter, const shared_member& m);
+
+    // Takes the loads of the members on shard, as (session, load) pairs.
+    void update_loads(unsigned shard, const std::vector<std::pair<subscriber_id, uint32_t>>& loads);
+
+    // Picks a member of every group with a filter matching topic.
+    void match(std::string_view topic, std::vector<shared_pick>& out);
+
+    size_t groups() const { return _groups.size(); }
+    size_t members() const { return _loads.size(); }
+    const stats& get_stats() const { return _stats; }
+private:
+    member& pick(group& g);
+};
+
+} /* namespace hero */
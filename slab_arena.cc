@@ -0,0 +1,144 @@
+/*
+ * This file is open source software, licensed to you under the terms
+ * of the Apache License, Version 2.0 (the "License").  See the NOTICE file
+ * distributed with this work for additional information regarding copyright
+ * ownership.  You may not use this file except in compliance with the License.
+ *
+ * You may obtain a copy of the License at
+ *
+ *   http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing,
+ * software distributed under the License is distributed on an
+ * "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+ * KIND, either express or implied.  See the License for the
+ * specific language governing permissions and limitations
+ * under the License.
+ */
+
+#include "slab_arena.hh"
+
+#include <new>
+#include <utility>
+
+namespace hero {
+
+slab_arena::~slab_arena() {
+    // The pages and large buffers still here have live buffers, which
+    // free them.
+    auto orphan = [] (page* p) { p->arena = nullptr; };
+    for (auto& l : _partial) {
+        l.clear_and_dispose(orphan);
+    }
+    _full.clear_and_dispose(orphan);
+    _large_buffers.clear_and_dispose([] (large_deleter* d) { d->arena = nullptr; });
+    ::free(_spare);
+}
+
+unsigned slab_arena::size_class(size_t size) {
+    if (size <= min_slot) {
+        return 0;
+    }
+    // 2^k < size <= 2^(k+1); the class is either 1.5 * 2^k or 2^(k+1).
+    unsigned k = 63 - __builtin_clzll(size - 1);
+    if (size <= (size_t(3) << (k - 1))) {
+        return 2 * (k - 5) + 1;
+    }
+    return 2 * (k - 4);
+}
+
+size_t slab_arena::slot_size(unsigned size_class) {
+    return (size_class & 1 ? 48 : 32) << (size_class / 2);
+}
+
+slab_arena::large_deleter::~large_deleter() {
+    if (arena) {
+        arena->_large -= size;
+        arena->_used -= size;
+    }
+}
+
+void slab_arena::slot_deleter::operator delete(void* p) {
+    auto slot = static_cast<char*>(p);
+    auto pg = reinterpret_cast<page*>(reinterpret_cast<uintptr_t>(slot) & ~uintptr_t(page_size - 1));
+    release(pg, slot);
+}
+
+temporary_buffer<char> slab_arena::allocate(size_t size) {
+    auto needed = size + sizeof(slot_deleter);
+    if (needed > max_slot) {
+        auto memory = ::malloc(sizeof(large_deleter) + size);
+        if (!memory) {
+            throw std::bad_alloc();
+        }
+        auto d = new (memory) large_deleter(this, size);
+        _large_buffers.push_back(*d);
+        _large += size;
+        _used += size;
+        return temporary_buffer<char>(reinterpret_cast<char*>(d + 1), size, deleter(d));
+    }
+    auto c = size_class(needed);
+    auto slot = slot_size(c);
+    auto& partial = _partial[c];
+    if (partial.empty()) {
+        auto memory = std::exchange(_spare, nullptr);
+        if (!memory) {
+            memory = ::aligned_alloc(page_size, page_size);
+            if (!memory) {
+                throw std::bad_alloc();
+            }
+            _pages++;
+        }
+        auto p = new (memory) page;
+        p->arena = this;
+        p->size_class = c;
+        p->slots = (page_size - page_header) / slot;
+        partial.push_back(*p);
+    }
+    auto& p = partial.front();
+    char* s;
+    if (p.free) {
+        s = static_cast<char*>(p.free);
+        p.free = *reinterpret_cast<void**>(s);
+    } else {
+        s = p.slot(p.carved++);
+    }
+    p.live++;
+    if (p.full()) {
+        p.link.unlink();
+        _full.push_back(p);
+    }
+    _used += slot;
+    auto d = new (s) slot_deleter();
+    return temporary_buffer<char>(s + sizeof(slot_deleter), size, deleter(d));
+}
+
+void slab_arena::release(page* p, char* slot) {
+    auto c = p->size_class;
+    auto arena = p->arena;
+    if (arena && p->full()) {
+        p->link.unlink();
+        arena->_partial[c].push_front(*p);
+    }
+    *reinterpret_cast<void**>(slot) = p->free;
+    p->free = slot;
+    p->live--;
+    if (arena) {
+        arena->_used -= slot_size(c);
+    }
+    if (!p->live) {
+        p->~page();
+        // One empty page's memory is kept, so that a class alternating
+        // between one buffer and none does not allocate a page each time.
+        if (arena && !arena->_spare) {
+            arena->_spare = p;
+        } else {
+            ::free(p);
+            if (arena) {
+                arena->_pages--;
+            }
+        }
+    }
+}
+
+} /* namespace hero */
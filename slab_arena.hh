@@ -0,0 +1,132 @@
+/*
+ * This file is open source software, licensed to you under the terms
+ * of the Apache License, Version 2.0 (the "License").  See the NOTICE file
+ * distributed with this work for additional information regarding copyright
+ * ownership.  You may not use this file except in compliance with the License.
+ *
+ * You may obtain a copy of the License at
+ *
+ *   http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing,
+ * software distributed under the License is distributed on an
+ * "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+ * KIND, either express or implied.  See the License for the
+ * specific language governing permissions and limitations
+ * under the License.
+ */
+
+#pragma once
+
+#include "core/deleter.hh"
+#include "core/temporary_buffer.hh"
+
+#include <boost/intrusive/list.hpp>
+
+#include <array>
+#include <cstddef>
+#include <cstdint>
+#include <cstdlib>
+
+namespace hero {
+
+using namespace seastar;
+
+// A slab allocator for many long-lived buffers of assorted sizes.
+//
+// Buffers are carved out of 1MB pages, each page serving one size class;
+// classes step by powers of two and the midpoints between them, so at most
+// a third of a slot is wasted.  A slot is reused as soon as every share of
+// the buffer that holds it is gone, and a page goes back to the system
+// once all its slots are free.  Buffers larger than the largest class are
+// allocated on their own.
+//
+// A buffer's deleter lives in its slot, ahead of the data, so handing out
+// a buffer allocates nothing beyond the slot.  Buffers may outlive the
+// arena: the pages still in use then belong to their buffers, and the
+// last buffer of each frees it.
+class slab_arena {
+    static constexpr size_t page_size = 1024 * 1024;
+    static constexpr size_t min_slot = 32;
+    static constexpr size_t max_slot = 64 * 1024;
+    // 32, 48, 64, 96, ... 65536.
+    static constexpr unsigned classes = 23;
+    // The page's slots start past its header.
+    static constexpr size_t page_header = 64;
+
+    using hook_type = boost::intrusive::list_member_hook<boost::intrusive::link_mode<boost::intrusive::auto_unlink>>;
+
+    // At the start of the page's memory, which is aligned to page_size, so
+    // that a slot finds its page from its own address.
+    struct page {
+        // Null once the arena is gone.
+        slab_arena* arena;
+        unsigned size_class;
+        uint32_t slots;
+        uint32_t live = 0;
+        // Slots below this were handed out at least once.
+        uint32_t carved = 0;
+        // Freed slots, linked through their first word.
+        void* free = nullptr;
+        // Linked into its class while it has a free slot, and into _full
+        // otherwise.
+        hook_type link;
+
+        bool full() const { return !free && carved == slots; }
+        char* slot(uint32_t i) {
+            return reinterpret_cast<char*>(this) + page_header + size_t(i) * slot_size(size_class);
+        }
+    };
+    static_assert(sizeof(page) <= page_header, "page header too small");
+    using page_list = boost::intrusive::list<page,
+          boost::intrusive::member_hook<page, hook_type, &page::link>,
+          boost::intrusive::constant_time_size<false>>;
+
+    // The deleter of a slot's buffer, at the start of the slot.  Shares of
+    // the buffer share it, and the slot is released once it is destroyed.
+    struct slot_deleter final : deleter::impl {
+        slot_deleter() : impl(deleter()) {}
+        static void operator delete(void* p);
+    };
+    // A buffer over the largest class, allocated behind its deleter.
+    struct large_deleter final : deleter::impl {
+        // Null once the arena is gone.
+        slab_arena* arena;
+        size_t size;
+        hook_type link;
+
+        large_deleter(slab_arena* a, size_t s) : impl(deleter()), arena(a), size(s) {}
+        ~large_deleter();
+        static void operator delete(void* p) { ::free(p); }
+    };
+    using large_list = boost::intrusive::list<large_deleter,
+          boost::intrusive::member_hook<large_deleter, hook_type, &large_deleter::link>,
+          boost::intrusive::constant_time_size<false>>;
+
+    std::array<page_list, classes> _partial;
+    page_list _full;
+    large_list _large_buffers;
+    // An empty page's memory, kept for the next page.
+    void* _spare = nullptr;
+    size_t _used = 0;
+    size_t _pages = 0;
+    size_t _large = 0;
+public:
+    slab_arena() = default;
+    slab_arena(const slab_arena&) = delete;
+    slab_arena& operator=(const slab_arena&) = delete;
+    ~slab_arena();
+
+    temporary_buffer<char> allocate(size_t size);
+
+    // Bytes held by live buffers, counting whole slots.
+    size_t used() const { return _used; }
+    // Bytes taken from the system, including free slots and the spare page.
+    size_t reserved() const { return _pages * page_size + _large; }
+private:
+    static unsigned size_class(size_t size);
+    static size_t slot_size(unsigned size_class);
+    static void release(page* p, char* slot);
+};
+
+} /* namespace hero */
@@ -0,0 +1,354 @@
+/*
+ * This file is open source software, licensed to you under the terms
+ * of the Apache License, Version 2.0 (the "License").  See the NOTICE file
+ * distributed with this work for additional information regarding copyright
+ * ownership.  You may not use this file except in compliance with the License.
+ *
+ * You may obtain a copy of the License at
+ *
+ *   http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing,
+ * software distributed under the License is distributed on an
+ * "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+ * KIND, either express or implied.  See the License for the
+ * specific language governing permissions and limitations
+ * under the License.
+ */
+
+#include "subscription_index.hh"
+
+#include <algorithm>
+
+namespace hero {
+
+static std::string_view view(const sstring& s) {
+    return std::string_view(s.c_str(), s.size());
+}
+
+// Calls func on every '/' separated level of topic, in order.
+template <typename Func>
+static void for_each_level(std::string_view topic, Func&& func) {
+    size_t start = 0;
+    while (true) {
+        auto end = topic.find('/', start);
+        if (end == std::string_view::npos) {
+            func(topic.substr(start));
+            return;
+        }
+        func(topic.substr(start, end - start));
+        start = end + 1;
+    }
+}
+
+topic_level_interner::level_id topic_level_interner::intern(std::string_view name) {
+    auto i = _ids.find(name);
+    if (i != _ids.end()) {
+        _levels[i->second].refs++;
+        return i->second;
+    }
+    level_id id;
+    if (!_free.empty()) {
+        id = _free.back();
+        _free.pop_back();
+    } else {
+        id = _levels.size();
+        _levels.emplace_back();
+    }
+    auto& l = _levels[id];
+    l.name = sstring(name.data(), name.size());
+    l.refs = 1;
+    _ids.emplace(view(l.name), id);
+    return id;
+}
+
+topic_level_interner::level_id topic_level_interner::find(std::string_view name) const {
+    auto i = _ids.find(name);
+    return i == _ids.end() ? npos : i->second;
+}
+
+void topic_level_interner::release(level_id id) {
+    auto& l = _levels[id];
+    if (--l.refs == 0) {
+        _ids.erase(view(l.name));
+        l.name = {};
+        _free.push_back(id);
+    }
+}
+
+topic_trie::topic_trie() {
+    _nodes.emplace_back();
+}
+
+topic_trie::node_index topic_trie::allocate(node_index parent, level_id level) {
+    node_index n;
+    if (!_free.empty()) {
+        n = _free.back();
+        _free.pop_back();
+    } else {
+        n = _nodes.size();
+        _nodes.emplace_back();
+    }
+    _nodes[n].parent = parent;
+    _nodes[n].level = level;
+    return n;
+}
+
+topic_trie::node_index topic_trie::child(node_index parent, std::string_view level) {
+    if (level == "+" || level == "#") {
+        bool plus = level[0] == '+';
+        auto existing = plus ? _nodes[parent].plus : _nodes[parent].hash;
+        if (existing != npos) {
+            return existing;
+        }
+        // allocate() may grow _nodes, so index again afterwards.
+        auto n = allocate(parent, plus ? plus_level : hash_level);
+        (plus ? _nodes[parent].plus : _nodes[parent].hash) = n;
+        return n;
+    }
+    auto id = _levels.find(level);
+    if (id != topic_level_interner::npos) {
+        auto i = _edges.find(edge_key(parent, id));
+        if (i != _edges.end()) {
+            return i->second;
+        }
+    }
+    id = _levels.intern(level);
+    auto n = allocate(parent, id);
+    _edges.emplace(edge_key(parent, id), n);
+    _nodes[parent].children++;
+    return n;
+}
+
+topic_trie::node_index topic_trie::find_node(std::string_view filter) const {
+    node_index n = root;
+    for_each_level(filter, [&] (std::string_view level) {
+        if (n == npos) {
+            return;
+        }
+        if (level == "+") {
+            n = _nodes[n].plus;
+        } else if (level == "#") {
+            n = _nodes[n].hash;
+        } else {
+            auto id = _levels.find(level);
+            auto i = id == topic_level_interner::npos ? _edges.end() : _edges.find(edge_key(n, id));
+            n = i == _edges.end() ? npos : i->second;
+        }
+    });
+    return n;
+}
+
+bool topic_trie::insert(std::string_view filter, subscriber_id id, const subscription_options& options) {
+    node_index n = root;
+    for_each_level(filter, [&] (std::string_view level) {
+        n = child(n, level);
+    });
+    auto& subs = _nodes[n].subscribers;
+    auto i = std::find_if(subs.begin(), subs.end(), [id] (const subscription_match& m) { return m.id == id; });
+    if (i != subs.end()) {
+        i->options = options;
+        return false;
+    }
+    subs.push_back(subscription_match{id, options});
+    _subscriptions++;
+    return true;
+}
+
+bool topic_trie::erase(std::string_view filter, subscriber_id id) {
+    auto n = find_node(filter);
+    if (n == npos) {
+        return false;
+    }
+    auto& subs = _nodes[n].subscribers;
+    auto i = std::find_if(subs.begin(), subs.end(), [id] (const subscription_match& m) { return m.id == id; });
+    if (i == subs.end()) {
+        return false;
+    }
+    *i = subs.back();
+    subs.pop_back();
+    _subscriptions--;
+    prune(n);
+    return true;
+}
+
+void topic_trie::prune(node_index n) {
+    while (n != root && _nodes[n].unused()) {
+        auto& nd = _nodes[n];
+        auto parent = nd.parent;
+        if (nd.level == plus_level) {
+            _nodes[parent].plus = npos;
+        } else if (nd.level == hash_level) {
+            _nodes[parent].hash = npos;
+        } else {
+            _edges.erase(edge_key(parent, nd.level));
+            _nodes[parent].children--;
+            _levels.release(nd.level);
+        }
+        nd = node();
+        _free.push_back(n);
+        n = parent;
+    }
+}
+
+void topic_trie::collect(const node& n, match_result& out) {
+    out.insert(out.end(), n.subscribers.begin(), n.subscribers.end());
+}
+
+void topic_trie::match(std::string_view topic, match_result& out) const {
+    _topic_levels.clear();
+    for_each_level(topic, [this] (std::string_view level) {
+        _topic_levels.push_back(_levels.find(level));
+    });
+    // Wildcards at the first level never match topics beginning with '$'.
+    bool system = !topic.empty() && topic[0] == '$';
+    uint32_t depth_limit = _topic_levels.size();
+
+    _stack.clear();
+    _stack.emplace_back(root, 0);
+    while (!_stack.empty()) {
+        auto n = _stack.back().first;
+        auto depth = _stack.back().second;
+        _stack.pop_back();
+        auto& nd = _nodes[n];
+        if (depth == depth_limit) {
+            collect(nd, out);
+            // "a/#" also matches "a".
+            if (nd.hash != npos) {
+                collect(_nodes[nd.hash], out);
+            }
+            continue;
+        }
+        bool wildcards = depth != 0 || !system;
+        if (wildcards && nd.hash != npos) {
+            collect(_nodes[nd.hash], out);
+        }
+        if (wildcards && nd.plus != npos) {
+            _stack.emplace_back(nd.plus, depth + 1);
+        }
+        auto id = _topic_levels[depth];
+        if (id != topic_level_interner::npos && nd.children) {
+            auto i = _edges.find(edge_key(n, id));
+            if (i != _edges.end()) {
+                _stack.emplace_back(i->second, depth + 1);
+            }
+        }
+    }
+}
+
+lw_shared_ptr<const match_result> match_cache::find(std::string_view topic, uint64_t generation) {
+    auto i = _index.find(topic);
+    if (i == _index.end()) {
+        return {};
+    }
+    auto e = i->second;
+    if (e->generation != generation) {
+        _index.erase(i);
+        _lru.erase(e);
+        return {};
+    }
+    _lru.splice(_lru.begin(), _lru, e);
+    return e->result;
+}
+
+void match_cache::insert(std::string_view topic, uint64_t generation, lw_shared_ptr<const match_result> result) {
+    if (!_capacity) {
+        return;
+    }
+    auto i = _index.find(topic);
+    if (i != _index.end()) {
+        i->second->generation = generation;
+        i->second->result = std::move(result);
+        _lru.splice(_lru.begin(), _lru, i->second);
+        return;
+    }
+    if (_index.size() >= _capacity) {
+        _index.erase(view(_lru.back().topic));
+        _lru.pop_back();
+    }
+    _lru.push_front(entry{sstring(topic.data(), topic.size()), generation, std::move(result)});
+    _index.emplace(view(_lru.front().topic), _lru.begin());
+}
+
+void match_cache::clear() {
+    _index.clear();
+    _lru.clear();
+}
+
+static std::string_view first_level(std::string_view s) {
+    return s.substr(0, s.find('/'));
+}
+
+size_t subscription_index::level_bucket(std::string_view level) {
+    return std::hash<std::string_view>()(level) % level_buckets;
+}
+
+void subscription_index::changed(std::string_view filter) {
+    auto level = first_level(filter);
+    if (level == "+" || level == "#") {
+        ++_wildcard_generation;
+    } else {
+        ++_level_generations[level_bucket(level)];
+    }
+}
+
+// Both counters only grow, so their sum changes whenever either does.
+uint64_t subscription_index::generation(std::string_view topic) const {
+    auto g = _level_generations[level_bucket(first_level(topic))];
+    if (topic.empty() || topic[0] != '$') {
+        g += _wildcard_generation;
+    }
+    return g;
+}
+
+bool subscription_index::subscribe(std::string_view filter, subscriber_id id, const subscription_options& options) {
+    changed(filter);
+    return _trie.insert(filter, id, options);
+}
+
+bool subscription_index::unsubscribe(std::string_view filter, subscriber_id id) {
+    if (!_trie.erase(filter, id)) {
+        return false;
+    }
+    changed(filter);
+    return true;
+}
+
+lw_shared_ptr<const match_result> subscription_index::match(std::string_view topic) {
+    auto g = generation(topic);
+    auto cached = _cache.find(topic, g);
+    if (cached) {
+        _stats.cache_hits++;
+        return cached;
+    }
+    _stats.cache_misses++;
+    auto result = make_lw_shared<match_result>();
+    _trie.match(topic, *result);
+    if (result->size() > 1) {
+        std::sort(result->begin(), result->end(), [] (const subscription_match& a, const subscription_match& b) {
+            return a.id < b.id;
+        });
+        auto out = result->begin();
+        for (auto i = result->begin() + 1; i != result->end(); ++i) {
+            if (i->id != out->id) {
+                *++out = *i;
+                continue;
+            }
+            auto& o = out->options;
+            if (i->options.max_qos > o.max_qos) {
+                o.max_qos = i->options.max_qos;
+                if (i->options.subscription_identifier) {
+                    o.subscription_identifier = i->options.subscription_identifier;
+                }
+            }
+            o.no_local = o.no_local && i->options.no_local;
+            o.retain_as_published = o.retain_as_published || i->options.retain_as_published;
+        }
+        result->erase(out + 1, result->end());
+    }
+    lw_shared_ptr<const match_result> r = std::move(result);
+    _cache.insert(topic, g, r);
+    return r;
+}
+
+} /* namespace hero */
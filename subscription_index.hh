@@ -0,0 +1,208 @@
+/*
+ * This file is open source software, licensed to you under the terms
+ * of the Apache License, Version 2.0 (the "License").  See the NOTICE file
+ * distributed with this work for additional information regarding copyright
+ * ownership.  You may not use this file except in compliance with the License.
+ *
+ * You may obtain a copy of the License at
+ *
+ *   http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing,
+ * software distributed under the License is distributed on an
+ * "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+ * KIND, either express or implied.  See the License for the
+ * specific language governing permissions and limitations
+ * under the License.
+ */
+
+#pragma once
+
+#include "core/shared_ptr.hh"
+#include "core/sstring.hh"
+#include "mqtt/protocol.hh"
+
+#include <array>
+#include <cstdint>
+#include <deque>
+#include <list>
+#include <string_view>
+#include <unordered_map>
+#include <utility>
+#include <vector>
+
+namespace hero {
+
+using namespace seastar;
+
+using subscriber_id = uint64_t;
+
+struct subscription_options {
+    mqtt::qos max_qos = mqtt::qos::at_most_once;
+    bool no_local = false;
+    bool retain_as_published = false;
+    uint32_t subscription_identifier = 0;
+    // When retained messages are sent on subscribing: 0 always, 1 only for
+    // a new subscription, 2 never.  Not part of the stored subscription.
+    uint8_t retain_handling = 0;
+};
+
+struct subscription_match {
+    subscriber_id id;
+    subscription_options options;
+};
+
+// Matches for one topic, one entry per subscriber.  When several of a
+// subscriber's filters match, they are merged into the most permissive
+// options.
+using match_result = std::vector<subscription_match>;
+
+// Maps topic levels to dense integer ids so that trie edges are keyed by
+// integers rather than strings, and each distinct level is stored once no
+// matter how many filters use it.  Levels are reference counted and
+// recycled once no filter uses them.
+class topic_level_interner {
+public:
+    using level_id = uint32_t;
+    static constexpr level_id npos = level_id(-1);
+private:
+    struct level {
+        sstring name;
+        uint32_t refs = 0;
+    };
+    // A deque never relocates its elements, so the views used as map keys
+    // stay valid as levels are added.
+    std::deque<level> _levels;
+    std::vector<level_id> _free;
+    std::unordered_map<std::string_view, level_id> _ids;
+public:
+    level_id intern(std::string_view name);
+    // Never allocates; returns npos for a level no filter uses.
+    level_id find(std::string_view name) const;
+    void release(level_id id);
+    size_t size() const { return _ids.size(); }
+};
+
+// Trie of topic filters.  Literal children are found through one hash
+// table of (parent, level) edges, and every node keeps its '+' and '#'
+// children inline, so matching costs one lookup per topic level plus one
+// per wildcard branch, independent of the number of subscriptions.
+class topic_trie {
+    using node_index = uint32_t;
+    using level_id = topic_level_interner::level_id;
+    static constexpr node_index npos = node_index(-1);
+    static constexpr node_index root = 0;
+
+    struct node {
+        node_index parent = npos;
+        level_id level = topic_level_interner::npos;
+        node_index plus = npos;
+        node_index hash = npos;
+        uint32_t children = 0;
+        std::vector<subscription_match> subscribers;
+
+        bool unused() const {
+            return children == 0 && plus == npos && hash == npos && subscribers.empty();
+        }
+    };
+    // Wildcard children are not interned; these tag them in node::level.
+    static constexpr level_id plus_level = topic_level_interner::npos - 1;
+    static constexpr level_id hash_level = topic_level_interner::npos - 2;
+
+    std::vector<node> _nodes;
+    std::vector<node_index> _free;
+    std::unordered_map<uint64_t, node_index> _edges;
+    topic_level_interner _levels;
+    size_t _subscriptions = 0;
+
+    // Scratch space reused by match() to avoid allocating per publish.
+    mutable std::vector<level_id> _topic_levels;
+    mutable std::vector<std::pair<node_index, uint32_t>> _stack;
+public:
+    topic_trie();
+
+    // Adds or updates a subscription.  Returns true if it is new.
+    bool insert(std::string_view filter, subscriber_id id, const subscription_options& options);
+    // Returns true if the subscription existed.
+    bool erase(std::string_view filter, subscriber_id id);
+    // Appends every subscription matching topic to out, unmerged.
+    void match(std::string_view topic, match_result& out) const;
+
+    size_t size() const { return _subscriptions; }
+    size_t nodes() const { return _nodes.size() - _free.size(); }
+    size_t levels() const { return _levels.size(); }
+private:
+    static uint64_t edge_key(node_index parent, level_id level) {
+        return (uint64_t(parent) << 32) | level;
+    }
+    node_index find_node(std::string_view filter) const;
+    node_index child(node_index parent, std::string_view level);
+    node_index allocate(node_index parent, level_id level);
+    void prune(node_index n);
+    static void collect(const node& n, match_result& out);
+};
+
+// Bounded LRU from concrete topic to its resolved subscriber set.  Entries
+// remember the generation, of the part of the index their topic can match,
+// they were computed at, so invalidating them on a subscription change is
+// a counter increment.
+class match_cache {
+    struct entry {
+        sstring topic;
+        uint64_t generation;
+        lw_shared_ptr<const match_result> result;
+    };
+    std::list<entry> _lru;
+    std::unordered_map<std::string_view, std::list<entry>::iterator> _index;
+    size_t _capacity;
+public:
+    explicit match_cache(size_t capacity) : _capacity(capacity) {}
+
+    lw_shared_ptr<const match_result> find(std::string_view topic, uint64_t generation);
+    void insert(std::string_view topic, uint64_t generation, lw_shared_ptr<const match_result> result);
+    void clear();
+    size_t size() const { return _index.size(); }
+};
+
+// The per-shard subscription index queried on every PUBLISH.
+//
+// A subscription change only invalidates the cached topics its filter can
+// match: those with the filter's first level, kept as one generation per
+// hash bucket of first levels, or, for a filter starting with a wildcard,
+// every topic not starting with '$'.  Topics sharing a bucket with a
+// changed level are recomputed needlessly.
+class subscription_index {
+public:
+    struct stats {
+        uint64_t cache_hits = 0;
+        uint64_t cache_misses = 0;
+    };
+private:
+    static constexpr size_t level_buckets = 256;
+
+    topic_trie _trie;
+    match_cache _cache;
+    uint64_t _wildcard_generation = 0;
+    std::array<uint64_t, level_buckets> _level_generations{};
+    stats _stats;
+public:
+    explicit subscription_index(size_t cache_capacity = 65536) : _cache(cache_capacity) {}
+
+    bool subscribe(std::string_view filter, subscriber_id id, const subscription_options& options);
+    bool unsubscribe(std::string_view filter, subscriber_id id);
+
+    // Returns the subscribers of topic, one entry each.  The result is
+    // shared with the cache and must not be modified.
+    lw_shared_ptr<const match_result> match(std::string_view topic);
+
+    size_t size() const { return _trie.size(); }
+    const topic_trie& trie() const { return _trie; }
+    const match_cache& cache() const { return _cache; }
+    const stats& get_stats() const { return _stats; }
+private:
+    static size_t level_bucket(std::string_view level);
+    void changed(std::string_view filter);
+    uint64_t generation(std::string_view topic) const;
+};
+
+} /* namespace hero */
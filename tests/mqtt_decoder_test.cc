@@ -0,0 +1,185 @@
+/*
+ * This file is open source software, licensed to you under the terms
+ * of the Apache License, Version 2.0 (the "License").  See the NOTICE file
+ * distributed with this work for additional information regarding copyright
+ * ownership.  You may not use this file except in compliance with the License.
+ *
+ * You may obtain a copy of the License at
+ *
+ *   http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing,
+ * software distributed under the License is distributed on an
+ * "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+ * KIND, either express or implied.  See the License for the
+ * specific language governing permissions and limitations
+ * under the License.
+ */
+
+
+#define BOOST_TEST_MODULE mqtt_decoder
+
+#include <boost/test/unit_test.hpp>
+
+#include "mqtt/decoder.hh"
+
+#include <string>
+
+using namespace seastar;
+using namespace hero;
+using namespace hero::mqtt;
+
+// CONNECT, v5, client "abc", keep alive 60, followed by a QoS 1 PUBLISH of
+// "hi" to "a/b" with packet id 7.
+static const std::string connect_and_publish = {
+    0x10, 16, 0, 4, 'M', 'Q', 'T', 'T', 5, 0x02, 0, 60, 0, 0, 3, 'a', 'b', 'c',
+    0x32, 10, 0, 3, 'a', '/', 'b', 0, 7, 0, 'h', 'i',
+};
+
+static void feed(decoder& d, const std::string& bytes, std::vector<packet>& out) {
+    d.feed(temporary_buffer<char>(bytes.data(), bytes.size()), out);
+}
+
+static reason_code feed_error(decoder& d, const std::string& bytes) {
+    std::vector<packet> out;
+    try {
+        feed(d, bytes, out);
+    } catch (protocol_error& e) {
+        return e.code();
+    }
+    BOOST_FAIL("no protocol_error");
+    return reason_code::success;
+}
+
+static void check_connect_and_publish(std::vector<packet>& out) {
+    BOOST_REQUIRE_EQUAL(out.size(), 2u);
+    auto con = parse_connect(std::move(out[0]));
+    BOOST_REQUIRE(con.version == protocol_version::v5);
+    BOOST_REQUIRE_EQUAL(con.keep_alive, 60);
+    BOOST_REQUIRE(as_string_view(con.client_id) == "abc");
+    auto pub = parse_publish(std::move(out[1]), protocol_version::v5);
+    BOOST_REQUIRE(as_string_view(pub.topic) == "a/b");
+    BOOST_REQUIRE_EQUAL(pub.packet_id, 7);
+    BOOST_REQUIRE(pub.qos == qos::at_least_once);
+    BOOST_REQUIRE(as_string_view(pub.payload) == "hi");
+}
+
+BOOST_AUTO_TEST_CASE(test_whole_read) {
+    decoder d;
+    std::vector<packet> out;
+    feed(d, connect_and_publish, out);
+    BOOST_REQUIRE(d.idle());
+    check_connect_and_publish(out);
+}
+
+BOOST_AUTO_TEST_CASE(test_split_reads) {
+    // Every chunk size, so that reads end inside the fixed header, inside
+    // the remaining length and inside the body.
+    for (size_t chunk = 1; chunk < connect_and_publish.size(); ++chunk) {
+        decoder d;
+        std::vector<packet> out;
+        for (size_t i = 0; i < connect_and_publish.size(); i += chunk) {
+            feed(d, connect_and_publish.substr(i, chunk), out);
+        }
+        BOOST_REQUIRE(d.idle());
+        check_connect_and_publish(out);
+    }
+}
+
+BOOST_AUTO_TEST_CASE(test_split_remaining_length) {
+    // A PINGREQ, then a PUBLISH whose two byte remaining length (130) is
+    // split across reads.
+    std::string publish = {0x30, char(0x82), 0x01, 0, 1, 't'};
+    publish.append(127, 'x');
+    decoder d;
+    std::vector<packet> out;
+    feed(d, std::string{char(0xc0), 0, 0x30, char(0x82)}, out);
+    BOOST_REQUIRE_EQUAL(out.size(), 1u);
+    BOOST_REQUIRE(out[0].header.type == packet_type::pingreq);
+    BOOST_REQUIRE(!d.idle());
+    feed(d, publish.substr(2), out);
+    BOOST_REQUIRE(d.idle());
+    BOOST_REQUIRE_EQUAL(out.size(), 2u);
+    BOOST_REQUIRE_EQUAL(out[1].header.remaining_length, 130u);
+    auto pub = parse_publish(std::move(out[1]), protocol_version::v311);
+    BOOST_REQUIRE(as_string_view(pub.topic) == "t");
+    BOOST_REQUIRE_EQUAL(pub.payload.size(), 127u);
+}
+
+BOOST_AUTO_TEST_CASE(test_four_byte_remaining_length) {
+    // 0x80 0x80 0x80 0x01 is 2^21, the largest number of bytes to encode.
+    decoder d;
+    std::vector<packet> out;
+    feed(d, std::string{0x30, char(0x80), char(0x80), char(0x80), 0x01}, out);
+    BOOST_REQUIRE(out.empty());
+    BOOST_REQUIRE(!d.idle());
+}
+
+BOOST_AUTO_TEST_CASE(test_remaining_length_too_long) {
+    decoder d;
+    auto code = feed_error(d, std::string{0x30, char(0xff), char(0xff), char(0xff), char(0xff), 0x7f});
+    BOOST_REQUIRE(code == reason_code::malformed_packet);
+
+    // The same, a byte at a time.
+    decoder split;
+    std::vector<packet> out;
+    std::string header = {0x30, char(0x80), char(0x80), char(0x80), char(0x80)};
+    for (auto c : header) {
+        feed(split, std::string(1, c), out);
+    }
+    BOOST_REQUIRE(feed_error(split, std::string(1, 0x01)) == reason_code::malformed_packet);
+}
+
+BOOST_AUTO_TEST_CASE(test_max_packet_size) {
+    // The limit counts the fixed header: 2 bytes here.
+    std::string fits = {0x30, 14, 0, 1, 't'};
+    fits.append(11, 'x');
+    decoder d(16);
+    std::vector<packet> out;
+    feed(d, fits, out);
+    BOOST_REQUIRE_EQUAL(out.size(), 1u);
+
+    BOOST_REQUIRE(feed_error(d, std::string{0x30, 15}) == reason_code::packet_too_large);
+
+    // Rejected as soon as the length is known, before the body arrives.
+    decoder large(1024);
+    BOOST_REQUIRE(feed_error(large, std::string{0x30, char(0x80), 0x08}) == reason_code::packet_too_large);
+}
+
+BOOST_AUTO_TEST_CASE(test_claimed_length_not_allocated) {
+    // The largest remaining length, followed by only a few bytes.
+    decoder d;
+    std::vector<packet> out;
+    feed(d, std::string{0x30, char(0xff), char(0xff), char(0xff), 0x7f, 0, 1, 't'}, out);
+    feed(d, std::string(100, 'x'), out);
+    BOOST_REQUIRE(out.empty());
+    BOOST_REQUIRE(!d.idle());
+    BOOST_REQUIRE_LE(d.buffered(), 4096u);
+}
+
+BOOST_AUTO_TEST_CASE(test_partial_grows_to_packet) {
+    // A packet several times the initial buffer, fed in small reads.
+    std::string publish = {0x30, char(0x83), char(0x80), 0x01, 0, 1, 't'};
+    publish.append(16384, 'x');
+    decoder d;
+    std::vector<packet> out;
+    for (size_t i = 0; i < publish.size(); i += 1000) {
+        feed(d, publish.substr(i, 1000), out);
+    }
+    BOOST_REQUIRE(d.idle());
+    BOOST_REQUIRE_EQUAL(d.buffered(), 0u);
+    BOOST_REQUIRE_EQUAL(out.size(), 1u);
+    BOOST_REQUIRE_EQUAL(out[0].body.size(), 16387u);
+    auto pub = parse_publish(std::move(out[0]), protocol_version::v311);
+    BOOST_REQUIRE_EQUAL(pub.payload.size(), 16384u);
+    BOOST_REQUIRE(as_string_view(pub.payload) == std::string(16384, 'x'));
+}
+
+BOOST_AUTO_TEST_CASE(test_invalid_fixed_header) {
+    decoder reserved;
+    BOOST_REQUIRE(feed_error(reserved, std::string{0x00, 0}) == reason_code::malformed_packet);
+    decoder qos3;
+    BOOST_REQUIRE(feed_error(qos3, std::string{0x36, 0}) == reason_code::malformed_packet);
+    decoder subscribe_flags;
+    BOOST_REQUIRE(feed_error(subscribe_flags, std::string{char(0x80), 0}) == reason_code::malformed_packet);
+}
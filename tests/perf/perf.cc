@@ -0,0 +1,169 @@
+/*
+ * This file is open source software, licensed to you under the terms
+ * of the Apache License, Version 2.0 (the "License").  See the NOTICE file
+ * distributed with this work for additional information regarding copyright
+ * ownership.  You may not use this file except in compliance with the License.
+ *
+ * You may obtain a copy of the License at
+ *
+ *   http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing,
+ * software distributed under the License is distributed on an
+ * "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+ * KIND, either express or implied.  See the License for the
+ * specific language governing permissions and limitations
+ * under the License.
+ */
+
+#include "tests/perf/perf.hh"
+#include "core/app-template.hh"
+#include "core/memory.hh"
+#include "core/print.hh"
+#include "core/reactor.hh"
+#include "core/thread.hh"
+
+#include <algorithm>
+#include <chrono>
+#include <fstream>
+#include <iostream>
+#include <regex>
+#include <vector>
+
+namespace hero {
+
+namespace perf {
+
+using clock_type = std::chrono::steady_clock;
+
+struct benchmark {
+    sstring name;
+    benchmark_body body;
+};
+
+static std::vector<benchmark>& benchmarks() {
+    static std::vector<benchmark> all;
+    return all;
+}
+
+registration::registration(const char* name, benchmark_body body) {
+    benchmarks().push_back(benchmark{name, std::move(body)});
+}
+
+struct sample {
+    double ns_per_op;
+    double allocations_per_op;
+};
+
+struct result {
+    sstring name;
+    size_t iterations;
+    std::vector<sample> runs;
+    double ns_per_op;
+    // Median absolute deviation of the runs.
+    double mad_ns;
+    double allocations_per_op;
+};
+
+static sample measure(benchmark& b, size_t iterations) {
+    auto mallocs = memory::stats().mallocs();
+    auto start = clock_type::now();
+    b.body(iterations).get();
+    std::chrono::duration<double, std::nano> elapsed = clock_type::now() - start;
+    return sample{elapsed.count() / iterations, double(memory::stats().mallocs() - mallocs) / iterations};
+}
+
+static double median(std::vector<double> v) {
+    std::sort(v.begin(), v.end());
+    auto n = v.size();
+    return n % 2 ? v[n / 2] : (v[n / 2 - 1] + v[n / 2]) / 2;
+}
+
+static result run(benchmark& b, unsigned runs, std::chrono::nanoseconds min_time) {
+    // Grows the operation count tenfold until a run takes a tenth of the
+    // target, then sizes it from the time per operation seen.
+    size_t iterations = 1;
+    auto s = measure(b, iterations);
+    while (s.ns_per_op * iterations < min_time.count() / 10.0 && iterations < (size_t(1) << 40)) {
+        iterations *= 10;
+        s = measure(b, iterations);
+    }
+    iterations = std::max<size_t>(1, min_time.count() / std::max(s.ns_per_op, 1.0));
+
+    result r;
+    r.name = b.name;
+    r.iterations = iterations;
+    std::vector<double> times, allocations;
+    for (unsigned i = 0; i < runs; ++i) {
+        r.runs.push_back(measure(b, iterations));
+        times.push_back(r.runs.back().ns_per_op);
+        allocations.push_back(r.runs.back().allocations_per_op);
+    }
+    r.ns_per_op = median(times);
+    std::vector<double> deviations;
+    for (auto t : times) {
+        deviations.push_back(std::abs(t - r.ns_per_op));
+    }
+    r.mad_ns = median(deviations);
+    r.allocations_per_op = median(allocations);
+    return r;
+}
+
+static void print_json(std::ostream& os, const std::vector<result>& results) {
+    os << "{\n  \"benchmarks\": [";
+    for (size_t i = 0; i < results.size(); ++i) {
+        auto& r = results[i];
+        os << (i ? ",\n" : "\n");
+        os << sprint("    {\"name\": \"%s\", \"iterations\": %d, \"ns_per_op\": %.3f, \"mad_ns\": %.3f, "
+                "\"ops_per_second\": %.1f, \"allocations_per_op\": %.3f, \"runs\": [",
+                r.name, r.iterations, r.ns_per_op, r.mad_ns, 1e9 / r.ns_per_op, r.allocations_per_op);
+        for (size_t j = 0; j < r.runs.size(); ++j) {
+            os << (j ? ", " : "") << sprint("%.3f", r.runs[j].ns_per_op);
+        }
+        os << "]}";
+    }
+    os << "\n  ]\n}\n";
+}
+
+} /* namespace perf */
+
+} /* namespace hero */
+
+using namespace seastar;
+using namespace hero::perf;
+
+int main(int argc, char** argv) {
+    namespace bpo = boost::program_options;
+    app_template app;
+    app.add_options()
+        ("runs", bpo::value<unsigned>()->default_value(5), "Measured runs of each benchmark")
+        ("min-time", bpo::value<unsigned>()->default_value(200), "Milliseconds each run lasts at least")
+        ("filter", bpo::value<sstring>()->default_value(""), "Only run the benchmarks whose names match this regular expression")
+        ("json", bpo::value<sstring>()->default_value(""), "File to write the results to as JSON");
+
+    return app.run(argc, argv, [&] {
+        return seastar::async([&] {
+            auto&& config = app.configuration();
+            auto runs = std::max(1u, config["runs"].as<unsigned>());
+            std::chrono::nanoseconds min_time = std::chrono::milliseconds(config["min-time"].as<unsigned>());
+            std::regex filter(config["filter"].as<sstring>().c_str());
+            std::vector<result> results;
+            std::cout << sprint("%-40s %14s %12s %14s %10s\n", "benchmark", "ns/op", "mad", "ops/s", "allocs/op");
+            for (auto& b : benchmarks()) {
+                if (!std::regex_search(b.name.c_str(), filter)) {
+                    continue;
+                }
+                auto r = run(b, runs, min_time);
+                std::cout << sprint("%-40s %14.2f %12.2f %14.0f %10.2f\n",
+                        r.name, r.ns_per_op, r.mad_ns, 1e9 / r.ns_per_op, r.allocations_per_op);
+                results.push_back(std::move(r));
+            }
+            auto json = config["json"].as<sstring>();
+            if (!json.empty()) {
+                std::ofstream f(json.c_str());
+                print_json(f, results);
+            }
+            return 0;
+        });
+    });
+}
@@ -0,0 +1,69 @@
+/*
+ * This file is open source software, licensed to you under the terms
+ * of the Apache License, Version 2.0 (the "License").  See the NOTICE file
+ * distributed with this work for additional information regarding copyright
+ * ownership.  You may not use this file except in compliance with the License.
+ *
+ * You may obtain a copy of the License at
+ *
+ *   http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing,
+ * software distributed under the License is distributed on an
+ * "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+ * KIND, either express or implied.  See the License for the
+ * specific language governing permissions and limitations
+ * under the License.
+ */
+
+#pragma once
+
+#include "core/future.hh"
+
+#include <functional>
+
+// A minimal microbenchmark harness.  A benchmark binary defines its
+// benchmarks with PERF_TEST and links tests/perf/perf.cc, which provides
+// main(): every benchmark is run several times, each time for as many
+// operations as fill --min-time, and the median time and allocation count
+// per operation are reported, as a table and, with --json, as JSON for
+// perf.py.
+//
+//   PERF_TEST(decoder, publish) {
+//       ... set up ...
+//       for (size_t i = 0; i < iterations; ++i) {
+//           ... one operation ...
+//       }
+//       return make_ready_future<>();
+//   }
+//
+// The body runs in a seastar thread, so it may also wait for futures with
+// get().  Allocations are counted on the benchmark's shard only.
+
+namespace hero {
+
+namespace perf {
+
+using namespace seastar;
+
+// Performs the given number of operations.
+using benchmark_body = std::function<future<> (size_t iterations)>;
+
+struct registration {
+    registration(const char* name, benchmark_body body);
+};
+
+// Keeps the compiler from optimizing away the computation of v.
+template <typename T>
+inline void do_not_optimize(const T& v) {
+    asm volatile("" : : "g"(&v) : "memory");
+}
+
+} /* namespace perf */
+
+} /* namespace hero */
+
+#define PERF_TEST(group, name) \
+    static seastar::future<> perf_##group##_##name(size_t iterations); \
+    static hero::perf::registration perf_registration_##group##_##name(#group "." #name, perf_##group##_##name); \
+    static seastar::future<> perf_##group##_##name(size_t iterations)
@@ -0,0 +1,93 @@
+/*
+ * This file is open source software, licensed to you under the terms
+ * of the Apache License, Version 2.0 (the "License").  See the NOTICE file
+ * distributed with this work for additional information regarding copyright
+ * ownership.  You may not use this file except in compliance with the License.
+ *
+ * You may obtain a copy of the License at
+ *
+ *   http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing,
+ * software distributed under the License is distributed on an
+ * "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+ * KIND, either express or implied.  See the License for the
+ * specific language governing permissions and limitations
+ * under the License.
+ */
+
+// Per-packet allocation and buffer handling.
+
+#include "tests/perf/perf.hh"
+#include "core/sharded.hh"
+#include "core/temporary_buffer.hh"
+#include "message.hh"
+#include "slab_arena.hh"
+
+#include <vector>
+
+using namespace seastar;
+using namespace hero;
+
+PERF_TEST(buffer, allocate) {
+    for (size_t i = 0; i < iterations; ++i) {
+        temporary_buffer<char> b(200);
+        perf::do_not_optimize(b);
+    }
+    return make_ready_future<>();
+}
+
+PERF_TEST(buffer, share) {
+    temporary_buffer<char> b(4096);
+    for (size_t i = 0; i < iterations; ++i) {
+        auto s = b.share(i % 2048, 64);
+        perf::do_not_optimize(s);
+    }
+    return make_ready_future<>();
+}
+
+PERF_TEST(slab_arena, allocate) {
+    // Keeps a window of live buffers, so slots are freed in a different
+    // order than they were taken.
+    slab_arena arena;
+    std::vector<temporary_buffer<char>> live(1024);
+    for (size_t i = 0; i < iterations; ++i) {
+        live[(i * 7) % live.size()] = arena.allocate(200);
+    }
+    return make_ready_future<>();
+}
+
+static mqtt::publish make_publish() {
+    mqtt::publish p;
+    p.topic = temporary_buffer<char>(26);
+    p.payload = temporary_buffer<char>(64);
+    p.qos = mqtt::qos::at_least_once;
+    p.retain = false;
+    p.dup = false;
+    return p;
+}
+
+PERF_TEST(message, make) {
+    auto pub = make_publish();
+    for (size_t i = 0; i < iterations; ++i) {
+        mqtt::publish p;
+        p.topic = pub.topic.share();
+        p.payload = pub.payload.share();
+        p.qos = pub.qos;
+        p.retain = false;
+        p.dup = false;
+        auto m = make_message(std::move(p), 0);
+        perf::do_not_optimize(m);
+    }
+    return make_ready_future<>();
+}
+
+PERF_TEST(message, import) {
+    // What a shard does with each message another shard sends it.
+    auto msg = make_message(make_publish(), 0);
+    for (size_t i = 0; i < iterations; ++i) {
+        auto m = import_message(make_foreign(msg));
+        perf::do_not_optimize(m);
+    }
+    return make_ready_future<>();
+}
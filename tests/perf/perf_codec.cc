@@ -0,0 +1,155 @@
+/*
+ * This file is open source software, licensed to you under the terms
+ * of the Apache License, Version 2.0 (the "License").  See the NOTICE file
+ * distributed with this work for additional information regarding copyright
+ * ownership.  You may not use this file except in compliance with the License.
+ *
+ * You may obtain a copy of the License at
+ *
+ *   http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing,
+ * software distributed under the License is distributed on an
+ * "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+ * KIND, either express or implied.  See the License for the
+ * specific language governing permissions and limitations
+ * under the License.
+ */
+
+// The connection's read and write paths, without the socket: framing and
+// parsing received packets, and encoding deliveries.
+
+#include "tests/perf/perf.hh"
+#include "mqtt/decoder.hh"
+#include "mqtt/encoder.hh"
+#include "net/packet.hh"
+#include "message.hh"
+#include "publish_encoder.hh"
+
+#include <algorithm>
+
+using namespace seastar;
+using namespace hero;
+
+static constexpr size_t packets_per_read = 256;
+
+static mqtt::publish make_publish(size_t payload_size, mqtt::qos qos) {
+    static const char topic[] = "site/42/sensor/temperature";
+    mqtt::publish p;
+    p.topic = temporary_buffer<char>(topic, sizeof(topic) - 1);
+    p.payload = temporary_buffer<char>(payload_size);
+    std::fill_n(p.payload.get_write(), payload_size, 'x');
+    p.qos = qos;
+    p.retain = false;
+    p.dup = false;
+    p.packet_id = qos == mqtt::qos::at_most_once ? 0 : 1;
+    return p;
+}
+
+// A read buffer full of PUBLISH packets, each packet_size bytes.
+static temporary_buffer<char> make_read_buffer(size_t payload_size, size_t& packet_size) {
+    auto one = mqtt::encode_publish(mqtt::protocol_version::v311, make_publish(payload_size, mqtt::qos::at_least_once));
+    packet_size = one.size();
+    temporary_buffer<char> buf(packet_size * packets_per_read);
+    for (size_t i = 0; i < packets_per_read; ++i) {
+        std::copy_n(one.get(), packet_size, buf.get_write() + i * packet_size);
+    }
+    return buf;
+}
+
+// Feeds buf in reads of up to packets_per_read packets, calling handle for
+// each, until iterations packets are done.
+template <typename Func>
+static void decode(temporary_buffer<char>& buf, size_t packet_size, size_t iterations, Func handle) {
+    mqtt::decoder d;
+    std::vector<mqtt::packet> packets;
+    for (size_t done = 0; done < iterations; ) {
+        auto n = std::min(packets_per_read, iterations - done);
+        d.feed(buf.share(0, n * packet_size), packets);
+        for (auto& p : packets) {
+            handle(std::move(p));
+        }
+        packets.clear();
+        done += n;
+    }
+}
+
+PERF_TEST(decoder, frame) {
+    size_t packet_size;
+    auto buf = make_read_buffer(64, packet_size);
+    decode(buf, packet_size, iterations, [] (mqtt::packet&& p) {
+        perf::do_not_optimize(p);
+    });
+    return make_ready_future<>();
+}
+
+PERF_TEST(decoder, publish_to_message) {
+    size_t packet_size;
+    auto buf = make_read_buffer(64, packet_size);
+    decode(buf, packet_size, iterations, [] (mqtt::packet&& p) {
+        auto msg = make_message(mqtt::parse_publish(std::move(p), mqtt::protocol_version::v311), 0);
+        perf::do_not_optimize(msg);
+    });
+    return make_ready_future<>();
+}
+
+PERF_TEST(decoder, straddling_reads) {
+    // Reads which end mid-packet, so every other packet is linearized.
+    size_t packet_size;
+    auto buf = make_read_buffer(1024, packet_size);
+    mqtt::decoder d;
+    std::vector<mqtt::packet> packets;
+    auto half = packet_size / 2;
+    for (size_t i = 0; i < iterations; i += 2) {
+        d.feed(buf.share(0, half), packets);
+        d.feed(buf.share(half, packet_size * 2 - half), packets);
+        perf::do_not_optimize(packets);
+        packets.clear();
+    }
+    return make_ready_future<>();
+}
+
+PERF_TEST(encoder, publish_inline) {
+    auto pub = make_publish(64, mqtt::qos::at_most_once);
+    for (size_t i = 0; i < iterations; ++i) {
+        auto p = net::packet(mqtt::encode_publish(mqtt::protocol_version::v311, pub));
+        perf::do_not_optimize(p);
+    }
+    return make_ready_future<>();
+}
+
+PERF_TEST(encoder, publish_fragment) {
+    // As a delivery of a large payload: the header is encoded, the payload
+    // shared.
+    auto pub = make_publish(4096, mqtt::qos::at_least_once);
+    for (size_t i = 0; i < iterations; ++i) {
+        auto p = net::packet(net::packet(mqtt::encode_publish_header(mqtt::protocol_version::v5, pub)), pub.payload.share());
+        perf::do_not_optimize(p);
+    }
+    return make_ready_future<>();
+}
+
+PERF_TEST(encoder, publish_repeated_topic) {
+    // Telemetry: a long topic and a small payload, delivered over and over
+    // to a v5 subscriber, which gets the topic alias and the cached header.
+    static const char topic[] = "plant/7/line/3/station/12/device/0f3a9c22-4b1e-4d8a-9e6f-1c2b3a4d5e6f/telemetry";
+    auto msg = make_message(make_publish(32, mqtt::qos::at_most_once), 0);
+    msg->topic = temporary_buffer<char>(topic, sizeof(topic) - 1);
+    output_stats stats;
+    publish_encoder encoder(stats, 64);
+    encoder.start(mqtt::protocol_version::v5, 64);
+    delivery d;
+    for (size_t i = 0; i < iterations; ++i) {
+        auto e = encoder.encode(*msg, d);
+        perf::do_not_optimize(e);
+    }
+    return make_ready_future<>();
+}
+
+PERF_TEST(encoder, ack) {
+    for (size_t i = 0; i < iterations; ++i) {
+        auto b = mqtt::encode_ack(mqtt::protocol_version::v311, mqtt::packet_type::puback, uint16_t(i));
+        perf::do_not_optimize(b);
+    }
+    return make_ready_future<>();
+}
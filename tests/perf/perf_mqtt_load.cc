@@ -0,0 +1,692 @@
+/*
+ * This file is open source software, licensed to you under the terms
+ * of the Apache License, Version 2.0 (the "License").  See the NOTICE file
+ * distributed with this work for additional information regarding copyright
+ * ownership.  You may not use this file except in compliance with the License.
+ *
+ * You may obtain a copy of the License at
+ *
+ *   http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing,
+ * software distributed under the License is distributed on an
+ * "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+ * KIND, either express or implied.  See the License for the
+ * specific language governing permissions and limitations
+ * under the License.
+ */
+
+// An MQTT load generator.
+//
+// Opens --subscribers and --publishers 3.1.1 connections to a running
+// broker, spread over every shard, and has each publisher send to its own
+// topic, topic number <publisher> modulo --topics, for --warmup and then
+// --duration seconds.  Subscriber k takes --subscriptions consecutive
+// topics from topic k * --subscriptions on; a --wildcard-ratio of them use
+// a filter matching the topic's group of ten instead.  The usual patterns
+// are a matter of counts:
+//
+//   fan-in:   --publishers 10000 --subscribers 1 --topics 1
+//   fan-out:  --publishers 1 --subscribers 10000 --topics 1
+//   pairs:    --publishers 5000 --subscribers 5000 --topics 5000
+//
+// Each payload starts with the time it was sent, so subscribers measure
+// the publish-to-deliver latency; the broker has to run on the same host.
+// The results, throughput and latency percentiles, are printed as JSON.
+
+#include "core/app-template.hh"
+#include "core/distributed.hh"
+#include "core/future-util.hh"
+#include "core/print.hh"
+#include "core/reactor.hh"
+#include "core/semaphore.hh"
+#include "core/sleep.hh"
+#include "core/thread.hh"
+#include "net/api.hh"
+#include "util/defer.hh"
+#include "mqtt/decoder.hh"
+#include "mqtt/encoder.hh"
+#include "admission.hh"
+#include "output_queue.hh"
+
+#include <boost/algorithm/string.hpp>
+#include <boost/range/irange.hpp>
+
+#include <array>
+#include <chrono>
+#include <cmath>
+#include <fstream>
+#include <iostream>
+#include <limits>
+#include <random>
+#include <sstream>
+
+using namespace seastar;
+using namespace hero;
+
+using clock_type = std::chrono::steady_clock;
+
+struct load_config {
+    ipv4_addr server;
+    unsigned publishers;
+    unsigned subscribers;
+    unsigned topics;
+    unsigned subscriptions;
+    double wildcard_ratio;
+    // Weights of QoS 0, 1 and 2.
+    std::array<double, 3> qos_mix;
+    size_t min_payload;
+    size_t max_payload;
+    // Messages per second per publisher; 0 for as fast as the window allows.
+    double rate;
+    // Unacknowledged QoS 1 and 2 messages per publisher.
+    unsigned window;
+    unsigned connect_concurrency;
+    clock_type::duration warmup;
+    clock_type::duration duration;
+};
+
+// A log-linear histogram after HdrHistogram: each power of two is split
+// into 64 buckets, so a value is recorded within 1.6% of itself.
+class hdr_histogram {
+    static constexpr unsigned sub_bits = 6;
+    static constexpr uint64_t sub_count = uint64_t(1) << sub_bits;
+    // Up to 2^40ns, about 18 minutes.
+    static constexpr unsigned max_bits = 40;
+    static constexpr unsigned bucket_count = (max_bits - sub_bits + 1) * sub_count;
+    std::vector<uint64_t> _counts;
+    uint64_t _samples = 0;
+    uint64_t _min = std::numeric_limits<uint64_t>::max();
+    uint64_t _max = 0;
+    double _sum = 0;
+
+    static unsigned index(uint64_t v) {
+        if (v < 2 * sub_count) {
+            return v;
+        }
+        unsigned shift = 63 - __builtin_clzll(v) - sub_bits;
+        return std::min<uint64_t>(shift * sub_count + (v >> shift), bucket_count - 1);
+    }
+    static uint64_t value(unsigned i) {
+        if (i < 2 * sub_count) {
+            return i;
+        }
+        unsigned shift = i / sub_count - 1;
+        return uint64_t(i - shift * sub_count) << shift;
+    }
+public:
+    hdr_histogram() : _counts(bucket_count) {}
+
+    void record(uint64_t v) {
+        _counts[index(v)]++;
+        _samples++;
+        _min = std::min(_min, v);
+        _max = std::max(_max, v);
+        _sum += v;
+    }
+    hdr_histogram& operator+=(const hdr_histogram& o) {
+        for (unsigned i = 0; i < bucket_count; ++i) {
+            _counts[i] += o._counts[i];
+        }
+        _samples += o._samples;
+        _min = std::min(_min, o._min);
+        _max = std::max(_max, o._max);
+        _sum += o._sum;
+        return *this;
+    }
+
+    uint64_t samples() const { return _samples; }
+    uint64_t min() const { return _samples ? _min : 0; }
+    uint64_t max() const { return _max; }
+    double mean() const { return _samples ? _sum / _samples : 0; }
+    // The lowest recorded value at or above which lie (100 - p)% of the
+    // samples.
+    uint64_t percentile(double p) const {
+        if (!_samples) {
+            return 0;
+        }
+        auto rank = std::max<uint64_t>(1, std::ceil(_samples * p / 100));
+        uint64_t seen = 0;
+        for (unsigned i = 0; i < bucket_count; ++i) {
+            seen += _counts[i];
+            if (seen >= rank) {
+                return std::min(std::max(value(i), _min), _max);
+            }
+        }
+        return _max;
+    }
+};
+
+struct load_result {
+    unsigned connected = 0;
+    unsigned connect_failures = 0;
+    std::array<uint64_t, 3> published{};
+    uint64_t acknowledged = 0;
+    uint64_t unacknowledged = 0;
+    uint64_t received = 0;
+    uint64_t received_bytes = 0;
+    hdr_histogram latency;
+
+    load_result& operator+=(const load_result& o) {
+        connected += o.connected;
+        connect_failures += o.connect_failures;
+        for (unsigned q = 0; q < 3; ++q) {
+            published[q] += o.published[q];
+        }
+        acknowledged += o.acknowledged;
+        unacknowledged += o.unacknowledged;
+        received += o.received;
+        received_bytes += o.received_bytes;
+        latency += o.latency;
+        return *this;
+    }
+};
+
+// The first bytes of every payload.
+struct payload_header {
+    uint64_t sent_ns;
+    uint32_t publisher;
+    uint32_t sequence;
+};
+
+static temporary_buffer<char> encode_connect(const sstring& client_id) {
+    static const char variable_header[] = {0, 4, 'M', 'Q', 'T', 'T', 4, 0x02, 0, 0};
+    uint32_t remaining = sizeof(variable_header) + 2 + client_id.size();
+    temporary_buffer<char> buf(1 + mqtt::varint_size(remaining) + remaining);
+    auto p = buf.get_write();
+    *p++ = 0x10;
+    p = mqtt::write_varint(p, remaining);
+    p = std::copy_n(variable_header, sizeof(variable_header), p);
+    *p++ = client_id.size() >> 8;
+    *p++ = client_id.size() & 0xff;
+    std::copy_n(client_id.begin(), client_id.size(), p);
+    return buf;
+}
+
+static temporary_buffer<char> encode_subscribe(uint16_t packet_id, const std::vector<sstring>& filters) {
+    uint32_t remaining = 2;
+    for (auto& f : filters) {
+        remaining += 2 + f.size() + 1;
+    }
+    temporary_buffer<char> buf(1 + mqtt::varint_size(remaining) + remaining);
+    auto p = buf.get_write();
+    *p++ = 0x82;
+    p = mqtt::write_varint(p, remaining);
+    *p++ = packet_id >> 8;
+    *p++ = packet_id & 0xff;
+    for (auto& f : filters) {
+        *p++ = f.size() >> 8;
+        *p++ = f.size() & 0xff;
+        p = std::copy_n(f.begin(), f.size(), p);
+        // QoS 2, so that subscribers get each message at the QoS it was
+        // published with.
+        *p++ = 2;
+    }
+    return buf;
+}
+
+static temporary_buffer<char> encode_disconnect() {
+    temporary_buffer<char> buf(2);
+    buf.get_write()[0] = char(0xe0);
+    buf.get_write()[1] = 0;
+    return buf;
+}
+
+static sstring topic_name(unsigned t) {
+    return sprint("load/%u/%u", t / 10, t);
+}
+
+static sstring topic_filter(unsigned t, bool wildcard) {
+    return wildcard ? sprint("load/%u/+", t / 10) : topic_name(t);
+}
+
+class load_shard;
+
+// One client connection, a publisher or a subscriber.
+class client {
+    load_shard& _shard;
+    unsigned _index;
+    connected_socket _socket;
+    input_stream<char> _in;
+    output_stream<char> _out;
+    output_queue _output;
+    mqtt::decoder _decoder;
+    std::vector<mqtt::packet> _packets;
+    // Resolved by CONNACK and SUBACK.
+    std::optional<promise<>> _reply;
+    semaphore _window;
+    uint16_t _next_packet_id = 1;
+    uint32_t _sequence = 0;
+    future<> _reader = make_ready_future<>();
+public:
+    client(load_shard& shard, unsigned index, connected_socket&& socket);
+
+    unsigned index() const { return _index; }
+
+    future<> connect(sstring client_id);
+    future<> subscribe(std::vector<sstring> filters);
+    // Publishes to topic until the shard stops publishing.
+    future<> publish(sstring topic);
+    // Waits for the messages in flight, then disconnects.
+    future<> close(clock_type::time_point deadline);
+private:
+    future<> read_loop();
+    void handle(mqtt::packet&& p);
+    future<> wait_reply();
+    uint16_t next_packet_id();
+    void send(temporary_buffer<char> buf) { _output.push(net::packet(std::move(buf))); }
+};
+
+class load_shard {
+    load_config _config;
+    output_policy _policy;
+    output_stats _output_stats;
+    admission_control _admission;
+    std::vector<std::unique_ptr<client>> _publishers;
+    std::vector<std::unique_ptr<client>> _subscribers;
+    std::default_random_engine _random;
+    std::discrete_distribution<unsigned> _qos;
+    load_result _result;
+    bool _measuring = false;
+    bool _publishing = false;
+    future<> _publish_done = make_ready_future<>();
+    friend class client;
+public:
+    explicit load_shard(load_config config)
+        : _config(config)
+        , _random(engine().cpu_id())
+        , _qos(_config.qos_mix.begin(), _config.qos_mix.end())
+    {
+    }
+
+    future<> stop() { return make_ready_future<>(); }
+
+    future<> connect_subscribers();
+    future<> connect_publishers();
+    void start_publishing();
+    void start_measuring() { _measuring = true; }
+    void stop_measuring() { _measuring = false; }
+    future<> finish();
+    load_result result() const { return _result; }
+private:
+    // The clients of this shard, numbers i with i % smp::count == cpu_id.
+    boost::integer_range<unsigned> own(unsigned count) const;
+    future<> connect_all(unsigned count, std::function<future<> (unsigned, client&)> setup,
+            std::vector<std::unique_ptr<client>>& out);
+    mqtt::qos pick_qos();
+    size_t pick_payload_size();
+};
+
+client::client(load_shard& shard, unsigned index, connected_socket&& socket)
+    : _shard(shard)
+    , _index(index)
+    , _socket(std::move(socket))
+    , _in(_socket.input())
+    , _out(_socket.output())
+    , _output(_out, shard._policy, shard._output_stats, shard._admission)
+    , _window(shard._config.window)
+{
+    _reader = read_loop();
+}
+
+future<> client::read_loop() {
+    return repeat([this] {
+        return _in.read().then([this] (temporary_buffer<char> data) {
+            if (data.empty()) {
+                return stop_iteration::yes;
+            }
+            _decoder.feed(std::move(data), _packets);
+            for (auto& p : _packets) {
+                handle(std::move(p));
+            }
+            _packets.clear();
+            return stop_iteration::no;
+        });
+    }).handle_exception([this] (std::exception_ptr ep) {
+        if (_reply) {
+            _reply->set_exception(ep);
+            _reply = {};
+        }
+    }).finally([this] {
+        if (_reply) {
+            _reply->set_exception(std::runtime_error("connection closed"));
+            _reply = {};
+        }
+    });
+}
+
+void client::handle(mqtt::packet&& p) {
+    auto& r = _shard._result;
+    switch (p.header.type) {
+    case mqtt::packet_type::connack:
+    case mqtt::packet_type::suback:
+        if (_reply) {
+            _reply->set_value();
+            _reply = {};
+        }
+        return;
+    case mqtt::packet_type::publish: {
+        auto pub = mqtt::parse_publish(std::move(p), mqtt::protocol_version::v311);
+        if (_shard._measuring && pub.payload.size() >= sizeof(payload_header)) {
+            payload_header h;
+            std::copy_n(pub.payload.get(), sizeof(h), reinterpret_cast<char*>(&h));
+            auto now = std::chrono::duration_cast<std::chrono::nanoseconds>(clock_type::now().time_since_epoch()).count();
+            r.latency.record(now > int64_t(h.sent_ns) ? now - h.sent_ns : 0);
+            r.received++;
+            r.received_bytes += pub.payload.size();
+        }
+        if (pub.qos == mqtt::qos::at_least_once) {
+            send(mqtt::encode_ack(mqtt::protocol_version::v311, mqtt::packet_type::puback, pub.packet_id));
+        } else if (pub.qos == mqtt::qos::exactly_once) {
+            send(mqtt::encode_ack(mqtt::protocol_version::v311, mqtt::packet_type::pubrec, pub.packet_id));
+        }
+        return;
+    }
+    case mqtt::packet_type::pubrel: {
+        auto ack = mqtt::parse_ack(std::move(p), mqtt::protocol_version::v311);
+        send(mqtt::encode_ack(mqtt::protocol_version::v311, mqtt::packet_type::pubcomp, ack.packet_id));
+        return;
+    }
+    case mqtt::packet_type::pubrec: {
+        auto ack = mqtt::parse_ack(std::move(p), mqtt::protocol_version::v311);
+        send(mqtt::encode_ack(mqtt::protocol_version::v311, mqtt::packet_type::pubrel, ack.packet_id));
+        return;
+    }
+    case mqtt::packet_type::puback:
+    case mqtt::packet_type::pubcomp:
+        if (_shard._measuring) {
+            r.acknowledged++;
+        }
+        _window.signal(1);
+        return;
+    default:
+        return;
+    }
+}
+
+future<> client::wait_reply() {
+    _reply = promise<>();
+    return _reply->get_future();
+}
+
+uint16_t client::next_packet_id() {
+    auto id = _next_packet_id++;
+    if (!_next_packet_id) {
+        _next_packet_id = 1;
+    }
+    return id;
+}
+
+future<> client::connect(sstring client_id) {
+    auto f = wait_reply();
+    send(encode_connect(client_id));
+    return f;
+}
+
+future<> client::subscribe(std::vector<sstring> filters) {
+    auto f = wait_reply();
+    send(encode_subscribe(next_packet_id(), filters));
+    return f;
+}
+
+future<> client::publish(sstring topic) {
+    auto& config = _shard._config;
+    auto interval = config.rate > 0
+            ? std::chrono::duration_cast<clock_type::duration>(std::chrono::duration<double>(1 / config.rate))
+            : clock_type::duration::zero();
+    // Publishers start spread over the first interval, not all at once.
+    auto next = clock_type::now() + interval * std::uniform_real_distribution<double>()(_shard._random);
+    return do_with(std::move(topic), next, [this, interval] (sstring& topic, clock_type::time_point& next) {
+        return repeat([this, &topic, &next, interval] {
+            if (!_shard._publishing) {
+                return make_ready_future<stop_iteration>(stop_iteration::yes);
+            }
+            auto pace = make_ready_future<>();
+            if (interval != clock_type::duration::zero()) {
+                auto now = clock_type::now();
+                if (next > now) {
+                    pace = sleep(next - now);
+                }
+                next += interval;
+            } else if (++_sequence % 16 == 0) {
+                pace = later();
+            }
+            return pace.then([this, &topic] {
+                auto qos = _shard.pick_qos();
+                // QoS 0 messages are only bounded by the send queue.
+                auto wait = qos == mqtt::qos::at_most_once ? _output.wait_for_space() : _window.wait(1);
+                return wait.then([this, &topic, qos] {
+                    if (!_shard._publishing) {
+                        if (qos != mqtt::qos::at_most_once) {
+                            _window.signal(1);
+                        }
+                        return stop_iteration::yes;
+                    }
+                    mqtt::publish pub;
+                    pub.topic = temporary_buffer<char>(topic.c_str(), topic.size());
+                    pub.payload = temporary_buffer<char>(_shard.pick_payload_size());
+                    std::fill_n(pub.payload.get_write(), pub.payload.size(), 0);
+                    payload_header h;
+                    h.sent_ns = std::chrono::duration_cast<std::chrono::nanoseconds>(clock_type::now().time_since_epoch()).count();
+                    h.publisher = _index;
+                    h.sequence = _sequence++;
+                    std::copy_n(reinterpret_cast<const char*>(&h), sizeof(h), pub.payload.get_write());
+                    pub.qos = qos;
+                    pub.retain = false;
+                    pub.dup = false;
+                    if (qos != mqtt::qos::at_most_once) {
+                        pub.packet_id = next_packet_id();
+                    }
+                    send(mqtt::encode_publish(mqtt::protocol_version::v311, pub));
+                    if (_shard._measuring) {
+                        _shard._result.published[unsigned(qos)]++;
+                    }
+                    return stop_iteration::no;
+                });
+            });
+        });
+    });
+}
+
+future<> client::close(clock_type::time_point deadline) {
+    auto window = _shard._config.window;
+    return _window.wait(deadline, window).then_wrapped([this, window] (future<> f) {
+        try {
+            f.get();
+            _window.signal(window);
+        } catch (semaphore_timed_out&) {
+            _shard._result.unacknowledged += window - _window.current();
+        }
+        send(encode_disconnect());
+        return _output.close();
+    }).then([this] {
+        return _out.close();
+    }).handle_exception([] (std::exception_ptr) {
+        // The broker dropped the connection first.
+    }).then([this] {
+        _socket.shutdown_input();
+        return std::move(_reader);
+    });
+}
+
+boost::integer_range<unsigned> load_shard::own(unsigned count) const {
+    // i % smp::count == cpu_id for i in [0, count), as a count of clients.
+    auto first = engine().cpu_id();
+    return boost::irange(0u, first < count ? (count - first + smp::count - 1) / smp::count : 0u);
+}
+
+future<> load_shard::connect_all(unsigned count, std::function<future<> (unsigned, client&)> setup,
+        std::vector<std::unique_ptr<client>>& out) {
+    auto limit = make_lw_shared<semaphore>(_config.connect_concurrency);
+    return parallel_for_each(own(count), [this, limit, setup = std::move(setup), &out] (unsigned n) {
+        auto index = n * smp::count + engine().cpu_id();
+        return with_semaphore(*limit, 1, [this, index, setup, &out] {
+            return engine().net().connect(make_ipv4_address(_config.server)).then([this, index, setup, &out] (connected_socket s) {
+                out.push_back(std::make_unique<client>(*this, index, std::move(s)));
+                return setup(index, *out.back());
+            }).then([this] {
+                _result.connected++;
+            }).handle_exception([this] (std::exception_ptr) {
+                _result.connect_failures++;
+            });
+        });
+    }).finally([limit] {});
+}
+
+future<> load_shard::connect_subscribers() {
+    return connect_all(_config.subscribers, [this] (unsigned index, client& c) {
+        return c.connect(sprint("load-sub-%u", index)).then([this, index, &c] {
+            std::vector<sstring> filters;
+            std::bernoulli_distribution wildcard(_config.wildcard_ratio);
+            for (unsigned j = 0; j < _config.subscriptions; ++j) {
+                filters.push_back(topic_filter((index * _config.subscriptions + j) % _config.topics, wildcard(_random)));
+            }
+            return c.subscribe(std::move(filters));
+        });
+    }, _subscribers);
+}
+
+future<> load_shard::connect_publishers() {
+    return connect_all(_config.publishers, [] (unsigned index, client& c) {
+        return c.connect(sprint("load-pub-%u", index));
+    }, _publishers);
+}
+
+void load_shard::start_publishing() {
+    _publishing = true;
+    _publish_done = parallel_for_each(_publishers, [this] (std::unique_ptr<client>& c) {
+        return c->publish(topic_name(c->index() % _config.topics));
+    });
+}
+
+future<> load_shard::finish() {
+    _publishing = false;
+    return std::move(_publish_done).then([this] {
+        // Whatever is still in flight gets a few seconds to be acknowledged.
+        auto deadline = clock_type::now() + std::chrono::seconds(5);
+        return parallel_for_each(_publishers, [deadline] (std::unique_ptr<client>& c) {
+            return c->close(deadline);
+        });
+    }).then([this] {
+        return parallel_for_each(_subscribers, [] (std::unique_ptr<client>& c) {
+            return c->close(clock_type::now());
+        });
+    });
+}
+
+mqtt::qos load_shard::pick_qos() {
+    return mqtt::qos(_qos(_random));
+}
+
+size_t load_shard::pick_payload_size() {
+    return std::uniform_int_distribution<size_t>(_config.min_payload, _config.max_payload)(_random);
+}
+
+static void print_json(std::ostream& os, const load_config& config, const load_result& r,
+        double connect_seconds, double seconds) {
+    auto us = [] (uint64_t ns) { return ns / 1000.0; };
+    uint64_t published = r.published[0] + r.published[1] + r.published[2];
+    os << "{\n";
+    os << sprint("  \"config\": {\"publishers\": %u, \"subscribers\": %u, \"topics\": %u, \"subscriptions\": %u, "
+            "\"wildcard_ratio\": %g, \"qos_mix\": [%g, %g, %g], \"payload\": [%u, %u], \"rate\": %g, \"window\": %u, "
+            "\"shards\": %u},\n",
+            config.publishers, config.subscribers, config.topics, config.subscriptions, config.wildcard_ratio,
+            config.qos_mix[0], config.qos_mix[1], config.qos_mix[2], config.min_payload, config.max_payload,
+            config.rate, config.window, smp::count);
+    os << sprint("  \"connections\": {\"connected\": %u, \"failed\": %u, \"seconds\": %.3f},\n",
+            r.connected, r.connect_failures, connect_seconds);
+    os << sprint("  \"duration_seconds\": %.3f,\n", seconds);
+    os << sprint("  \"published\": {\"qos0\": %u, \"qos1\": %u, \"qos2\": %u, \"total\": %u, \"per_second\": %.1f, "
+            "\"acknowledged\": %u, \"unacknowledged\": %u},\n",
+            r.published[0], r.published[1], r.published[2], published, published / seconds,
+            r.acknowledged, r.unacknowledged);
+    os << sprint("  \"received\": {\"messages\": %u, \"per_second\": %.1f, \"bytes_per_second\": %.1f},\n",
+            r.received, r.received / seconds, r.received_bytes / seconds);
+    auto& h = r.latency;
+    os << sprint("  \"latency_us\": {\"samples\": %u, \"min\": %.1f, \"mean\": %.1f, \"p50\": %.1f, \"p90\": %.1f, "
+            "\"p99\": %.1f, \"p99.9\": %.1f, \"p99.99\": %.1f, \"max\": %.1f}\n",
+            h.samples(), us(h.min()), h.mean() / 1000, us(h.percentile(50)), us(h.percentile(90)),
+            us(h.percentile(99)), us(h.percentile(99.9)), us(h.percentile(99.99)), us(h.max()));
+    os << "}\n";
+}
+
+int main(int argc, char** argv) {
+    namespace bpo = boost::program_options;
+    app_template app;
+    app.add_options()
+        ("server", bpo::value<sstring>()->default_value("127.0.0.1:1883"), "The broker's address")
+        ("publishers", bpo::value<unsigned>()->default_value(1000), "Publishing connections")
+        ("subscribers", bpo::value<unsigned>()->default_value(1000), "Subscribing connections")
+        ("topics", bpo::value<unsigned>()->default_value(1000), "Distinct topics")
+        ("subscriptions", bpo::value<unsigned>()->default_value(1), "Filters per subscriber")
+        ("wildcard-ratio", bpo::value<double>()->default_value(0), "Fraction of filters matching a group of ten topics rather than one")
+        ("qos-mix", bpo::value<sstring>()->default_value("1,0,0"), "Relative weights of QoS 0, 1 and 2 publishes")
+        ("payload-size", bpo::value<sstring>()->default_value("64"), "Payload size in bytes, or min,max for a uniform spread")
+        ("rate", bpo::value<double>()->default_value(10), "Publishes per second per publisher; 0 for as many as flow control allows")
+        ("window", bpo::value<unsigned>()->default_value(16), "Unacknowledged QoS 1 and 2 publishes per publisher")
+        ("connect-concurrency", bpo::value<unsigned>()->default_value(64), "Connections each shard sets up at once")
+        ("warmup", bpo::value<unsigned>()->default_value(5), "Seconds of load before measuring")
+        ("duration", bpo::value<unsigned>()->default_value(30), "Seconds of measurement")
+        ("output", bpo::value<sstring>()->default_value(""), "File for the JSON results; standard output if empty");
+
+    distributed<load_shard> shards;
+    return app.run(argc, argv, [&] {
+        return seastar::async([&] {
+            auto&& opts = app.configuration();
+            load_config config;
+            config.server = ipv4_addr(opts["server"].as<sstring>());
+            config.publishers = opts["publishers"].as<unsigned>();
+            config.subscribers = opts["subscribers"].as<unsigned>();
+            config.topics = std::max(1u, opts["topics"].as<unsigned>());
+            config.subscriptions = opts["subscriptions"].as<unsigned>();
+            config.wildcard_ratio = std::min(1.0, std::max(0.0, opts["wildcard-ratio"].as<double>()));
+            std::vector<sstring> fields;
+            auto mix = opts["qos-mix"].as<sstring>();
+            boost::split(fields, mix, boost::is_any_of(","));
+            if (fields.size() != 3) {
+                throw std::invalid_argument("--qos-mix takes three weights");
+            }
+            for (unsigned q = 0; q < 3; ++q) {
+                config.qos_mix[q] = std::stod(fields[q]);
+            }
+            auto sizes = opts["payload-size"].as<sstring>();
+            boost::split(fields, sizes, boost::is_any_of(","));
+            config.min_payload = std::max(sizeof(payload_header), size_t(std::stoul(fields[0])));
+            config.max_payload = std::max(config.min_payload, size_t(std::stoul(fields.back())));
+            config.rate = opts["rate"].as<double>();
+            config.window = std::max(1u, opts["window"].as<unsigned>());
+            config.connect_concurrency = std::max(1u, opts["connect-concurrency"].as<unsigned>());
+            config.warmup = std::chrono::seconds(opts["warmup"].as<unsigned>());
+            config.duration = std::chrono::seconds(std::max(1u, opts["duration"].as<unsigned>()));
+
+            shards.start(config).get();
+            auto stop = defer([&] { shards.stop().get(); });
+
+            auto start = clock_type::now();
+            // Subscribers first, so that no message is published to nobody.
+            shards.invoke_on_all(&load_shard::connect_subscribers).get();
+            shards.invoke_on_all(&load_shard::connect_publishers).get();
+            std::chrono::duration<double> connect_time = clock_type::now() - start;
+
+            shards.invoke_on_all(&load_shard::start_publishing).get();
+            sleep(config.warmup).get();
+            shards.invoke_on_all(&load_shard::start_measuring).get();
+            start = clock_type::now();
+            sleep(config.duration).get();
+            shards.invoke_on_all(&load_shard::stop_measuring).get();
+            std::chrono::duration<double> measured = clock_type::now() - start;
+            shards.invoke_on_all(&load_shard::finish).get();
+
+            auto result = shards.map_reduce0(std::mem_fn(&load_shard::result), load_result(),
+                    [] (load_result a, const load_result& b) { return std::move(a += b); }).get0();
+            auto output = opts["output"].as<sstring>();
+            if (output.empty()) {
+                print_json(std::cout, config, result, connect_time.count(), measured.count());
+            } else {
+                std::ofstream f(output);
+                print_json(f, config, result, connect_time.count(), measured.count());
+            }
+            return 0;
+        });
+    });
+}
@@ -0,0 +1,75 @@
+/*
+ * This file is open source software, licensed to you under the terms
+ * of the Apache License, Version 2.0 (the "License").  See the NOTICE file
+ * distributed with this work for additional information regarding copyright
+ * ownership.  You may not use this file except in compliance with the License.
+ *
+ * You may obtain a copy of the License at
+ *
+ *   http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing,
+ * software distributed under the License is distributed on an
+ * "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+ * KIND, either express or implied.  See the License for the
+ * specific language governing permissions and limitations
+ * under the License.
+ */
+
+// The connection's send side: output_queue batching packets into writes
+// to a socket, here a sink which discards them.
+
+#include "tests/perf/perf.hh"
+#include "core/iostream.hh"
+#include "core/reactor.hh"
+#include "mqtt/encoder.hh"
+#include "admission.hh"
+#include "output_queue.hh"
+
+using namespace seastar;
+using namespace hero;
+
+class null_sink : public data_sink_impl {
+public:
+    virtual future<> put(net::packet data) override {
+        return make_ready_future<>();
+    }
+    virtual future<> close() override {
+        return make_ready_future<>();
+    }
+};
+
+// Pushes iterations copies of what make_packet returns, letting the queue
+// write at the end of every poll cycle of flush_packets packets.
+template <typename Func>
+static void push(size_t iterations, Func make_packet) {
+    output_stream<char> out(data_sink(std::make_unique<null_sink>()), 8192);
+    output_policy policy;
+    output_stats stats;
+    admission_control admission;
+    output_queue q(out, policy, stats, admission);
+    for (size_t i = 0; i < iterations; ++i) {
+        q.push(make_packet());
+        if ((i + 1) % policy.flush_packets == 0) {
+            later().get();
+        }
+    }
+    q.close().get();
+    out.close().get();
+}
+
+PERF_TEST(output, ack) {
+    push(iterations, [] {
+        return net::packet(mqtt::encode_ack(mqtt::protocol_version::v311, mqtt::packet_type::puback, 1));
+    });
+    return make_ready_future<>();
+}
+
+PERF_TEST(output, shared_payload) {
+    temporary_buffer<char> header(32);
+    temporary_buffer<char> payload(4096);
+    push(iterations, [&] {
+        return net::packet(net::packet(header.share()), payload.share());
+    });
+    return make_ready_future<>();
+}
@@ -0,0 +1,83 @@
+/*
+ * This file is open source software, licensed to you under the terms
+ * of the Apache License, Version 2.0 (the "License").  See the NOTICE file
+ * distributed with this work for additional information regarding copyright
+ * ownership.  You may not use this file except in compliance with the License.
+ *
+ * You may obtain a copy of the License at
+ *
+ *   http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing,
+ * software distributed under the License is distributed on an
+ * "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+ * KIND, either express or implied.  See the License for the
+ * specific language governing permissions and limitations
+ * under the License.
+ */
+
+// Cross-shard traffic.  Needs at least two shards (-c2).
+
+#include "tests/perf/perf.hh"
+#include "core/future-util.hh"
+#include "core/reactor.hh"
+#include "core/smp.hh"
+#include "fanout.hh"
+#include "message.hh"
+
+#include <boost/range/irange.hpp>
+
+#include <stdexcept>
+
+using namespace seastar;
+using namespace hero;
+
+static unsigned other_shard() {
+    if (smp::count < 2) {
+        throw std::runtime_error("cross-shard benchmarks need at least two shards");
+    }
+    return (engine().cpu_id() + 1) % smp::count;
+}
+
+PERF_TEST(smp, submit_to_round_trip) {
+    auto shard = other_shard();
+    for (size_t i = 0; i < iterations; ++i) {
+        smp::submit_to(shard, [] {}).get();
+    }
+    return make_ready_future<>();
+}
+
+PERF_TEST(smp, submit_to_pipelined) {
+    // 128 calls in flight at a time.
+    auto shard = other_shard();
+    for (size_t done = 0; done < iterations; done += 128) {
+        auto n = std::min<size_t>(128, iterations - done);
+        parallel_for_each(boost::irange<size_t>(0, n), [shard] (size_t) {
+            return smp::submit_to(shard, [] {});
+        }).get();
+    }
+    return make_ready_future<>();
+}
+
+PERF_TEST(fanout, enqueue) {
+    // Messages batched per poll cycle, as publishes to another shard's
+    // subscribers are.
+    auto shard = other_shard();
+    fanout f([] (unsigned shard, fanout::batch&& b) {
+        return smp::submit_to(shard, [b = std::move(b)] () mutable {
+            return std::move(b);
+        });
+    });
+    auto msg = make_lw_shared<message>();
+    msg->topic = temporary_buffer<char>(16);
+    msg->payload = temporary_buffer<char>(64);
+    for (size_t i = 0; i < iterations; ++i) {
+        f.enqueue(shard, msg);
+        if ((i + 1) % 256 == 0) {
+            later().get();
+        }
+    }
+    f.flush();
+    f.stop().get();
+    return make_ready_future<>();
+}
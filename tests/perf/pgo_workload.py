@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+#
+# This file is open source software, licensed to you under the terms
+# of the Apache License, Version 2.0 (the "License").  See the NOTICE file
+# distributed with this work for additional information regarding copyright
+# ownership.  You may not use this file except in compliance with the License.
+#
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+
+# The training workload of the release-pgo build mode.
+#
+# Starts the given (instrumented) broker, drives it with a mix of the
+# traffic it is tuned for, and stops it cleanly so that it writes its
+# profile.  The mix matters more than the volume: MQTT 3.1.1 and 5
+# clients, exact and wildcard subscriptions, QoS 0, 1 and 2, small and
+# large payloads, retained messages, persistent sessions and reconnects.
+
+import argparse
+import asyncio
+import os
+import random
+import shutil
+import signal
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+V311 = 4
+V5 = 5
+
+
+def varint(n):
+    out = bytearray()
+    while True:
+        b = n % 128
+        n //= 128
+        out.append(b | (0x80 if n else 0))
+        if not n:
+            return bytes(out)
+
+
+def string(s):
+    b = s.encode()
+    return struct.pack('!H', len(b)) + b
+
+
+def packet(first, body, version = V311, properties = None):
+    if properties is not None and version == V5:
+        body = body[0] + varint(len(properties)) + properties + body[1]
+    elif isinstance(body, tuple):
+        body = body[0] + body[1]
+    return bytes([first]) + varint(len(body)) + body
+
+
+def connect(client_id, version, clean = True):
+    flags = 0x02 if clean else 0
+    header = string('MQTT') + bytes([version, flags]) + struct.pack('!H', 60)
+    return packet(0x10, (header, string(client_id)), version, b'')
+
+
+def publish(topic, payload, qos, packet_id, version, retain = False):
+    first = 0x30 | (qos << 1) | (1 if retain else 0)
+    head = string(topic) + (struct.pack('!H', packet_id) if qos else b'')
+    return packet(first, (head, payload), version, b'')
+
+
+def subscribe(packet_id, filters, version):
+    body = b''.join(string(f) + bytes([q]) for f, q in filters)
+    return packet(0x82, (struct.pack('!H', packet_id), body), version, b'')
+
+
+def unsubscribe(packet_id, filters, version):
+    body = b''.join(string(f) for f in filters)
+    return packet(0xa2, (struct.pack('!H', packet_id), body), version, b'')
+
+
+def ack(kind, packet_id):
+    first = {'puback': 0x40, 'pubrec': 0x50, 'pubrel': 0x62, 'pubcomp': 0x70}[kind]
+    return bytes([first, 2]) + struct.pack('!H', packet_id)
+
+
+class Client:
+    def __init__(self, client_id, version):
+        self.client_id = client_id
+        self.version = version
+        self.next_id = 1
+        self.replies = asyncio.Queue()
+
+    async def open(self, port, clean = True):
+        self.reader, self.writer = await asyncio.open_connection('127.0.0.1', port)
+        self.writer.write(connect(self.client_id, self.version, clean))
+        self.task = asyncio.ensure_future(self.read_loop())
+        await self.replies.get()
+
+    def packet_id(self):
+        pid = self.next_id
+        self.next_id = self.next_id % 65535 + 1
+        return pid
+
+    async def read_loop(self):
+        try:
+            while True:
+                first = (await self.reader.readexactly(1))[0]
+                length, shift = 0, 0
+                while True:
+                    b = (await self.reader.readexactly(1))[0]
+                    length |= (b & 0x7f) << shift
+                    shift += 7
+                    if not b & 0x80:
+                        break
+                body = await self.reader.readexactly(length)
+                kind = first >> 4
+                if kind == 3:
+                    qos = (first >> 1) & 3
+                    if qos:
+                        topic_len = struct.unpack('!H', body[:2])[0]
+                        pid = struct.unpack('!H', body[2 + topic_len:4 + topic_len])[0]
+                        self.writer.write(ack('puback' if qos == 1 else 'pubrec', pid))
+                elif kind == 5:
+                    self.writer.write(ack('pubrel', struct.unpack('!H', body[:2])[0]))
+                elif kind == 6:
+                    self.writer.write(ack('pubcomp', struct.unpack('!H', body[:2])[0]))
+                elif kind in (2, 9, 11, 13):
+                    # CONNACK, SUBACK, UNSUBACK and PINGRESP answer requests.
+                    self.replies.put_nowait(kind)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+
+    async def subscribe(self, filters):
+        self.writer.write(subscribe(self.packet_id(), filters, self.version))
+        await self.replies.get()
+
+    async def unsubscribe(self, filters):
+        self.writer.write(unsubscribe(self.packet_id(), filters, self.version))
+        await self.replies.get()
+
+    def publish(self, topic, payload, qos, retain = False):
+        pid = self.packet_id() if qos else 0
+        self.writer.write(publish(topic, payload, qos, pid, self.version, retain))
+
+    async def ping(self):
+        self.writer.write(bytes([0xc0, 0]))
+        await self.replies.get()
+
+    async def close(self):
+        await self.writer.drain()
+        self.writer.write(bytes([0xe0, 0]))
+        self.writer.close()
+        await self.task
+
+
+def topic(i):
+    return 'site/{}/device/{}/telemetry'.format(i % 16, i)
+
+
+async def round_of_traffic(port, rng, clients, messages):
+    # Subscribers: exact topics, single and multi level wildcards.
+    subs = []
+    for i in range(clients):
+        c = Client('sub-{}'.format(i), V5 if i % 3 == 0 else V311)
+        await c.open(port, clean = i % 4 != 0)
+        kind = i % 3
+        if kind == 0:
+            filters = [(topic(i), 2)]
+        elif kind == 1:
+            filters = [('site/{}/device/+/telemetry'.format(i % 16), 1)]
+        else:
+            filters = [('site/{}/#'.format(i % 16), 0)]
+        await c.subscribe(filters)
+        subs.append(c)
+    pubs = []
+    for i in range(clients):
+        c = Client('pub-{}'.format(i), V5 if i % 2 else V311)
+        await c.open(port)
+        pubs.append(c)
+    for n in range(messages):
+        c = pubs[n % len(pubs)]
+        size = rng.choice([16, 64, 200, 1024, 8192])
+        c.publish(topic(rng.randrange(clients * 2)), os.urandom(size), rng.choice([0, 0, 0, 1, 1, 2]),
+                  retain = n % 97 == 0)
+        if n % 256 == 0:
+            await asyncio.gather(*(p.writer.drain() for p in pubs))
+            await c.ping()
+    # Late subscribers get the retained messages.
+    late = Client('late', V5)
+    await late.open(port)
+    await late.subscribe([('site/+/device/+/telemetry', 1)])
+    await late.unsubscribe(['site/+/device/+/telemetry'])
+    await asyncio.sleep(0.5)
+    for c in subs + pubs + [late]:
+        await c.close()
+
+
+async def run(port, rounds, clients, messages):
+    rng = random.Random(1)
+    for _ in range(rounds):
+        # Persistent sessions from the previous round are taken over.
+        await round_of_traffic(port, rng, clients, messages)
+
+
+def wait_for_port(port, proc, timeout):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError('broker exited with status {}'.format(proc.returncode))
+        try:
+            loop = asyncio.new_event_loop()
+            _, w = loop.run_until_complete(asyncio.open_connection('127.0.0.1', port))
+            w.close()
+            loop.close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError('broker did not start listening')
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Run the PGO training workload against a broker')
+    parser.add_argument('--hero', required = True, help = 'Broker binary to train')
+    parser.add_argument('--port', type = int, default = 18830)
+    parser.add_argument('--smp', type = int, default = 2)
+    parser.add_argument('--memory', default = '1G')
+    parser.add_argument('--rounds', type = int, default = 3)
+    parser.add_argument('--clients', type = int, default = 100)
+    parser.add_argument('--messages', type = int, default = 50000)
+    args = parser.parse_args()
+
+    data_dir = tempfile.mkdtemp(prefix = 'hero-pgo-')
+    proc = subprocess.Popen([args.hero, '--port', str(args.port), '--metrics-port', '0',
+                             '--data-dir', data_dir, '-c', str(args.smp), '-m', args.memory])
+    try:
+        wait_for_port(args.port, proc, 30)
+        loop = asyncio.new_event_loop()
+        loop.run_until_complete(run(args.port, args.rounds, args.clients, args.messages))
+        loop.close()
+    finally:
+        # The profile is written as the broker exits.
+        if proc.poll() is None:
+            proc.send_signal(signal.SIGINT)
+        status = proc.wait()
+        shutil.rmtree(data_dir, ignore_errors = True)
+    if status != 0:
+        print('broker exited with status {}'.format(status))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
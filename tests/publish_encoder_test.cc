@@ -0,0 +1,206 @@
+/*
+ * This file is open source software, licensed to you under the terms
+ * of the Apache License, Version 2.0 (the "License").  See the NOTICE file
+ * distributed with this work for additional information regarding copyright
+ * ownership.  You may not use this file except in compliance with the License.
+ *
+ * You may obtain a copy of the License at
+ *
+ *   http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing,
+ * software distributed under the License is distributed on an
+ * "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+ * KIND, either express or implied.  See the License for the
+ * specific language governing permissions and limitations
+ * under the License.
+ */
+
+
+#define BOOST_TEST_MODULE publish_encoder
+
+#include <boost/test/unit_test.hpp>
+
+#include "publish_encoder.hh"
+#include "mqtt/decoder.hh"
+
+#include <string>
+
+using namespace seastar;
+using namespace hero;
+
+static message make_message(std::string_view topic, std::string_view payload) {
+    message m;
+    m.topic = temporary_buffer<char>(topic.data(), topic.size());
+    m.payload = temporary_buffer<char>(payload.data(), payload.size());
+    m.qos = mqtt::qos::at_least_once;
+    m.retain = false;
+    m.origin_shard = 0;
+    m.origin = 0;
+    return m;
+}
+
+static delivery qos1(uint16_t packet_id) {
+    delivery d;
+    d.qos = mqtt::qos::at_least_once;
+    d.packet_id = packet_id;
+    return d;
+}
+
+// Decodes what the encoder built, as the client would.
+static mqtt::publish decode(const encoded_publish& e, mqtt::protocol_version v = mqtt::protocol_version::v5) {
+    std::string bytes;
+    for (unsigned i = 0; i < e.packet.nr_frags(); ++i) {
+        auto f = e.packet.frag(i);
+        bytes.append(f.base, f.size);
+    }
+    mqtt::decoder d;
+    std::vector<mqtt::packet> out;
+    d.feed(temporary_buffer<char>(bytes.data(), bytes.size()), out);
+    BOOST_REQUIRE_EQUAL(out.size(), 1u);
+    BOOST_REQUIRE(d.idle());
+    return mqtt::parse_publish(std::move(out[0]), v);
+}
+
+static std::string_view topic_of(const mqtt::publish& p) {
+    return mqtt::as_string_view(p.topic);
+}
+
+static uint16_t alias_of(const mqtt::publish& p) {
+    return p.properties.topic_alias ? *p.properties.topic_alias : 0;
+}
+
+BOOST_AUTO_TEST_CASE(test_alias_sent_once) {
+    output_stats stats;
+    publish_encoder pe(stats, 4);
+    pe.start(mqtt::protocol_version::v5, 10);
+    auto a = make_message("site/a", "1");
+    auto b = make_message("site/b", "2");
+
+    auto e = pe.encode(a, qos1(1));
+    BOOST_REQUIRE(e.sets_alias);
+    auto p = decode(e);
+    BOOST_REQUIRE(topic_of(p) == "site/a");
+    BOOST_REQUIRE_EQUAL(alias_of(p), 1);
+
+    e = pe.encode(a, qos1(2));
+    BOOST_REQUIRE(!e.sets_alias);
+    p = decode(e);
+    BOOST_REQUIRE(p.topic.empty());
+    BOOST_REQUIRE_EQUAL(alias_of(p), 1);
+    BOOST_REQUIRE_EQUAL(p.packet_id, 2);
+    BOOST_REQUIRE(mqtt::as_string_view(p.payload) == "1");
+
+    e = pe.encode(b, qos1(3));
+    BOOST_REQUIRE(e.sets_alias);
+    p = decode(e);
+    BOOST_REQUIRE(topic_of(p) == "site/b");
+    BOOST_REQUIRE_EQUAL(alias_of(p), 2);
+    BOOST_REQUIRE_EQUAL(stats.topic_alias_hits, 1u);
+}
+
+BOOST_AUTO_TEST_CASE(test_alias_maximum) {
+    output_stats stats;
+    publish_encoder pe(stats, 4);
+    pe.start(mqtt::protocol_version::v5, 1);
+    auto a = make_message("site/a", "1");
+    auto b = make_message("site/b", "2");
+
+    BOOST_REQUIRE_EQUAL(alias_of(decode(pe.encode(a, qos1(1)))), 1);
+    // Out of aliases: b always goes out in full.
+    for (uint16_t id = 2; id < 4; ++id) {
+        auto e = pe.encode(b, qos1(id));
+        BOOST_REQUIRE(!e.sets_alias);
+        auto p = decode(e);
+        BOOST_REQUIRE(topic_of(p) == "site/b");
+        BOOST_REQUIRE_EQUAL(alias_of(p), 0);
+    }
+}
+
+BOOST_AUTO_TEST_CASE(test_eviction_recycles_alias) {
+    output_stats stats;
+    publish_encoder pe(stats, 2);
+    pe.start(mqtt::protocol_version::v5, 10);
+    auto a = make_message("site/a", "1");
+    auto b = make_message("site/b", "2");
+    auto c = make_message("site/c", "3");
+
+    BOOST_REQUIRE_EQUAL(alias_of(decode(pe.encode(a, qos1(1)))), 1);
+    BOOST_REQUIRE_EQUAL(alias_of(decode(pe.encode(b, qos1(2)))), 2);
+    // a is now the most recently used, so c evicts b and takes its alias.
+    pe.encode(a, qos1(3));
+    auto e = pe.encode(c, qos1(4));
+    BOOST_REQUIRE(e.sets_alias);
+    auto p = decode(e);
+    BOOST_REQUIRE(topic_of(p) == "site/c");
+    BOOST_REQUIRE_EQUAL(alias_of(p), 2);
+    BOOST_REQUIRE_EQUAL(pe.topics(), 2u);
+
+    // b comes back in full, with the alias a had.
+    e = pe.encode(b, qos1(5));
+    BOOST_REQUIRE(e.sets_alias);
+    p = decode(e);
+    BOOST_REQUIRE(topic_of(p) == "site/b");
+    BOOST_REQUIRE_EQUAL(alias_of(p), 1);
+
+    p = decode(pe.encode(c, qos1(6)));
+    BOOST_REQUIRE(p.topic.empty());
+    BOOST_REQUIRE_EQUAL(alias_of(p), 2);
+}
+
+BOOST_AUTO_TEST_CASE(test_dropped_alias_sent_again) {
+    output_stats stats;
+    publish_encoder pe(stats, 4);
+    pe.start(mqtt::protocol_version::v5, 10);
+    auto a = make_message("site/a", "1");
+
+    BOOST_REQUIRE(pe.encode(a, qos1(1)).sets_alias);
+    pe.dropped("site/a");
+    auto e = pe.encode(a, qos1(2));
+    BOOST_REQUIRE(e.sets_alias);
+    auto p = decode(e);
+    BOOST_REQUIRE(topic_of(p) == "site/a");
+    BOOST_REQUIRE_EQUAL(alias_of(p), 1);
+    BOOST_REQUIRE(decode(pe.encode(a, qos1(3))).topic.empty());
+}
+
+BOOST_AUTO_TEST_CASE(test_no_aliases) {
+    auto a = make_message("site/a", "1");
+    auto check = [&] (size_t capacity, mqtt::protocol_version v, uint16_t alias_maximum) {
+        output_stats stats;
+        publish_encoder pe(stats, capacity);
+        pe.start(v, alias_maximum);
+        for (uint16_t id = 1; id < 4; ++id) {
+            auto e = pe.encode(a, qos1(id));
+            BOOST_REQUIRE(!e.sets_alias);
+            auto p = decode(e, v);
+            BOOST_REQUIRE(topic_of(p) == "site/a");
+            BOOST_REQUIRE_EQUAL(alias_of(p), 0);
+            BOOST_REQUIRE_EQUAL(p.packet_id, id);
+        }
+    };
+    check(4, mqtt::protocol_version::v311, 10);
+    check(4, mqtt::protocol_version::v5, 0);
+    check(0, mqtt::protocol_version::v5, 10);
+}
+
+BOOST_AUTO_TEST_CASE(test_header_reuse) {
+    output_stats stats;
+    publish_encoder pe(stats, 4);
+    pe.start(mqtt::protocol_version::v311, 0);
+    auto first = make_message("site/a", "12345");
+    auto second = make_message("site/a", "abcde");
+
+    decode(pe.encode(first, qos1(1)), mqtt::protocol_version::v311);
+    auto p = decode(pe.encode(second, qos1(2)), mqtt::protocol_version::v311);
+    BOOST_REQUIRE_EQUAL(stats.header_cache_hits, 1u);
+    BOOST_REQUIRE_EQUAL(p.packet_id, 2);
+    BOOST_REQUIRE(topic_of(p) == "site/a");
+    BOOST_REQUIRE(mqtt::as_string_view(p.payload) == "abcde");
+
+    // A different payload size needs a new header.
+    auto longer = make_message("site/a", "123456");
+    p = decode(pe.encode(longer, qos1(3)), mqtt::protocol_version::v311);
+    BOOST_REQUIRE_EQUAL(stats.header_cache_hits, 1u);
+    BOOST_REQUIRE(mqtt::as_string_view(p.payload) == "123456");
+}
@@ -0,0 +1,143 @@
+/*
+ * This file is open source software, licensed to you under the terms
+ * of the Apache License, Version 2.0 (the "License").  See the NOTICE file
+ * distributed with this work for additional information regarding copyright
+ * ownership.  You may not use this file except in compliance with the License.
+ *
+ * You may obtain a copy of the License at
+ *
+ *   http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing,
+ * software distributed under the License is distributed on an
+ * "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+ * KIND, either express or implied.  See the License for the
+ * specific language governing permissions and limitations
+ * under the License.
+ */
+
+
+#include "tests/test-utils.hh"
+#include "core/print.hh"
+#include "core/reactor.hh"
+#include "core/thread.hh"
+#include "segment_log.hh"
+
+#include <boost/filesystem.hpp>
+
+#include <cstring>
+#include <fstream>
+#include <vector>
+
+using namespace seastar;
+using namespace hero;
+
+namespace fs = boost::filesystem;
+
+// A log directory removed with everything in it once the test is done.
+class scratch_directory {
+    fs::path _path;
+public:
+    scratch_directory() : _path(fs::temp_directory_path() / fs::unique_path("hero-log-%%%%-%%%%")) {
+        fs::create_directories(_path);
+    }
+    ~scratch_directory() {
+        fs::remove_all(_path);
+    }
+    sstring path() const { return _path.string(); }
+    // The file holding segment id of this shard's log.
+    std::string segment(uint64_t id) const {
+        auto name = sprint("shard-%d/%016x.log", engine().cpu_id(), id);
+        return (_path / name.c_str()).string();
+    }
+};
+
+static log_config config(const scratch_directory& dir) {
+    log_config cfg;
+    cfg.directory = dir.path();
+    return cfg;
+}
+
+static temporary_buffer<char> record(const char* s) {
+    return temporary_buffer<char>(s, std::strlen(s));
+}
+
+// Opens the log, keeping every record replayed live, appends records and
+// stops it.  Returns the replayed records.
+static std::vector<sstring> reopen(const scratch_directory& dir, std::vector<const char*> append = {},
+        bool retain = true) {
+    segment_log log(config(dir), {});
+    std::vector<sstring> replayed;
+    log.replay([&] (uint64_t segment, temporary_buffer<char> r) {
+        replayed.emplace_back(r.get(), r.size());
+        if (retain) {
+            log.retain(segment);
+        }
+    }).get();
+    log.start().get();
+    for (auto r : append) {
+        log.append(record(r)).get();
+    }
+    log.stop().get();
+    return replayed;
+}
+
+// The records of the first test segment: 8 bytes of header each, so "two"
+// starts at 11 and "three" at 22 and ends at 35.
+static const std::vector<const char*> three_records = {"one", "two", "three"};
+
+SEASTAR_TEST_CASE(test_replay) {
+    return seastar::async([] {
+        scratch_directory dir;
+        BOOST_REQUIRE(reopen(dir, three_records).empty());
+        BOOST_REQUIRE((reopen(dir, {"four"}) == std::vector<sstring>{"one", "two", "three"}));
+        BOOST_REQUIRE((reopen(dir) == std::vector<sstring>{"one", "two", "three", "four"}));
+    });
+}
+
+SEASTAR_TEST_CASE(test_torn_tail) {
+    return seastar::async([] {
+        scratch_directory dir;
+        reopen(dir, three_records);
+        // A crash in the middle of writing "three".
+        fs::resize_file(dir.segment(0), 30);
+        BOOST_REQUIRE((reopen(dir, {"four"}) == std::vector<sstring>{"one", "two"}));
+        // Appends after the torn record went to a new segment and survive.
+        BOOST_REQUIRE((reopen(dir) == std::vector<sstring>{"one", "two", "four"}));
+    });
+}
+
+SEASTAR_TEST_CASE(test_torn_header) {
+    return seastar::async([] {
+        scratch_directory dir;
+        reopen(dir, three_records);
+        // Only part of the header of "three" made it.
+        fs::resize_file(dir.segment(0), 26);
+        BOOST_REQUIRE((reopen(dir) == std::vector<sstring>{"one", "two"}));
+    });
+}
+
+SEASTAR_TEST_CASE(test_bad_checksum) {
+    return seastar::async([] {
+        scratch_directory dir;
+        reopen(dir, three_records);
+        {
+            std::fstream f(dir.segment(0), std::ios::in | std::ios::out | std::ios::binary);
+            f.seekp(19);
+            f.put('T');
+        }
+        // Nothing after the damaged record is trusted.
+        BOOST_REQUIRE((reopen(dir) == std::vector<sstring>{"one"}));
+    });
+}
+
+SEASTAR_TEST_CASE(test_dead_segments_deleted) {
+    return seastar::async([] {
+        scratch_directory dir;
+        reopen(dir, three_records);
+        // Nothing replayed is kept, so starting deletes the old segment.
+        BOOST_REQUIRE_EQUAL(reopen(dir, {}, false).size(), 3u);
+        BOOST_REQUIRE(!fs::exists(dir.segment(0)));
+        BOOST_REQUIRE(reopen(dir).empty());
+    });
+}
@@ -0,0 +1,189 @@
+/*
+ * This file is open source software, licensed to you under the terms
+ * of the Apache License, Version 2.0 (the "License").  See the NOTICE file
+ * distributed with this work for additional information regarding copyright
+ * ownership.  You may not use this file except in compliance with the License.
+ *
+ * You may obtain a copy of the License at
+ *
+ *   http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing,
+ * software distributed under the License is distributed on an
+ * "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+ * KIND, either express or implied.  See the License for the
+ * specific language governing permissions and limitations
+ * under the License.
+ */
+
+
+#define BOOST_TEST_MODULE subscription_index
+
+#include <boost/test/unit_test.hpp>
+
+#include "subscription_index.hh"
+
+#include <set>
+
+using namespace hero;
+
+static std::set<subscriber_id> matches(subscription_index& idx, std::string_view topic) {
+    std::set<subscriber_id> ids;
+    for (auto&& m : *idx.match(topic)) {
+        ids.insert(m.id);
+    }
+    return ids;
+}
+
+static subscription_options with_qos(mqtt::qos q, uint32_t identifier = 0) {
+    subscription_options o;
+    o.max_qos = q;
+    o.subscription_identifier = identifier;
+    return o;
+}
+
+BOOST_AUTO_TEST_CASE(test_wildcards) {
+    subscription_index idx;
+    subscription_options o;
+    idx.subscribe("a/b/c", 1, o);
+    idx.subscribe("a/+/c", 2, o);
+    idx.subscribe("a/#", 3, o);
+    idx.subscribe("#", 4, o);
+    idx.subscribe("+/b/+", 5, o);
+    idx.subscribe("+/+", 6, o);
+
+    BOOST_REQUIRE((matches(idx, "a/b/c") == std::set<subscriber_id>{1, 2, 3, 4, 5}));
+    BOOST_REQUIRE((matches(idx, "a/x/c") == std::set<subscriber_id>{2, 3, 4}));
+    // '#' also matches its parent level.
+    BOOST_REQUIRE((matches(idx, "a") == std::set<subscriber_id>{3, 4}));
+    BOOST_REQUIRE((matches(idx, "a/b") == std::set<subscriber_id>{3, 4, 6}));
+    BOOST_REQUIRE((matches(idx, "a/b/c/d") == std::set<subscriber_id>{3, 4}));
+    // Empty levels are levels too.
+    BOOST_REQUIRE((matches(idx, "/") == std::set<subscriber_id>{4, 6}));
+    BOOST_REQUIRE((matches(idx, "x/b/") == std::set<subscriber_id>{4, 5}));
+}
+
+BOOST_AUTO_TEST_CASE(test_system_topics) {
+    subscription_index idx;
+    subscription_options o;
+    idx.subscribe("#", 1, o);
+    idx.subscribe("+/broker/load", 2, o);
+    idx.subscribe("$SYS/#", 3, o);
+    idx.subscribe("$SYS/+/load", 4, o);
+    idx.subscribe("a/$x", 5, o);
+
+    // Wildcards at the first level skip topics starting with '$'.
+    BOOST_REQUIRE((matches(idx, "$SYS/broker/load") == std::set<subscriber_id>{3, 4}));
+    BOOST_REQUIRE((matches(idx, "x/broker/load") == std::set<subscriber_id>{1, 2}));
+    BOOST_REQUIRE((matches(idx, "a/$x") == std::set<subscriber_id>{1, 5}));
+}
+
+BOOST_AUTO_TEST_CASE(test_overlapping_filters_merge) {
+    subscription_index idx;
+    BOOST_REQUIRE(idx.subscribe("a/+", 1, with_qos(mqtt::qos::at_most_once, 10)));
+    BOOST_REQUIRE(idx.subscribe("a/#", 1, with_qos(mqtt::qos::exactly_once, 11)));
+    BOOST_REQUIRE(idx.subscribe("a/b", 2, with_qos(mqtt::qos::at_least_once)));
+
+    auto r = idx.match("a/b");
+    BOOST_REQUIRE_EQUAL(r->size(), 2u);
+    BOOST_REQUIRE_EQUAL((*r)[0].id, 1u);
+    BOOST_REQUIRE((*r)[0].options.max_qos == mqtt::qos::exactly_once);
+    BOOST_REQUIRE_EQUAL((*r)[0].options.subscription_identifier, 11u);
+    BOOST_REQUIRE_EQUAL((*r)[1].id, 2u);
+
+    // Subscribing again updates the subscription rather than adding one.
+    BOOST_REQUIRE(!idx.subscribe("a/b", 2, with_qos(mqtt::qos::exactly_once)));
+    BOOST_REQUIRE_EQUAL(idx.size(), 3u);
+    BOOST_REQUIRE(idx.match("a/b")->back().options.max_qos == mqtt::qos::exactly_once);
+}
+
+BOOST_AUTO_TEST_CASE(test_cache_invalidation) {
+    subscription_index idx;
+    subscription_options o;
+    idx.subscribe("a/+", 1, o);
+
+    auto first = idx.match("a/b");
+    BOOST_REQUIRE(idx.match("a/b") == first);
+    BOOST_REQUIRE_EQUAL(idx.get_stats().cache_hits, 1u);
+    BOOST_REQUIRE_EQUAL(idx.get_stats().cache_misses, 1u);
+
+    idx.subscribe("a/b", 2, o);
+    BOOST_REQUIRE((matches(idx, "a/b") == std::set<subscriber_id>{1, 2}));
+    BOOST_REQUIRE_EQUAL(idx.get_stats().cache_misses, 2u);
+    // Results handed out earlier are left as they were.
+    BOOST_REQUIRE_EQUAL(first->size(), 1u);
+
+    BOOST_REQUIRE(idx.unsubscribe("a/+", 1));
+    BOOST_REQUIRE((matches(idx, "a/b") == std::set<subscriber_id>{2}));
+    BOOST_REQUIRE_EQUAL(idx.get_stats().cache_misses, 3u);
+
+    // Unsubscribing from nothing keeps the cache.
+    BOOST_REQUIRE(!idx.unsubscribe("a/+", 1));
+    idx.match("a/b");
+    BOOST_REQUIRE_EQUAL(idx.get_stats().cache_misses, 3u);
+}
+
+BOOST_AUTO_TEST_CASE(test_cache_invalidation_is_selective) {
+    subscription_index idx;
+    subscription_options o;
+    idx.subscribe("a/+", 1, o);
+    idx.subscribe("$SYS/#", 2, o);
+    idx.match("a/x");
+    idx.match("$SYS/load");
+    auto misses = idx.get_stats().cache_misses;
+
+    // A filter on another first level leaves both cached.
+    idx.subscribe("b/x", 3, o);
+    idx.match("a/x");
+    idx.match("$SYS/load");
+    BOOST_REQUIRE_EQUAL(idx.get_stats().cache_misses, misses);
+
+    // One on the same first level invalidates the topics under it.
+    idx.subscribe("a/x", 4, o);
+    BOOST_REQUIRE((matches(idx, "a/x") == std::set<subscriber_id>{1, 4}));
+    BOOST_REQUIRE_EQUAL(idx.get_stats().cache_misses, misses + 1);
+
+    // One starting with a wildcard invalidates every topic but those
+    // starting with '$', which it cannot match.
+    idx.subscribe("+/x", 5, o);
+    BOOST_REQUIRE((matches(idx, "a/x") == std::set<subscriber_id>{1, 4, 5}));
+    BOOST_REQUIRE((matches(idx, "$SYS/load") == std::set<subscriber_id>{2}));
+    BOOST_REQUIRE_EQUAL(idx.get_stats().cache_misses, misses + 2);
+
+    BOOST_REQUIRE(idx.unsubscribe("+/x", 5));
+    BOOST_REQUIRE((matches(idx, "a/x") == std::set<subscriber_id>{1, 4}));
+}
+
+BOOST_AUTO_TEST_CASE(test_cache_eviction) {
+    subscription_index idx(2);
+    idx.subscribe("#", 1, subscription_options());
+    idx.match("a");
+    idx.match("b");
+    idx.match("a");
+    // "b" is the least recently used.
+    idx.match("c");
+    BOOST_REQUIRE_EQUAL(idx.cache().size(), 2u);
+    auto misses = idx.get_stats().cache_misses;
+    idx.match("a");
+    BOOST_REQUIRE_EQUAL(idx.get_stats().cache_misses, misses);
+    idx.match("b");
+    BOOST_REQUIRE_EQUAL(idx.get_stats().cache_misses, misses + 1);
+}
+
+BOOST_AUTO_TEST_CASE(test_prune) {
+    subscription_index idx;
+    subscription_options o;
+    const char* filters[] = {"a/b/c", "a/+/c", "a/#", "#", "$SYS/+"};
+    for (auto f : filters) {
+        idx.subscribe(f, 1, o);
+        idx.subscribe(f, 2, o);
+    }
+    for (auto f : filters) {
+        BOOST_REQUIRE(idx.unsubscribe(f, 1));
+        BOOST_REQUIRE(idx.unsubscribe(f, 2));
+    }
+    BOOST_REQUIRE_EQUAL(idx.size(), 0u);
+    BOOST_REQUIRE_EQUAL(idx.trie().nodes(), 1u);
+    BOOST_REQUIRE_EQUAL(idx.trie().levels(), 0u);
+    BOOST_REQUIRE(idx.match("a/b/c")->empty());
+}
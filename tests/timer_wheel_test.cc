@@ -0,0 +1,151 @@
+/*
+ * This file is open source software, licensed to you under the terms
+ * of the Apache License, Version 2.0 (the "License").  See the NOTICE file
+ * distributed with this work for additional information regarding copyright
+ * ownership.  You may not use this file except in compliance with the License.
+ *
+ * You may obtain a copy of the License at
+ *
+ *   http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing,
+ * software distributed under the License is distributed on an
+ * "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+ * KIND, either express or implied.  See the License for the
+ * specific language governing permissions and limitations
+ * under the License.
+ */
+
+
+#define BOOST_TEST_MODULE timer_wheel
+
+#include <boost/test/unit_test.hpp>
+
+#include "timer_wheel.hh"
+
+#include <memory>
+#include <random>
+#include <vector>
+
+using namespace std::chrono_literals;
+
+namespace hero {
+
+class timer_wheel_tester {
+public:
+    // Runs every tick up to and including tick, as the reactor's timer
+    // would once that many resolutions have passed.
+    static void run_until(timer_wheel& w, uint64_t tick) {
+        while (w._now <= tick) {
+            w.run_tick();
+        }
+    }
+    static uint64_t now(const timer_wheel& w) {
+        return w._now;
+    }
+};
+
+}
+
+using namespace hero;
+using tester = timer_wheel_tester;
+
+BOOST_AUTO_TEST_CASE(test_fires_on_deadline) {
+    timer_wheel w(100ms);
+    unsigned fired = 0;
+    wheel_timer t([&] { ++fired; });
+    // Rounded up to 3 ticks.
+    w.arm(t, 250ms);
+    tester::run_until(w, 2);
+    BOOST_REQUIRE_EQUAL(fired, 0u);
+    BOOST_REQUIRE(t.armed());
+    tester::run_until(w, 3);
+    BOOST_REQUIRE_EQUAL(fired, 1u);
+    BOOST_REQUIRE(!t.armed());
+    tester::run_until(w, 1000);
+    BOOST_REQUIRE_EQUAL(fired, 1u);
+    BOOST_REQUIRE_EQUAL(w.expired(), 1u);
+}
+
+BOOST_AUTO_TEST_CASE(test_cascade) {
+    timer_wheel w(1ms);
+    // One timer on the root wheel and one on each coarser level, none of
+    // them aligned to a slot boundary.
+    const std::vector<uint64_t> delays = {200, 300, 20000, 3000000, 200000000};
+    std::vector<uint64_t> fired(delays.size());
+    std::vector<std::unique_ptr<wheel_timer>> timers;
+    for (size_t i = 0; i < delays.size(); ++i) {
+        timers.emplace_back(std::make_unique<wheel_timer>([&, i] { fired[i] = tester::now(w) - 1; }));
+    }
+    // Start off the tick 0 boundary too.
+    tester::run_until(w, 99);
+    for (size_t i = 0; i < delays.size(); ++i) {
+        w.arm(*timers[i], std::chrono::milliseconds(delays[i]));
+    }
+    for (size_t i = 0; i < delays.size(); ++i) {
+        auto due = 100 + delays[i];
+        tester::run_until(w, due - 1);
+        BOOST_REQUIRE(timers[i]->armed());
+        tester::run_until(w, due);
+        BOOST_REQUIRE(!timers[i]->armed());
+        BOOST_REQUIRE_EQUAL(fired[i], due);
+    }
+}
+
+BOOST_AUTO_TEST_CASE(test_many_timers) {
+    timer_wheel w(1ms);
+    std::mt19937_64 rng(1);
+    const size_t n = 20000;
+    std::vector<std::unique_ptr<wheel_timer>> timers;
+    std::vector<uint64_t> due(n), fired(n);
+    for (size_t i = 0; i < n; ++i) {
+        timers.emplace_back(std::make_unique<wheel_timer>([&, i] { fired[i] = tester::now(w) - 1; }));
+    }
+    for (size_t i = 0; i < n; ++i) {
+        uint64_t delay = 1 + rng() % (i % 3 == 0 ? 300 : i % 3 == 1 ? 20000 : 3000000);
+        due[i] = tester::now(w) + delay;
+        w.arm(*timers[i], std::chrono::milliseconds(delay));
+        if (i % 7 == 0) {
+            tester::run_until(w, tester::now(w));
+        }
+    }
+    // Cancelled and destroyed timers never fire.
+    for (size_t i = 0; i < n; i += 11) {
+        timers[i]->cancel();
+        fired[i] = 0;
+    }
+    for (size_t i = 5; i < n; i += 13) {
+        timers[i].reset();
+        fired[i] = 0;
+    }
+    tester::run_until(w, tester::now(w) + 3000000);
+    for (size_t i = 0; i < n; ++i) {
+        if (i % 11 == 0 || (i >= 5 && (i - 5) % 13 == 0)) {
+            BOOST_REQUIRE_EQUAL(fired[i], 0u);
+        } else {
+            BOOST_REQUIRE_EQUAL(fired[i], due[i]);
+        }
+    }
+}
+
+BOOST_AUTO_TEST_CASE(test_callbacks_rearm_and_destroy) {
+    timer_wheel w(1ms);
+    unsigned periodic = 0;
+    wheel_timer t;
+    t.set_callback([&] {
+        if (++periodic < 10) {
+            w.arm(t, 100ms);
+        }
+    });
+    w.arm(t, 100ms);
+
+    // Due on the same tick; the first one destroys the second.
+    auto victim = std::make_unique<wheel_timer>([] { BOOST_FAIL("destroyed timer fired"); });
+    wheel_timer killer([&] { victim.reset(); });
+    w.arm(killer, 50ms);
+    w.arm(*victim, 50ms);
+
+    tester::run_until(w, 2000);
+    BOOST_REQUIRE_EQUAL(periodic, 10u);
+    BOOST_REQUIRE(!victim);
+}
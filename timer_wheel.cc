@@ -0,0 +1,119 @@
+/*
+ * This file is open source software, licensed to you under the terms
+ * of the Apache License, Version 2.0 (the "License").  See the NOTICE file
+ * distributed with this work for additional information regarding copyright
+ * ownership.  You may not use this file except in compliance with the License.
+ *
+ * You may obtain a copy of the License at
+ *
+ *   http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing,
+ * software distributed under the License is distributed on an
+ * "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+ * KIND, either express or implied.  See the License for the
+ * specific language governing permissions and limitations
+ * under the License.
+ */
+
+#include "timer_wheel.hh"
+
+namespace hero {
+
+timer_wheel::timer_wheel(duration resolution)
+    : _resolution(resolution)
+    , _start(clock_type::now())
+    , _timer([this] { advance(); })
+{
+}
+
+timer_wheel::~timer_wheel() {
+    for (auto& l : _root) {
+        l.clear();
+    }
+    for (auto& level : _levels) {
+        for (auto& l : level) {
+            l.clear();
+        }
+    }
+}
+
+void timer_wheel::start() {
+    _timer.arm_periodic(_resolution);
+}
+
+void timer_wheel::arm(wheel_timer& t, duration delay) {
+    t.cancel();
+    auto ticks = (delay.count() + _resolution.count() - 1) / _resolution.count();
+    t._expiry = _now + std::max<decltype(ticks)>(ticks, 1);
+    place(t);
+}
+
+void timer_wheel::place(wheel_timer& t) {
+    auto delta = t._expiry - _now;
+    if (t._expiry < _now) {
+        // Overdue; run it with the next tick.
+        t._expiry = _now;
+        delta = 0;
+    } else if (delta > max_delta) {
+        t._expiry = _now + max_delta;
+        delta = max_delta;
+    }
+    if (delta < root_size) {
+        _root[t._expiry & (root_size - 1)].push_back(t);
+        return;
+    }
+    for (unsigned level = 0; level < levels; ++level) {
+        auto shift = root_bits + (level + 1) * level_bits;
+        if (level == levels - 1 || delta < (uint64_t(1) << shift)) {
+            auto index = (t._expiry >> (shift - level_bits)) & (level_size - 1);
+            _levels[level][index].push_back(t);
+            return;
+        }
+    }
+}
+
+// Moves the timers of one slot to finer levels.
+void timer_wheel::cascade(unsigned level, unsigned index) {
+    list_type l;
+    l.swap(_levels[level][index]);
+    while (!l.empty()) {
+        auto& t = l.front();
+        l.pop_front();
+        place(t);
+    }
+}
+
+void timer_wheel::run_tick() {
+    auto index = _now & (root_size - 1);
+    if (!index) {
+        for (unsigned level = 0; level < levels; ++level) {
+            auto slot = (_now >> (root_bits + level * level_bits)) & (level_size - 1);
+            cascade(level, slot);
+            if (slot) {
+                break;
+            }
+        }
+    }
+    list_type l;
+    l.swap(_root[index]);
+    _now++;
+    while (!l.empty()) {
+        auto& t = l.front();
+        l.pop_front();
+        _expired++;
+        // Nothing touches t after this; the callback may destroy it.
+        t._callback();
+    }
+}
+
+void timer_wheel::advance() {
+    // Catches up after a reactor stall, so deadlines are never late by more
+    // than the stall itself.
+    auto target = uint64_t((clock_type::now() - _start) / _resolution);
+    while (_now <= target) {
+        run_tick();
+    }
+}
+
+} /* namespace hero */
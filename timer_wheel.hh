@@ -0,0 +1,110 @@
+/*
+ * This file is open source software, licensed to you under the terms
+ * of the Apache License, Version 2.0 (the "License").  See the NOTICE file
+ * distributed with this work for additional information regarding copyright
+ * ownership.  You may not use this file except in compliance with the License.
+ *
+ * You may obtain a copy of the License at
+ *
+ *   http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing,
+ * software distributed under the License is distributed on an
+ * "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+ * KIND, either express or implied.  See the License for the
+ * specific language governing permissions and limitations
+ * under the License.
+ */
+
+#pragma once
+
+#include "core/lowres_clock.hh"
+#include "core/timer.hh"
+
+#include <boost/intrusive/list.hpp>
+
+#include <array>
+#include <chrono>
+#include <functional>
+
+namespace hero {
+
+using namespace seastar;
+
+class timer_wheel;
+
+// A timeout kept in a timer_wheel.  It is linked into the wheel while
+// armed and unlinks itself when cancelled or destroyed, so arming and
+// cancelling cost no allocation and no search.
+class wheel_timer {
+    using hook_type = boost::intrusive::list_member_hook<boost::intrusive::link_mode<boost::intrusive::auto_unlink>>;
+    hook_type _link;
+    uint64_t _expiry = 0;
+    std::function<void ()> _callback;
+    friend class timer_wheel;
+public:
+    wheel_timer() = default;
+    explicit wheel_timer(std::function<void ()> callback) : _callback(std::move(callback)) {}
+    wheel_timer(const wheel_timer&) = delete;
+    wheel_timer& operator=(const wheel_timer&) = delete;
+
+    void set_callback(std::function<void ()> callback) { _callback = std::move(callback); }
+    bool armed() const { return _link.is_linked(); }
+    void cancel() { _link.unlink(); }
+};
+
+// A hierarchical timing wheel (Varghese and Lauck), one per shard, driven
+// by a single seastar timer.  Deadlines are rounded up to the wheel's
+// resolution.  Arming and cancelling are O(1); each tick runs one slot of
+// the first level and, every 256 ticks, spreads one slot of a coarser
+// level over the finer ones.
+//
+// Callbacks run from the reactor's timer and may arm, cancel or destroy
+// any timer, including their own.
+class timer_wheel {
+public:
+    using clock_type = lowres_clock;
+    using duration = clock_type::duration;
+private:
+    static constexpr unsigned root_bits = 8;
+    static constexpr unsigned level_bits = 6;
+    static constexpr unsigned levels = 4;
+    static constexpr uint64_t root_size = uint64_t(1) << root_bits;
+    static constexpr uint64_t level_size = uint64_t(1) << level_bits;
+    // Deadlines further away (about 13 years at 100ms) are clamped.
+    static constexpr uint64_t max_delta = (uint64_t(1) << (root_bits + levels * level_bits)) - 1;
+
+    using list_type = boost::intrusive::list<wheel_timer,
+          boost::intrusive::member_hook<wheel_timer, wheel_timer::hook_type, &wheel_timer::_link>,
+          boost::intrusive::constant_time_size<false>>;
+
+    duration _resolution;
+    clock_type::time_point _start;
+    // The next tick to run.
+    uint64_t _now = 0;
+    std::array<list_type, root_size> _root;
+    std::array<std::array<list_type, level_size>, levels> _levels;
+    timer<clock_type> _timer;
+    uint64_t _expired = 0;
+    // Drives the wheel tick by tick in tests, without the reactor.
+    friend class timer_wheel_tester;
+public:
+    explicit timer_wheel(duration resolution = std::chrono::milliseconds(100));
+    ~timer_wheel();
+
+    void start();
+    void stop() { _timer.cancel(); }
+
+    // (Re)arms t to fire after delay.
+    void arm(wheel_timer& t, duration delay);
+
+    duration resolution() const { return _resolution; }
+    uint64_t expired() const { return _expired; }
+private:
+    void place(wheel_timer& t);
+    void cascade(unsigned level, unsigned index);
+    void advance();
+    void run_tick();
+};
+
+} /* namespace hero */
@@ -0,0 +1,236 @@
+/*
+ * This file is open source software, licensed to you under the terms
+ * of the Apache License, Version 2.0 (the "License").  See the NOTICE file
+ * distributed with this work for additional information regarding copyright
+ * ownership.  You may not use this file except in compliance with the License.
+ *
+ * You may obtain a copy of the License at
+ *
+ *   http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing,
+ * software distributed under the License is distributed on an
+ * "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+ * KIND, either express or implied.  See the License for the
+ * specific language governing permissions and limitations
+ * under the License.
+ */
+
+#include "tls_acceptor.hh"
+#include "core/future-util.hh"
+#include "core/metrics.hh"
+#include "core/print.hh"
+#include "util/log.hh"
+
+#include <fstream>
+#include <iterator>
+#include <stdexcept>
+#include <time.h>
+
+namespace hero {
+
+static logger tlog("tls");
+
+// The size of a GnuTLS session ticket key.
+static constexpr size_t ticket_key_size = 64;
+
+// The acceptor of the shard running on this thread, for the GnuTLS
+// wrappers.
+static thread_local tls_acceptor* shard_acceptor = nullptr;
+
+static std::chrono::nanoseconds thread_cpu_time() {
+    struct timespec ts;
+    clock_gettime(CLOCK_THREAD_CPUTIME_ID, &ts);
+    return std::chrono::seconds(ts.tv_sec) + std::chrono::nanoseconds(ts.tv_nsec);
+}
+
+sstring load_ticket_key(const sstring& file) {
+    if (file.empty()) {
+        gnutls_datum_t key;
+        auto r = gnutls_session_ticket_key_generate(&key);
+        if (r != GNUTLS_E_SUCCESS) {
+            throw std::runtime_error(sprint("cannot make a session ticket key: %s", gnutls_strerror(r)));
+        }
+        sstring s(reinterpret_cast<const char*>(key.data), key.size);
+        gnutls_free(key.data);
+        return s;
+    }
+    std::ifstream in(file.c_str(), std::ios::binary);
+    if (!in) {
+        throw std::runtime_error(sprint("cannot open %s", file));
+    }
+    std::string key((std::istreambuf_iterator<char>(in)), std::istreambuf_iterator<char>());
+    if (key.size() != ticket_key_size) {
+        throw std::runtime_error(sprint("%s has %d bytes, not the %d of a session ticket key", file, key.size(), ticket_key_size));
+    }
+    return sstring(key.data(), key.size());
+}
+
+tls_handshake::~tls_handshake() {
+    if (_acceptor && _acceptor->_pending.erase(_session)) {
+        _acceptor->_stats.handshake_failures++;
+    }
+}
+
+std::chrono::milliseconds tls_handshake::timeout() const {
+    return _acceptor->_config.handshake_timeout;
+}
+
+bool tls_handshake::expire() {
+    if (!_acceptor || !_acceptor->_pending.erase(_session)) {
+        return false;
+    }
+    _acceptor->_stats.handshake_timeouts++;
+    _acceptor = nullptr;
+    return true;
+}
+
+tls_acceptor::tls_acceptor(tls_config config)
+    : _config(std::move(config))
+    , _handshakes(_config.max_concurrent_handshakes)
+{
+    if (!_config.ticket_key.empty()) {
+        _ticket_key.data = reinterpret_cast<unsigned char*>(_config.ticket_key.begin());
+        _ticket_key.size = _config.ticket_key.size();
+    }
+    shard_acceptor = this;
+    setup_metrics();
+}
+
+tls_acceptor::~tls_acceptor() {
+    shard_acceptor = nullptr;
+}
+
+void tls_acceptor::setup_metrics() {
+    namespace sm = seastar::metrics;
+    sm::label kind_label("kind");
+    _metrics.add_group("hero_tls", {
+        sm::make_derive("handshakes", _stats.handshakes,
+                sm::description("TLS handshakes completed")),
+        sm::make_derive("resumed_handshakes", _stats.resumed_handshakes,
+                sm::description("TLS handshakes completed by resuming a session from its ticket")),
+        sm::make_derive("handshake_failures", _stats.handshake_failures,
+                sm::description("TLS connections which failed or closed before their handshake completed")),
+        sm::make_derive("handshake_timeouts", _stats.handshake_timeouts,
+                sm::description("TLS connections closed for not completing their handshake in time")),
+        sm::make_derive("handshake_waits", _stats.handshake_waits,
+                sm::description("TLS connections which waited for another handshake to finish before starting theirs")),
+        sm::make_gauge("handshakes_in_progress", [this] {
+            return ssize_t(_config.max_concurrent_handshakes) - _handshakes.available_units();
+        }, sm::description("TLS handshakes running")),
+        sm::make_gauge("handshakes_waiting", [this] { return _handshakes.waiters(); },
+                sm::description("TLS connections waiting to start their handshake")),
+        sm::make_histogram("handshake_latency", [this] { return _handshake_latency.to_metrics(); },
+                sm::description("Microseconds from starting a TLS handshake to completing it")),
+        sm::make_histogram("handshake_cpu", [this] { return _full_handshake_cpu.to_metrics(); },
+                sm::description("Microseconds of CPU time spent in a TLS handshake"), {kind_label("full")}),
+        sm::make_histogram("handshake_cpu", [this] { return _resumed_handshake_cpu.to_metrics(); },
+                sm::description("Microseconds of CPU time spent in a TLS handshake"), {kind_label("resumed")}),
+    });
+}
+
+future<> tls_acceptor::load() {
+    auto builder = make_lw_shared<tls::credentials_builder>();
+    if (!_config.priority.empty()) {
+        builder->set_priority_string(_config.priority);
+    }
+    return builder->set_x509_key_file(_config.certificate_file, _config.key_file, tls::x509_crt_format::PEM).then([this, builder] {
+        _credentials = builder->build_server_credentials();
+    });
+}
+
+void tls_acceptor::stop() {
+    _handshakes.broken();
+}
+
+future<connected_socket, tls_handshake> tls_acceptor::wrap(connected_socket s) {
+    if (_handshakes.available_units() <= 0) {
+        _stats.handshake_waits++;
+    }
+    return get_units(_handshakes, 1).then([this, s = std::move(s)] (semaphore_units<> slot) mutable {
+        // Seastar makes the session right away, and handshakes in the
+        // socket's first read.
+        _creating = true;
+        auto wrapped = futurize_apply([this, &s] {
+            return tls::wrap_server(_credentials, std::move(s));
+        });
+        _creating = false;
+        auto session = std::exchange(_created, nullptr);
+        if (!session) {
+            return make_exception_future<connected_socket, tls_handshake>(
+                    std::runtime_error("the GnuTLS wrappers are not linked in"));
+        }
+        _pending.emplace(session, pending_handshake{std::move(slot), latency_histogram::clock_type::now()});
+        tls_handshake handshake(*this, session);
+        return wrapped.then([handshake = std::move(handshake)] (connected_socket s) mutable {
+            return make_ready_future<connected_socket, tls_handshake>(std::move(s), std::move(handshake));
+        });
+    });
+}
+
+void tls_acceptor::session_created(gnutls_session_t session) {
+    if (!_creating) {
+        return;
+    }
+    _created = session;
+    if (_ticket_key.size) {
+        auto r = gnutls_session_ticket_enable_server(session, &_ticket_key);
+        if (r != GNUTLS_E_SUCCESS) {
+            tlog.warn("cannot enable session tickets: {}", gnutls_strerror(r));
+        }
+    }
+}
+
+void tls_acceptor::handshake_step(gnutls_session_t session, std::chrono::nanoseconds cpu, int result) {
+    auto i = _pending.find(session);
+    if (i == _pending.end()) {
+        return;
+    }
+    auto& p = i->second;
+    p.cpu += cpu;
+    // Other errors end the connection, and the handshake fails once it
+    // is gone.
+    if (result != GNUTLS_E_SUCCESS) {
+        return;
+    }
+    _stats.handshakes++;
+    _handshake_latency.record_since(p.started);
+    if (gnutls_session_is_resumed(session)) {
+        _stats.resumed_handshakes++;
+        _resumed_handshake_cpu.record(p.cpu);
+    } else {
+        _full_handshake_cpu.record(p.cpu);
+    }
+    // Frees the slot.
+    _pending.erase(i);
+}
+
+} /* namespace hero */
+
+// Seastar's calls of these functions go to the wrappers (see
+// tls_acceptor).
+
+extern "C" {
+
+int __real_gnutls_init(gnutls_session_t* session, unsigned int flags);
+int __real_gnutls_handshake(gnutls_session_t session);
+
+int __wrap_gnutls_init(gnutls_session_t* session, unsigned int flags) {
+    auto r = __real_gnutls_init(session, flags);
+    if (r == GNUTLS_E_SUCCESS && (flags & GNUTLS_SERVER) && hero::shard_acceptor) {
+        hero::shard_acceptor->session_created(*session);
+    }
+    return r;
+}
+
+int __wrap_gnutls_handshake(gnutls_session_t session) {
+    if (!hero::shard_acceptor) {
+        return __real_gnutls_handshake(session);
+    }
+    auto started = hero::thread_cpu_time();
+    auto r = __real_gnutls_handshake(session);
+    hero::shard_acceptor->handshake_step(session, hero::thread_cpu_time() - started, r);
+    return r;
+}
+
+}
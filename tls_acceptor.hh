@@ -0,0 +1,159 @@
+/*
+ * This file is open source software, licensed to you under the terms
+ * of the Apache License, Version 2.0 (the "License").  See the NOTICE file
+ * distributed with this work for additional information regarding copyright
+ * ownership.  You may not use this file except in compliance with the License.
+ *
+ * You may obtain a copy of the License at
+ *
+ *   http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing,
+ * software distributed under the License is distributed on an
+ * "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+ * KIND, either express or implied.  See the License for the
+ * specific language governing permissions and limitations
+ * under the License.
+ */
+
+#pragma once
+
+#include "core/future.hh"
+#include "core/metrics_registration.hh"
+#include "core/semaphore.hh"
+#include "core/shared_ptr.hh"
+#include "core/sstring.hh"
+#include "net/api.hh"
+#include "net/tls.hh"
+#include "broker_metrics.hh"
+
+#include <gnutls/gnutls.h>
+
+#include <chrono>
+#include <unordered_map>
+#include <utility>
+
+namespace hero {
+
+using namespace seastar;
+using namespace net;
+
+// The credentials of the MQTT over TLS listeners.
+struct tls_config {
+    // PEM files.
+    sstring certificate_file;
+    sstring key_file;
+    // A GnuTLS priority string; empty for the library's default.
+    sstring priority;
+    // Handshakes each shard runs at once.  The other connections wait
+    // with their ClientHello unread, so a reconnect storm is handshaken at
+    // the pace the shard can take instead of starving its established
+    // connections.
+    size_t max_concurrent_handshakes = 64;
+    // Time a client has to complete its handshake, which holds a slot
+    // meanwhile.
+    std::chrono::milliseconds handshake_timeout = std::chrono::seconds(5);
+    // The key which encrypts session tickets, the same on every shard so
+    // that a client resumes its session on whichever shard it reconnects
+    // to; empty disables resumption.  64 bytes, as made by
+    // gnutls_session_ticket_key_generate().
+    sstring ticket_key;
+};
+
+// Reads a session ticket key from file, or makes a random one if file is
+// empty.  Throws std::runtime_error.
+sstring load_ticket_key(const sstring& file);
+
+struct tls_stats {
+    uint64_t handshakes = 0;
+    // Of the handshakes, those which resumed a session.
+    uint64_t resumed_handshakes = 0;
+    uint64_t handshake_failures = 0;
+    uint64_t handshake_timeouts = 0;
+    uint64_t handshake_waits = 0;
+};
+
+class tls_acceptor;
+
+// A TLS handshake in progress, which holds one of its shard's handshake
+// slots until it completes.  It counts as failed if the connection goes
+// away before.
+class tls_handshake {
+    tls_acceptor* _acceptor;
+    gnutls_session_t _session;
+public:
+    tls_handshake(tls_acceptor& acceptor, gnutls_session_t session)
+        : _acceptor(&acceptor)
+        , _session(session)
+    {
+    }
+    tls_handshake(tls_handshake&& o) noexcept
+        : _acceptor(std::exchange(o._acceptor, nullptr))
+        , _session(o._session)
+    {
+    }
+    ~tls_handshake();
+
+    std::chrono::milliseconds timeout() const;
+    // Gives up on the handshake at its deadline; returns false if it has
+    // completed.
+    bool expire();
+};
+
+// Accepts MQTT over TLS on one shard.  Every shard loads its own copy of
+// the credentials and handshakes the connections it accepts, so a
+// handshake never leaves the shard its connection lives on.
+//
+// Reconnecting clients resume their sessions with session tickets rather
+// than a session cache: the session state travels in the ticket, and
+// every shard holds the key, so any of them resumes any session without
+// asking the others.
+//
+// Seastar's TLS API has no way to reach a GnuTLS session, so the link
+// wraps its calls of gnutls_init() and gnutls_handshake() (see
+// configure.py).  The wrappers enable tickets on the server sessions made
+// by wrap(), and tell the acceptor of the shard when their handshakes
+// complete and how much CPU time each step took.
+class tls_acceptor {
+    struct pending_handshake {
+        semaphore_units<> slot;
+        latency_histogram::clock_type::time_point started;
+        std::chrono::nanoseconds cpu{0};
+    };
+    tls_config _config;
+    gnutls_datum_t _ticket_key{nullptr, 0};
+    ::shared_ptr<tls::server_credentials> _credentials;
+    semaphore _handshakes;
+    std::unordered_map<gnutls_session_t, pending_handshake> _pending;
+    // While wrap() creates a session, and then the session it created.
+    bool _creating = false;
+    gnutls_session_t _created = nullptr;
+    tls_stats _stats;
+    latency_histogram _handshake_latency;
+    // CPU time spent in the handshakes, full and resumed.
+    latency_histogram _full_handshake_cpu;
+    latency_histogram _resumed_handshake_cpu;
+    metrics::metric_groups _metrics;
+public:
+    explicit tls_acceptor(tls_config config);
+    ~tls_acceptor();
+
+    const tls_config& config() const { return _config; }
+
+    // Reads the certificate and key.
+    future<> load();
+    void stop();
+
+    // Waits for a handshake slot and wraps an accepted socket.
+    future<connected_socket, tls_handshake> wrap(connected_socket s);
+
+    // Called by the GnuTLS wrappers on this shard.
+    void session_created(gnutls_session_t session);
+    void handshake_step(gnutls_session_t session, std::chrono::nanoseconds cpu, int result);
+private:
+    void setup_metrics();
+
+    friend class tls_handshake;
+};
+
+} /* namespace hero */